@@ -0,0 +1,3 @@
+"""
+Micro-benchmarks (run as python -m benchmarks.<name> from backend/).
+"""
@@ -0,0 +1,93 @@
+"""
+Segmentation micro-benchmark
+============================
+Compares the row-wise waterfall (DataFrame.apply(axis=1), the former
+insights_service._waterfall_segment) with the numpy.select rule engine in
+utils.segmentation on synthetic score columns, and checks both assign the
+same segments.
+
+Run from backend/:
+    python -m benchmarks.segmentation_bench [--rows 1000000] [--repeat 3]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from schemas import CustomerCategory
+from utils.segmentation import assign_segments
+
+
+def waterfall_segment_rowwise(row, store_avg_bulkiness: float = 0.0) -> str:
+    """The per-row waterfall the rule engine replaced (reference implementation)."""
+    total = int(row["rfm_score"])
+    r = int(row["r_score"])
+    f = int(row["f_score"])
+    m = int(row["m_score"])
+    bulk = float(row.get("bulkiness", 0.0))
+
+    if total >= 12 and (m >= 4 or f == 5):
+        return CustomerCategory.VIP.value
+    elif r == 1 and total > 4:
+        return CustomerCategory.AT_RISK.value
+    elif 5 <= total <= 11 and bulk > store_avg_bulkiness:
+        return CustomerCategory.POTENTIAL_BULK.value
+    elif total >= 5 and f >= 3 and f >= m:
+        return CustomerCategory.LOYAL_FREQUENT.value
+    else:
+        return CustomerCategory.BORING.value
+
+
+def make_scores(rows: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "r_score": rng.integers(1, 6, rows),
+        "f_score": rng.integers(1, 6, rows),
+        "m_score": rng.integers(1, 6, rows),
+        "bulkiness": rng.gamma(2.0, 2.0, rows),
+    })
+    df["rfm_score"] = df["r_score"] + df["f_score"] + df["m_score"]
+    return df
+
+
+def _best_of(fn, repeat: int):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--rowwise-rows", type=int, default=200_000,
+                        help="cap for the row-wise run (extrapolated linearly beyond it)")
+    args = parser.parse_args()
+
+    df = make_scores(args.rows)
+    stats = {"store_avg_bulkiness": float(df["bulkiness"].mean())}
+
+    vec_time, vec_segments = _best_of(lambda: assign_segments(df, None, stats), args.repeat)
+
+    sample = df.iloc[: min(args.rows, args.rowwise_rows)]
+    row_time, row_segments = _best_of(
+        lambda: sample.apply(lambda row: waterfall_segment_rowwise(row, stats["store_avg_bulkiness"]), axis=1),
+        1,
+    )
+    row_time_full = row_time * len(df) / len(sample)
+
+    mismatches = int((row_segments.to_numpy() != vec_segments[: len(sample)]).sum())
+    print(f"rows:               {len(df):,}")
+    print(f"numpy.select:       {vec_time * 1000:10.1f} ms  (best of {args.repeat})")
+    print(f"apply(axis=1):      {row_time_full * 1000:10.1f} ms"
+          + ("  (extrapolated from %s rows)" % f"{len(sample):,}" if len(sample) < len(df) else ""))
+    print(f"speed-up:           {row_time_full / vec_time:10.0f}x")
+    print(f"mismatched rows:    {mismatches:10d}  (of {len(sample):,} compared)")
+
+
+if __name__ == "__main__":
+    main()
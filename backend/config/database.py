@@ -74,6 +74,8 @@ class Database:
                 # files — old shape without content_hash
                 ("files", "unique_file_upload"),
                 ("files", "unique_shop_file_upload"),
+                # transactions — old key without superseded
+                ("transactions", "unique_transaction_row"),
             ]
             for coll_name, idx_name in legacy_drops:
                 try:
@@ -143,6 +145,10 @@ class Database:
             await db.customers.create_index([("shop_id", 1)])
             await db.customers.create_index([("customer_id", 1)])
             await db.customers.create_index([("period_tag", 1)])
+            # Keyset pages (GET /customers/page) and the insights → customer join
+            await db.customers.create_index([("user_id", 1), ("shop_id", 1), ("uploaded_at", -1), ("_id", -1)])
+            await db.customers.create_index([("user_id", 1), ("uploaded_at", -1), ("_id", -1)])
+            await db.customers.create_index([("shop_id", 1), ("customer_id", 1)])
 
             # ══════════════════════════════════════════════════════════════════════
             # 5. products  (renamed from product_inventory)
@@ -166,6 +172,8 @@ class Database:
             # 6. transactions
             #
             # Unique compound index to prevent duplicate rows within the same period (Addendum A).
+            # superseded is part of the key: while an upload replaces a period its
+            # old rows are flagged, so unchanged rows can be re-inserted beside them.
             # ══════════════════════════════════════════════════════════════════════
             try:
                 await db.transactions.create_index(
@@ -175,10 +183,11 @@ class Database:
                         ("product_id", 1), 
                         ("purchase_date", 1), 
                         ("purchase_qty", 1), 
-                        ("total_amount", 1)
+                        ("total_amount", 1),
+                        ("superseded", 1)
                     ],
                     unique=True,
-                    name="unique_transaction_row"
+                    name="unique_transaction_row_v2"
                 )
             except Exception:
                 pass
@@ -213,6 +222,9 @@ class Database:
             await db.customer_insights.create_index([("segment_changed", 1)])    # NEW
             await db.customer_insights.create_index([("updated_at", -1)])
             await db.customer_insights.create_index([("last_calculated_at", -1)])
+            # Customer pages filtered by segment / rfm_score range
+            await db.customer_insights.create_index([("shop_id", 1), ("segment", 1), ("rfm_score", -1), ("_id", -1)])
+            await db.customer_insights.create_index([("shop_id", 1), ("rfm_score", -1), ("_id", -1)])
 
             # ══════════════════════════════════════════════════════════════════════
             # 8. templates
@@ -249,6 +261,7 @@ class Database:
             #   failure_reason — categorized: rate_limit | network | invalid_number | unknown
             #   next_attempt_at — scheduler uses this for retry timing
             #   shop_id        — for per-shop monitoring queries
+            #   lease_owner / lease_token / lease_expires_at — multi-worker claims
             #
             # Removed: separate msg_queues collection entirely.
             # Scheduler polls messages directly using (status, next_attempt_at).
@@ -270,6 +283,12 @@ class Database:
                 [("status", 1), ("next_attempt_at", 1)],
                 name="scheduler_poll_query",
             )
+            # Lease-based claims: read-back by claim token, expired-lease scan
+            await db.messages.create_index([("lease_token", 1)], sparse=True)
+            await db.messages.create_index(
+                [("status", 1), ("lease_expires_at", 1)],
+                name="lease_expiry_lookup",
+            )
             # Campaign-scoped status lookups (replaces msg_queues campaign_status_lookup)
             await db.messages.create_index(
                 [("shop_id", 1), ("campaign_id", 1), ("status", 1)],
@@ -302,6 +321,63 @@ class Database:
             await db.offers.create_index([("target_segments", 1)])           # multi-key: array field
             await db.offers.create_index([("shop_id", 1), ("is_active", 1)]) # common filter combo
 
+            # ══════════════════════════════════════════════════════════════════════
+            # 13. whatsapp_quota — per-account daily quota / failure counters
+            #
+            # Schema:
+            #   _id ("<account_id>:<YYYY-MM-DD IST>"), account_id, date,
+            #   sent_count, consecutive_failures, updated_at, expires_at
+            # ══════════════════════════════════════════════════════════════════════
+            await db.whatsapp_quota.create_index([("expires_at", 1)], expireAfterSeconds=0)
+
+            # ══════════════════════════════════════════════════════════════════════
+            # 14. jobs — background jobs (ingest, insights, campaign creation)
+            #
+            # Schema:
+            #   id, kind, user_id, shop_id, params, status, progress{},
+            #   result, error, cancel_requested, worker_id, heartbeat_at,
+            #   created_at, started_at, finished_at, expires_at
+            # ══════════════════════════════════════════════════════════════════════
+            await db.jobs.create_index([("id", 1)], unique=True)
+            await db.jobs.create_index([("user_id", 1), ("created_at", -1)])
+            await db.jobs.create_index([("status", 1), ("heartbeat_at", 1)])
+            await db.jobs.create_index([("expires_at", 1)], expireAfterSeconds=0)
+
+            # ══════════════════════════════════════════════════════════════════════
+            # 15. product_affinity — co-purchase partners per product
+            #
+            # Schema:
+            #   shop_id, product_id, baskets, related[{product_id, count}],
+            #   updated_at
+            # ══════════════════════════════════════════════════════════════════════
+            await db.product_affinity.create_index(
+                [("shop_id", 1), ("product_id", 1)], unique=True
+            )
+            await db.product_affinity.create_index([("shop_id", 1), ("updated_at", 1)])
+
+            # ══════════════════════════════════════════════════════════════════════
+            # 16. customer_aggregates — per-(customer, period) transaction totals
+            #
+            # Schema:
+            #   shop_id, customer_id, period_tag, tx_count, amount, quantity,
+            #   last_purchase, days[], updated_at
+            # ══════════════════════════════════════════════════════════════════════
+            await db.customer_aggregates.create_index(
+                [("shop_id", 1), ("period_tag", 1), ("customer_id", 1)], unique=True
+            )
+            await db.customer_aggregates.create_index([("shop_id", 1), ("customer_id", 1)])
+
+            # ══════════════════════════════════════════════════════════════════════
+            # 17. shop_stats — denormalized per-shop summary for the shop list
+            #
+            # Schema:
+            #   shop_id, user_id, csv_status{}, customer_count, product_count,
+            #   transaction_count, live_stats{}, stale, updated_at, reconciled_at
+            # ══════════════════════════════════════════════════════════════════════
+            await db.shop_stats.create_index([("shop_id", 1)], unique=True)
+            await db.shop_stats.create_index([("user_id", 1)])
+            await db.shop_stats.create_index([("reconciled_at", 1)])
+
             logger.info("✓ Database indexes created/verified for all 8 refined collections (Phase 1)")
         
         except Exception as e:
@@ -6,11 +6,16 @@ from typing import Any
 from datetime import datetime, timezone
 from schemas import BatchCreate, BatchSplitEstimate, BatchUpdateRequest
 from services import BatchService
+from services.scheduler_service import notify_scheduler, invalidate_campaign_state, reopen_for_requeue
+from services.shop_stats import ShopStatsStore
 from middleware import get_current_user
 from config import get_db
 
 router = APIRouter(prefix="/batches", tags=["batches"])
 
+# Items on the Dead Letter Queue desk: failed for good, or sent without confirmation
+DLQ_STATUSES = ["failed_final", "unconfirmed"]
+
 
 @router.post("/estimate", response_model=BatchSplitEstimate)
 async def estimate_batch_split(
@@ -25,6 +30,7 @@ async def estimate_batch_split(
 @router.post("/create")
 async def create_batch(
     batch_data: BatchCreate,
+    background: bool = Query(False, description="Return a job id immediately and generate messages in the background"),
     current_user: dict = Depends(get_current_user),
     db: Any = Depends(get_db)
 ):
@@ -35,6 +41,10 @@ async def create_batch(
     2. Segment-based: Provide segment_templates - different templates for different segments
     
     Campaign tracking: Provide campaign_name and file_id for campaign tracking in MongoDB
+
+    background=true: validation runs inline, then message generation runs as a
+    background job; poll GET /api/jobs/{job_id} for progress, or cancel it with
+    POST /api/jobs/{job_id}/cancel (this also cancels the partial campaign).
     """
     try:
         service = BatchService(db)
@@ -52,10 +62,10 @@ async def create_batch(
             shop_id=batch_data.shop_id,
             ai_mode=batch_data.ai_mode if hasattr(batch_data, 'ai_mode') else False,
             fixed_product=batch_data.fixed_product if hasattr(batch_data, 'fixed_product') else None,
+            background=background,
         )
         
-        # The scheduler worker (7s poll) will automatically pick up
-        # the newly enqueued items — no manual trigger needed.
+        # create_batch signals the scheduler worker — first send goes out immediately.
         
         return result
     except ValueError as e:
@@ -305,6 +315,7 @@ async def stop_campaign(
         user_id = current_user.get("user_id") or current_user.get("id")
         service = BatchService(db)
         result = await service.stop_campaign(campaign_id, user_id)
+        invalidate_campaign_state(campaign_id)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -395,15 +406,16 @@ async def pause_campaign(
     current_user: dict = Depends(get_current_user),
     db: Any = Depends(get_db),
 ):
-    """Pause a sending campaign. Worker stops after finishing current item."""
+    """Pause a sending campaign. Worker stops claiming its messages from the next cycle."""
     try:
         user_id = current_user.get("user_id") or current_user.get("id")
         result = await db.campaigns.update_one(
-            {"_id": campaign_id, "user_id": user_id, "status": {"$in": ["sending", "pending", "in_progress"]}},
+            {"_id": campaign_id, "user_id": user_id, "status": {"$in": ["generating", "sending", "pending", "in_progress"]}},
             {"$set": {"status": "paused", "updated_at": datetime.now(timezone.utc)}},
         )
         if result.modified_count == 0:
             raise HTTPException(status_code=400, detail="Campaign not found or cannot be paused")
+        invalidate_campaign_state(campaign_id)
         return {"message": "Campaign paused", "campaign_id": campaign_id}
     except HTTPException:
         raise
@@ -417,7 +429,7 @@ async def resume_campaign(
     current_user: dict = Depends(get_current_user),
     db: Any = Depends(get_db),
 ):
-    """Resume a paused campaign. Worker picks up items on next poll cycle."""
+    """Resume a paused campaign. Worker is woken immediately."""
     try:
         user_id = current_user.get("user_id") or current_user.get("id")
         result = await db.campaigns.update_one(
@@ -426,6 +438,8 @@ async def resume_campaign(
         )
         if result.modified_count == 0:
             raise HTTPException(status_code=400, detail="Campaign not found or not paused")
+        invalidate_campaign_state(campaign_id)
+        notify_scheduler()
         return {"message": "Campaign resumed", "campaign_id": campaign_id}
     except HTTPException:
         raise
@@ -448,6 +462,7 @@ async def cancel_campaign(
             {"_id": campaign_id, "user_id": user_id},
             {"$set": {"status": "cancelled", "completed_at": datetime.now(timezone.utc), "updated_at": datetime.now(timezone.utc)}},
         )
+        invalidate_campaign_state(campaign_id)
 
         # Cancel all pending/retry_wait queue items in messages
         queue_result = await db.messages.update_many(
@@ -460,6 +475,7 @@ async def cancel_campaign(
             {"campaign_id": campaign_id, "status": {"$in": ["pending", "sending"]}},
             {"$set": {"status": "cancelled"}},
         )
+        await ShopStatsStore(db).mark_campaign_stale(campaign_id)
 
         return {
             "message": "Campaign cancelled",
@@ -503,6 +519,7 @@ async def get_campaign_live_stats(
         # Support both "failed_permanently" (new) and "failed_final" (legacy)
         failed_final = counts.get("failed_permanently", 0) + counts.get("failed_final", 0)
         cancelled = counts.get("cancelled", 0)
+        unconfirmed = counts.get("unconfirmed", 0)
 
         # Convert datetimes
         c_status = campaign.get("status", "pending")
@@ -528,6 +545,7 @@ async def get_campaign_live_stats(
             "retry_wait": retry_wait,
             "failed_final": failed_final,
             "cancelled": cancelled,
+            "unconfirmed": unconfirmed,
             "completed_batches": campaign.get("completed_batches", 0),
             "total_batches": campaign.get("total_batches", 0),
             "segment_stats": campaign.get("segment_stats", {}),
@@ -547,7 +565,7 @@ async def get_campaign_dlq(
     current_user: dict = Depends(get_current_user),
     db: Any = Depends(get_db),
 ):
-    """Get all failed_final items for the Dead Letter Queue desk."""
+    """Get all failed_final and unconfirmed items for the Dead Letter Queue desk."""
     try:
         user_id = current_user.get("user_id") or current_user.get("id")
 
@@ -560,7 +578,7 @@ async def get_campaign_dlq(
             raise HTTPException(status_code=404, detail="Campaign not found")
 
         items = await db.messages.find(
-            {"campaign_id": campaign_id, "status": "failed_final"},
+            {"campaign_id": campaign_id, "status": {"$in": DLQ_STATUSES}},
             {"_id": 0},
         ).sort("updated_at", -1).to_list(500)
 
@@ -581,13 +599,23 @@ async def requeue_item(
     current_user: dict = Depends(get_current_user),
     db: Any = Depends(get_db),
 ):
-    """Re-queue a failed_final item back into the active queue."""
+    """Re-queue a failed_final (or verified-undelivered unconfirmed) item back into the active queue."""
     try:
         user_id = current_user.get("user_id") or current_user.get("id")
         now = datetime.now()
 
+        item = await db.messages.find_one(
+            {"id": item_id, "user_id": user_id, "status": {"$in": DLQ_STATUSES}},
+            {"_id": 0, "id": 1, "status": 1, "batch_id": 1, "campaign_id": 1,
+             "shop_id": 1, "customer_segment": 1},
+        )
+        if item is None:
+            raise HTTPException(status_code=404, detail="Item not found or not in the DLQ")
+        # Counters back in flight (and closed batch / campaign reopened) before the
+        # worker can pick the message up again
+        await reopen_for_requeue(db, [item])
         result = await db.messages.update_one(
-            {"id": item_id, "user_id": user_id, "status": "failed_final"},
+            {"id": item_id, "user_id": user_id, "status": item["status"]},
             {"$set": {
                 "status": "pending",
                 "retry_count": 0,
@@ -597,7 +625,8 @@ async def requeue_item(
             }},
         )
         if result.modified_count == 0:
-            raise HTTPException(status_code=404, detail="Item not found or not in failed_final")
+            raise HTTPException(status_code=404, detail="Item not found or not in the DLQ")
+        notify_scheduler()
 
         return {"message": "Item re-queued successfully", "item_id": item_id}
     except HTTPException:
@@ -612,12 +641,12 @@ async def resolve_item(
     current_user: dict = Depends(get_current_user),
     db: Any = Depends(get_db),
 ):
-    """Mark a failed item as resolved, removing it from the DLQ view."""
+    """Mark a failed (or verified-delivered unconfirmed) item as resolved, removing it from the DLQ view."""
     try:
         user_id = current_user.get("user_id") or current_user.get("id")
 
         result = await db.messages.update_one(
-            {"id": item_id, "user_id": user_id, "status": "failed_final"},
+            {"id": item_id, "user_id": user_id, "status": {"$in": DLQ_STATUSES}},
             {"$set": {
                 "status": "resolved",
                 "resolved_at": datetime.now().isoformat(),
@@ -625,7 +654,7 @@ async def resolve_item(
             }},
         )
         if result.modified_count == 0:
-            raise HTTPException(status_code=404, detail="Item not found or not in failed_final")
+            raise HTTPException(status_code=404, detail="Item not found or not in the DLQ")
 
         return {"message": "Item marked as resolved", "item_id": item_id}
     except HTTPException:
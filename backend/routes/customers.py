@@ -1,11 +1,11 @@
 """
 Customer routes.
 """
-from fastapi import APIRouter, UploadFile, File, HTTPException, Depends, Form
+from fastapi import APIRouter, UploadFile, File, HTTPException, Depends, Form, Query
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from typing import Optional
 import json
-from schemas import CustomerUploadResponse, ColumnDetectionResponse
+from schemas import CustomerCategory, CustomerUploadResponse, ColumnDetectionResponse
 from services import CustomerService
 from services.file_service import file_service
 from middleware import get_current_user
@@ -287,13 +287,49 @@ async def upload_customers(
 @router.get("/list")
 async def list_customers(
     shop_id: Optional[str] = None,
+    skip: int = Query(0, ge=0, description="Number of records to skip"),
+    limit: int = Query(1000, ge=1, le=1000, description="Maximum number of records"),
     current_user: dict = Depends(get_current_user),
     db: AsyncIOMotorDatabase = Depends(get_db)
 ):
-    """List all customers for the current user."""
+    """List customers for the current user, a page at a time (newest first)."""
     user_id = current_user.get("user_id") or current_user.get("id")
     service = CustomerService(db)
-    return await service.list_customers(user_id, shop_id=shop_id)
+    return await service.list_customers(user_id, shop_id=shop_id, skip=skip, limit=limit)
+
+
+@router.get("/page")
+async def page_customers(
+    shop_id: Optional[str] = None,
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    limit: int = Query(50, ge=1, le=200, description="Maximum number of records"),
+    segment: Optional[CustomerCategory] = Query(None, description="Only customers in this segment"),
+    min_score: Optional[float] = Query(None, ge=0, description="Minimum rfm_score"),
+    max_score: Optional[float] = Query(None, ge=0, description="Maximum rfm_score"),
+    current_user: dict = Depends(get_current_user),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
+    """
+    Cursor-paginated customers with their segment / RFM fields.
+
+    Unfiltered pages are newest first; pages filtered by segment or score
+    (shop_id required) are ordered by rfm_score, highest first.  Pass the
+    returned next_cursor to get the following page.
+    """
+    user_id = current_user.get("user_id") or current_user.get("id")
+    service = CustomerService(db)
+    try:
+        return await service.page_customers(
+            user_id,
+            shop_id=shop_id,
+            cursor=cursor,
+            limit=limit,
+            segment=segment.value if segment else None,
+            min_score=min_score,
+            max_score=max_score,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 @router.get("/by-file/{file_id}")
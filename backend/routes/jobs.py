@@ -0,0 +1,55 @@
+"""
+Background job routes: status / progress polling and cancellation.
+"""
+from fastapi import APIRouter, Depends, HTTPException, Query
+from typing import Any, Optional
+
+from config.database import get_db
+from middleware import get_current_user
+from services.job_service import JobService
+
+router = APIRouter(prefix="/jobs", tags=["jobs"])
+
+
+@router.get("")
+async def list_jobs(
+    shop_id: Optional[str] = Query(None),
+    status: Optional[str] = Query(None, description="queued | running | completed | failed | cancelled"),
+    limit: int = Query(50, ge=1, le=200),
+    current_user: dict = Depends(get_current_user),
+    db: Any = Depends(get_db),
+):
+    """Most recent jobs of the current user (results omitted)."""
+    user_id = current_user.get("user_id") or current_user.get("id")
+    jobs = await JobService(db).list_jobs(user_id, shop_id=shop_id, status=status, limit=limit)
+    return {"jobs": jobs}
+
+
+@router.get("/{job_id}")
+async def get_job(
+    job_id: str,
+    current_user: dict = Depends(get_current_user),
+    db: Any = Depends(get_db),
+):
+    """Job status, progress and (once finished) result or error."""
+    user_id = current_user.get("user_id") or current_user.get("id")
+    job = await JobService(db).get(job_id, user_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.post("/{job_id}/cancel")
+async def cancel_job(
+    job_id: str,
+    current_user: dict = Depends(get_current_user),
+    db: Any = Depends(get_db),
+):
+    """Request cancellation of a queued or running job."""
+    user_id = current_user.get("user_id") or current_user.get("id")
+    try:
+        job = await JobService(db).cancel(job_id, user_id)
+    except ValueError as e:
+        status_code = 404 if "not found" in str(e) else 409
+        raise HTTPException(status_code=status_code, detail=str(e))
+    return {"message": "Cancellation requested", "job": job}
@@ -2,7 +2,7 @@
 Shop routes for shop management, file upload, and processing.
 """
 from fastapi import APIRouter, UploadFile, File, HTTPException, Depends, Query
-from typing import Any, Optional
+from typing import Any, Dict, List, Optional
 from pydantic import BaseModel
 from datetime import datetime
 import logging
@@ -14,6 +14,8 @@ from services.file_service import file_service
 from services.customer_service import CustomerService
 from services.product_service import ProductService
 from services.transaction_service import TransactionService
+from services.job_service import JobService
+from services.shop_stats import ShopStatsStore
 
 logger = logging.getLogger(__name__)
 
@@ -111,12 +113,26 @@ async def update_shop_product(
 @router.post("/{shop_id}/recalculate-insights")
 async def trigger_recalculate_insights(
     shop_id: str,
+    background: bool = Query(False, description="Run as a background job and return its job id"),
     current_user: dict = Depends(get_current_user),
     db: Any = Depends(Database.get_database),
 ):
-    """Manually trigger recalculation of customer insights after product edits."""
+    """Manually trigger recalculation of customer insights after product edits.
+
+    background=true: returns {job_id} at once; poll GET /api/jobs/{job_id}.
+    """
     try:
         from services.insights_service import recalculate_all_insights
+        if background:
+            user_id = current_user.get("user_id") or current_user.get("id")
+
+            async def _work(ctx):
+                await ctx.progress(stage="insights")
+                return {"recalculated_count": await recalculate_all_insights(db, shop_id)}
+
+            job = await JobService(db).submit("recalculate_insights", user_id, _work, shop_id=shop_id)
+            return {"success": True, "job_id": job["id"], "status": job["status"]}
+
         count = await recalculate_all_insights(db, shop_id)
         return {"success": True, "recalculated_count": count}
     except Exception as e:
@@ -124,6 +140,42 @@ async def trigger_recalculate_insights(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+class SegmentRulesRequest(BaseModel):
+    segment_rules: Optional[List[Dict[str, Any]]] = None   # None → reset to the default waterfall
+
+
+@router.get("/{shop_id}/segment-rules")
+async def get_segment_rules(
+    shop_id: str,
+    current_user: dict = Depends(get_current_user),
+    db: Any = Depends(Database.get_database),
+):
+    """Get the shop's segmentation rule table."""
+    user_id = current_user.get("user_id") or current_user.get("id")
+    rules = await ShopService(db).get_segment_rules(shop_id, user_id)
+    if rules is None:
+        raise HTTPException(status_code=404, detail="Shop not found")
+    return rules
+
+
+@router.put("/{shop_id}/segment-rules")
+async def update_segment_rules(
+    shop_id: str,
+    body: SegmentRulesRequest,
+    current_user: dict = Depends(get_current_user),
+    db: Any = Depends(Database.get_database),
+):
+    """Replace the shop's segmentation rule table (applied at the next insights recalculation)."""
+    user_id = current_user.get("user_id") or current_user.get("id")
+    try:
+        rules = await ShopService(db).update_segment_rules(shop_id, user_id, body.segment_rules)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if rules is None:
+        raise HTTPException(status_code=404, detail="Shop not found")
+    return rules
+
+
 @router.get("/{shop_id}")
 async def get_shop_detail(
     shop_id: str,
@@ -382,6 +434,7 @@ async def resend_campaign_messages(
     """
     from datetime import timedelta
     from services import BatchService
+    from services.scheduler_service import reopen_for_requeue, invalidate_campaign_state, notify_scheduler
 
     user_id = current_user.get("user_id") or current_user.get("id")
 
@@ -427,6 +480,10 @@ async def resend_campaign_messages(
     requeued = 0
     dead = 0
 
+    # Counters back in flight (closed batches / campaign reopened) before the
+    # worker can pick any of them up
+    await reopen_for_requeue(db, [m for m in messages if m.get("retry_count", 0) + 1 <= 2])
+
     for msg in messages:
         retry = msg.get("retry_count", 0) + 1
         if retry > 2:
@@ -441,7 +498,7 @@ async def resend_campaign_messages(
         # Re-queue
         scheduled = now + timedelta(minutes=5)
         await db.messages.update_one(
-            {"id": msg["id"]},
+            {"id": msg["id"], "status": msg["status"]},
             {"$set": {"status": "pending", "retry_count": retry, "scheduled_at": scheduled, "error": None}},
         )
         # Also re-create queue item
@@ -470,17 +527,18 @@ async def resend_campaign_messages(
         )
         requeued += 1
 
-    # Reset the parent batches that contained failed messages back to pending
+    # Parent batches were reopened by reopen_for_requeue; a resend also
+    # restarts a stopped / cancelled campaign
     if requeued > 0:
-        affected_batch_ids = list({m["batch_id"] for m in messages})
-        await db.batches.update_many(
-            {"id": {"$in": affected_batch_ids}, "status": {"$in": ["failed", "completed", "cancelled"]}},
-            {"$set": {"status": "pending"}},
-        )
         await db.campaigns.update_one(
             {"_id": campaign_id},
             {"$set": {"status": "pending", "updated_at": now}},
         )
+        invalidate_campaign_state(campaign_id)
+        notify_scheduler()
+    # dead-lettered messages leave the shop's failed count
+    if dead > 0:
+        await ShopStatsStore(db).mark_stale(shop_id)
 
     return {
         "message": f"Re-queued {requeued} messages. {dead} moved to dead letter (max retries).",
@@ -569,12 +627,17 @@ async def process_shop_file(
     data_type: str,
     file_id: str,
     body: ProcessDataRequest,
+    background: bool = Query(False, description="Run as a background job and return its job id"),
     current_user: dict = Depends(get_current_user),
     db: Any = Depends(Database.get_database),
 ):
     """
     Process an uploaded file with the user's column mapping.
     data_type must be one of: customers, products, transactions
+
+    background=true: the file is validated, then processing runs as a job;
+    returns {job_id} at once — poll GET /api/jobs/{job_id} for progress and
+    the same result the synchronous call would return.
     """
     valid_types = {"customers", "products", "transactions"}
     if data_type not in valid_types:
@@ -590,47 +653,24 @@ async def process_shop_file(
         if not file_doc:
             raise HTTPException(status_code=404, detail="File not found")
 
-        # Download content
-        file_content = await file_service.download_file(file_doc["file_name"])
+        if background:
+            async def _work(ctx):
+                async def _on_stage(stage: str):
+                    await ctx.progress(stage=stage)
 
-        if data_type == "customers":
-            service = CustomerService(db)
-            result = await service.upload_customers(
-                file_content,
-                file_doc["original_file_name"],
-                user_id,
-                shop_id=shop_id,
-                file_url=file_doc.get("file_url"),
-                file_id=str(file_doc["_id"]),
-                campaign_id=file_doc.get("campaign_id"),
-                column_mapping=body.column_mapping,
-                percentile=body.percentile,
-                period_tag=body.period_tag or file_doc.get("period_tag"),
-            )
-            return result
+                async def _on_progress(processed: int, total: Optional[int]):
+                    await ctx.progress(processed=processed, total=total)
+                await _on_stage("downloading")
+                return await _process_file(db, data_type, file_doc, user_id, shop_id, body,
+                                           _on_stage, _on_progress)
 
-        elif data_type == "products":
-            service = ProductService(db)
-            result = await service.process_products(
-                file_content,
-                file_doc["original_file_name"],
-                user_id,
-                shop_id,
-                body.column_mapping,
+            job = await JobService(db).submit(
+                f"process_{data_type}", user_id, _work, shop_id=shop_id,
+                params={"file_id": file_id, "data_type": data_type},
             )
-            return result
-
-        elif data_type == "transactions":
-            service = TransactionService(db)
-            result = await service.process_transactions(
-                file_content,
-                file_doc["original_file_name"],
-                user_id,
-                shop_id,
-                body.column_mapping,
-                period_tag=body.period_tag or file_doc.get("period_tag"),
-            )
-            return result
+            return {"job_id": job["id"], "status": job["status"], "data_type": data_type}
+
+        return await _process_file(db, data_type, file_doc, user_id, shop_id, body)
 
     except HTTPException:
         raise
@@ -643,6 +683,51 @@ async def process_shop_file(
 
 # ============ Helpers ============
 
+async def _process_file(db, data_type: str, file_doc: dict, user_id: str, shop_id: str,
+                        body: ProcessDataRequest, on_stage=None, on_progress=None):
+    """Download an uploaded file and run the ingest service for its data_type."""
+    # Download content
+    file_content = await file_service.download_file(file_doc["file_name"])
+
+    if data_type == "customers":
+        service = CustomerService(db)
+        return await service.upload_customers(
+            file_content,
+            file_doc["original_file_name"],
+            user_id,
+            shop_id=shop_id,
+            file_url=file_doc.get("file_url"),
+            file_id=str(file_doc["_id"]),
+            campaign_id=file_doc.get("campaign_id"),
+            column_mapping=body.column_mapping,
+            percentile=body.percentile,
+            period_tag=body.period_tag or file_doc.get("period_tag"),
+        )
+
+    elif data_type == "products":
+        service = ProductService(db)
+        return await service.process_products(
+            file_content,
+            file_doc["original_file_name"],
+            user_id,
+            shop_id,
+            body.column_mapping,
+        )
+
+    elif data_type == "transactions":
+        service = TransactionService(db)
+        return await service.process_transactions(
+            file_content,
+            file_doc["original_file_name"],
+            user_id,
+            shop_id,
+            body.column_mapping,
+            period_tag=body.period_tag or file_doc.get("period_tag"),
+            on_stage=on_stage,
+            on_progress=on_progress,
+        )
+
+
 def _get_customer_required_columns():
     """Required columns info for customer CSV.
     
@@ -65,6 +65,7 @@ class MessageStatus(str, Enum):
     FAILED_FINAL      = "failed_final"
     FAILED_PERMANENTLY = "failed_permanently"
     CANCELLED         = "cancelled"
+    UNCONFIRMED       = "unconfirmed"       # send started, not confirmed — verify before resending
     SKIPPED           = "skipped"           # NEW: e.g., expired offer
 
 
@@ -82,6 +83,7 @@ class MessageFailureReason(str, Enum):
 class CampaignStatus(str, Enum):
     """Campaign-level status for scheduler coordination."""
     PENDING   = "pending"
+    GENERATING = "generating"  # messages still being queued by create_batch
     SENDING   = "sending"
     PAUSED    = "paused"
     CANCELLED = "cancelled"
@@ -280,10 +282,14 @@ class ColumnDetectionResponse(BaseModel):
 
 
 class CustomerUploadResponse(BaseModel):
-    """Response for customer CSV upload."""
+    """Response for customer CSV upload (summary only — list customers via GET /customers/list)."""
     total_customers: int
+    uploaded_customers: int = 0
+    new_customers: int = 0
+    updated_customers: int = 0
+    duplicate_rows: int = 0
+    blank_phone_rows: int = 0
     classifications: Dict[str, int]
-    customers: List[Dict[str, Any]]
     rfm_info: Optional[Dict[str, Any]] = None
     thresholds: Optional[Dict[str, Any]] = None  # Deprecated: kept for backwards compatibility
 
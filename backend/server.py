@@ -5,6 +5,7 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from pathlib import Path
 from dotenv import load_dotenv
+import asyncio
 import logging
 
 # Load environment variables
@@ -34,6 +35,7 @@ from routes import auth, customers, templates, batches, dashboard, files
 from routes import shops as shops_router
 from routes import offers as offers_router
 from routes import monitoring as monitoring_router
+from routes import jobs as jobs_router
 
 app.include_router(auth.router, prefix="/api")
 app.include_router(customers.router, prefix="/api")
@@ -44,6 +46,7 @@ app.include_router(files.router, prefix="/api")
 app.include_router(shops_router.router, prefix="/api")
 app.include_router(offers_router.router, prefix="/api")
 app.include_router(monitoring_router.router, prefix="/api")
+app.include_router(jobs_router.router, prefix="/api")
 
 
 @app.get("/api/health")
@@ -82,6 +85,13 @@ async def startup_event():
         except Exception as migration_err:
             logger.error(f"Failed to run database migration: {migration_err}")
         
+        # Fail background jobs orphaned by a previous (crashed) process
+        try:
+            from services.job_service import JobService
+            await JobService(db).recover_interrupted()
+        except Exception as job_err:
+            logger.error(f"Failed to recover interrupted jobs: {job_err}")
+
         # Initialize and start scheduler worker
         from services.scheduler_service import SchedulerWorker
         message_scheduler = SchedulerWorker(db)
@@ -92,7 +102,10 @@ async def startup_event():
         import os
         if os.environ.get("PROVIDER_MODE", "mock").lower() == "whatsapp_web":
             from services.whatsapp_sender import get_whatsapp_sender
+            from services.account_quota import AccountQuotaStore
             sender = get_whatsapp_sender()
+            # Durable per-account daily quota / failure counters (shared by all workers)
+            sender.use_quota_store(AccountQuotaStore(db))
             # Start playwright context without blocking
             asyncio.create_task(sender.start())
         
@@ -111,6 +124,17 @@ async def shutdown_event():
         message_scheduler.stop()
         logger.info("Scheduler worker stopped")
         
+    # Release pooled provider connections
+    try:
+        from services.provider_adapter import ProviderAdapter
+        await ProviderAdapter.close()
+    except Exception as e:
+        logger.error(f"Error closing provider: {e}")
+
+    # Stop the CPU process pool used by background jobs
+    from services.job_service import shutdown_process_pool
+    shutdown_process_pool()
+
     # Stop WhatsApp Web Sender
     import os
     if os.environ.get("PROVIDER_MODE", "mock").lower() == "whatsapp_web":
@@ -9,7 +9,11 @@ from services.dashboard_service import DashboardService
 from services.shop_service import ShopService
 from services.product_service import ProductService
 from services.transaction_service import TransactionService
-from services.insights_service import recalculate_all_insights, migrate_behavior_to_insights
+from services.insights_service import (
+    recalculate_all_insights,
+    recalculate_insights_incremental,
+    migrate_behavior_to_insights,
+)
 
 __all__ = [
     "AuthService",
@@ -21,5 +25,6 @@ __all__ = [
     "ProductService",
     "TransactionService",
     "recalculate_all_insights",
+    "recalculate_insights_incremental",
     "migrate_behavior_to_insights",
 ]
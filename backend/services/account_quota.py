@@ -0,0 +1,171 @@
+"""
+Account Quota Store — Durable WhatsApp Daily Quota & Failure Counters
+=====================================================================
+Daily send quota and the consecutive-failure counter of every WhatsApp
+account live in MongoDB so they survive restarts and are shared by all
+worker processes.
+
+Collection: whatsapp_quota
+    _id                   "<account_id>:<YYYY-MM-DD IST>"
+    account_id, date
+    sent_count            sends reserved today ($inc, conditional on < limit)
+    consecutive_failures  reset to 0 on the first success after a failure
+    expires_at            TTL cleanup (QUOTA_RETENTION_DAYS after the day)
+
+Reservation:
+    try_reserve() takes one unit of quota with a single conditional upsert
+    ($inc where sent_count < limit); a send that does not go through hands
+    its unit back with release().  Concurrent workers can therefore never
+    overshoot WHATSAPP_MAX_PER_DAY.
+
+Local cache:
+    The last seen sent_count per account/day is cached in-process.  An
+    account known to be exhausted today is refused without a round trip
+    (the count only grows within a day); usage() reads are cached for
+    USAGE_CACHE_TTL_SECONDS for the scheduler's admission check.
+"""
+import logging
+import time
+from datetime import datetime, timezone, timedelta
+from typing import Any, Dict, Iterable, Set, Tuple
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from services.whatsapp_sender import _now_ist, IST_OFFSET
+
+logger = logging.getLogger(__name__)
+
+USAGE_CACHE_TTL_SECONDS = 5
+QUOTA_RETENTION_DAYS = 7
+
+
+def _today_ist() -> str:
+    return _now_ist().strftime("%Y-%m-%d")
+
+
+class AccountQuotaStore:
+    """Atomic per-account, per-IST-day counters in the whatsapp_quota collection."""
+
+    def __init__(self, db: Any):
+        self.db = db
+        self._counts: Dict[Tuple[str, str], int] = {}           # (account, date) → sent_count
+        self._usage_fetched: Dict[Tuple[str, str], float] = {}  # (account, date) → monotonic ts
+        self._failures: Dict[str, int] = {}                     # account → consecutive_failures
+
+    @staticmethod
+    def _key(account_id: str, date: str) -> str:
+        return f"{account_id}:{date}"
+
+    @staticmethod
+    def _expires_at(date: str) -> datetime:
+        day_start_utc = datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=timezone.utc) - IST_OFFSET
+        return day_start_utc + timedelta(days=QUOTA_RETENTION_DAYS + 1)
+
+    # ── Daily quota ──────────────────────────────────────────────────────
+
+    async def try_reserve(self, account_id: str, limit: int) -> bool:
+        """Atomically take one unit of today's quota. False if the account is exhausted."""
+        date = _today_ist()
+        if self._counts.get((account_id, date), 0) >= limit:
+            return False
+        query = {"_id": self._key(account_id, date), "sent_count": {"$lt": limit}}
+        update = {
+            "$inc": {"sent_count": 1},
+            "$set": {"updated_at": datetime.now(timezone.utc)},
+            "$setOnInsert": {
+                "account_id": account_id,
+                "date": date,
+                "consecutive_failures": 0,
+                "expires_at": self._expires_at(date),
+            },
+        }
+        try:
+            doc = await self.db.whatsapp_quota.find_one_and_update(
+                query, update, upsert=True,
+                projection={"sent_count": 1}, return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # The day's document already exists: either it is at the limit (the
+            # filter missed and the upsert collided) or another worker created it
+            # concurrently — retry as a plain conditional update.
+            doc = await self.db.whatsapp_quota.find_one_and_update(
+                query, update,
+                projection={"sent_count": 1}, return_document=ReturnDocument.AFTER,
+            )
+        if doc is None:
+            self._counts[(account_id, date)] = limit
+            return False
+        self._counts[(account_id, date)] = doc.get("sent_count", 0)
+        return True
+
+    async def release(self, account_id: str):
+        """Give back a reserved unit whose send did not go through."""
+        date = _today_ist()
+        await self.db.whatsapp_quota.update_one(
+            {"_id": self._key(account_id, date), "sent_count": {"$gt": 0}},
+            {"$inc": {"sent_count": -1}},
+        )
+        key = (account_id, date)
+        if self._counts.get(key, 0) > 0:
+            self._counts[key] -= 1
+
+    async def usage(self, account_ids: Iterable[str]) -> Dict[str, int]:
+        """Today's sent_count per account (cached for USAGE_CACHE_TTL_SECONDS)."""
+        date = _today_ist()
+        now = time.monotonic()
+        account_ids = list(account_ids)
+        stale = [
+            a for a in account_ids
+            if now - self._usage_fetched.get((a, date), 0.0) > USAGE_CACHE_TTL_SECONDS
+        ]
+        if stale:
+            cursor = self.db.whatsapp_quota.find(
+                {"_id": {"$in": [self._key(a, date) for a in stale]}},
+                {"account_id": 1, "sent_count": 1},
+            )
+            fetched = {doc["account_id"]: doc.get("sent_count", 0) async for doc in cursor}
+            for a in stale:
+                self._counts[(a, date)] = fetched.get(a, 0)
+                self._usage_fetched[(a, date)] = now
+        return {a: self._counts.get((a, date), 0) for a in account_ids}
+
+    async def exhausted(self, limits: Dict[str, int]) -> Set[str]:
+        """Accounts whose quota for today is used up. `limits`: account → daily limit."""
+        counts = await self.usage(limits.keys())
+        return {a for a, limit in limits.items() if counts.get(a, 0) >= limit}
+
+    # ── Consecutive failures ─────────────────────────────────────────────
+
+    async def record_failure(self, account_id: str) -> int:
+        """$inc the account's consecutive-failure counter; returns the new value."""
+        date = _today_ist()
+        doc = await self.db.whatsapp_quota.find_one_and_update(
+            {"_id": self._key(account_id, date)},
+            {
+                "$inc": {"consecutive_failures": 1},
+                "$set": {"updated_at": datetime.now(timezone.utc)},
+                "$setOnInsert": {
+                    "account_id": account_id,
+                    "date": date,
+                    "sent_count": 0,
+                    "expires_at": self._expires_at(date),
+                },
+            },
+            upsert=True,
+            projection={"consecutive_failures": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+        failures = doc.get("consecutive_failures", 0)
+        self._failures[account_id] = failures
+        return failures
+
+    async def reset_failures(self, account_id: str):
+        """Zero the consecutive-failure counter (skipped when already known to be 0)."""
+        if self._failures.get(account_id) == 0:
+            return
+        await self.db.whatsapp_quota.update_one(
+            {"_id": self._key(account_id, _today_ist())},
+            {"$set": {"consecutive_failures": 0}},
+        )
+        self._failures[account_id] = 0
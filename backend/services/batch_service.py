@@ -2,13 +2,100 @@
 Batch service for managing message batches and campaigns.
 """
 from datetime import datetime, timezone
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Callable, Awaitable, AsyncIterator
+import logging
 import uuid
 import math
 import asyncio
 import random
+from pymongo.errors import BulkWriteError
 from schemas import BatchStatus, MessageStatus
-from utils.classifier import prepare_message
+from utils.template_renderer import compile_template
+from services.offers_service import OffersService
+from services.scheduler_service import notify_scheduler, invalidate_campaign_state, reopen_for_requeue
+from services.job_service import JobService, JobCancelled
+from services.shop_stats import ShopStatsStore
+
+logger = logging.getLogger(__name__)
+
+# Segment → message priority (Hybrid RFM+B Intelligence)
+SEGMENT_PRIORITY = {
+    "vip": 1,                    # VIP Champions - highest priority
+    "at_risk": 1,                # At-Risk - urgent (same as VIP)
+    "potential_bulk": 2,         # Potential Bulk - increase spend
+    "loyal_frequent": 3,         # Loyal Frequent - reward habit
+    "boring": 4                  # Boring - low priority
+}
+
+# Messages per unordered insert_many during campaign generation
+MESSAGE_INSERT_CHUNK = 1000
+
+# Message statuses reschedule_batch puts back to pending (legacy "failed" included)
+RESCHEDULABLE_STATUSES = [
+    MessageStatus.FAILED.value, MessageStatus.FAILED_FINAL.value, MessageStatus.FAILED_PERMANENTLY.value,
+]
+
+async def _achunks(cursor: Any, size: int) -> AsyncIterator[List[Dict[str, Any]]]:
+    """Yield lists of up to `size` documents from an async cursor."""
+    chunk: List[Dict[str, Any]] = []
+    async for doc in cursor:
+        chunk.append(doc)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _offer_fields(best_offer: Dict[str, Any]):
+    """(offer_title, offer_discount, offer_product) placeholder values for a matched offer."""
+    if not best_offer:
+        return (
+            "Great deals throughout our store",
+            "the best wholesale prices",
+            "your next household purchase",
+        )
+    offer_title = best_offer.get("title", "") or "Great deals throughout our store"
+    offer_discount_type  = best_offer.get("discount_type", "")
+    offer_discount_value = best_offer.get("discount_value", "")
+    if offer_discount_type == "percentage":
+        offer_discount_str = f"{offer_discount_value}% OFF"
+    elif offer_discount_type == "flat":
+        offer_discount_str = f"₹{offer_discount_value} OFF"
+    elif offer_discount_type == "bogo":
+        offer_discount_str = "Buy 1 Get 1 Free"
+    else:
+        offer_discount_str = str(offer_discount_value) if offer_discount_value else "the best wholesale prices"
+
+    product_ids = best_offer.get("product_ids", [])
+    offer_product_str = ", ".join(str(p) for p in product_ids) if product_ids else "your next household purchase"
+    return offer_title, offer_discount_str, offer_product_str
+
+
+# Placeholders the generator can fill: customer fields + hydration + product values
+KNOWN_PLACEHOLDERS = {
+    "id", "customer_id", "name", "phone", "email", "city", "shop_id", "period_tag",
+    "customer_name", "segment", "favorite_category", "favorite_premium_product",
+    "favorite_bulk_product", "second_favorite_premium_product", "recently_bought_product",
+    "complementary_product", "offer_title", "offer_discount", "offer_product", "offer_list",
+    "offer_product_1", "favorite_item", "fixed_product",
+}
+
+
+def _product_values(ai_mode: bool, behavior: Optional[Dict[str, Any]],
+                    fixed_product: Optional[str]) -> Dict[str, str]:
+    """{{offer_product_1}} / {{favorite_item}} (AI mode) and {{fixed_product}} values."""
+    values: Dict[str, str] = {}
+    if ai_mode:
+        if behavior and behavior.get("fav_items"):
+            offer_product = behavior["fav_items"][0].get("product_name", "")
+        else:
+            offer_product = fixed_product or ""
+        values["offer_product_1"] = offer_product
+        values["favorite_item"] = offer_product
+    if fixed_product:
+        values["fixed_product"] = fixed_product
+    return values
 
 
 class BatchService:
@@ -54,6 +141,8 @@ class BatchService:
         ai_mode: bool = False,
         fixed_product: str = None,
         segment_offer_map: Dict[str, str] = None,  # {segment: offer_id} — Phase 3
+        background: bool = False,
+        on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None,
     ) -> Dict[str, Any]:
         """Create batch campaign with messages.
         
@@ -64,18 +153,25 @@ class BatchService:
         AI mode: If ai_mode=True, looks up customer_behavior_map for each customer
         to fill {{offer_product_1}} with their favorite item.
         If fixed_product is set, uses that for {{fixed_product}} in all messages.
+
+        Messages are generated in one streaming pass over the customers
+        cursor; batches and messages are flushed with chunked unordered
+        insert_many (MESSAGE_INSERT_CHUNK), so memory stays constant.
+        on_progress(processed_customers, total_customers) is awaited after
+        every flush.  With background=True validation runs inline, then
+        generation continues as a "create_campaign" job (see job_service);
+        its job id is returned immediately and cancelling the job cancels
+        the partially built campaign.
         """
         # Validate at least one template approach is provided
         if not template_id and not segment_templates:
             raise ValueError("Either template_id or segment_templates must be provided")
         
-        # Get customers
-        customers = await self.db.customers.find(
-            {"id": {"$in": customer_ids}, "user_id": user_id},
-            {"_id": 0}
-        ).to_list(10000)
+        # Count customers (the cursor is streamed later, in a single pass)
+        customer_query = {"id": {"$in": customer_ids}, "user_id": user_id}
+        total_customers = await self.db.customers.count_documents(customer_query)
         
-        if not customers:
+        if not total_customers:
             raise ValueError("No customers found")
         
         # If using segment-based templates, validate all templates exist
@@ -110,8 +206,11 @@ class BatchService:
         else:
             start_time = datetime.now(timezone.utc)
         
-        # Create campaign document for tracking
-        campaign_id = str(uuid.uuid4()) if campaign_name or file_id else None
+        total_batches = math.ceil(total_customers / batch_size)
+
+        # Create campaign document for tracking (always when running in the background,
+        # so a cancelled job can be cleaned up by campaign id)
+        campaign_id = str(uuid.uuid4()) if campaign_name or file_id or background else None
         if campaign_id:
             campaign_doc = {
                 "_id": campaign_id,
@@ -121,21 +220,153 @@ class BatchService:
                 "file_id": file_id,
                 "ai_mode": ai_mode,
                 "fixed_product": fixed_product,
-                "status": "sending",
-                "total_customers": len(customers),
-                "total_batches": math.ceil(len(customers) / batch_size),
+                # 'generating' until every message is queued, so auto-complete
+                # cannot close the campaign while it is still being built
+                "status": "generating",
+                "total_customers": total_customers,
+                "total_batches": total_batches,
                 "completed_batches": 0,
                 "messages_sent": 0,
                 "messages_failed": 0,
+                "segment_stats": {},
+                "generation": {"status": "running", "processed": 0, "total": total_customers},
                 "created_at": datetime.now(timezone.utc),
                 "updated_at": datetime.now(timezone.utc),
             }
             await self.db.campaigns.insert_one(campaign_doc)
+            await ShopStatsStore(self.db).increment(shop_id, total_campaigns=1)
 
+        async def _generate(progress) -> Dict[str, Any]:
+            try:
+                created_batches = await self._generate_messages(
+                    customer_query=customer_query,
+                    total_customers=total_customers,
+                    batch_size=batch_size,
+                    total_batches=total_batches,
+                    start_time=start_time,
+                    priority=priority,
+                    user_id=user_id,
+                    template_id=template_id,
+                    segment_templates=segment_templates,
+                    templates_map=templates_map,
+                    campaign_id=campaign_id,
+                    campaign_name=campaign_name,
+                    file_id=file_id,
+                    shop_id=shop_id,
+                    ai_mode=ai_mode,
+                    fixed_product=fixed_product,
+                    on_progress=progress,
+                )
+            except (JobCancelled, asyncio.CancelledError):
+                if campaign_id:
+                    await asyncio.shield(self._abort_generation(campaign_id))
+                raise
+            except Exception as e:
+                logger.error(f"Message generation failed for campaign {campaign_id}: {e}", exc_info=True)
+                if campaign_id:
+                    await self.db.campaigns.update_one(
+                        {"_id": campaign_id},
+                        {"$set": {"generation.status": "failed", "generation.error": str(e),
+                                  "updated_at": datetime.now(timezone.utc)}},
+                    )
+                raise
+
+            if campaign_id:
+                await self.db.campaigns.update_one(
+                    {"_id": campaign_id, "generation.status": "running"},
+                    {"$set": {"generation.status": "completed",
+                              "updated_at": datetime.now(timezone.utc)}},
+                )
+                # Hand the campaign to the scheduler (unless it was cancelled meanwhile)
+                await self.db.campaigns.update_one(
+                    {"_id": campaign_id, "status": "generating"},
+                    {"$set": {"status": "sending"}},
+                )
+
+            # Wake the scheduler so the first send goes out immediately
+            notify_scheduler()
+            
+            return {
+                "message": f"Created {total_batches} batches successfully",
+                "batches": created_batches
+            }
+
+        if background:
+            async def _work(ctx) -> Dict[str, Any]:
+                async def _progress(processed: int, total: int):
+                    await ctx.progress(processed, total, stage="generating")
+                    if on_progress:
+                        await on_progress(processed, total)
+
+                result = await _generate(_progress)
+                return {
+                    "message": result["message"],
+                    "campaign_id": campaign_id,
+                    "batch_count": len(result["batches"]),
+                }
+
+            job = await JobService(self.db).submit(
+                "create_campaign", user_id, _work, shop_id=shop_id,
+                params={"campaign_id": campaign_id, "total_customers": total_customers},
+            )
+            return {
+                "message": f"Generating {total_batches} batches in the background",
+                "job_id": job["id"],
+                "campaign_id": campaign_id,
+                "total_customers": total_customers,
+                "total_batches": total_batches,
+            }
+        return await _generate(on_progress)
+
+    async def _abort_generation(self, campaign_id: str):
+        """Cancel a campaign whose generation job was cancelled, including what was already queued."""
+        now = datetime.now(timezone.utc)
+        await self.db.campaigns.update_one(
+            {"_id": campaign_id},
+            {"$set": {"generation.status": "cancelled", "updated_at": now}},
+        )
+        await self.db.campaigns.update_one(
+            {"_id": campaign_id, "status": "generating"},
+            {"$set": {"status": "cancelled", "completed_at": now}},
+        )
+        invalidate_campaign_state(campaign_id)
+        await self.db.messages.update_many(
+            {"campaign_id": campaign_id, "status": {"$in": ["pending", "retry_wait"]}},
+            {"$set": {"status": "cancelled", "updated_at": now.isoformat()}},
+        )
+        await self.db.batches.update_many(
+            {"campaign_id": campaign_id, "status": {"$in": ["pending", "sending"]}},
+            {"$set": {"status": "cancelled"}},
+        )
+        await ShopStatsStore(self.db).mark_campaign_stale(campaign_id)
+        logger.info(f"Campaign {campaign_id} cancelled together with its generation job")
+
+    async def _generate_messages(
+        self,
+        customer_query: Dict[str, Any],
+        total_customers: int,
+        batch_size: int,
+        total_batches: int,
+        start_time: datetime,
+        priority: int,
+        user_id: str,
+        template_id: Optional[str],
+        segment_templates: Optional[Dict[str, str]],
+        templates_map: Dict[str, Dict[str, Any]],
+        campaign_id: Optional[str],
+        campaign_name: Optional[str],
+        file_id: Optional[str],
+        shop_id: Optional[str],
+        ai_mode: bool,
+        fixed_product: Optional[str],
+        on_progress: Optional[Callable[[int, int], Awaitable[None]]],
+    ) -> List[Dict[str, Any]]:
+        """Single streaming pass: customers → batch + message documents → chunked inserts."""
         # Load behavior maps (from customer_insights) if AI mode is on
         behavior_map = {}
         insights_segment_map = {}
         offer_match_map: Dict[str, Any] = {}  # customer_id -> best_offer_doc
+        prod_name_map = None
         if shop_id:
             insight_cursor = self.db.customer_insights.find(
                 {"shop_id": shop_id}, {"_id": 0}
@@ -146,28 +377,80 @@ class BatchService:
 
             # Phase 3: Run affinity matching if shop has active offers
             try:
-                from services.offers_service import OffersService
                 offers_svc = OffersService(self.db)
                 offer_match_map = await offers_svc.match_offers_to_customers(shop_id, user_id)
             except Exception as _offer_err:
-                import logging
-                logging.getLogger(__name__).warning(f"Offer matching skipped: {_offer_err}")
+                logger.warning(f"Offer matching skipped: {_offer_err}")
                 
             # Fetch products to build name map
-            products_cursor = self.db.products.find({"shop_id": shop_id, "user_id": user_id})
+            products_cursor = self.db.products.find(
+                {"shop_id": shop_id, "user_id": user_id},
+                {"_id": 0, "product_id": 1, "product_name": 1},
+            )
             prod_name_map = {}
             async for p in products_cursor:
                 prod_name_map[p["product_id"]] = p.get("product_name") or p["product_id"]
-        
-        # Split into batches
-        total_batches = math.ceil(len(customers) / batch_size)
-        created_batches = []
-        
-        for i in range(total_batches):
-            start_idx = i * batch_size
-            end_idx = start_idx + batch_size
-            batch_customers = customers[start_idx:end_idx]
-            
+
+        # Parse every template once; typos in placeholders are reported here
+        compiled_templates = {
+            tid: compile_template(t["content"], template_id=tid, known_keys=KNOWN_PLACEHOLDERS)
+            for tid, t in templates_map.items()
+        }
+
+        created_batches: List[Dict[str, Any]] = []
+        pending_batches: List[Dict[str, Any]] = []
+        pending_messages: List[Dict[str, Any]] = []
+        chunk_segments: Dict[str, int] = {}  # segment totals of the unflushed chunk
+        processed = 0
+
+        async def _flush():
+            # Shop summary first, for the same reason: the scheduler decrements
+            # its pending counter as soon as a message is sent.
+            await ShopStatsStore(self.db).increment(
+                shop_id, active_batches=len(pending_batches), pending=len(pending_messages)
+            )
+            # Batches first: a batch must exist (with its final pending_count)
+            # before the scheduler can send — and decrement — any of its messages.
+            if pending_batches:
+                await self.db.batches.insert_many(pending_batches, ordered=False)
+                created_batches.extend(
+                    {k: v for k, v in b.items() if k != "_id"} for b in pending_batches
+                )
+                pending_batches.clear()
+            # Seed segment totals for the incremental campaign counters
+            if campaign_id and chunk_segments:
+                await self.db.campaigns.update_one(
+                    {"_id": campaign_id},
+                    {"$inc": {f"segment_stats.{seg}.total": n for seg, n in chunk_segments.items()}},
+                )
+                chunk_segments.clear()
+            if pending_messages:
+                try:
+                    await self.db.messages.insert_many(pending_messages, ordered=False)
+                except BulkWriteError as bwe:
+                    logger.error(
+                        f"Message insert partially failed for campaign {campaign_id}: "
+                        f"{len(bwe.details.get('writeErrors', []))} errors"
+                    )
+                    await ShopStatsStore(self.db).increment(
+                        shop_id, pending=-len(bwe.details.get("writeErrors", []))
+                    )
+                pending_messages.clear()
+            if campaign_id:
+                await self.db.campaigns.update_one(
+                    {"_id": campaign_id},
+                    {"$set": {"generation.processed": processed,
+                              "updated_at": datetime.now(timezone.utc)}},
+                )
+            if on_progress:
+                await on_progress(processed, total_customers)
+
+        customers_cursor = self.db.customers.find(customer_query, {"_id": 0}).batch_size(
+            MESSAGE_INSERT_CHUNK
+        )
+        batch_number = 0
+        async for batch_customers in _achunks(customers_cursor, batch_size):
+            batch_number += 1
             batch_id = str(uuid.uuid4())
             batch_doc = {
                 "id": batch_id,
@@ -176,7 +459,7 @@ class BatchService:
                 "file_id": file_id,
                 "shop_id": shop_id,
                 "user_id": user_id,
-                "batch_number": i + 1,
+                "batch_number": batch_number,
                 "total_batches": total_batches,
                 "customer_count": len(batch_customers),
                 "batch_size": batch_size,
@@ -184,7 +467,7 @@ class BatchService:
                 "status": BatchStatus.PENDING.value,
                 "success_count": 0,
                 "failed_count": 0,
-                "pending_count": len(batch_customers),
+                "pending_count": 0,
                 "priority": priority,
                 "created_at": datetime.now(timezone.utc).isoformat(),
             }
@@ -197,10 +480,8 @@ class BatchService:
                 batch_doc["template_id"] = template_id
                 batch_doc["mode"] = "single-template"
             
-            await self.db.batches.insert_one(batch_doc)
-            
             # Create message records
-            messages = []
+            batch_messages = 0
             for customer in batch_customers:
                 # Determine which template to use
                 cust_key = customer.get("customer_id") or customer.get("phone", "")
@@ -227,29 +508,10 @@ class BatchService:
                 # Phase 3: resolve best matched offer for this customer
                 customer_offers = offer_match_map.get(cust_key) or []
                 best_offer = customer_offers[0] if customer_offers else {}
-                if not best_offer:
-                    offer_title = "Great deals throughout our store"
-                    offer_discount_str = "the best wholesale prices"
-                    offer_product_str = "your next household purchase"
-                else:
-                    offer_title = best_offer.get("title", "") or "Great deals throughout our store"
-                    offer_discount_type  = best_offer.get("discount_type", "")
-                    offer_discount_value = best_offer.get("discount_value", "")
-                    if offer_discount_type == "percentage":
-                        offer_discount_str = f"{offer_discount_value}% OFF"
-                    elif offer_discount_type == "flat":
-                        offer_discount_str = f"₹{offer_discount_value} OFF"
-                    elif offer_discount_type == "bogo":
-                        offer_discount_str = "Buy 1 Get 1 Free"
-                    else:
-                        offer_discount_str = str(offer_discount_value) if offer_discount_value else "the best wholesale prices"
-                    
-                    product_ids = best_offer.get("product_ids", [])
-                    offer_product_str = ", ".join(str(p) for p in product_ids) if product_ids else "your next household purchase"
+                offer_title, offer_discount_str, offer_product_str = _offer_fields(best_offer)
 
                 # Generate formatted offer list
-                from services.offers_service import OffersService
-                offer_list_str = OffersService.format_offer_list(customer_offers, prod_name_map if shop_id else None)
+                offer_list_str = OffersService.format_offer_list(customer_offers, prod_name_map)
 
                 # Build unified data dict for placeholder substitution
                 hydration_data = {
@@ -269,34 +531,20 @@ class BatchService:
                     "offer_list":     offer_list_str,
                 }
                 
-                message_content = prepare_message(customer_template["content"], hydration_data)
-                
-                # AI mode: inject offer_product_1 from behavior map
+                # AI mode: offer_product_1 from behavior map; fixed product mode
+                cust_behavior = None
                 if ai_mode and shop_id:
-                    cust_phone = customer.get("phone", "")
-                    cust_behavior = behavior_map.get(cust_phone) or behavior_map.get(customer.get("id", ""))
-                    if cust_behavior and cust_behavior.get("fav_items"):
-                        offer_product = cust_behavior["fav_items"][0].get("product_name", "")
-                        message_content = message_content.replace("{{offer_product_1}}", offer_product)
-                        message_content = message_content.replace("{{favorite_item}}", offer_product)
-                    else:
-                        message_content = message_content.replace("{{offer_product_1}}", fixed_product or "")
-                        message_content = message_content.replace("{{favorite_item}}", fixed_product or "")
-                
-                # Fixed product mode
-                if fixed_product:
-                    message_content = message_content.replace("{{fixed_product}}", fixed_product)
+                    cust_behavior = behavior_map.get(customer.get("phone", "")) or behavior_map.get(customer.get("id", ""))
+                product_values = _product_values(bool(ai_mode and shop_id), cust_behavior, fixed_product)
+
+                message_content = compiled_templates[customer_template_id].render(
+                    hydration_data, product_values
+                )
                 
                 # Map segment to priority - Hybrid RFM+B Intelligence
-                segment_priority_map = {
-                    "vip": 1,                    # VIP Champions - highest priority
-                    "at_risk": 1,                # At-Risk - urgent (same as VIP)
-                    "potential_bulk": 2,         # Potential Bulk - increase spend
-                    "loyal_frequent": 3,         # Loyal Frequent - reward habit
-                    "boring": 4                  # Boring - low priority
-                }
-                message_priority = segment_priority_map.get(customer_segment, 4)
+                message_priority = SEGMENT_PRIORITY.get(customer_segment, 4)
                 
+                now_iso = datetime.now(timezone.utc).isoformat()
                 message_doc = {
                     "id": str(uuid.uuid4()),
                     "batch_id": batch_id,
@@ -317,22 +565,34 @@ class BatchService:
                     "processed_at": None,
                     "user_id": user_id,
                     "offer_id": best_offer.get("id"),   # Phase 3: track matched offer
-                    "created_at": datetime.now(timezone.utc).isoformat(),
-                    "updated_at": datetime.now(timezone.utc).isoformat(),
+                    "created_at": now_iso,
+                    "updated_at": now_iso,
                 }
-                messages.append(message_doc)
+                pending_messages.append(message_doc)
+                batch_messages += 1
+                chunk_segments[customer_segment] = chunk_segments.get(customer_segment, 0) + 1
             
-            if messages:
-                await self.db.messages.insert_many(messages)
-            
-            # Remove MongoDB's _id field before adding to response
-            batch_response = {k: v for k, v in batch_doc.items() if k != '_id'}
-            created_batches.append(batch_response)
-        
-        return {
-            "message": f"Created {total_batches} batches successfully",
-            "batches": created_batches
-        }
+            # pending_count must match the messages actually queued — the
+            # scheduler closes the batch when its $inc counter reaches 0
+            batch_doc["pending_count"] = batch_messages
+            pending_batches.append(batch_doc)
+            processed += len(batch_customers)
+
+            if len(pending_messages) >= MESSAGE_INSERT_CHUNK:
+                await _flush()
+                # Stop building if the campaign was cancelled / stopped meanwhile
+                if campaign_id and await self.db.campaigns.find_one(
+                    {"_id": campaign_id, "status": {"$in": ["cancelled", "stopped"]}}, {"_id": 1}
+                ):
+                    logger.info(f"Campaign {campaign_id} cancelled during generation — stopping")
+                    await self.db.campaigns.update_one(
+                        {"_id": campaign_id},
+                        {"$set": {"generation.status": "cancelled"}},
+                    )
+                    return created_batches
+
+        await _flush()
+        return created_batches
 
     async def list_batches(self, user_id: str) -> List[Dict[str, Any]]:
         """List all batches for a user."""
@@ -353,7 +613,13 @@ class BatchService:
         return messages
     
     async def reschedule_batch(self, batch_id: str, user_id: str) -> bool:
-        """Reschedule a failed batch."""
+        """
+        Reschedule a failed batch: its failed messages go back to pending.
+
+        The counters are put back in flight first (reopen_for_requeue
+        reopens the batch and campaign if they had closed), then each
+        message is reset fenced on the status it was read with.
+        """
         batch = await self.db.batches.find_one(
             {"id": batch_id, "user_id": user_id},
             {"_id": 0}
@@ -362,57 +628,57 @@ class BatchService:
         if not batch:
             raise ValueError("Batch not found")
         
-        # Reset failed messages to pending
-        await self.db.messages.update_many(
-            {"batch_id": batch_id, "status": MessageStatus.FAILED.value},
-            {"$set": {"status": MessageStatus.PENDING.value, "error": None}}
-        )
-
-        # Re-queue failed messages back into waiting-room
         failed_messages = await self.db.messages.find(
-            {"batch_id": batch_id, "user_id": user_id, "status": MessageStatus.PENDING.value},
+            {"batch_id": batch_id, "user_id": user_id, "status": {"$in": RESCHEDULABLE_STATUSES}},
             {"_id": 0}
         ).to_list(10000)
-        if failed_messages:
-            for msg in failed_messages:
-                await self.db.msg_queues.update_one(
-                    {"message_id": msg["id"], "user_id": user_id},
-                    {
-                        "$set": {
-                            "campaign_id": batch.get("campaign_id"),
-                            "batch_id": batch_id,
-                            "customer_id": msg.get("customer_id"),
-                            "phone_number": msg.get("phone_number"),
-                            "customer_segment": msg.get("customer_segment", "boring"),
-                            "status": "pending",
-                            "priority": msg.get("priority", 4),
-                            "scheduled_at": msg.get("scheduled_at"),
-                            "updated_at": datetime.now(timezone.utc).isoformat(),
-                        },
-                        "$setOnInsert": {
-                            "id": msg.get("id"),
-                            "message_id": msg.get("id"),
-                            "user_id": user_id,
-                            "created_at": datetime.now(timezone.utc).isoformat(),
-                        },
+        await reopen_for_requeue(self.db, failed_messages)
+
+        now = datetime.now(timezone.utc)
+        for msg in failed_messages:
+            result = await self.db.messages.update_one(
+                {"id": msg["id"], "status": msg["status"]},
+                {"$set": {
+                    "status": MessageStatus.PENDING.value,
+                    "retry_count": 0,
+                    "next_attempt_at": now,
+                    "error": None,
+                    "updated_at": now.isoformat(),
+                }}
+            )
+            if not result.modified_count:
+                continue
+            # Re-queue failed messages back into waiting-room
+            await self.db.msg_queues.update_one(
+                {"message_id": msg["id"], "user_id": user_id},
+                {
+                    "$set": {
+                        "campaign_id": batch.get("campaign_id"),
+                        "batch_id": batch_id,
+                        "customer_id": msg.get("customer_id"),
+                        "phone_number": msg.get("phone_number"),
+                        "customer_segment": msg.get("customer_segment", "boring"),
+                        "status": "pending",
+                        "priority": msg.get("priority", 4),
+                        "scheduled_at": msg.get("scheduled_at"),
+                        "updated_at": now.isoformat(),
                     },
-                    upsert=True,
-                )
+                    "$setOnInsert": {
+                        "id": msg.get("id"),
+                        "message_id": msg.get("id"),
+                        "user_id": user_id,
+                        "created_at": now.isoformat(),
+                    },
+                },
+                upsert=True,
+            )
         
-        # Update batch
-        failed_count = batch.get("failed_count", 0)
+        # Update batch (counters were moved by reopen_for_requeue)
         await self.db.batches.update_one(
             {"id": batch_id},
-            {
-                "$set": {
-                    "status": BatchStatus.PENDING.value,
-                    "priority": 1,
-                    "failed_count": 0,
-                    "pending_count": failed_count
-                }
-            }
+            {"$set": {"status": BatchStatus.PENDING.value, "priority": 1}}
         )
-        await self._sync_campaign_batch_from_batch(batch_id, user_id)
+        notify_scheduler()
         
         return True
     
@@ -443,6 +709,7 @@ class BatchService:
             {"_id": campaign_id, "user_id": user_id},
             {"$set": {"status": "stopped", "completed_at": datetime.now(timezone.utc), "updated_at": datetime.now(timezone.utc)}}
         )
+        await ShopStatsStore(self.db).mark_campaign_stale(campaign_id)
         return {
             "message": "Campaign stopped. Current batch will finish; future batches cancelled.",
             "batches_cancelled": batch_result.modified_count,
@@ -461,6 +728,7 @@ class BatchService:
         # Delete all campaigns for this user
         campaigns_result = await self.db.campaigns.delete_many({"user_id": user_id})
         campaign_batches_result = await self.db.campaign_batches.delete_many({"user_id": user_id})
+        await ShopStatsStore(self.db).mark_user_stale(user_id)
         
         return {
             "message": "All batches, campaigns and messages cleared successfully",
@@ -492,6 +760,7 @@ class BatchService:
             {"$set": {"status": BatchStatus.PAUSED.value}}
         )
         await self._sync_campaign_batch_from_batch(batch_id, user_id)
+        await ShopStatsStore(self.db).mark_stale(batch.get("shop_id"))
 
         return {"message": "Batch paused", "messages_paused": pending_update.modified_count}
 
@@ -516,6 +785,8 @@ class BatchService:
             {"$set": {"status": BatchStatus.PENDING.value}}
         )
         await self._sync_campaign_batch_from_batch(batch_id, user_id)
+        await ShopStatsStore(self.db).mark_stale(batch.get("shop_id"))
+        notify_scheduler()
 
         return {"message": "Batch resumed", "messages_reactivated": paused_update.modified_count}
 
@@ -601,23 +872,16 @@ class BatchService:
                     "complementary_product": cust_insight.get("complementary_product", ""),
                 }
                 
-                new_content = prepare_message(tpl["content"], hydration_data)
-                
                 # Handle AI and fixed product placeholders
-                ai_mode = batch.get("ai_mode", False)
-                fixed_product = batch.get("fixed_product")
-                if ai_mode and shop_id:
-                    cust_behavior = behavior_map.get(customer.get("phone", "")) or behavior_map.get(customer.get("id", "")) or behavior_map.get(cust_key) or {}
-                    if cust_behavior and cust_behavior.get("fav_items"):
-                        offer_product = cust_behavior["fav_items"][0].get("product_name", "")
-                        new_content = new_content.replace("{{offer_product_1}}", offer_product)
-                        new_content = new_content.replace("{{favorite_item}}", offer_product)
-                    else:
-                        new_content = new_content.replace("{{offer_product_1}}", fixed_product or "")
-                        new_content = new_content.replace("{{favorite_item}}", fixed_product or "")
-                
-                if fixed_product:
-                    new_content = new_content.replace("{{fixed_product}}", fixed_product)
+                ai_mode = bool(batch.get("ai_mode", False) and shop_id)
+                cust_behavior = None
+                if ai_mode:
+                    cust_behavior = behavior_map.get(customer.get("phone", "")) or behavior_map.get(customer.get("id", "")) or behavior_map.get(cust_key)
+                product_values = _product_values(ai_mode, cust_behavior, batch.get("fixed_product"))
+
+                new_content = compile_template(tpl["content"], template_id=selected_template_id).render(
+                    hydration_data, product_values
+                )
 
                 await self.db.messages.update_one(
                     {"id": msg["id"], "user_id": user_id},
@@ -667,23 +931,16 @@ class BatchService:
                     "complementary_product": cust_insight.get("complementary_product", ""),
                 }
                 
-                new_content = prepare_message(template["content"], hydration_data)
-                
                 # Handle AI and fixed product placeholders
-                ai_mode = batch.get("ai_mode", False)
-                fixed_product = batch.get("fixed_product")
-                if ai_mode and shop_id:
-                    cust_behavior = behavior_map.get(customer.get("phone", "")) or behavior_map.get(customer.get("id", "")) or behavior_map.get(cust_key) or {}
-                    if cust_behavior and cust_behavior.get("fav_items"):
-                        offer_product = cust_behavior["fav_items"][0].get("product_name", "")
-                        new_content = new_content.replace("{{offer_product_1}}", offer_product)
-                        new_content = new_content.replace("{{favorite_item}}", offer_product)
-                    else:
-                        new_content = new_content.replace("{{offer_product_1}}", fixed_product or "")
-                        new_content = new_content.replace("{{favorite_item}}", fixed_product or "")
-                
-                if fixed_product:
-                    new_content = new_content.replace("{{fixed_product}}", fixed_product)
+                ai_mode = bool(batch.get("ai_mode", False) and shop_id)
+                cust_behavior = None
+                if ai_mode:
+                    cust_behavior = behavior_map.get(customer.get("phone", "")) or behavior_map.get(customer.get("id", "")) or behavior_map.get(cust_key)
+                product_values = _product_values(ai_mode, cust_behavior, batch.get("fixed_product"))
+
+                new_content = compile_template(template["content"], template_id=template_id).render(
+                    hydration_data, product_values
+                )
 
                 await self.db.messages.update_one(
                     {"id": msg["id"], "user_id": user_id},
@@ -715,6 +972,7 @@ class BatchService:
                 await self.db.campaigns.delete_one({"_id": batch.get("campaign_id"), "user_id": user_id})
             else:
                 await self._update_campaign_stats(batch.get("campaign_id"))
+        await ShopStatsStore(self.db).mark_stale(batch.get("shop_id"))
 
         return {
             "message": "Batch deleted successfully",
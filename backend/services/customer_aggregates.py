@@ -0,0 +1,215 @@
+"""
+Customer Aggregates — Running Per-Customer Totals for Incremental Insights
+==========================================================================
+Keeps, per customer, the figures Level 1 RFM scoring needs, so a
+transaction upload does not have to reload every transaction of the shop.
+
+Collection: customer_aggregates
+    shop_id, customer_id, period_tag
+    tx_count        transaction rows
+    amount          sum of total_amount
+    quantity        sum of purchase_qty
+    last_purchase   max purchase_date
+    days            distinct purchase days ("YYYY-MM-DD")
+    updated_at
+
+Why per period:
+    Transaction uploads replace one period_tag at a time.  Counts and sums
+    could be adjusted by delta, but a max date and a distinct-day set cannot
+    be "un-merged" when a period's rows are replaced — so the aggregates are
+    kept per (customer, period_tag) and the delta of an upload is exactly
+    that period's documents.  Per-customer totals are combined server-side
+    (load_totals): sums are summed, last_purchase is the max, and
+    frequency is the size of the union of the day sets.
+
+Delta:
+    replace_period(shop_id, period_tag) swaps one period's aggregates for
+    freshly grouped ones and returns the customers whose totals changed.
+    rebuild(shop_id) regroups every period (first use on an existing shop).
+
+Shop-wide totals for Level 2:
+    load_product_totals / load_baskets group the shop's transactions by
+    (category, product) and by (day, product).  They feed the profiler's
+    shop-wide fallbacks and the co-purchase matrix when only some customers
+    are re-profiled.
+
+All grouping runs in MongoDB ($group); only one row per customer (and
+period), product or basket reaches the application.
+"""
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+AGGREGATE_INSERT_CHUNK = 5000
+
+# purchase_qty / total_amount win over the legacy quantity / amount; values
+# that are missing or not numeric count as quantity 1 / amount 0 — the same
+# defaults the full recalculation applies.
+_QTY_EXPR = {"$trunc": {"$ifNull": [
+    {"$convert": {"input": {"$ifNull": ["$purchase_qty", "$quantity"]},
+                  "to": "double", "onError": None, "onNull": None}},
+    1,
+]}}
+_AMOUNT_EXPR = {"$ifNull": [
+    {"$convert": {"input": {"$ifNull": ["$total_amount", "$amount"]},
+                  "to": "double", "onError": None, "onNull": None}},
+    0,
+]}
+_DATE_EXPR = {"$convert": {"input": "$purchase_date", "to": "date", "onError": None, "onNull": None}}
+
+
+def _valid_transactions(shop_id: str) -> List[Dict[str, Any]]:
+    """Pipeline prefix: the shop's transactions with a usable purchase date."""
+    return [
+        {"$match": {"shop_id": shop_id}},
+        {"$project": {"product_id": 1, "category": 1, "date": _DATE_EXPR,
+                      "qty": _QTY_EXPR, "amount": _AMOUNT_EXPR}},
+        {"$match": {"date": {"$ne": None}}},
+    ]
+
+
+def _group_pipeline(match: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """transactions → one aggregate per (customer_id, period_tag)."""
+    return [
+        {"$match": match},
+        {"$project": {"customer_id": 1, "period_tag": 1, "date": _DATE_EXPR,
+                      "qty": _QTY_EXPR, "amount": _AMOUNT_EXPR}},
+        {"$match": {"date": {"$ne": None}, "customer_id": {"$ne": None}}},
+        {"$group": {
+            "_id": {"customer_id": "$customer_id", "period_tag": "$period_tag"},
+            "tx_count": {"$sum": 1},
+            "amount": {"$sum": "$amount"},
+            "quantity": {"$sum": "$qty"},
+            "last_purchase": {"$max": "$date"},
+            "days": {"$addToSet": {"$dateToString": {"format": "%Y-%m-%d", "date": "$date"}}},
+        }},
+    ]
+
+
+class CustomerAggregateStore:
+    """Per-(customer, period_tag) transaction aggregates in customer_aggregates."""
+
+    def __init__(self, db: Any):
+        self.db = db
+
+    async def has_aggregates(self, shop_id: str) -> bool:
+        return await self.db.customer_aggregates.find_one({"shop_id": shop_id}, {"_id": 1}) is not None
+
+    async def _insert_grouped(self, shop_id: str, match: Dict[str, Any]) -> Set[str]:
+        """Group matching transactions and insert the aggregates; returns their customers."""
+        now = datetime.now(timezone.utc)
+        customers: Set[str] = set()
+        chunk: List[Dict[str, Any]] = []
+        cursor = self.db.transactions.aggregate(_group_pipeline(match), allowDiskUse=True)
+        async for row in cursor:
+            key = row.pop("_id")
+            customers.add(key["customer_id"])
+            chunk.append({"shop_id": shop_id, **key, **row, "updated_at": now})
+            if len(chunk) >= AGGREGATE_INSERT_CHUNK:
+                await self.db.customer_aggregates.insert_many(chunk, ordered=False)
+                chunk = []
+        if chunk:
+            await self.db.customer_aggregates.insert_many(chunk, ordered=False)
+        return customers
+
+    async def replace_period(self, shop_id: str, period_tag: str) -> Set[str]:
+        """
+        Re-derive one period's aggregates after its transactions were replaced.
+
+        Returns the customers whose totals may have changed: those with
+        transactions in the period before or after the upload.
+        """
+        previous = set(await self.db.customer_aggregates.distinct(
+            "customer_id", {"shop_id": shop_id, "period_tag": period_tag}
+        ))
+        await self.db.customer_aggregates.delete_many({"shop_id": shop_id, "period_tag": period_tag})
+        current = await self._insert_grouped(shop_id, {"shop_id": shop_id, "period_tag": period_tag})
+        logger.info(
+            f"[Aggregates] Shop {shop_id} period {period_tag}: "
+            f"{len(current)} customers now, {len(previous)} before"
+        )
+        return previous | current
+
+    async def rebuild(self, shop_id: str) -> int:
+        """Regroup all of the shop's transactions. Returns the number of customers."""
+        await self.db.customer_aggregates.delete_many({"shop_id": shop_id})
+        customers = await self._insert_grouped(shop_id, {"shop_id": shop_id})
+        logger.info(f"[Aggregates] Rebuilt aggregates for {len(customers)} customers of shop {shop_id}")
+        return len(customers)
+
+    async def load_totals(self, shop_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Per-customer totals as columns: customer_id (list), recency_date
+        (datetime64[ns]), frequency, purchase_count, total_quantity (int64),
+        monetary (float64).  None when the shop has no aggregates.
+        """
+        pipeline = [
+            {"$match": {"shop_id": shop_id}},
+            {"$group": {
+                "_id": "$customer_id",
+                "purchase_count": {"$sum": "$tx_count"},
+                "monetary": {"$sum": "$amount"},
+                "total_quantity": {"$sum": "$quantity"},
+                "recency_date": {"$max": "$last_purchase"},
+                "day_sets": {"$push": "$days"},
+            }},
+            {"$project": {
+                "purchase_count": 1, "monetary": 1, "total_quantity": 1, "recency_date": 1,
+                "frequency": {"$size": {"$reduce": {
+                    "input": "$day_sets", "initialValue": [],
+                    "in": {"$setUnion": ["$$value", "$$this"]},
+                }}},
+            }},
+        ]
+        rows = [row async for row in self.db.customer_aggregates.aggregate(pipeline, allowDiskUse=True)]
+        if not rows:
+            return None
+        return {
+            "customer_id": [row["_id"] for row in rows],
+            "recency_date": np.array(
+                [row["recency_date"].replace(tzinfo=None) for row in rows], dtype="datetime64[ns]"
+            ),
+            "frequency": np.array([row["frequency"] for row in rows], dtype=np.int64),
+            "purchase_count": np.array([row["purchase_count"] for row in rows], dtype=np.int64),
+            "total_quantity": np.array([row["total_quantity"] for row in rows], dtype=np.int64),
+            "monetary": np.array([row["monetary"] for row in rows], dtype=np.float64),
+        }
+
+    # ── Shop-wide totals (Level 2 fallbacks and co-purchase baskets) ─────
+
+    async def load_product_totals(self, shop_id: str) -> Dict[str, List[Any]]:
+        """Amount / quantity per (category, product_id) across the shop, as columns."""
+        pipeline = _valid_transactions(shop_id) + [
+            {"$group": {
+                "_id": {"category": "$category", "product_id": "$product_id"},
+                "amount": {"$sum": "$amount"},
+                "quantity": {"$sum": "$qty"},
+            }},
+        ]
+        columns: Dict[str, List[Any]] = {"category": [], "product_id": [], "amount": [], "quantity": []}
+        async for row in self.db.transactions.aggregate(pipeline, allowDiskUse=True):
+            columns["category"].append(row["_id"].get("category"))
+            columns["product_id"].append(row["_id"].get("product_id"))
+            columns["amount"].append(row["amount"])
+            columns["quantity"].append(row["quantity"])
+        return columns
+
+    async def load_baskets(self, shop_id: str) -> Dict[str, List[Any]]:
+        """Transactions per (purchase day, product_id) across the shop, as columns."""
+        pipeline = _valid_transactions(shop_id) + [
+            {"$group": {
+                "_id": {"day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$date"}},
+                        "product_id": "$product_id"},
+                "count": {"$sum": 1},
+            }},
+        ]
+        columns: Dict[str, List[Any]] = {"day": [], "product_id": [], "count": []}
+        async for row in self.db.transactions.aggregate(pipeline, allowDiskUse=True):
+            columns["day"].append(row["_id"]["day"])
+            columns["product_id"].append(row["_id"].get("product_id"))
+            columns["count"].append(row["count"])
+        return columns
@@ -2,16 +2,58 @@
 Customer service for managing customer data.
 Per schema spec: customers = identity-only (name, phone, email, city, first_seen, last_seen).
 RFM / segment data lives exclusively in customer_insights.
+Uploads are streamed like transaction uploads: parsed block by block in the
+CPU process pool and upserted in chunks while the next blocks parse.
 """
+import asyncio
+import base64
+import binascii
+import json
 from datetime import datetime, timezone
-from typing import List, Dict, Any, Optional
-import uuid
+from itertools import repeat
+from typing import List, Dict, Any, Optional, Set, Tuple
 import pandas as pd
-import io
 import logging
 
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+
+from services.job_service import run_cpu
+from services.shop_stats import ShopStatsStore
+from services.transaction_service import (
+    TX_QUEUE_BLOCKS,
+    _clean_ids,
+    _map_blocks,
+    _read_table,
+    _split_upload,
+    _uuid4_strings,
+)
+
 logger = logging.getLogger(__name__)
 
+CUSTOMER_UPSERT_CHUNK = 5000    # UpdateOne operations per bulk_write
+
+REQUIRED_COLUMNS = ['name', 'phone']
+CUSTOMER_COLUMNS = ['customer_id', 'name', 'phone', 'email', 'city']
+SEGMENT_KEYS = ["vip", "at_risk", "potential_bulk", "loyal_frequent", "boring"]
+
+# Header aliases applied when no column mapping is given
+AUTO_COLUMN_MAP = {
+    'customer_name': 'name',
+    'customer': 'name',
+    'full_name': 'name',
+    'phone_number': 'phone',
+    'mobile': 'phone',
+    'mobile_no': 'phone',
+    'contact': 'phone',
+    'email_address': 'email',
+    'cust_id': 'customer_id',
+    'town': 'city',
+    'location': 'city',
+    'area': 'city',
+}
+
 
 class CustomerService:
     """Service for customer operations."""
@@ -112,6 +154,16 @@ class CustomerService:
 
         RFM segmentation is NOT stored here. It is computed exclusively
         by recalculate_all_insights() and lives in customer_insights.
+
+        The upload is streamed like transaction uploads: CSV files are cut
+        into blocks of whole rows, each cleaned and turned into documents
+        in the CPU process pool (vectorized phone cleaning, drop_duplicates
+        on phone) while earlier blocks are upserted in bulk_writes of
+        CUSTOMER_UPSERT_CHUNK.  A phone seen in an earlier block is skipped
+        — the first row of a phone wins, as before.
+
+        The response is a summary (counts and the segment histogram); the
+        customers themselves are listed page by page through list_customers.
         
         Args:
             file_content: Raw file bytes
@@ -124,260 +176,274 @@ class CustomerService:
             column_mapping: User-provided column mapping (optional)
             percentile: Deprecated — kept for backward compat
         """
-        # Parse file
-        df = self._parse_customer_csv(file_content, filename, column_mapping)
-        
+        header, ranges = _split_upload(file_content, filename)
+        # Reject a file with missing columns before anything is written
+        await run_cpu(_check_customer_header, header or file_content, filename, column_mapping)
+
         now = datetime.now(timezone.utc).isoformat()
+        # File references are only stored when the file was uploaded to cloud
+        links = {k: v for k, v in (("file_url", file_url), ("file_id", file_id),
+                                   ("campaign_id", campaign_id)) if v}
+        queue: asyncio.Queue = asyncio.Queue(maxsize=TX_QUEUE_BLOCKS)
 
-        # Prepare customer documents with ONLY identity fields
-        customers = []
-        for _, row in df.iterrows():
-            customer_data = row.to_dict()
-            phone_value = str(customer_data.get('phone', '')).strip()
-
-            # Blank phone rows cannot be safely upserted (phone is part of the unique key)
-            if not phone_value:
-                continue
-            
-            # Extract customer_id from CSV if available, else use phone as fallback
-            csv_customer_id = str(customer_data.get('customer_id', '')).strip()
-            city_value = str(customer_data.get('city', '')).strip()
-
-            customer_doc = {
-                "user_id": user_id,
-                "shop_id": shop_id,
-                "customer_id": csv_customer_id if csv_customer_id else phone_value,
-                "name": str(customer_data.get('name', '')).strip(),
-                "phone": phone_value,
-                "email": str(customer_data.get('email', '')).strip() if 'email' in customer_data else '',
-                "city": city_value,
-                "last_seen": now,
-                "uploaded_at": now,
-                "source_file": filename,
-                "period_tag": period_tag,
-            }
-            
-            # Add file reference if file was uploaded to cloud
-            if file_url:
-                customer_doc["file_url"] = file_url
-            if file_id:
-                customer_doc["file_id"] = file_id
-            if campaign_id:
-                customer_doc["campaign_id"] = campaign_id
-
-            customers.append(customer_doc)
-
-        # Deduplicate on (shop_id, phone) before bulk upsert
-        deduped_customers = []
-        seen_keys = set()
-        for customer in customers:
-            key = (customer.get("shop_id"), customer.get("phone"))
-            if key in seen_keys:
-                continue
-            seen_keys.add(key)
-            deduped_customers.append(customer)
-        customers = deduped_customers
-        
-        # Upsert: set first_seen only on insert, always update last_seen
-        if customers:
-            from pymongo import UpdateOne
-            
-            operations = []
-            for customer in customers:
-                # Separate first_seen — only set on insert
-                set_fields = {k: v for k, v in customer.items()}
-                operations.append(
-                    UpdateOne(
-                        {
-                            "shop_id": customer.get("shop_id"),
-                            "phone": customer["phone"],
-                        },
-                        {
-                            "$set": set_fields,
-                            "$setOnInsert": {
-                                "first_seen": now,
-                                "id": str(uuid.uuid4()),
-                            },
-                        },
-                        upsert=True
-                    )
-                )
-            
-            if operations:
-                result = await self.db.customers.bulk_write(operations, ordered=False)
-                logger.info(f"Upserted {result.upserted_count} new customers, modified {result.modified_count} existing")
-        
-        # After storing customers, trigger insights recalculation if transactions exist
-        classifications = {
-            "vip": 0,
-            "at_risk": 0,
-            "potential_bulk": 0,
-            "loyal_frequent": 0,
-            "boring": len(customers),  # Default all to boring until insights run
-        }
+        async def produce():
+            try:
+                async for block in _map_blocks(_process_customer_block, file_content, header, ranges,
+                                               filename, column_mapping, user_id, shop_id,
+                                               period_tag, now, links):
+                    await queue.put(block)
+            except Exception as e:
+                await queue.put(e)
+            else:
+                await queue.put(None)
 
-        if shop_id:
-            # Read classifications from customer_insights if they exist
-            seg_pipeline = [
-                {"$match": {"shop_id": shop_id}},
-                {"$group": {"_id": "$segment", "count": {"$sum": 1}}},
-            ]
-            seg_cursor = self.db.customer_insights.aggregate(seg_pipeline)
-            has_insights = False
-            async for doc in seg_cursor:
-                if not has_insights:
-                    classifications = {
-                        "vip": 0,
-                        "at_risk": 0,
-                        "potential_bulk": 0,
-                        "loyal_frequent": 0,
-                        "boring": 0,
-                    }
-                    has_insights = True
-                seg = doc["_id"] or "boring"
-                if seg in classifications:
-                    classifications[seg] = doc["count"]
-                else:
-                    classifications["boring"] += doc["count"]
+        counts = {"rows": 0, "blank_phone": 0, "uploaded": 0, "inserted": 0, "updated": 0}
+        seen_phones: Set[str] = set()
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                block = await queue.get()
+                if block is None:
+                    break
+                if isinstance(block, Exception):
+                    raise block
+                docs, stats = block
+                counts["rows"] += stats["rows"]
+                counts["blank_phone"] += stats["blank_phone"]
 
+                # Deduplicate on (shop_id, phone) across blocks before the upsert
+                fresh = []
+                for doc in docs:
+                    if doc["phone"] not in seen_phones:
+                        seen_phones.add(doc["phone"])
+                        fresh.append(doc)
+                for start in range(0, len(fresh), CUSTOMER_UPSERT_CHUNK):
+                    inserted, updated = await self._upsert_customers(fresh[start:start + CUSTOMER_UPSERT_CHUNK], now)
+                    counts["inserted"] += inserted
+                    counts["updated"] += updated
+                counts["uploaded"] += len(fresh)
+        finally:
+            producer.cancel()
+        logger.info(
+            f"Upserted {counts['inserted']} new customers, updated {counts['updated']} existing "
+            f"({counts['uploaded']} unique phones in {counts['rows']} rows)"
+        )
 
-        # Return customers without _id
-        customers_response = await self.db.customers.find(
-            {"user_id": user_id, "shop_id": shop_id},
-            {"_id": 0}
-        ).to_list(10000)
+        await ShopStatsStore(self.db).increment(shop_id, customer_count=counts["inserted"])
 
-        # Merge segment/RFM fields from customer_insights for each customer
-        if shop_id and customers_response:
-            insights_cursor = self.db.customer_insights.find({"shop_id": shop_id})
-            insights = {doc["customer_id"]: doc async for doc in insights_cursor}
-            
-            for c in customers_response:
-                cust_key = c.get("customer_id") or c.get("phone", "")
-                insight = insights.get(cust_key)
-                if insight:
-                    c["segment"] = insight.get("segment", "boring")
-                    c["rfm_score"] = insight.get("rfm_score")
-                    c["r_score"] = insight.get("r_score")
-                    c["f_score"] = insight.get("f_score")
-                    c["m_score"] = insight.get("m_score")
-                    c["b_score"] = insight.get("b_score")
-                    c["recency_days"] = insight.get("recency_days")
-                    c["frequency"] = insight.get("frequency")
-                    c["monetary"] = insight.get("monetary")
-                    c["favorite_category"] = insight.get("favorite_category")
-                    c["top_categories"] = insight.get("top_categories", [])
-                else:
-                    c["segment"] = "boring"
+        # Segments come from customer_insights; until insights run everyone is boring
+        classifications = dict.fromkeys(SEGMENT_KEYS, 0)
+        classifications["boring"] = counts["uploaded"]
+        if shop_id:
+            classifications = await self._segment_histogram(shop_id) or classifications
 
         return {
-            "total_customers": len(customers_response),
+            "total_customers": await self.db.customers.count_documents({"user_id": user_id, "shop_id": shop_id}),
+            "uploaded_customers": counts["uploaded"],
+            "new_customers": counts["inserted"],
+            "updated_customers": counts["updated"],
+            "duplicate_rows": counts["rows"] - counts["blank_phone"] - counts["uploaded"],
+            "blank_phone_rows": counts["blank_phone"],
             "classifications": classifications,
-            "customers": customers_response,
             "rfm_info": {
                 "method": "Hybrid RFM+B Intelligence",
                 "note": "RFM scores computed from transaction data via customer_insights pipeline"
             }
         }
-    
-    def _parse_customer_csv(
-        self,
-        file_content: bytes,
-        filename: str,
-        column_mapping: Optional[Dict[str, str]] = None,
-    ) -> pd.DataFrame:
-        """Parse customer CSV with the simplified schema.
-        
-        Supported columns: customer_id, name, phone, email, city
-        Required: name, phone
-        """
-        filename_lower = filename.lower()
-        
-        if filename_lower.endswith('.csv'):
-            df = pd.read_csv(io.BytesIO(file_content))
-        elif filename_lower.endswith(('.xlsx', '.xls')):
-            df = pd.read_excel(io.BytesIO(file_content))
-        else:
-            raise ValueError("Unsupported file format. Please upload CSV or Excel file.")
-        
-        # Apply user column mapping if provided
-        if column_mapping:
-            reverse = {v: k for k, v in column_mapping.items() if v and v != 'none' and v in df.columns}
-            df = df.rename(columns=reverse)
-        else:
-            # Auto-standardize column names
-            df.columns = df.columns.str.lower().str.strip().str.replace(' ', '_')
-            auto_map = {
-                'customer_name': 'name',
-                'customer': 'name',
-                'full_name': 'name',
-                'phone_number': 'phone',
-                'mobile': 'phone',
-                'mobile_no': 'phone',
-                'contact': 'phone',
-                'email_address': 'email',
-                'cust_id': 'customer_id',
-                'town': 'city',
-                'location': 'city',
-                'area': 'city',
-            }
-            df.rename(columns=auto_map, inplace=True)
-        
-        # Validate required columns (name + phone)
-        required_cols = ['name', 'phone']
-        missing_cols = [col for col in required_cols if col not in df.columns]
-        if missing_cols:
-            raise ValueError(
-                f"Missing required columns: {', '.join(missing_cols)}. "
-                f"Available columns: {', '.join(df.columns.tolist())}"
+
+    async def _upsert_customers(self, customers: List[Dict[str, Any]], now: str) -> Tuple[int, int]:
+        """Upsert one chunk on (shop_id, phone); returns (inserted, updated)."""
+        # Upsert: set first_seen only on insert, always update last_seen
+        operations = [
+            UpdateOne(
+                {"shop_id": customer["shop_id"], "phone": customer["phone"]},
+                {
+                    "$set": customer,
+                    "$setOnInsert": {"first_seen": now, "id": new_id},
+                },
+                upsert=True,
             )
-        
-        # Clean phone numbers
-        if 'phone' in df.columns:
-            df['phone'] = df['phone'].astype(str).str.replace(r'[\s\-\(\)]', '', regex=True)
-        
-        # Ensure optional columns exist with empty defaults
-        for optional_col in ['email', 'customer_id', 'city']:
-            if optional_col not in df.columns:
-                df[optional_col] = ''
-        
-        return df
-    
-    async def list_customers(self, user_id: str, shop_id: Optional[str] = None) -> Dict[str, Any]:
-        """List all customers for a user (optionally scoped to a shop)."""
+            for customer, new_id in zip(customers, _uuid4_strings(len(customers)))
+        ]
+        if not operations:
+            return 0, 0
+        result = await self.db.customers.bulk_write(operations, ordered=False)
+        return result.upserted_count, result.matched_count
+
+    async def _segment_histogram(self, shop_id: str) -> Optional[Dict[str, int]]:
+        """Customers per segment in customer_insights (None when the shop has no insights)."""
+        seg_pipeline = [
+            {"$match": {"shop_id": shop_id}},
+            {"$group": {"_id": "$segment", "count": {"$sum": 1}}},
+        ]
+        classifications = None
+        async for doc in self.db.customer_insights.aggregate(seg_pipeline):
+            if classifications is None:
+                classifications = dict.fromkeys(SEGMENT_KEYS, 0)
+            seg = doc["_id"] or "boring"
+            if seg in classifications:
+                classifications[seg] = doc["count"]
+            else:
+                classifications["boring"] += doc["count"]
+        return classifications
+
+    async def list_customers(
+        self,
+        user_id: str,
+        shop_id: Optional[str] = None,
+        skip: int = 0,
+        limit: int = 1000,
+    ) -> Dict[str, Any]:
+        """List a page of customers for a user (optionally scoped to a shop), newest first."""
         query = {"user_id": user_id}
         if shop_id:
             query["shop_id"] = shop_id
         customers = await self.db.customers.find(
             query,
             {"_id": 0}
-        ).sort("uploaded_at", -1).to_list(1000)
+        ).sort("uploaded_at", -1).skip(skip).limit(limit).to_list(length=limit)
         
-        # Merge segment/RFM fields from customer_insights for each customer
+        # Merge segment/RFM fields from customer_insights — only this page's customers
         if shop_id and customers:
-            insights_cursor = self.db.customer_insights.find({"shop_id": shop_id})
+            keys = [c.get("customer_id") or c.get("phone", "") for c in customers]
+            insights_cursor = self.db.customer_insights.find(
+                {"shop_id": shop_id, "customer_id": {"$in": keys}}, INSIGHT_LIST_PROJECTION
+            )
             insights = {doc["customer_id"]: doc async for doc in insights_cursor}
-            
-            for c in customers:
-                cust_key = c.get("customer_id") or c.get("phone", "")
-                insight = insights.get(cust_key)
-                if insight:
-                    c["segment"] = insight.get("segment", "boring")
-                    c["rfm_score"] = insight.get("rfm_score")
-                    c["r_score"] = insight.get("r_score")
-                    c["f_score"] = insight.get("f_score")
-                    c["m_score"] = insight.get("m_score")
-                    c["b_score"] = insight.get("b_score")
-                    c["recency_days"] = insight.get("recency_days")
-                    c["frequency"] = insight.get("frequency")
-                    c["monetary"] = insight.get("monetary")
-                    c["favorite_category"] = insight.get("favorite_category")
-                    c["top_categories"] = insight.get("top_categories", [])
-                else:
-                    c["segment"] = "boring"
-        
-        return {"customers": customers, "total": len(customers)}
+            for c, key in zip(customers, keys):
+                _merge_insight(c, insights.get(key))
+
+        total = await self.db.customers.count_documents(query)
+        return {"customers": customers, "total": total, "skip": skip, "limit": limit}
     
+    async def page_customers(
+        self,
+        user_id: str,
+        shop_id: Optional[str] = None,
+        cursor: Optional[str] = None,
+        limit: int = 50,
+        segment: Optional[str] = None,
+        min_score: Optional[float] = None,
+        max_score: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """
+        One keyset-paginated page of customers with their insight fields.
+
+        Without filters, customers are walked newest first on
+        (uploaded_at, _id) and the page joins customer_insights with a
+        $lookup — one indexed point lookup per customer, projected to the
+        listed fields.  With a segment or rfm_score filter the walk runs over
+        customer_insights instead (highest rfm_score first, on the
+        (shop_id, segment, rfm_score, _id) index) and joins the customer
+        identity; insights without a customer record are skipped, so such a
+        page can come back short.  Either way a page reads at most limit + 1
+        documents, however large the shop.
+
+        Args:
+            cursor: next_cursor of the previous page (None for the first page)
+
+        Returns:
+            {"customers": [...], "next_cursor": str or None, "has_more": bool}
+
+        Raises:
+            ValueError: on a malformed cursor, or a filter without shop_id.
+        """
+        if segment is not None or min_score is not None or max_score is not None:
+            if not shop_id:
+                raise ValueError("shop_id is required to filter customers by segment or score")
+            return await self._page_by_insights(user_id, shop_id, cursor, limit, segment, min_score, max_score)
+
+        match: Dict[str, Any] = {"user_id": user_id}
+        if shop_id:
+            match["shop_id"] = shop_id
+        after = _decode_cursor(cursor, "uploaded_at")
+        if after:
+            match["$or"] = _keyset_after("uploaded_at", *after)
+        pipeline = [
+            {"$match": match},
+            {"$sort": {"uploaded_at": -1, "_id": -1}},
+            {"$limit": limit + 1},
+            {"$lookup": {
+                "from": "customer_insights",
+                "let": {"shop_id": "$shop_id", "customer_id": _INSIGHT_KEY_EXPR},
+                "pipeline": [
+                    {"$match": {"$expr": {"$and": [
+                        {"$eq": ["$shop_id", "$$shop_id"]},
+                        {"$eq": ["$customer_id", "$$customer_id"]},
+                    ]}}},
+                    {"$project": INSIGHT_LIST_PROJECTION},
+                    {"$limit": 1},
+                ],
+                "as": "insight",
+            }},
+        ]
+        rows = await self.db.customers.aggregate(pipeline).to_list(length=limit + 1)
+
+        customers = []
+        for row in rows[:limit]:
+            insight = row.pop("insight")
+            _merge_insight(row, insight[0] if insight else None)
+            customers.append(row)
+        has_more = len(rows) > limit
+        next_cursor = _encode_cursor("uploaded_at", rows[limit - 1]["uploaded_at"], rows[limit - 1]["_id"]) if has_more else None
+        for row in customers:
+            row.pop("_id")
+        return {"customers": customers, "next_cursor": next_cursor, "has_more": has_more}
+
+    async def _page_by_insights(
+        self,
+        user_id: str,
+        shop_id: str,
+        cursor: Optional[str],
+        limit: int,
+        segment: Optional[str],
+        min_score: Optional[float],
+        max_score: Optional[float],
+    ) -> Dict[str, Any]:
+        """Filtered page: walk customer_insights by (rfm_score, _id), join the customers."""
+        # A lower bound is always set so unscored insights never enter the keyset
+        score_range: Dict[str, float] = {"$gte": min_score if min_score is not None else 0}
+        if max_score is not None:
+            score_range["$lte"] = max_score
+        match: Dict[str, Any] = {"shop_id": shop_id, "rfm_score": score_range}
+        if segment is not None:
+            match["segment"] = segment
+        after = _decode_cursor(cursor, "rfm_score")
+        if after:
+            match["$or"] = _keyset_after("rfm_score", *after)
+        pipeline = [
+            {"$match": match},
+            {"$sort": {"rfm_score": -1, "_id": -1}},
+            {"$limit": limit + 1},
+            {"$project": {**INSIGHT_LIST_PROJECTION, "_id": 1}},
+            {"$lookup": {
+                "from": "customers",
+                "let": {"customer_id": "$customer_id"},
+                "pipeline": [
+                    {"$match": {"$expr": {"$and": [
+                        {"$eq": ["$shop_id", shop_id]},
+                        {"$eq": ["$customer_id", "$$customer_id"]},
+                        {"$eq": ["$user_id", user_id]},
+                    ]}}},
+                    {"$project": {"_id": 0}},
+                    {"$limit": 1},
+                ],
+                "as": "customer",
+            }},
+        ]
+        rows = await self.db.customer_insights.aggregate(pipeline).to_list(length=limit + 1)
+
+        customers = []
+        for row in rows[:limit]:
+            found = row.pop("customer")
+            if found:
+                customer = found[0]
+                _merge_insight(customer, row)
+                customers.append(customer)
+        has_more = len(rows) > limit
+        next_cursor = _encode_cursor("rfm_score", rows[limit - 1]["rfm_score"], rows[limit - 1]["_id"]) if has_more else None
+        return {"customers": customers, "next_cursor": next_cursor, "has_more": has_more}
+
     async def clear_customers(self, user_id: str, shop_id: Optional[str] = None) -> int:
         """Delete all customers for a user (optionally scoped to a shop)."""
         query = {"user_id": user_id}
@@ -387,6 +453,9 @@ class CustomerService:
         # Also clear insights for this shop
         if shop_id:
             await self.db.customer_insights.delete_many({"shop_id": shop_id})
+            await ShopStatsStore(self.db).increment(shop_id, customer_count=-result.deleted_count)
+        else:
+            await ShopStatsStore(self.db).mark_user_stale(user_id)
         return result.deleted_count
     
     async def get_customers_by_file(self, file_id: str, user_id: str) -> Dict[str, Any]:
@@ -405,18 +474,12 @@ class CustomerService:
         
         # Get classifications from customer_insights (source of truth)
         shop_ids = list({c.get("shop_id") for c in customers if c.get("shop_id")})
-        classifications = {
-            "vip": 0,
-            "at_risk": 0,
-            "potential_bulk": 0,
-            "loyal_frequent": 0,
-            "boring": 0,
-        }
+        classifications = dict.fromkeys(SEGMENT_KEYS, 0)
         
         # Fetch insights and merge into customers
         insights = {}
         for sid in shop_ids:
-            insights_cursor = self.db.customer_insights.find({"shop_id": sid})
+            insights_cursor = self.db.customer_insights.find({"shop_id": sid}, INSIGHT_LIST_PROJECTION)
             async for doc in insights_cursor:
                 insights[(sid, doc["customer_id"])] = doc
                 
@@ -435,24 +498,172 @@ class CustomerService:
         for c in customers:
             sid = c.get("shop_id")
             cust_id = c.get("customer_id") or c.get("phone", "")
-            insight = insights.get((sid, cust_id))
-            if insight:
-                c["segment"] = insight.get("segment", "boring")
-                c["rfm_score"] = insight.get("rfm_score")
-                c["r_score"] = insight.get("r_score")
-                c["f_score"] = insight.get("f_score")
-                c["m_score"] = insight.get("m_score")
-                c["b_score"] = insight.get("b_score")
-                c["recency_days"] = insight.get("recency_days")
-                c["frequency"] = insight.get("frequency")
-                c["monetary"] = insight.get("monetary")
-                c["favorite_category"] = insight.get("favorite_category")
-                c["top_categories"] = insight.get("top_categories", [])
-            else:
-                c["segment"] = "boring"
+            _merge_insight(c, insights.get((sid, cust_id)))
 
         return {
             "total_customers": len(customers),
             "classifications": classifications,
             "customers": customers
         }
+
+
+# ── Insight fields merged into customer listings ─────────────────────────────
+
+INSIGHT_LIST_FIELDS = [
+    "rfm_score", "r_score", "f_score", "m_score", "b_score",
+    "recency_days", "frequency", "monetary", "favorite_category",
+]
+INSIGHT_LIST_PROJECTION = {
+    "_id": 0, "customer_id": 1, "segment": 1, "top_categories": 1,
+    **{field: 1 for field in INSIGHT_LIST_FIELDS},
+}
+
+
+def _merge_insight(customer: Dict[str, Any], insight: Optional[Dict[str, Any]]):
+    """Copy segment / RFM fields of a customer_insights document onto a customer."""
+    if insight:
+        customer["segment"] = insight.get("segment", "boring")
+        for field in INSIGHT_LIST_FIELDS:
+            customer[field] = insight.get(field)
+        customer["top_categories"] = insight.get("top_categories", [])
+    else:
+        customer["segment"] = "boring"
+
+
+# customer_insights key of a customer: customer_id, or phone when it has none
+_INSIGHT_KEY_EXPR = {"$cond": [
+    {"$in": [{"$ifNull": ["$customer_id", ""]}, [""]]}, "$phone", "$customer_id",
+]}
+
+
+# ── Page cursors ─────────────────────────────────────────────────────────────
+
+def _encode_cursor(field: str, value: Any, oid: ObjectId) -> str:
+    """Opaque cursor for the position just after (value, _id) in a `field` walk."""
+    raw = json.dumps([field, value, str(oid)], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_cursor(cursor: Optional[str], field: str) -> Optional[Tuple[Any, ObjectId]]:
+    """(value, _id) of a cursor from _encode_cursor for the same walk; None for no cursor."""
+    if not cursor:
+        return None
+    try:
+        cursor_field, value, oid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if cursor_field != field:
+            raise ValueError(cursor_field)
+        return value, ObjectId(oid)
+    except (ValueError, TypeError, InvalidId, binascii.Error):
+        raise ValueError("Invalid cursor") from None
+
+
+def _keyset_after(field: str, value: Any, oid: ObjectId) -> List[Dict[str, Any]]:
+    """$or clauses for documents after (value, _id) in descending (field, _id) order."""
+    return [{field: {"$lt": value}}, {field: value, "_id": {"$lt": oid}}]
+
+
+# ── CPU stages (run in the job process pool; arguments must be picklable) ────
+
+def _standardize_customer_columns(df: pd.DataFrame, column_mapping: Optional[Dict[str, str]]) -> pd.DataFrame:
+    """Rename file headers to name / phone / email / city / customer_id."""
+    # Apply user column mapping if provided
+    if column_mapping:
+        reverse = {v: k for k, v in column_mapping.items() if v and v != 'none' and v in df.columns}
+        return df.rename(columns=reverse)
+
+    # Auto-standardize column names
+    df.columns = df.columns.str.lower().str.strip().str.replace(' ', '_')
+    return df.rename(columns=AUTO_COLUMN_MAP)
+
+
+def _check_customer_columns(df: pd.DataFrame):
+    """Raise ValueError unless the required columns (name + phone) are present."""
+    missing_cols = [col for col in REQUIRED_COLUMNS if col not in df.columns]
+    if missing_cols:
+        raise ValueError(
+            f"Missing required columns: {', '.join(missing_cols)}. "
+            f"Available columns: {', '.join(df.columns.tolist())}"
+        )
+
+
+def _check_customer_header(data: bytes, filename: str, column_mapping: Optional[Dict[str, str]]):
+    _check_customer_columns(_standardize_customer_columns(_read_customer_table(data, filename, nrows=0), column_mapping))
+
+
+def _read_customer_table(data: bytes, filename: str, **kwargs) -> pd.DataFrame:
+    filename_lower = filename.lower()
+    if not filename_lower.endswith(('.csv', '.xlsx', '.xls')):
+        raise ValueError("Unsupported file format. Please upload CSV or Excel file.")
+    # Everything is read as text so every block of an upload agrees on phone / id formats
+    return _read_table(data, filename, dtype=str, **kwargs)
+
+
+def _parse_customer_file(
+    file_content: bytes,
+    filename: str,
+    column_mapping: Optional[Dict[str, str]] = None,
+) -> pd.DataFrame:
+    """Parse customer CSV (or one block of it) with the simplified schema.
+    
+    Supported columns: customer_id, name, phone, email, city
+    Required: name, phone
+    Returns exactly those columns as stripped strings ('' when missing).
+    """
+    df = _standardize_customer_columns(_read_customer_table(file_content, filename), column_mapping)
+    _check_customer_columns(df)
+
+    # Ensure optional columns exist with empty defaults
+    for optional_col in ['email', 'customer_id', 'city']:
+        if optional_col not in df.columns:
+            df[optional_col] = ''
+    df = df[CUSTOMER_COLUMNS].fillna('')
+    for col in ('name', 'email', 'city'):
+        df[col] = df[col].str.strip()
+
+    # Ids / phones like the former numeric parse wrote them, then clean phone numbers
+    df['customer_id'] = _clean_ids(df['customer_id'])
+    df['phone'] = _clean_ids(df['phone']).str.replace(r'[\s\-\(\)]', '', regex=True)
+    return df
+
+
+def _process_customer_block(
+    block: bytes,
+    filename: str,
+    column_mapping: Optional[Dict[str, str]],
+    user_id: str,
+    shop_id: Optional[str],
+    period_tag: Optional[str],
+    now: str,
+    links: Dict[str, str],
+) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """
+    One block → customer documents (identity fields only), built column by
+    column, first row per phone, plus the block's row counts.
+    """
+    df = _parse_customer_file(block, filename, column_mapping)
+    rows = len(df)
+
+    # Blank phone rows cannot be safely upserted (phone is part of the unique key)
+    df = df[df['phone'] != '']
+    blank_phone = rows - len(df)
+    df = df.drop_duplicates(subset='phone', keep='first')
+
+    n = len(df)
+    columns = {
+        "user_id": repeat(user_id, n),
+        "shop_id": repeat(shop_id, n),
+        # customer_id from CSV if available, else phone as fallback
+        "customer_id": df['customer_id'].where(df['customer_id'] != '', df['phone']).tolist(),
+        "name": df['name'].tolist(),
+        "phone": df['phone'].tolist(),
+        "email": df['email'].tolist(),
+        "city": df['city'].tolist(),
+        "last_seen": repeat(now, n),
+        "uploaded_at": repeat(now, n),
+        "source_file": repeat(filename, n),
+        "period_tag": repeat(period_tag, n),
+        **{field: repeat(value, n) for field, value in links.items()},
+    }
+    keys = list(columns)
+    docs = [dict(zip(keys, row)) for row in zip(*columns.values())]
+    return docs, {"rows": rows, "blank_phone": blank_phone}
@@ -17,6 +17,7 @@ from b2sdk.v2 import B2Api, InMemoryAccountInfo
 from motor.motor_asyncio import AsyncIOMotorDatabase
 
 from config import settings
+from services.shop_stats import ShopStatsStore
 
 logger = logging.getLogger(__name__)
 
@@ -209,6 +210,9 @@ class FileUploadService:
             # Store in MongoDB
             result = await db.files.insert_one(file_metadata)
             file_metadata["_id"] = str(result.inserted_id)
+            await ShopStatsStore(db).record_upload(
+                shop_id, data_purpose, file.filename, file_metadata["uploaded_at"]
+            )
             
             logger.info(f"File uploaded successfully: {file.filename} -> {file_url}")
             
@@ -366,6 +370,8 @@ class FileUploadService:
             
             # Delete from MongoDB
             await db.files.delete_one({"_id": ObjectId(file_id)})
+            # customers are matched by source file name across the user's shops
+            await ShopStatsStore(db).mark_user_stale(user_id)
             
             logger.info(f"File deleted successfully: {file_id}")
             
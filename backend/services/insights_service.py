@@ -4,6 +4,7 @@ Customer Insights Service
 Computes and caches ALL derived customer intelligence in one place:
   - Level 1: RFM scores + segment classification
   - Level 2: Behavioral profiling (favorite_category, premium/bulk products, etc.)
+  - Product co-purchase affinity (product_affinity collection)
 
 The customer_insights collection is the SINGLE SOURCE OF TRUTH for all computed
 customer data. It can be safely deleted and regenerated from raw transactions.
@@ -12,151 +13,577 @@ Per schema spec:
   - Reads 'purchase_qty' and 'total_amount' from transactions (renamed fields)
   - Stores 'recency_days' (renamed from 'recency')
   - Stores 'updated_at' timestamp
+  - Stores 'content_hash' of the computed fields; a document is rewritten
+    only when its hash changed (unchanged ones just get last_calculated_at)
   - Does NOT write back to customers collection (customers = identity only)
 
 Usage:
     await recalculate_all_insights(db, shop_id)
+    await recalculate_insights_incremental(db, shop_id, changed_customer_ids)
+
+The pandas / numpy work (compute_insight_docs, score_customer_totals,
+compute_profile_docs) runs in the job process pool; only loading and
+persisting run on the event loop.
+
+Incremental mode:
+    After a transaction upload, Level 1 is rescored from the per-customer
+    totals in customer_aggregates (services.customer_aggregates) instead of
+    every transaction: the quintiles are recomputed over all customers
+    from those totals, and only documents whose Level 1 fields changed are
+    rewritten.  Level 2 is re-profiled for the customers whose
+    transactions or segment changed, loading only their transactions; the
+    shop-wide fallbacks and the co-purchase matrix come from server-side
+    $group totals.  Profiles of untouched customers keep their previous
+    shop-wide fallbacks / complementary products until the next full
+    recalculation.
 """
+import hashlib
+import json
 import logging
 from datetime import datetime, timezone
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Set, Tuple
 
 import numpy as np
 import pandas as pd
 from motor.motor_asyncio import AsyncIOMotorDatabase
 
-from utils.level2_profiler import build_customer_profiles
+from utils.level2_profiler import build_customer_profiles, CoPurchaseMatrix
+from utils.segmentation import assign_segments
 from schemas import CustomerCategory
+from services.customer_aggregates import CustomerAggregateStore
+from services.job_service import run_cpu
 
 logger = logging.getLogger(__name__)
 
 
+# Transaction fields the compute phase reads (everything else stays in MongoDB)
+TX_PROJECTION = {
+    "_id": 0, "customer_id": 1, "product_id": 1, "category": 1, "purchase_date": 1,
+    "purchase_qty": 1, "total_amount": 1, "quantity": 1, "amount": 1,
+}
+TX_LOAD_BATCH_SIZE = 10000
+# customer_id values per $in query when loading a subset of customers
+TX_CUSTOMER_CHUNK = 5000
+
+PRODUCT_PROJECTION = {
+    "_id": 0, "product_id": 1, "product_name": 1, "category": 1,
+    "price_per_unit": 1, "price": 1, "unit": 1,
+    "is_premium": 1, "is_bulk": 1, "product_type": 1,
+}
+
+# Customers per update_many when refreshing last_calculated_at of unchanged documents
+INSIGHT_TOUCH_CHUNK = 5000
+
+# Fields left out of content_hash: run timestamps and the hash itself
+UNHASHED_FIELDS = {"last_calculated_at", "updated_at", "content_hash"}
+
+# Level 1 fields of a customer_insights document (diffed by incremental mode)
+LEVEL1_FIELDS = [
+    "recency_days", "frequency", "monetary", "purchase_count", "total_quantity",
+    "r_score", "f_score", "m_score", "b_score", "rfm_score",
+    "segment", "previous_segment", "segment_changed",
+]
+
+
 async def recalculate_all_insights(db: AsyncIOMotorDatabase, shop_id: str) -> int:
     """
     Master insight computation pipeline.
 
-    Steps:
-        1. Load all transactions for the shop into RAM.
-        2. Load all products for the shop.
-        3. Compute foundational metrics per customer_id (R, F, M, qty, purchase_count).
-        4. Run Level 1 RFM quintile scoring + waterfall segmentation.
-        5. Run Level 2 behavioral profiling (category affinity, premium/bulk picks).
-        6. Merge both into a single document per customer and upsert into customer_insights.
+    Phases:
+        1. Load (async I/O)    — transactions as dictionary-encoded NumPy
+                                 columns, products, previous segments.
+        2. Compute (process pool, compute_insight_docs) — foundational
+                                 metrics per customer, Level 1 RFM scoring +
+                                 waterfall segmentation, Level 2 behavioral
+                                 profiling, merged into one doc per customer.
+        3. Persist (async I/O) — upsert the customer_insights documents
+                                 whose content_hash changed, refresh
+                                 last_calculated_at of the rest, mark
+                                 absent customers dormant, replace the
+                                 shop's product_affinity documents.
+
+    Only NumPy buffers and small vocabularies cross the process boundary
+    (never a pickled list of transaction dicts), and the event loop shared
+    with the scheduler stays free while pandas runs.
 
     Returns:
-        Number of customer insight documents written.
+        Number of active customer insight documents (written or unchanged).
     """
-    # ── Step 1: Load transactions ──────────────────────────────────────────
-    tx_cursor = db.transactions.find({"shop_id": shop_id}, {"_id": 0})
-    tx_rows = [doc async for doc in tx_cursor]
-
-    if not tx_rows:
+    # ── Phase 1: Load ──────────────────────────────────────────────────────
+    tx_columns = await _load_transaction_columns(db, shop_id)
+    if tx_columns is None:
         logger.warning(f"[Insights] No transactions found for shop {shop_id}")
         # Clear stale insights if transactions were removed
         await db.customer_insights.delete_many({"shop_id": shop_id})
+        await db.product_affinity.delete_many({"shop_id": shop_id})
         return 0
 
-    tx_df = pd.DataFrame(tx_rows)
-    tx_df["purchase_date"] = pd.to_datetime(tx_df["purchase_date"], errors="coerce")
-    tx_df = tx_df.dropna(subset=["purchase_date"])
+    products_df = await _load_products_frame(db, shop_id)
 
-    # ── Support both old field names (quantity/amount) and new spec names (purchase_qty/total_amount)
-    # This ensures the pipeline works regardless of which upload version created the transactions.
-    if "purchase_qty" in tx_df.columns:
-        tx_df["quantity"] = pd.to_numeric(tx_df["purchase_qty"], errors="coerce").fillna(1).astype(int)
-    elif "quantity" in tx_df.columns:
-        tx_df["quantity"] = pd.to_numeric(tx_df["quantity"], errors="coerce").fillna(1).astype(int)
-    else:
-        tx_df["quantity"] = 1
+    # BUG #4 & #6 FIX: Fetch old insights to get previous_segment
+    old_insights_cursor = db.customer_insights.find(
+        {"shop_id": shop_id}, {"customer_id": 1, "segment": 1, "content_hash": 1}
+    )
+    old_segments: Dict[str, Any] = {}
+    stored_hashes: Dict[str, str] = {}
+    async for doc in old_insights_cursor:
+        old_segments[doc["customer_id"]] = doc.get("segment")
+        if doc.get("content_hash"):
+            stored_hashes[doc["customer_id"]] = doc["content_hash"]
+    tx_columns.update(_encode_previous_segments(tx_columns["customer_values"], old_segments))
 
-    if "total_amount" in tx_df.columns:
-        tx_df["amount"] = pd.to_numeric(tx_df["total_amount"], errors="coerce").fillna(0)
-    elif "amount" in tx_df.columns:
-        tx_df["amount"] = pd.to_numeric(tx_df["amount"], errors="coerce").fillna(0)
-    else:
-        tx_df["amount"] = 0
+    segment_rules = await _load_segment_rules(db, shop_id)
 
-    if tx_df.empty:
+    # ── Phase 2: Compute (CPU process pool) ────────────────────────────────
+    now_iso = datetime.now(timezone.utc).isoformat()
+    insight_docs, affinity_docs = await run_cpu(
+        compute_insight_docs, tx_columns, products_df, shop_id, now_iso, segment_rules
+    )
+
+    if not insight_docs:
         await db.customer_insights.delete_many({"shop_id": shop_id})
+        await db.product_affinity.delete_many({"shop_id": shop_id})
         return 0
 
-    # ── Step 2: Load products ──────────────────────────────────────────────
-    prod_cursor = db.products.find(
+    # ── Phase 3: Persist ───────────────────────────────────────────────────
+    active_ids = [doc["customer_id"] for doc in insight_docs]
+
+    # BUG #1 FIX: Use upsert instead of atomic replace to avoid silent data loss
+    written = await _write_insight_docs(db, shop_id, insight_docs, stored_hashes, now_iso)
+
+    # Mark absent customers as dormant (once — already dormant ones are left alone)
+    if active_ids:
+        await db.customer_insights.update_many(
+            {"shop_id": shop_id, "customer_id": {"$nin": active_ids},
+             "segment": {"$ne": CustomerCategory.DORMANT.value}},
+            _dormant_update(now_iso),
+        )
+
+    logger.info(
+        f"[Insights] Upserted {written} of {len(insight_docs)} active customer insights for shop {shop_id} "
+        f"({len(insight_docs) - written} unchanged). Absent customers marked as dormant."
+    )
+
+    await _replace_product_affinity(db, shop_id, affinity_docs, now_iso)
+
+    # NOTE: We do NOT write back to customers collection.
+    # Per schema spec: customers = identity only (name, phone, city, etc.)
+    # All RFM / segment data lives exclusively in customer_insights.
+    # batch_service.py already has an insights_segment_map fallback that reads
+    # directly from customer_insights for priority routing.
+
+    return len(insight_docs)
+
+
+async def recalculate_insights_incremental(
+    db: AsyncIOMotorDatabase,
+    shop_id: str,
+    changed_customers: Set[str],
+) -> Dict[str, int]:
+    """
+    Incremental insight pipeline, run after customer_aggregates was updated
+    for `changed_customers` (CustomerAggregateStore.replace_period).
+
+    Phases:
+        1. Load (async I/O)    — per-customer totals from customer_aggregates
+                                 and the stored Level 1 fields.
+        2. Score (process pool, score_customer_totals) — quintiles over all
+                                 customers, diff against the stored fields.
+        3. Profile (process pool, compute_profile_docs) — Level 2 for the
+                                 changed customers and those whose segment
+                                 moved, from their transactions only.
+        4. Persist (async I/O) — full documents for the re-profiled
+                                 customers, Level 1 $set for the other
+                                 changed ones, dormant for customers left
+                                 without transactions, product_affinity.
+
+    Returns:
+        Counts of re-profiled, rescored and newly dormant customers.
+    """
+    store = CustomerAggregateStore(db)
+
+    # ── Phase 1: Load ──────────────────────────────────────────────────────
+    totals = await store.load_totals(shop_id)
+    if totals is None:
+        logger.warning(f"[Insights] No customer aggregates for shop {shop_id}")
+        await db.customer_insights.delete_many({"shop_id": shop_id})
+        await db.product_affinity.delete_many({"shop_id": shop_id})
+        return {"profiled": 0, "rescored": 0, "dormant": 0}
+
+    stored_cursor = db.customer_insights.find(
         {"shop_id": shop_id},
-        {"_id": 0, "product_id": 1, "product_name": 1, "category": 1,
-         "price_per_unit": 1, "price": 1, "unit": 1,
-         "is_premium": 1, "is_bulk": 1, "product_type": 1},
+        {"_id": 0, "customer_id": 1, "content_hash": 1, **{f: 1 for f in LEVEL1_FIELDS}},
+    )
+    stored_df = pd.DataFrame(
+        [doc async for doc in stored_cursor], columns=["customer_id", "content_hash", *LEVEL1_FIELDS]
+    )
+    stored_hashes = dict(stored_df[["customer_id", "content_hash"]].dropna().itertuples(index=False))
+    segment_rules = await _load_segment_rules(db, shop_id)
+
+    # ── Phase 2: Score (CPU process pool) ──────────────────────────────────
+    agg_df, level1_updates, segment_moved = await run_cpu(
+        score_customer_totals, totals, stored_df, segment_rules
+    )
+
+    active_ids = set(agg_df["customer_id"])
+    to_profile = sorted((set(map(str, changed_customers)) | segment_moved) & active_ids)
+
+    # ── Phase 3: Profile (CPU process pool) ────────────────────────────────
+    now_iso = datetime.now(timezone.utc).isoformat()
+    tx_columns = await _load_transaction_columns(db, shop_id, to_profile) if to_profile else None
+    products_df = await _load_products_frame(db, shop_id)
+    shop_tx = await store.load_product_totals(shop_id)
+    baskets = await store.load_baskets(shop_id)
+
+    insight_docs, affinity_docs = await run_cpu(
+        compute_profile_docs,
+        agg_df[agg_df["customer_id"].isin(to_profile)],
+        tx_columns, shop_tx, baskets, products_df, shop_id, now_iso, agg_df["recency_date"].max(),
+    )
+
+    # ── Phase 4: Persist ───────────────────────────────────────────────────
+    from pymongo import UpdateOne
+    written = await _write_insight_docs(db, shop_id, insight_docs, stored_hashes, now_iso)
+
+    # Level 1 only: the content_hash is recomputed over the stored document
+    # with the new Level 1 fields, so it keeps describing what is stored
+    profiled = {doc["customer_id"] for doc in insight_docs}
+    rescored = {cust_id: fields for cust_id, fields in level1_updates.items() if cust_id not in profiled}
+    hashes = await _rescored_hashes(db, shop_id, rescored)
+    ops = [
+        UpdateOne(
+            {"shop_id": shop_id, "customer_id": cust_id},
+            {"$set": {**fields, "content_hash": hashes[cust_id],
+                      "last_calculated_at": now_iso, "updated_at": now_iso}},
+        )
+        for cust_id, fields in rescored.items()
+        if cust_id in hashes
+    ]
+    if ops:
+        await db.customer_insights.bulk_write(ops, ordered=False)
+
+    # Customers whose last transactions were removed by this upload
+    gone = sorted(set(stored_df["customer_id"].astype(str)) - active_ids)
+    dormant = 0
+    for start in range(0, len(gone), TX_CUSTOMER_CHUNK):
+        result = await db.customer_insights.update_many(
+            {"shop_id": shop_id, "customer_id": {"$in": gone[start:start + TX_CUSTOMER_CHUNK]},
+             "segment": {"$ne": CustomerCategory.DORMANT.value}},
+            _dormant_update(now_iso),
+        )
+        dormant += result.modified_count
+
+    await _replace_product_affinity(db, shop_id, affinity_docs, now_iso)
+
+    logger.info(
+        f"[Insights] Incremental update for shop {shop_id}: {len(insight_docs)} re-profiled "
+        f"({written} changed), {len(ops)} rescored, {dormant} marked dormant "
+        f"(of {len(active_ids)} active customers)"
     )
-    prod_rows = [doc async for doc in prod_cursor]
-    products_df = pd.DataFrame(prod_rows) if prod_rows else pd.DataFrame(
+    return {"profiled": written, "rescored": len(ops), "dormant": dormant}
+
+
+async def _rescored_hashes(
+    db: AsyncIOMotorDatabase,
+    shop_id: str,
+    level1_updates: Dict[str, Dict[str, Any]],
+) -> Dict[str, str]:
+    """
+    content_hash of each stored document with its Level 1 fields replaced
+    by `level1_updates` ({customer_id: fields}), keeping its Level 2 fields.
+    Customers without a stored document are left out.
+    """
+    hashes: Dict[str, str] = {}
+    cust_ids = sorted(level1_updates)
+    for start in range(0, len(cust_ids), TX_CUSTOMER_CHUNK):
+        async for doc in db.customer_insights.find(
+            {"shop_id": shop_id, "customer_id": {"$in": cust_ids[start:start + TX_CUSTOMER_CHUNK]}},
+            {"_id": 0},
+        ):
+            doc.update(level1_updates[doc["customer_id"]])
+            hashes[doc["customer_id"]] = _insight_hash(doc)
+    return hashes
+
+
+async def _load_products_frame(db: AsyncIOMotorDatabase, shop_id: str) -> pd.DataFrame:
+    prod_rows = [doc async for doc in db.products.find({"shop_id": shop_id}, PRODUCT_PROJECTION)]
+    return pd.DataFrame(prod_rows) if prod_rows else pd.DataFrame(
         columns=["product_id", "product_name", "category", "price_per_unit", "product_type"]
     )
 
+
+async def _load_segment_rules(db: AsyncIOMotorDatabase, shop_id: str) -> Optional[List[Dict[str, Any]]]:
+    """Shop-specific segmentation thresholds (None → DEFAULT_SEGMENT_RULES)."""
+    shop = await db.shops.find_one({"id": shop_id}, {"_id": 0, "segment_rules": 1})
+    return (shop or {}).get("segment_rules")
+
+
+def _dormant_update(now_iso: str) -> Dict[str, Any]:
+    # The content_hash is dropped so a returning customer is always rewritten
+    return {"$set": {"segment": CustomerCategory.DORMANT.value, "updated_at": now_iso},
+            "$unset": {"content_hash": ""}}
+
+
+async def _write_insight_docs(
+    db: AsyncIOMotorDatabase,
+    shop_id: str,
+    insight_docs: List[Dict[str, Any]],
+    stored_hashes: Dict[str, str],
+    now_iso: str,
+) -> int:
+    """
+    Upsert the documents whose content_hash differs from the stored one.
+
+    Unchanged documents only get last_calculated_at, in one update_many per
+    INSIGHT_TOUCH_CHUNK customers, so a re-run after a small upload leaves
+    the other fields and their indexes untouched.  Returns the number of
+    documents upserted.
+    """
+    from pymongo import UpdateOne
+    ops = []
+    unchanged: List[str] = []
+    for doc in insight_docs:
+        if stored_hashes.get(doc["customer_id"]) == doc["content_hash"]:
+            unchanged.append(doc["customer_id"])
+        else:
+            ops.append(UpdateOne(
+                {"shop_id": shop_id, "customer_id": doc["customer_id"]},
+                {"$set": doc},
+                upsert=True
+            ))
+    if ops:
+        await db.customer_insights.bulk_write(ops, ordered=False)
+
+    for start in range(0, len(unchanged), INSIGHT_TOUCH_CHUNK):
+        await db.customer_insights.update_many(
+            {"shop_id": shop_id, "customer_id": {"$in": unchanged[start:start + INSIGHT_TOUCH_CHUNK]}},
+            {"$set": {"last_calculated_at": now_iso}},
+        )
+    return len(ops)
+
+
+async def _replace_product_affinity(
+    db: AsyncIOMotorDatabase,
+    shop_id: str,
+    affinity_docs: List[Dict[str, Any]],
+    now_iso: str,
+):
+    """Upsert this run's product_affinity docs and drop products no longer co-purchased."""
+    from pymongo import ReplaceOne
+    if affinity_docs:
+        await db.product_affinity.bulk_write(
+            [
+                ReplaceOne({"shop_id": shop_id, "product_id": doc["product_id"]}, doc, upsert=True)
+                for doc in affinity_docs
+            ],
+            ordered=False,
+        )
+    await db.product_affinity.delete_many({"shop_id": shop_id, "updated_at": {"$ne": now_iso}})
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# Columnar transport between the I/O and compute phases
+# ────────────────────────────────────────────────────────────────────────────
+
+def _as_datetime64(value: Any) -> Any:
+    """BSON date → numpy datetime64 (legacy string dates parsed; NaT if invalid)."""
+    if isinstance(value, datetime):
+        return np.datetime64(value.replace(tzinfo=None), "ns")
+    if isinstance(value, str):
+        try:
+            return np.datetime64(pd.Timestamp(value).tz_localize(None), "ns")
+        except (ValueError, TypeError):
+            return np.datetime64("NaT")
+    return np.datetime64("NaT")
+
+
+def _as_float(value: Any) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _first_present(doc: Dict[str, Any], keys: tuple) -> Any:
+    for key in keys:
+        if doc.get(key) is not None:
+            return doc[key]
+    return None
+
+
+async def _load_transaction_columns(
+    db: AsyncIOMotorDatabase,
+    shop_id: str,
+    customer_ids: Optional[List[str]] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Stream the shop's transactions (or only those of `customer_ids`) into columns.
+
+    String columns are dictionary-encoded: an int32 code array plus the list
+    of distinct values (code -1 = missing).  Dates become datetime64[ns],
+    quantity / amount float64 (NaN = missing).  The spec field names
+    (purchase_qty / total_amount) win over the legacy quantity / amount.
+    Returns None when the shop has no transactions.
+    """
+    vocabularies: Dict[str, Dict[Any, int]] = {"customer": {}, "product": {}, "category": {}}
+    codes: Dict[str, List[int]] = {"customer": [], "product": [], "category": []}
+    dates: List[Any] = []
+    quantities: List[float] = []
+    amounts: List[float] = []
+
+    if customer_ids is None:
+        queries = [{"shop_id": shop_id}]
+    else:
+        queries = [
+            {"shop_id": shop_id, "customer_id": {"$in": customer_ids[start:start + TX_CUSTOMER_CHUNK]}}
+            for start in range(0, len(customer_ids), TX_CUSTOMER_CHUNK)
+        ]
+
+    for query in queries:
+        async for doc in db.transactions.find(query, TX_PROJECTION).batch_size(TX_LOAD_BATCH_SIZE):
+            for name, field in (("customer", "customer_id"), ("product", "product_id"), ("category", "category")):
+                value = doc.get(field)
+                if value is None:
+                    codes[name].append(-1)
+                else:
+                    vocab = vocabularies[name]
+                    codes[name].append(vocab.setdefault(value, len(vocab)))
+            dates.append(_as_datetime64(doc.get("purchase_date")))
+            quantities.append(_as_float(_first_present(doc, ("purchase_qty", "quantity"))))
+            amounts.append(_as_float(_first_present(doc, ("total_amount", "amount"))))
+
+    if not dates:
+        return None
+
+    columns: Dict[str, Any] = {
+        "purchase_date": np.array(dates, dtype="datetime64[ns]"),
+        "quantity": np.array(quantities, dtype=np.float64),
+        "amount": np.array(amounts, dtype=np.float64),
+    }
+    for name in ("customer", "product", "category"):
+        columns[f"{name}_codes"] = np.array(codes[name], dtype=np.int32)
+        columns[f"{name}_values"] = list(vocabularies[name])
+    return columns
+
+
+def _encode_previous_segments(customer_values: List[Any], old_segments: Dict[str, Any]) -> Dict[str, Any]:
+    """previous_segment per customer vocabulary entry, dictionary-encoded (-1 = none)."""
+    segment_vocab: Dict[Any, int] = {}
+    codes = np.full(len(customer_values), -1, dtype=np.int32)
+    for i, cust in enumerate(customer_values):
+        segment = old_segments.get(str(cust))
+        if segment is not None:
+            codes[i] = segment_vocab.setdefault(segment, len(segment_vocab))
+    return {"previous_segment_codes": codes, "previous_segment_values": list(segment_vocab)}
+
+
+def _decode(codes: np.ndarray, values: List[Any], missing: Any = None) -> np.ndarray:
+    """Inverse of the dictionary encoding: code -1 maps to `missing`."""
+    lookup = np.empty(len(values) + 1, dtype=object)
+    lookup[:len(values)] = values
+    lookup[-1] = missing
+    return lookup[codes]
+
+
+# ────────────────────────────────────────────────────────────────────────────
+# Compute phase (runs in the job process pool)
+# ────────────────────────────────────────────────────────────────────────────
+
+def _transactions_frame(tx_columns: Dict[str, Any]) -> pd.DataFrame:
+    """Decode the columnar transport into a transactions frame (undated rows dropped)."""
+    tx_df = pd.DataFrame({
+        "customer_id": _decode(tx_columns["customer_codes"], tx_columns["customer_values"]),
+        "product_id": _decode(tx_columns["product_codes"], tx_columns["product_values"]),
+        "category": _decode(tx_columns["category_codes"], tx_columns["category_values"], np.nan),
+        "purchase_date": tx_columns["purchase_date"],
+        "quantity": pd.Series(tx_columns["quantity"]).fillna(1).astype(int),
+        "amount": pd.Series(tx_columns["amount"]).fillna(0),
+    })
+    return tx_df.dropna(subset=["purchase_date"])
+
+
+def _normalise_prices(products_df: pd.DataFrame) -> pd.DataFrame:
     # Normalise price column: support both price_per_unit (new) and price (legacy)
     if "price_per_unit" in products_df.columns:
         products_df["price"] = pd.to_numeric(products_df["price_per_unit"], errors="coerce").fillna(0)
     elif "price" not in products_df.columns:
         products_df["price"] = 0
+    return products_df
 
-    # ── Step 3: Compute foundational metrics per customer ──────────────────
-    today = tx_df["purchase_date"].max()
-    if pd.isna(today):
-        today = pd.Timestamp.now()
-
-    agg_df = tx_df.groupby("customer_id").agg(
-        recency_date=("purchase_date", "max"),
-        frequency=("purchase_date", lambda x: x.dt.date.nunique()),
-        monetary=("amount", "sum"),
-        purchase_count=("purchase_date", "count"),  # total transaction rows
-        total_quantity=("quantity", "sum"),
-    ).reset_index()
 
+def _score_customers(
+    agg_df: pd.DataFrame,
+    today: pd.Timestamp,
+    old_segments: Dict[str, Any],
+    segment_rules: Optional[List[Dict[str, Any]]],
+) -> pd.DataFrame:
+    """
+    Level 1 on per-customer totals (customer_id, recency_date, frequency,
+    monetary, purchase_count, total_quantity): RFM+B quintile scores and
+    waterfall segment.  Shared by the full and the incremental pipeline.
+    """
     agg_df["recency_days"] = (today - agg_df["recency_date"]).dt.days.clip(lower=0)
     agg_df["recency_raw"] = agg_df["recency_days"]
 
     # Bulkiness = avg items per transaction row
     agg_df["bulkiness"] = (agg_df["total_quantity"] / agg_df["purchase_count"]).fillna(0)
 
-    # ── Step 4: Level 1 — RFM Quintile Scoring ────────────────────────────
+    # ── RFM Quintile Scoring ──
     agg_df = _compute_rfm_scores(agg_df)
 
-    # BUG #4 & #6 FIX: Fetch old insights to get previous_segment
-    old_insights_cursor = db.customer_insights.find({"shop_id": shop_id}, {"customer_id": 1, "segment": 1})
-    old_segments = {doc["customer_id"]: doc.get("segment") async for doc in old_insights_cursor}
+    # BUG #4 & #6 FIX: previous_segment (loaded in the I/O phase)
     agg_df["previous_segment"] = agg_df["customer_id"].astype(str).map(old_segments)
 
     # Store average bulkiness for waterfall
     store_avg_bulkiness = agg_df["bulkiness"].mean()
 
-    # Waterfall segmentation — pass store_avg_bulkiness for Potential Bulk threshold
-    agg_df["segment"] = agg_df.apply(
-        lambda row: _waterfall_segment(row, store_avg_bulkiness), axis=1
+    # Waterfall segmentation over whole score columns — store_avg_bulkiness
+    # is the Potential Bulk threshold
+    agg_df["segment"] = assign_segments(
+        agg_df, segment_rules, {"store_avg_bulkiness": store_avg_bulkiness}
     )
-
-    # ── Step 5: Level 2 — Behavioral Profiling ────────────────────────────
-    # Build segment_map so profiler can compute dynamic top_n per segment
-    segment_map = dict(zip(agg_df["customer_id"].astype(str), agg_df["segment"]))
-    behavior_docs = build_customer_profiles(
-        tx_df=tx_df,
-        products_df=products_df,
-        shop_id=shop_id,
-        today=today,
-        segment_map=segment_map,
-    )
-
-    # Index behavior by customer_id for fast merge
-    behavior_map: Dict[str, Dict] = {}
-    for bdoc in behavior_docs:
-        behavior_map[bdoc["customer_id"]] = bdoc
-
-    # ── Step 6: Merge & Persist ────────────────────────────────────────────
-    now_iso = datetime.now(timezone.utc).isoformat()
+    agg_df["segment_changed"] = [
+        bool(prev != seg) if prev else False
+        for prev, seg in zip(agg_df["previous_segment"], agg_df["segment"])
+    ]
+    return agg_df
+
+
+def _level1_fields(row: pd.Series) -> Dict[str, Any]:
+    return {
+        "recency_days": int(row["recency_days"]),    # renamed per spec (was 'recency')
+        "frequency": int(row["frequency"]),
+        "monetary": float(row["monetary"]),
+        "purchase_count": int(row["purchase_count"]),
+        "total_quantity": int(row["total_quantity"]),
+
+        # ── Level 1 Scores ──
+        "r_score": int(row["r_score"]),
+        "f_score": int(row["f_score"]),
+        "m_score": int(row["m_score"]),
+        "b_score": int(row["b_score"]),
+        "rfm_score": int(row["rfm_score"]),
+        "segment": row["segment"],
+        "previous_segment": row["previous_segment"],
+        "segment_changed": bool(row["segment_changed"]),
+    }
+
+
+def _insight_hash(doc: Dict[str, Any]) -> str:
+    """SHA-256 of the computed fields (key order and run timestamps ignored)."""
+    payload = {k: v for k, v in doc.items() if k not in UNHASHED_FIELDS}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _insight_docs(
+    agg_df: pd.DataFrame,
+    behavior_map: Dict[str, Dict[str, Any]],
+    shop_id: str,
+    now_iso: str,
+) -> List[Dict[str, Any]]:
+    """Merge Level 1 rows and Level 2 profiles into customer_insights documents."""
     insight_docs: List[Dict[str, Any]] = []
 
-    from pymongo import UpdateOne
-    ops = []
-    active_ids = []
-
     for _, row in agg_df.iterrows():
         cust_id = str(row["customer_id"])
         behavior = behavior_map.get(cust_id, {})
@@ -166,21 +593,7 @@ async def recalculate_all_insights(db: AsyncIOMotorDatabase, shop_id: str) -> in
             "customer_id": cust_id,
 
             # ── Level 1 — RFM ──
-            "recency_days": int(row["recency_days"]),    # renamed per spec (was 'recency')
-            "frequency": int(row["frequency"]),
-            "monetary": float(row["monetary"]),
-            "purchase_count": int(row["purchase_count"]),
-            "total_quantity": int(row["total_quantity"]),
-
-            # ── Level 1 Scores ──
-            "r_score": int(row["r_score"]),
-            "f_score": int(row["f_score"]),
-            "m_score": int(row["m_score"]),
-            "b_score": int(row["b_score"]),
-            "rfm_score": int(row["rfm_score"]),
-            "segment": row["segment"],
-            "previous_segment": row["previous_segment"],
-            "segment_changed": (row["previous_segment"] != row["segment"]) if row["previous_segment"] else False,
+            **_level1_fields(row),
 
             # ── Level 2 Classifications ──
             "favorite_category": behavior.get("favorite_category"),
@@ -208,39 +621,162 @@ async def recalculate_all_insights(db: AsyncIOMotorDatabase, shop_id: str) -> in
             "last_calculated_at": now_iso,
             "updated_at": now_iso,                        # NEW per spec
         }
+        doc["content_hash"] = _insight_hash(doc)
         insight_docs.append(doc)
-        active_ids.append(cust_id)
-        
-        ops.append(
-            UpdateOne(
-                {"shop_id": shop_id, "customer_id": cust_id},
-                {"$set": doc},
-                upsert=True
-            )
-        )
 
-    # BUG #1 FIX: Use upsert instead of atomic replace to avoid silent data loss
-    if ops:
-        await db.customer_insights.bulk_write(ops, ordered=False)
-        
-    # Mark absent customers as dormant
-    if active_ids:
-        await db.customer_insights.update_many(
-            {"shop_id": shop_id, "customer_id": {"$nin": active_ids}},
-            {"$set": {"segment": CustomerCategory.DORMANT.value, "updated_at": now_iso}}
-        )
+    return insight_docs
 
-    logger.info(
-        f"[Insights] Upserted {len(insight_docs)} active customer insights for shop {shop_id}. Absent customers marked as dormant."
+
+def compute_insight_docs(
+    tx_columns: Dict[str, Any],
+    products_df: pd.DataFrame,
+    shop_id: str,
+    now_iso: str,
+    segment_rules: Optional[List[Dict[str, Any]]] = None,
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Pure-CPU part of recalculate_all_insights: columns in, one merged
+    customer_insights document per active customer out, plus the shop's
+    product_affinity documents.
+    """
+    tx_df = _transactions_frame(tx_columns)
+    if tx_df.empty:
+        return [], []
+
+    # Missing previous segments stay NaN, exactly as the former dict .map() produced
+    old_segments = dict(zip(
+        (str(c) for c in tx_columns["customer_values"]),
+        _decode(tx_columns["previous_segment_codes"], tx_columns["previous_segment_values"], np.nan),
+    ))
+
+    products_df = _normalise_prices(products_df)
+
+    # ── Step 3: Compute foundational metrics per customer ──────────────────
+    today = tx_df["purchase_date"].max()
+    if pd.isna(today):
+        today = pd.Timestamp.now()
+
+    agg_df = tx_df.groupby("customer_id").agg(
+        recency_date=("purchase_date", "max"),
+        frequency=("purchase_date", lambda x: x.dt.date.nunique()),
+        monetary=("amount", "sum"),
+        purchase_count=("purchase_date", "count"),  # total transaction rows
+        total_quantity=("quantity", "sum"),
+    ).reset_index()
+
+    # ── Step 4: Level 1 — RFM Quintile Scoring + waterfall segment ────────
+    agg_df = _score_customers(agg_df, today, old_segments, segment_rules)
+
+    # ── Step 5: Level 2 — Behavioral Profiling ────────────────────────────
+    # Build segment_map so profiler can compute dynamic top_n per segment
+    segment_map = dict(zip(agg_df["customer_id"].astype(str), agg_df["segment"]))
+    # Co-purchase matrix: built once per shop, feeds complementary_product
+    # and is persisted as product_affinity
+    co_purchase = CoPurchaseMatrix.from_transactions(tx_df)
+    behavior_docs = build_customer_profiles(
+        tx_df=tx_df,
+        products_df=products_df,
+        shop_id=shop_id,
+        today=today,
+        segment_map=segment_map,
+        co_purchase=co_purchase,
     )
 
-    # NOTE: We do NOT write back to customers collection.
-    # Per schema spec: customers = identity only (name, phone, city, etc.)
-    # All RFM / segment data lives exclusively in customer_insights.
-    # batch_service.py already has an insights_segment_map fallback that reads
-    # directly from customer_insights for priority routing.
+    # Index behavior by customer_id for fast merge
+    behavior_map: Dict[str, Dict] = {}
+    for bdoc in behavior_docs:
+        behavior_map[bdoc["customer_id"]] = bdoc
 
-    return len(insight_docs)
+    # ── Step 6: Merge ──────────────────────────────────────────────────────
+    return _insight_docs(agg_df, behavior_map, shop_id, now_iso), co_purchase.to_docs(shop_id, now_iso)
+
+
+def score_customer_totals(
+    totals: Dict[str, Any],
+    stored_df: pd.DataFrame,
+    segment_rules: Optional[List[Dict[str, Any]]] = None,
+) -> Tuple[pd.DataFrame, Dict[str, Dict[str, Any]], Set[str]]:
+    """
+    Pure-CPU Level 1 of recalculate_insights_incremental.
+
+    Scores every customer from its customer_aggregates totals and diffs the
+    result against the stored documents (stored_df: customer_id plus
+    LEVEL1_FIELDS).  Quintiles are relative, so one customer's new
+    purchases can move the scores of others — the diff finds them.
+
+    Returns:
+        (scored frame, {customer_id: Level 1 fields} for customers whose
+        fields differ from the stored ones, customer_ids whose segment
+        differs from the stored one)
+    """
+    agg_df = pd.DataFrame(totals)
+    agg_df["customer_id"] = agg_df["customer_id"].astype(str)
+    today = agg_df["recency_date"].max()
+
+    stored = stored_df.assign(customer_id=stored_df["customer_id"].astype(str)).drop_duplicates(
+        "customer_id"
+    ).set_index("customer_id")
+    # previous_segment is the segment stored before this run (NaN for new customers)
+    agg_df = _score_customers(agg_df, today, stored["segment"].dropna().to_dict(), segment_rules)
+
+    current = stored.reindex(agg_df["customer_id"])
+    differs = np.zeros(len(agg_df), dtype=bool)
+    for field in LEVEL1_FIELDS:
+        new = agg_df[field].to_numpy()
+        if field == "monetary":
+            old = pd.to_numeric(current[field], errors="coerce").to_numpy(dtype=np.float64)
+            differs |= ~np.isclose(new.astype(np.float64), old, rtol=0, atol=1e-9)
+        else:
+            old = current[field].to_numpy()
+            both_missing = pd.isna(new) & pd.isna(old)
+            differs |= ~both_missing & (new != old)
+
+    level1_updates = {
+        row["customer_id"]: _level1_fields(row) for _, row in agg_df[differs].iterrows()
+    }
+    moved = agg_df["segment"].to_numpy() != current["segment"].to_numpy()
+    segment_moved = set(agg_df["customer_id"][moved])
+    return agg_df, level1_updates, segment_moved
+
+
+def compute_profile_docs(
+    agg_df: pd.DataFrame,
+    tx_columns: Optional[Dict[str, Any]],
+    shop_tx: Dict[str, List[Any]],
+    baskets: Dict[str, List[Any]],
+    products_df: pd.DataFrame,
+    shop_id: str,
+    now_iso: str,
+    today: pd.Timestamp,
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Pure-CPU Level 2 of recalculate_insights_incremental: full
+    customer_insights documents for the customers in `agg_df` (scored by
+    score_customer_totals; tx_columns holds only their transactions), plus
+    the shop's product_affinity documents.  `today` is the shop's latest
+    purchase date, as in the full pipeline.
+
+    shop_tx / baskets are the shop-wide (category, product_id) totals and
+    (day, product_id) counts, so the fallbacks and complementary products
+    match a full recalculation.
+    """
+    co_purchase = CoPurchaseMatrix.from_baskets(baskets["day"], baskets["product_id"], baskets["count"])
+
+    behavior_map: Dict[str, Dict] = {}
+    tx_df = _transactions_frame(tx_columns) if tx_columns is not None else None
+    if tx_df is not None and not tx_df.empty:
+        behavior_docs = build_customer_profiles(
+            tx_df=tx_df,
+            products_df=_normalise_prices(products_df),
+            shop_id=shop_id,
+            today=today,
+            segment_map=dict(zip(agg_df["customer_id"], agg_df["segment"])),
+            co_purchase=co_purchase,
+            shop_tx=pd.DataFrame(shop_tx),
+        )
+        behavior_map = {bdoc["customer_id"]: bdoc for bdoc in behavior_docs}
+
+    return _insight_docs(agg_df, behavior_map, shop_id, now_iso), co_purchase.to_docs(shop_id, now_iso)
 
 
 # ────────────────────────────────────────────────────────────────────────────
@@ -289,48 +825,6 @@ def _safe_qcut(series: pd.Series, labels_asc: list, q: int = 5) -> pd.Series:
             return pd.Series(3, index=series.index)
 
 
-def _waterfall_segment(row, store_avg_bulkiness: float = 0.0) -> str:
-    """
-    Enhanced Self-Balancing 5-Tier Waterfall.
-
-    Rules (evaluated top-to-bottom; first match wins):
-      1. VIP         — total >= 12 AND (m >= 4 OR f == 5)
-      2. At-Risk     — r == 1 AND total > 4
-      3. Potential Bulk — 5 <= total <= 11 AND bulkiness > store_avg_bulkiness
-      4. Loyal Frequent — total >= 5 AND f >= 3 AND f >= m
-      5. Boring      — catch-all
-    """
-    total = int(row["rfm_score"])
-    r = int(row["r_score"])
-    f = int(row["f_score"])
-    m = int(row["m_score"])
-    bulk = float(row.get("bulkiness", 0.0))
-
-    # ── Rule 1: VIP Champions (Frequency Override) ──
-    # Catches highest spenders AND highly frequent daily shoppers
-    if total >= 12 and (m >= 4 or f == 5):
-        return CustomerCategory.VIP.value
-
-    # ── Rule 2: At-Risk Churn (tightened to bottom-20% recency only) ──
-    # r == 1 means coldest 20% of the dataset — historically valuable but gone cold
-    elif r == 1 and total > 4:
-        return CustomerCategory.AT_RISK.value
-
-    # ── Rule 3: Potential Bulk Pantry Stockers ──
-    # Moderate engagement BUT buys significantly more items per basket than store average
-    elif 5 <= total <= 11 and bulk > store_avg_bulkiness:
-        return CustomerCategory.POTENTIAL_BULK.value
-
-    # ── Rule 4: Loyal Frequent Daily Habit (floor lowered to total >= 5) ──
-    # Rescues regular foot-traffic from falling into Boring bucket
-    elif total >= 5 and f >= 3 and f >= m:
-        return CustomerCategory.LOYAL_FREQUENT.value
-
-    # ── Rule 5: Boring Baseline Catch-All ──
-    else:
-        return CustomerCategory.BORING.value
-
-
 async def migrate_behavior_to_insights(db: AsyncIOMotorDatabase) -> Dict[str, Any]:
     """
     One-time migration: copies all behavioral fields from the legacy
@@ -0,0 +1,308 @@
+"""
+Job Service — Background Jobs for Long Operations
+=================================================
+Transaction ingest, insight recalculation and campaign creation can take
+minutes for large shops.  Instead of running inside the request they are
+submitted as jobs: the request returns a job id at once and the client
+polls GET /api/jobs/{job_id} for progress.
+
+Collection: jobs
+    id, kind, user_id, shop_id, params
+    status            queued → running → completed | failed | cancelled
+    progress          {processed, total, stage}
+    result / error    set when the job finishes
+    cancel_requested  set by cancel(); honoured at the next checkpoint
+    worker_id         process running the job
+    heartbeat_at      refreshed every JOB_HEARTBEAT_SECONDS while queued or running
+    created_at, started_at, finished_at, expires_at (TTL)
+
+Execution:
+    Jobs run as asyncio tasks in the submitting process, at most
+    MAX_CONCURRENT_JOBS at a time (the rest wait as 'queued').  The job
+    function receives a JobContext for progress reporting and cancellation
+    checkpoints.  Cancellation works across workers: the flag is stored on
+    the job document and picked up by the owning process's heartbeat.
+
+CPU-bound stages:
+    run_cpu(fn, *args) runs a picklable module-level function in the shared
+    ProcessPoolExecutor, so pandas / numpy work never blocks the event loop
+    that the scheduler and every other request share.
+
+Interrupted jobs:
+    A job whose heartbeat is older than JOB_STALE_SECONDS (its process died)
+    is marked failed by recover_interrupted() at startup.  Jobs waiting for
+    a slot heartbeat too, so a restarting process never fails the live
+    queue of another; and a job only ever leaves an active status once —
+    _finish does not overwrite a status that recovery already set.
+"""
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from bson.errors import InvalidDocument
+from pymongo import ReturnDocument
+
+from services.message_queue import make_worker_id
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_JOBS = int(os.environ.get("JOB_CONCURRENCY", "2"))
+CPU_WORKERS = int(os.environ.get("JOB_CPU_WORKERS", str(max(1, min(4, (os.cpu_count() or 2) - 1)))))
+JOB_HEARTBEAT_SECONDS = 15
+JOB_STALE_SECONDS = JOB_HEARTBEAT_SECONDS * 8
+JOB_RETENTION_DAYS = 7
+
+ACTIVE_STATUSES = ["queued", "running"]
+
+JOB_WORKER_ID = make_worker_id()
+
+
+class JobCancelled(Exception):
+    """Raised at a checkpoint once cancellation of the job was requested."""
+
+
+# ── Process pool for CPU-bound stages ────────────────────────────────────────
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Shared pool, created on first use. 'spawn' keeps children free of the parent's loop/threads."""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(
+            max_workers=CPU_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+        logger.info(f"[Jobs] Started CPU process pool with {CPU_WORKERS} workers")
+    return _process_pool
+
+
+async def run_cpu(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Run `fn(*args, **kwargs)` in the process pool (fn and args must be picklable)."""
+    global _process_pool
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(get_process_pool(), functools.partial(fn, *args, **kwargs))
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed) — replace the pool for later calls
+        logger.error(f"[Jobs] CPU process pool broken while running {getattr(fn, '__name__', fn)}")
+        _process_pool = None
+        raise
+
+
+def shutdown_process_pool():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+
+# ── Job execution ────────────────────────────────────────────────────────────
+
+# Strong references to running job tasks (asyncio only keeps weak ones), by job id
+_running: Dict[str, asyncio.Task] = {}
+_job_slots = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+
+
+class JobContext:
+    """Handle passed to a job function for progress reporting and cancellation checks."""
+
+    def __init__(self, db: Any, job_id: str):
+        self.db = db
+        self.job_id = job_id
+
+    async def progress(self, processed: Optional[int] = None, total: Optional[int] = None,
+                       stage: Optional[str] = None):
+        """Record progress (and heartbeat); raises JobCancelled if cancellation was requested."""
+        fields: Dict[str, Any] = {"heartbeat_at": datetime.now(timezone.utc)}
+        if processed is not None:
+            fields["progress.processed"] = processed
+        if total is not None:
+            fields["progress.total"] = total
+        if stage is not None:
+            fields["progress.stage"] = stage
+        doc = await self.db.jobs.find_one_and_update(
+            {"id": self.job_id}, {"$set": fields},
+            projection={"cancel_requested": 1}, return_document=ReturnDocument.AFTER,
+        )
+        if doc and doc.get("cancel_requested"):
+            raise JobCancelled(self.job_id)
+
+    async def checkpoint(self):
+        """Cancellation point without a progress update."""
+        await self.progress()
+
+
+JobFunc = Callable[[JobContext], Awaitable[Any]]
+
+
+class JobService:
+    """Submit, inspect and cancel background jobs."""
+
+    def __init__(self, db: Any):
+        self.db = db
+
+    @staticmethod
+    def _public(doc: Dict[str, Any]) -> Dict[str, Any]:
+        return {k: v for k, v in doc.items() if k not in ("_id", "expires_at")}
+
+    async def submit(
+        self,
+        kind: str,
+        user_id: str,
+        work: JobFunc,
+        shop_id: Optional[str] = None,
+        params: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """Create the job document and start `work(ctx)` in the background."""
+        now = datetime.now(timezone.utc)
+        job = {
+            "id": str(uuid.uuid4()),
+            "kind": kind,
+            "user_id": user_id,
+            "shop_id": shop_id,
+            "params": params or {},
+            "status": "queued",
+            "progress": {"processed": 0, "total": None, "stage": None},
+            "result": None,
+            "error": None,
+            "cancel_requested": False,
+            "worker_id": JOB_WORKER_ID,
+            "heartbeat_at": now,
+            "created_at": now,
+            "started_at": None,
+            "finished_at": None,
+        }
+        await self.db.jobs.insert_one(dict(job))
+
+        task = asyncio.create_task(self._run(job["id"], kind, work))
+        _running[job["id"]] = task
+        task.add_done_callback(lambda _t, job_id=job["id"]: _running.pop(job_id, None))
+        return job
+
+    async def _finish(self, job_id: str, status: str, **fields):
+        now = datetime.now(timezone.utc)
+        await self.db.jobs.update_one(
+            {"id": job_id, "status": {"$in": ACTIVE_STATUSES}},
+            {"$set": {"status": status, "finished_at": now, "heartbeat_at": now,
+                      "expires_at": now + timedelta(days=JOB_RETENTION_DAYS), **fields}},
+        )
+
+    async def _heartbeat(self, job_id: str, task: asyncio.Task):
+        """Refresh heartbeat_at and cancel `task` once cancel_requested is seen."""
+        while not task.done():
+            await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+            try:
+                doc = await self.db.jobs.find_one_and_update(
+                    {"id": job_id, "status": {"$in": ACTIVE_STATUSES}},
+                    {"$set": {"heartbeat_at": datetime.now(timezone.utc)}},
+                    projection={"cancel_requested": 1},
+                )
+            except Exception as e:
+                logger.warning(f"[Jobs] Heartbeat for {job_id} failed: {e}")
+                continue
+            if doc and doc.get("cancel_requested"):
+                task.cancel()
+
+    async def _run(self, job_id: str, kind: str, work: JobFunc):
+        # Heartbeat while queued: recovery must not take a waiting job for a dead one
+        queued_beat = asyncio.create_task(self._heartbeat(job_id, asyncio.current_task()))
+        try:
+            async with _job_slots:
+                queued_beat.cancel()
+                await self._execute(job_id, kind, work)
+        except asyncio.CancelledError:
+            # Cancelled while still waiting for a job slot
+            await asyncio.shield(self._finish(job_id, "cancelled"))
+        finally:
+            queued_beat.cancel()
+
+    async def _execute(self, job_id: str, kind: str, work: JobFunc):
+        started = await self.db.jobs.find_one_and_update(
+            {"id": job_id, "status": "queued", "cancel_requested": False},
+            {"$set": {"status": "running", "started_at": datetime.now(timezone.utc),
+                      "heartbeat_at": datetime.now(timezone.utc)}},
+        )
+        if started is None:
+            await self._finish(job_id, "cancelled")
+            return
+
+        logger.info(f"[Jobs] {kind} job {job_id} started")
+        work_task = asyncio.create_task(work(JobContext(self.db, job_id)))
+        heartbeat = asyncio.create_task(self._heartbeat(job_id, work_task))
+        try:
+            result = await work_task
+        except (JobCancelled, asyncio.CancelledError):
+            logger.info(f"[Jobs] {kind} job {job_id} cancelled")
+            work_task.cancel()
+            await asyncio.shield(self._finish(job_id, "cancelled"))
+        except Exception as e:
+            logger.error(f"[Jobs] {kind} job {job_id} failed: {e}", exc_info=True)
+            await self._finish(job_id, "failed", error=str(e))
+        else:
+            logger.info(f"[Jobs] {kind} job {job_id} completed")
+            try:
+                await self._finish(job_id, "completed", result=result)
+            except InvalidDocument as e:
+                logger.warning(f"[Jobs] Result of {kind} job {job_id} not storable: {e}")
+                await self._finish(job_id, "completed", error=f"result not stored: {e}")
+        finally:
+            heartbeat.cancel()
+
+    async def get(self, job_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        doc = await self.db.jobs.find_one({"id": job_id, "user_id": user_id}, {"_id": 0})
+        return self._public(doc) if doc else None
+
+    async def list_jobs(
+        self,
+        user_id: str,
+        shop_id: Optional[str] = None,
+        status: Optional[str] = None,
+        limit: int = 50,
+    ) -> List[Dict[str, Any]]:
+        query: Dict[str, Any] = {"user_id": user_id}
+        if shop_id:
+            query["shop_id"] = shop_id
+        if status:
+            query["status"] = status
+        cursor = self.db.jobs.find(query, {"_id": 0, "result": 0}).sort("created_at", -1).limit(limit)
+        return [self._public(doc) async for doc in cursor]
+
+    async def cancel(self, job_id: str, user_id: str) -> Dict[str, Any]:
+        """Request cancellation. The job stops at its next checkpoint (or heartbeat)."""
+        doc = await self.db.jobs.find_one_and_update(
+            {"id": job_id, "user_id": user_id, "status": {"$in": ACTIVE_STATUSES}},
+            {"$set": {"cancel_requested": True}},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER,
+        )
+        if doc is None:
+            existing = await self.db.jobs.find_one({"id": job_id, "user_id": user_id}, {"status": 1})
+            if not existing:
+                raise ValueError("Job not found")
+            raise ValueError(f"Job already {existing['status']}")
+
+        task = _running.get(job_id)
+        if task is not None:
+            task.cancel()
+        return self._public(doc)
+
+    async def recover_interrupted(self) -> int:
+        """Fail active jobs whose owning process stopped heartbeating."""
+        now = datetime.now(timezone.utc)
+        result = await self.db.jobs.update_many(
+            {"status": {"$in": ACTIVE_STATUSES},
+             "heartbeat_at": {"$lt": now - timedelta(seconds=JOB_STALE_SECONDS)}},
+            {"$set": {"status": "failed", "error": "interrupted (worker stopped)",
+                      "finished_at": now, "expires_at": now + timedelta(days=JOB_RETENTION_DAYS)}},
+        )
+        if result.modified_count:
+            logger.warning(f"[Jobs] Marked {result.modified_count} interrupted jobs as failed")
+        return result.modified_count
@@ -0,0 +1,244 @@
+"""
+Message Queue — Lease-Based Claim API
+=====================================
+Thin queue API over the messages collection so several worker processes
+(uvicorn workers, hosts) can drain one queue without fighting over the
+same documents.
+
+Claim-many (3 round trips for N messages, independent of N):
+    1. find     — candidate ids of due messages (priority, next_attempt_at order)
+    2. update_many — flip candidates still in a due status to 'processing',
+                     stamping lease_owner / lease_token / lease_expires_at and
+                     incrementing attempt_count.  The status predicate makes
+                     this atomic per document: a candidate already taken by
+                     another worker simply does not match.
+    3. find     — read back exactly the documents carrying this claim's token
+
+Lease fields on a claimed message:
+    lease_owner       — worker id (host:pid:nonce) holding the claim
+    lease_token       — unique per claim call; used to fence later writes
+    lease_expires_at  — UTC datetime; past this the claim is considered orphaned
+
+Orphan handling:
+    expired_leases() returns 'processing' messages whose lease has lapsed,
+    grouped by lease_owner, so the scheduler can release them per worker.
+
+Write-behind transitions:
+    TransitionBuffer collects the outcome updates of one micro-batch and
+    flushes them with a single unordered bulk_write.  Until the flush a
+    message simply stays 'processing' under its lease — if the process dies
+    first, the lease expires and orphan recovery re-queues it, preserving
+    the at-least-once guarantee.  Every buffered write is fenced on
+    lease_token, so a flush can never overwrite a newer claim.
+"""
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Any, List, Optional, Tuple
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+DUE_STATUSES = ["pending", "retry_wait"]
+
+
+def make_worker_id() -> str:
+    """Stable-per-process, unique-per-start worker id: host:pid:nonce."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+def lease_fence(item: Dict[str, Any], **extra) -> Dict[str, Any]:
+    """Filter that only matches the message while this claim's lease is still current."""
+    fence = {"id": item.get("id"), **extra}
+    if item.get("lease_token"):
+        fence["lease_token"] = item["lease_token"]
+    return fence
+
+
+class TransitionBuffer:
+    """Write-behind buffer of fenced message state transitions."""
+
+    def __init__(self):
+        # (item, fence filter, update document, new status)
+        self._entries: List[Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any], str]] = []
+        self._ids = set()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, item: Dict[str, Any], update: Dict[str, Any], new_status: str,
+            **fence_extra):
+        """Queue `update` for `item` (fenced on its lease) moving it to `new_status`."""
+        self._entries.append((item, lease_fence(item, **fence_extra), update, new_status))
+        self._ids.add(item.get("id"))
+
+    def has(self, item_id: str) -> bool:
+        return item_id in self._ids
+
+    async def flush(self, db: Any) -> List[Tuple[Dict[str, Any], str]]:
+        """
+        Write every buffered transition in one unordered bulk_write.
+
+        Returns the (item, new_status) pairs that actually applied.  When every
+        fenced write matched (the normal case) that is all of them; otherwise
+        the survivors are identified by reading back status + lease_token.
+        """
+        if not self._entries:
+            return []
+        entries, self._entries, self._ids = self._entries, [], set()
+
+        try:
+            result = await db.messages.bulk_write(
+                [UpdateOne(fence, update) for _i, fence, update, _s in entries],
+                ordered=False,
+            )
+            modified = result.modified_count
+        except BulkWriteError as bwe:
+            modified = bwe.details.get("nModified", 0)
+            logger.error(
+                f"[Queue] Transition flush partially failed "
+                f"({len(bwe.details.get('writeErrors', []))} errors)"
+            )
+
+        applied = [(item, status) for item, _f, _u, status in entries]
+        if modified == len(entries):
+            return applied
+
+        # Some fences did not match (lease lapsed and re-claimed) — find the survivors
+        current = {
+            doc["id"]: doc async for doc in db.messages.find(
+                {"id": {"$in": [item.get("id") for item, _s in applied]}},
+                {"_id": 0, "id": 1, "status": 1, "lease_token": 1},
+            )
+        }
+        survivors = []
+        for item, status in applied:
+            doc = current.get(item.get("id")) or {}
+            if doc.get("status") == status and doc.get("lease_token") == item.get("lease_token"):
+                survivors.append((item, status))
+        return survivors
+
+
+class MessageQueue:
+    """Lease-based claim / release operations on the messages collection."""
+
+    def __init__(self, db: Any):
+        self.db = db
+
+    async def claim_due(
+        self,
+        worker_id: str,
+        limit: int,
+        lease_seconds: float,
+        extra_filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Atomically claim up to `limit` due messages for `worker_id`.
+
+        Returns the claimed message documents (status='processing',
+        attempt_count already incremented), in dispatch order.
+        """
+        now = datetime.now(timezone.utc)
+        query = {
+            "status": {"$in": DUE_STATUSES},
+            "next_attempt_at": {"$lte": now},
+        }
+        if extra_filter:
+            query.update(extra_filter)
+
+        candidates = await self.db.messages.find(
+            query, {"_id": 0, "id": 1}
+        ).sort([
+            ("priority", 1),          # VIP first (priority=1)
+            ("next_attempt_at", 1),   # Oldest due first
+        ]).limit(limit).to_list(length=limit)
+        if not candidates:
+            return []
+
+        token = uuid.uuid4().hex
+        result = await self.db.messages.update_many(
+            {
+                "id": {"$in": [c["id"] for c in candidates]},
+                "status": {"$in": DUE_STATUSES},
+            },
+            {
+                "$set": {
+                    "status": "processing",
+                    "lease_owner": worker_id,
+                    "lease_token": token,
+                    "lease_expires_at": now + timedelta(seconds=lease_seconds),
+                    "processing_started_at": now.isoformat(),
+                    "updated_at": now.isoformat(),
+                },
+                "$inc": {"attempt_count": 1},
+            },
+        )
+        if result.modified_count == 0:
+            return []  # Every candidate was taken by another worker
+        if result.modified_count < len(candidates):
+            logger.debug(
+                f"[Queue] {worker_id} claimed {result.modified_count}/{len(candidates)} "
+                f"(rest taken by other workers)"
+            )
+
+        return await self.db.messages.find(
+            {"lease_token": token}, {"_id": 0}
+        ).sort([("priority", 1), ("next_attempt_at", 1)]).to_list(length=limit)
+
+    async def release(self, items: List[Dict[str, Any]]) -> int:
+        """
+        Give back claimed-but-unsent messages without spending an attempt.
+        Fenced on lease_token so a lapsed claim never clobbers a newer one.
+        """
+        released = 0
+        now_iso = datetime.now(timezone.utc).isoformat()
+        for item in items:
+            prior_attempts = max(item.get("attempt_count", 1) - 1, 0)
+            res = await self.db.messages.update_one(
+                lease_fence(item, status="processing"),
+                {
+                    "$set": {
+                        "status": "retry_wait" if prior_attempts else "pending",
+                        "attempt_count": prior_attempts,
+                        "updated_at": now_iso,
+                    },
+                    "$unset": {"lease_owner": "", "lease_token": "", "lease_expires_at": ""},
+                },
+            )
+            released += res.modified_count
+        return released
+
+    async def expired_leases(
+        self, legacy_threshold_seconds: int = 60, limit: int = 500
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        'processing' messages whose lease has lapsed, grouped by lease_owner.
+
+        Messages claimed before leases existed (no lease_expires_at) fall back
+        to the legacy updated_at check and are grouped under owner "legacy".
+        Each document carries the fields the transition flush needs for its
+        counter deltas (batch, campaign, shop and segment), as claim_due's do.
+        """
+        now = datetime.now(timezone.utc)
+        legacy_threshold = (now - timedelta(seconds=legacy_threshold_seconds)).isoformat()
+        cursor = self.db.messages.find(
+            {
+                "status": "processing",
+                "$or": [
+                    {"lease_expires_at": {"$lt": now}},
+                    {"lease_expires_at": {"$exists": False},
+                     "updated_at": {"$lt": legacy_threshold}},
+                ],
+            },
+            {"_id": 0, "id": 1, "attempt_count": 1, "lease_owner": 1, "lease_token": 1,
+             "batch_id": 1, "campaign_id": 1, "shop_id": 1, "customer_segment": 1},
+        ).limit(limit)
+
+        by_owner: Dict[str, List[Dict[str, Any]]] = {}
+        async for doc in cursor:
+            by_owner.setdefault(doc.get("lease_owner") or "legacy", []).append(doc)
+        return by_owner
@@ -161,7 +161,11 @@ class MonitoringService:
         elif mode == "all_pending":
             query["status"] = {"$in": ["failed", "failed_final", "pending", "retry_wait", "cancelled"]}
         
-        messages = await self.db.messages.find(query, {"_id": 0, "id": 1, "failure_reason": 1}).to_list(None)
+        messages = await self.db.messages.find(
+            query,
+            {"_id": 0, "id": 1, "status": 1, "failure_reason": 1, "batch_id": 1,
+             "campaign_id": 1, "shop_id": 1, "customer_segment": 1},
+        ).to_list(None)
         
         rescheduled = 0
         skipped = 0
@@ -169,16 +173,23 @@ class MonitoringService:
 
         now = datetime.now(timezone.utc)
         from services.whatsapp_sender import _next_day_9am_ist_utc
+        from services.scheduler_service import reopen_for_requeue
 
+        # Smart rescheduling logic: invalid numbers are never retried
+        eligible = []
         for msg in messages:
-            reason = msg.get("failure_reason", "")
-            
-            # Smart rescheduling logic
-            if reason == "invalid_number":
+            if msg.get("failure_reason", "") == "invalid_number":
                 skipped += 1
                 reasons_skipped["invalid_number"] = reasons_skipped.get("invalid_number", 0) + 1
-                continue
-                
+            else:
+                eligible.append(msg)
+
+        # Counters back in flight (closed batches / campaign reopened) before
+        # the worker can pick any of them up
+        await reopen_for_requeue(self.db, eligible)
+
+        for msg in eligible:
+            reason = msg.get("failure_reason", "")
             next_attempt_at = now
             if reason == "rate_limit":
                 next_attempt_at = _next_day_9am_ist_utc()
@@ -186,7 +197,7 @@ class MonitoringService:
                 next_attempt_at = now + timedelta(minutes=5)
                 
             await self.db.messages.update_one(
-                {"id": msg["id"]},
+                {"id": msg["id"], "status": msg["status"]},
                 {"$set": {
                     "status": "pending",
                     "next_attempt_at": next_attempt_at,
@@ -198,6 +209,10 @@ class MonitoringService:
             )
             rescheduled += 1
 
+        if rescheduled:
+            from services.scheduler_service import notify_scheduler
+            notify_scheduler()
+
         return {
             "rescheduled": rescheduled,
             "skipped": skipped,
@@ -8,15 +8,28 @@ Per schema spec:
 """
 import io
 import logging
+import re
 from datetime import datetime, timezone
-from typing import Dict, Any, Optional, List
+from itertools import repeat
+from typing import Dict, Any, Optional, List, Tuple
 
+import numpy as np
 import pandas as pd
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from pymongo import UpdateOne
 
+from services.job_service import run_cpu
+from services.shop_stats import ShopStatsStore
+
 logger = logging.getLogger(__name__)
 
+PRODUCT_UPSERT_CHUNK = 5000     # UpdateOne operations per bulk_write
+
+# A unit containing any of these marks a bulk product ("5kg", "family pack", …)
+BULK_UNIT_KEYWORDS = ["kg", "kgs", "pack", "bundle", "box", "carton", "dozen",
+                      "liter", "litre", "litres", "sack", "pouch", "crate"]
+BULK_UNIT_RE = re.compile("|".join(re.escape(kw) for kw in BULK_UNIT_KEYWORDS))
+
 
 class ProductService:
     """Service for product inventory operations."""
@@ -57,125 +70,37 @@ class ProductService:
             price_per_unit, unit, is_premium (bool), is_bulk (bool),
             product_type (str, for backward compat), uploaded_at
 
+        Classification runs over whole columns (groupby-transform, one
+        compiled regex, numpy.where) in the CPU process pool; the upserts
+        are sent in bulk_writes of PRODUCT_UPSERT_CHUNK.
+
         Returns:
             Dict with product_count, categories_found, category_breakdown, product_types
         """
-        # Parse file
-        filename_lower = filename.lower()
-        if filename_lower.endswith(".csv"):
-            df = pd.read_csv(io.BytesIO(file_content))
-        elif filename_lower.endswith((".xlsx", ".xls")):
-            df = pd.read_excel(io.BytesIO(file_content))
-        else:
-            raise ValueError("Unsupported file format. Use CSV or Excel.")
-
-        # Apply column mapping
-        reverse_map = {v: k for k, v in column_mapping.items() if v and v != "none"}
-        df = df.rename(columns=reverse_map)
-
-        # Validate required columns
-        required = ["product_id", "product_name", "category", "price", "unit"]
-        missing = [col for col in required if col not in df.columns]
-        if missing:
-            raise ValueError(f"Missing required columns after mapping: {', '.join(missing)}")
-
-        # Clean data
-        df["product_id"] = df["product_id"].astype(str).str.strip()
-        df["product_name"] = df["product_name"].astype(str).str.strip()
-        df["category"] = df["category"].astype(str).str.strip()
-        df["price"] = pd.to_numeric(df["price"], errors="coerce").fillna(0)
-        df["unit"] = df["unit"].astype(str).str.strip().str.lower()
-
-        # Drop rows with empty product_id
-        df = df[df["product_id"].str.len() > 0]
-
-        # ── Premium Classification (per-category std dev) ──────────────────
-        # Compute per-category mean/std for more accurate thresholds
-        cat_stats = df.groupby("category")["price"].agg(["mean", "std"]).reset_index()
-        cat_stats.columns = ["category", "cat_mean", "cat_std"]
-        df = df.merge(cat_stats, on="category", how="left")
-
-        def _premium_threshold(row):
-            std = row["cat_std"]
-            mean = row["cat_mean"]
-            if pd.isna(std) or std == 0:
-                return mean * 1.15
-            return mean + 1.0 * std
-
-        df["premium_threshold"] = df.apply(_premium_threshold, axis=1)
-
-        # ── Bulk Classification ────────────────────────────────────────────
-        bulk_keywords = ["kg", "kgs", "pack", "bundle", "box", "carton", "dozen",
-                         "liter", "litre", "litres", "sack", "pouch", "crate"]
-
-        def classify_product(row):
-            is_prem = row["price"] > row["premium_threshold"]
-            is_blk = any(kw in str(row["unit"]).lower() for kw in bulk_keywords)
-            # product_type string for level2_profiler backward compat
-            if is_prem:
-                ptype = "premium"
-            elif is_blk:
-                ptype = "bulk"
-            else:
-                ptype = "daily"
-            return is_prem, is_blk, ptype
-
-        results = df.apply(classify_product, axis=1, result_type="expand")
-        df["is_premium"] = results[0]
-        df["is_bulk"] = results[1]
-        df["product_type"] = results[2]
-
-        # Drop helper columns
-        df = df.drop(columns=["cat_mean", "cat_std", "premium_threshold"], errors="ignore")
+        uploaded_at = datetime.now(timezone.utc).isoformat()
+        products, summary = await run_cpu(
+            _prepare_products, file_content, filename, column_mapping, shop_id, user_id, uploaded_at
+        )
 
         # Products are upserted by (shop_id, product_id) — existing catalog is preserved.
         # Re-uploading a smaller file only updates/adds those rows, never deletes others.
-
-        # Prepare documents
-        products = []
-        uploaded_at = datetime.now(timezone.utc).isoformat()
-        for _, row in df.iterrows():
-            doc = {
-                "shop_id": shop_id,
-                "user_id": user_id,
-                "product_id": row["product_id"],
-                "product_name": row["product_name"],
-                "category": row["category"],
-                "price_per_unit": float(row["price"]),   # renamed per spec
-                "unit": row["unit"],
-                "is_premium": bool(row["is_premium"]),    # explicit boolean
-                "is_bulk": bool(row["is_bulk"]),          # explicit boolean
-                "product_type": row["product_type"],      # kept for level2_profiler compat
-                "uploaded_at": uploaded_at,
-            }
-            products.append(doc)
-
-        if products:
-            from pymongo import UpdateOne
-            # Upsert by (shop_id, product_id) — products accumulate
+        new_products = 0
+        for start in range(0, len(products), PRODUCT_UPSERT_CHUNK):
             ops = [
                 UpdateOne(
                     {"shop_id": doc["shop_id"], "product_id": doc["product_id"]},
                     {"$set": doc},
                     upsert=True
                 )
-                for doc in products
+                for doc in products[start:start + PRODUCT_UPSERT_CHUNK]
             ]
-            await self.db.products.bulk_write(ops, ordered=False)
+            result = await self.db.products.bulk_write(ops, ordered=False)
+            new_products += result.upserted_count
+        await ShopStatsStore(self.db).increment(shop_id, product_count=new_products)
+        if products:
             logger.info(f"Upserted {len(products)} products for shop {shop_id}")
 
-        # Calculate category breakdown
-        category_breakdown = df["category"].value_counts().to_dict()
-        product_type_breakdown = df["product_type"].value_counts().to_dict()
-        premium_threshold_global = float(df["price"].mean() + df["price"].std()) if len(df) > 1 else float(df["price"].mean())
-
-        return {
-            "product_count": len(products),
-            "categories_found": len(category_breakdown),
-            "category_breakdown": category_breakdown,
-            "product_types": product_type_breakdown,
-            "premium_threshold": round(premium_threshold_global, 2),
-        }
+        return {"product_count": len(products), **summary}
 
     async def get_products(self, shop_id: str, category: Optional[str] = None, search: Optional[str] = None) -> List[Dict[str, Any]]:
         """Fetch products for a shop, optionally filtered by category and search term."""
@@ -221,3 +146,101 @@ class ProductService:
             {"$set": allowed_updates}
         )
         return result.modified_count > 0
+
+
+# ── CPU stages (run in the job process pool; arguments must be picklable) ────
+
+def _parse_product_file(file_content: bytes, filename: str, column_mapping: Dict[str, str]) -> pd.DataFrame:
+    """Read, map and clean a product upload."""
+    # Parse file
+    filename_lower = filename.lower()
+    if filename_lower.endswith(".csv"):
+        df = pd.read_csv(io.BytesIO(file_content))
+    elif filename_lower.endswith((".xlsx", ".xls")):
+        df = pd.read_excel(io.BytesIO(file_content))
+    else:
+        raise ValueError("Unsupported file format. Use CSV or Excel.")
+
+    # Apply column mapping
+    reverse_map = {v: k for k, v in column_mapping.items() if v and v != "none"}
+    df = df.rename(columns=reverse_map)
+
+    # Validate required columns
+    required = ["product_id", "product_name", "category", "price", "unit"]
+    missing = [col for col in required if col not in df.columns]
+    if missing:
+        raise ValueError(f"Missing required columns after mapping: {', '.join(missing)}")
+
+    # Clean data
+    df["product_id"] = df["product_id"].astype(str).str.strip()
+    df["product_name"] = df["product_name"].astype(str).str.strip()
+    df["category"] = df["category"].astype(str).str.strip()
+    df["price"] = pd.to_numeric(df["price"], errors="coerce").fillna(0)
+    df["unit"] = df["unit"].astype(str).str.strip().str.lower()
+
+    # Drop rows with empty product_id
+    return df[df["product_id"].str.len() > 0]
+
+
+def _classify_products(df: pd.DataFrame) -> pd.DataFrame:
+    """Add is_premium, is_bulk and product_type, over whole columns."""
+    # ── Premium Classification (per-category std dev) ──────────────────
+    # Per-category mean/std for more accurate thresholds; a category with a
+    # single product or uniform prices (std NaN / 0) uses mean × 1.15
+    by_category = df.groupby("category")["price"]
+    cat_mean = by_category.transform("mean")
+    cat_std = by_category.transform("std")
+    premium_threshold = np.where(cat_std.isna() | (cat_std == 0), cat_mean * 1.15, cat_mean + 1.0 * cat_std)
+    is_premium = df["price"].to_numpy() > premium_threshold
+
+    # ── Bulk Classification ────────────────────────────────────────────
+    is_bulk = df["unit"].str.contains(BULK_UNIT_RE).to_numpy(dtype=bool)
+
+    # product_type string for level2_profiler backward compat
+    return df.assign(
+        is_premium=is_premium,
+        is_bulk=is_bulk,
+        product_type=np.where(is_premium, "premium", np.where(is_bulk, "bulk", "daily")),
+    )
+
+
+def _prepare_products(
+    file_content: bytes,
+    filename: str,
+    column_mapping: Dict[str, str],
+    shop_id: str,
+    user_id: str,
+    uploaded_at: str,
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """Product documents for the upsert plus the response summary."""
+    df = _classify_products(_parse_product_file(file_content, filename, column_mapping))
+
+    # Prepare documents, column by column
+    n = len(df)
+    columns = {
+        "shop_id": repeat(shop_id, n),
+        "user_id": repeat(user_id, n),
+        "product_id": df["product_id"].tolist(),
+        "product_name": df["product_name"].tolist(),
+        "category": df["category"].tolist(),
+        "price_per_unit": df["price"].astype(float).tolist(),   # renamed per spec
+        "unit": df["unit"].tolist(),
+        "is_premium": df["is_premium"].tolist(),                # explicit boolean
+        "is_bulk": df["is_bulk"].tolist(),                      # explicit boolean
+        "product_type": df["product_type"].tolist(),            # kept for level2_profiler compat
+        "uploaded_at": repeat(uploaded_at, n),
+    }
+    keys = list(columns)
+    products = [dict(zip(keys, row)) for row in zip(*columns.values())]
+
+    # Calculate category breakdown
+    category_breakdown = df["category"].value_counts().to_dict()
+    product_type_breakdown = df["product_type"].value_counts().to_dict()
+    premium_threshold_global = float(df["price"].mean() + df["price"].std()) if len(df) > 1 else float(df["price"].mean())
+
+    return products, {
+        "categories_found": len(category_breakdown),
+        "category_breakdown": category_breakdown,
+        "product_types": product_type_breakdown,
+        "premium_threshold": round(premium_threshold_global, 2),
+    }
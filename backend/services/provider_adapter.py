@@ -5,6 +5,7 @@ Implements the Adapter Design Pattern so the scheduler worker never
 directly interacts with external APIs.  It calls:
 
     result = await ProviderAdapter.send_message(phone, content, attempt_count)
+    results = await ProviderAdapter.send_many(requests)   # one call per micro-batch
 
 The adapter reads PROVIDER_MODE from .env and routes to the correct
 sub-module.  All providers return a Uniform Transaction Schema:
@@ -13,16 +14,32 @@ sub-module.  All providers return a Uniform Transaction Schema:
         "success": bool,
         "provider_sid": str | None,
         "error": str | None,          # "network", "rate_limit", "invalid_number", or None
-        "outcome": str                 # "success" | "temporary" | "permanent"
+        "outcome": str                 # "success" | "temporary" | "permanent" | "unknown"
     }
+
+"unknown" means the send may have gone out but was not confirmed in time;
+the scheduler records it as unconfirmed instead of retrying it.
+
+Send slots:
+    send_slot(shop_id) is held by the scheduler around one send, outside
+    its send timeout.  The default is a no-op; WhatsAppWebProvider returns
+    the owning account's tab slot so sends never queue inside the timeout.
+
+Batch sends:
+    send_many() takes a list of send requests
+        { "phone": str, "content": str, "attempt_count": int, "shop_id": str | None }
+    and returns one result per request, in the same order.  BaseProvider
+    fans out over send() with at most max_concurrency calls in flight;
+    DummyGateProvider and HttpApiProvider implement it natively.
 """
+import contextlib
 import hashlib
 import os
 import asyncio
 import random
 import logging
 import uuid
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 
 logger = logging.getLogger(__name__)
 
@@ -30,11 +47,76 @@ logger = logging.getLogger(__name__)
 # ─── Abstract base ────────────────────────────────────────────────────────────
 
 class BaseProvider:
-    """Base class for all messaging providers."""
+    """
+    Base class for all messaging providers.
+
+    Send-pipeline policy (read by the scheduler worker via
+    ProviderAdapter.get_send_policy()):
+        max_concurrency     — max in-flight sends against this provider
+        min_send_interval   — provider-wide gap between two dispatches (seconds)
+        pacing_jitter       — extra random gap added on top of min_send_interval
+        per_phone_interval  — min gap between two sends to the same phone
+        max_send_rate       — sends / second ceiling; the scheduler's adaptive
+                              token bucket starts here and backs off (AIMD)
+                              on rate_limit responses
+    """
 
-    async def send(self, phone: str, content: str, attempt_count: int = 1) -> Dict[str, Any]:
+    max_concurrency: int = 8
+    max_send_rate: float = 20.0
+    min_send_interval: float = 0.0
+    pacing_jitter: float = 0.0
+    per_phone_interval: float = 0.0
+
+    # True when send_many() is a native batch call rather than the fan-out default
+    native_batch: bool = False
+
+    async def send(self, phone: str, content: str, attempt_count: int = 1,
+                   shop_id: Optional[str] = None) -> Dict[str, Any]:
         raise NotImplementedError
 
+    async def send_many(self, requests: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Send several messages in one call.  Default: concurrent fan-out over
+        send(), bounded by max_concurrency.  A failing request yields a
+        temporary failure result; it never fails its neighbours.
+        """
+        semaphore = asyncio.Semaphore(max(1, int(self.max_concurrency)))
+
+        async def _one(req: Dict[str, Any]) -> Dict[str, Any]:
+            async with semaphore:
+                try:
+                    return await self.send(
+                        req["phone"], req["content"], req.get("attempt_count", 1), req.get("shop_id")
+                    )
+                except Exception as e:
+                    return _exception_result(e)
+
+        return list(await asyncio.gather(*(_one(req) for req in requests)))
+
+    def send_slot(self, shop_id: Optional[str] = None) -> Any:
+        """Async context manager held around one send (per-account in-flight cap). Default: none."""
+        return contextlib.nullcontext()
+
+    async def aclose(self):
+        """Release pooled resources (connections, clients). Default: nothing to do."""
+
+    async def over_quota_filter(self) -> Optional[Dict[str, Any]]:
+        """
+        Messages filter for sends this provider cannot accept until its daily
+        quota resets (None = no quota).  The scheduler defers matching due
+        messages to the next 9AM IST instead of claiming them.
+        """
+        return None
+
+
+def _exception_result(e: Exception) -> Dict[str, Any]:
+    return {
+        "success": False,
+        "provider_sid": None,
+        "error": f"adapter_exception: {str(e)}",
+        "outcome": "temporary",
+    }
+
 
 # ─── DummyGateProvider — Deterministic MD5 Bucket Gate ───────────────────────
 
@@ -58,6 +140,11 @@ class DummyGateProvider(BaseProvider):
         13–99 → Clean Track (175 customers) — instant success on first try
     """
 
+    # Simulated gate has no real ceiling — let the pipeline run wide open
+    max_concurrency = 64
+    max_send_rate = 500.0
+    native_batch = True
+
     @staticmethod
     def _bucket(phone: str) -> int:
         """Compute stable MD5 bucket (0–99) for a given phone string."""
@@ -67,10 +154,19 @@ class DummyGateProvider(BaseProvider):
         tail_int = int(hash_hex[-6:], 16)
         return tail_int % 100
 
-    async def send(self, phone: str, content: str, attempt_count: int = 1) -> Dict[str, Any]:
+    async def send(self, phone: str, content: str, attempt_count: int = 1,
+                   shop_id: Optional[str] = None) -> Dict[str, Any]:
         # Simulate minimal network latency (50–150ms)
         await asyncio.sleep(random.uniform(0.05, 0.15))
+        return self._gate(phone, attempt_count)
 
+    async def send_many(self, requests: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # One simulated round trip for the whole batch
+        await asyncio.sleep(random.uniform(0.05, 0.15))
+        return [self._gate(req["phone"], req.get("attempt_count", 1)) for req in requests]
+
+    def _gate(self, phone: str, attempt_count: int) -> Dict[str, Any]:
+        """Deterministic outcome for one phone / attempt."""
         bucket = self._bucket(phone)
 
         # ── Track 1: Terminal DLQ (buckets 0–1) ───────────────────────────
@@ -135,7 +231,11 @@ class TwilioProvider(BaseProvider):
     TODO: Implement with actual twilio SDK when credentials are ready.
     """
 
-    async def send(self, phone: str, content: str, attempt_count: int = 1) -> Dict[str, Any]:
+    max_concurrency = 16
+    max_send_rate = 80.0  # WhatsApp Business API default throughput tier
+
+    async def send(self, phone: str, content: str, attempt_count: int = 1,
+                   shop_id: Optional[str] = None) -> Dict[str, Any]:
         logger.info(f"[TwilioProvider] Stub — would send to {phone}")
         return {
             "success": False,
@@ -145,27 +245,160 @@ class TwilioProvider(BaseProvider):
         }
 
 
+# ─── HTTP API Provider (pooled, HTTP/2) ───────────────────────────────────────
+
+class HttpApiProvider(BaseProvider):
+    """
+    Generic WhatsApp Business API provider over HTTPS.
+
+    One shared httpx.AsyncClient keeps a connection pool (HTTP/2 when the
+    'h2' package is installed, so a whole micro-batch multiplexes over a
+    single connection).  Configuration (.env):
+        WHATSAPP_API_URL    — messages endpoint; receives POST {"to", "body"}
+        WHATSAPP_API_TOKEN  — bearer token
+        WHATSAPP_API_HTTP2  — "false" to force HTTP/1.1 (default: true)
+
+    Status mapping:
+        2xx        → success (sid from "id" / "sid" / "message_id")
+        429        → rate_limit      (temporary)
+        5xx / I/O  → network_error   (temporary)
+        other 4xx  → invalid_number for 400/404/422, else http_<code> (permanent)
+    """
+
+    max_concurrency = 32
+    max_send_rate = 80.0
+    native_batch = True
+
+    def __init__(self):
+        self.url = os.environ.get("WHATSAPP_API_URL", "")
+        self.token = os.environ.get("WHATSAPP_API_TOKEN", "")
+        self.http2 = os.environ.get("WHATSAPP_API_HTTP2", "true").lower() == "true"
+        self._client = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _get_client(self):
+        if self._client is None:
+            import httpx
+
+            http2 = self.http2
+            if http2:
+                try:
+                    import h2  # noqa: F401 — required by httpx for HTTP/2
+                except ImportError:
+                    logger.warning("[HttpApiProvider] 'h2' not installed — falling back to HTTP/1.1")
+                    http2 = False
+            self._client = httpx.AsyncClient(
+                http2=http2,
+                timeout=httpx.Timeout(30.0, connect=10.0),
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                ),
+                headers={"Authorization": f"Bearer {self.token}"} if self.token else None,
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def send(self, phone: str, content: str, attempt_count: int = 1,
+                   shop_id: Optional[str] = None) -> Dict[str, Any]:
+        if not self.url:
+            return {
+                "success": False,
+                "provider_sid": None,
+                "error": "WHATSAPP_API_URL not configured",
+                "outcome": "permanent",
+            }
+        client = self._get_client()
+        async with self._semaphore:
+            try:
+                resp = await client.post(self.url, json={"to": phone, "body": content})
+            except Exception as e:
+                logger.warning(f"[HttpApiProvider] ✗ NETWORK_ERROR phone={phone}: {e}")
+                return {"success": False, "provider_sid": None,
+                        "error": "network_error", "outcome": "temporary"}
+        return self._map_response(resp)
+
+    async def send_many(self, requests: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # All requests share the pooled client; send() bounds in-flight requests
+        results = await asyncio.gather(
+            *(self.send(req["phone"], req["content"], req.get("attempt_count", 1), req.get("shop_id"))
+              for req in requests),
+            return_exceptions=True,
+        )
+        return [_exception_result(r) if isinstance(r, Exception) else r for r in results]
+
+    @staticmethod
+    def _map_response(resp) -> Dict[str, Any]:
+        code = resp.status_code
+        if 200 <= code < 300:
+            # Any 2xx was accepted — the id is read only from a JSON object body
+            try:
+                body = resp.json()
+            except ValueError:
+                body = None
+            sid = None
+            if isinstance(body, dict):
+                sid = body.get("id") or body.get("sid") or body.get("message_id")
+            return {"success": True, "provider_sid": sid, "error": None, "outcome": "success"}
+        if code == 429:
+            return {"success": False, "provider_sid": None, "error": "rate_limit", "outcome": "temporary"}
+        if code >= 500:
+            return {"success": False, "provider_sid": None, "error": "network_error", "outcome": "temporary"}
+        error = "invalid_number" if code in (400, 404, 422) else f"http_{code}"
+        return {"success": False, "provider_sid": None, "error": error, "outcome": "permanent"}
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
 # ─── WhatsApp Web Automation Provider ─────────────────────────────────────────
 
 class WhatsAppWebProvider(BaseProvider):
     """
     Real WhatsApp Web automation provider.
-    Delegates to WhatsAppWebSender (pywhatkit + pyautogui).
+    Delegates to the WhatsAppWebSender pool (Playwright), routing by shop_id.
     PROVIDER_MODE=whatsapp_web activates this provider.
     """
 
-    async def send(self, phone: str, content: str, attempt_count: int = 1) -> Dict[str, Any]:
+    # Per tab: strictly one send at a time, human-like pacing
+    max_concurrency = 1
+    min_send_interval = 0.5
+    pacing_jitter = 1.0
+    per_phone_interval = 30.0
+    max_send_rate = 1.0
+
+    def __init__(self):
+        from services.whatsapp_sender import get_whatsapp_sender
+        # Scale the provider-wide policy with the number of tabs in the pool
+        tabs = get_whatsapp_sender().pool_size
+        self.max_concurrency = tabs
+        self.min_send_interval = WhatsAppWebProvider.min_send_interval / tabs
+        self.pacing_jitter = WhatsAppWebProvider.pacing_jitter / tabs
+        self.max_send_rate = WhatsAppWebProvider.max_send_rate * tabs
+
+    async def send(self, phone: str, content: str, attempt_count: int = 1,
+                   shop_id: Optional[str] = None) -> Dict[str, Any]:
         from services.whatsapp_sender import get_whatsapp_sender
         sender = get_whatsapp_sender()
-        result = await sender.send_message(phone, content)
+        result = await sender.send_message(phone, content, shop_id=shop_id)
         return {
             "success": result["success"],
             "provider_sid": result.get("provider_sid"),
             "error": result.get("error"),
-            "outcome": "success" if result["success"] else "temporary",
+            "outcome": result.get("outcome") or ("success" if result["success"] else "temporary"),
             "reschedule_at": result.get("reschedule_at"),
         }
 
+    def send_slot(self, shop_id: Optional[str] = None) -> Any:
+        from services.whatsapp_sender import get_whatsapp_sender
+        return get_whatsapp_sender().slot(shop_id)
+
+    async def over_quota_filter(self) -> Optional[Dict[str, Any]]:
+        from services.whatsapp_sender import get_whatsapp_sender
+        return await get_whatsapp_sender().over_quota_filter()
+
 
 # ─── Adapter Router ──────────────────────────────────────────────────────────
 
@@ -173,6 +406,7 @@ _PROVIDERS = {
     "mock": DummyGateProvider,
     "simulator": DummyGateProvider,
     "twilio": TwilioProvider,
+    "http_api": HttpApiProvider,
     "whatsapp_web": WhatsAppWebProvider,
 }
 
@@ -204,7 +438,34 @@ class ProviderAdapter:
         return _provider_instance
 
     @staticmethod
-    async def send_message(phone: str, content: str, attempt_count: int = 1) -> Dict[str, Any]:
+    def get_send_policy() -> Dict[str, Any]:
+        """
+        Concurrency / pacing policy of the active provider.
+
+        Returns:
+            { "provider": str, "max_concurrency": int, "min_send_interval": float,
+              "pacing_jitter": float, "per_phone_interval": float,
+              "max_send_rate": float, "native_batch": bool }
+        """
+        provider = ProviderAdapter._get_provider()
+        return {
+            "provider": type(provider).__name__,
+            "max_concurrency": max(1, int(provider.max_concurrency)),
+            "min_send_interval": float(provider.min_send_interval),
+            "pacing_jitter": float(provider.pacing_jitter),
+            "per_phone_interval": float(provider.per_phone_interval),
+            "max_send_rate": float(provider.max_send_rate),
+            "native_batch": bool(provider.native_batch),
+        }
+
+    @staticmethod
+    def send_slot(shop_id: Optional[str] = None) -> Any:
+        """The active provider's per-send slot (async context manager)."""
+        return ProviderAdapter._get_provider().send_slot(shop_id)
+
+    @staticmethod
+    async def send_message(phone: str, content: str, attempt_count: int = 1,
+                           shop_id: Optional[str] = None) -> Dict[str, Any]:
         """
         Send a message through the active provider.
 
@@ -213,12 +474,45 @@ class ProviderAdapter:
         """
         provider = ProviderAdapter._get_provider()
         try:
-            return await provider.send(phone, content, attempt_count)
+            return await provider.send(phone, content, attempt_count, shop_id)
         except Exception as e:
             logger.error(f"[ProviderAdapter] Unhandled exception sending to {phone}: {e}")
-            return {
-                "success": False,
-                "provider_sid": None,
-                "error": f"adapter_exception: {str(e)}",
-                "outcome": "temporary",
-            }
+            return _exception_result(e)
+
+    @staticmethod
+    async def send_many(requests: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Send a batch through the active provider in one call.
+
+        Args:
+            requests: [{ "phone": str, "content": str, "attempt_count": int, "shop_id": str }, ...]
+        Returns:
+            One uniform result per request, in request order.
+        """
+        if not requests:
+            return []
+        provider = ProviderAdapter._get_provider()
+        try:
+            results = await provider.send_many(requests)
+        except Exception as e:
+            logger.error(f"[ProviderAdapter] Unhandled exception in batch of {len(requests)}: {e}")
+            return [_exception_result(e) for _ in requests]
+        if len(results) != len(requests):
+            logger.error(
+                f"[ProviderAdapter] {type(provider).__name__}.send_many returned "
+                f"{len(results)} results for {len(requests)} requests"
+            )
+            return [_exception_result(RuntimeError("result_count_mismatch")) for _ in requests]
+        return results
+
+    @staticmethod
+    async def over_quota_filter() -> Optional[Dict[str, Any]]:
+        """Messages the active provider cannot send before its quota resets (or None)."""
+        return await ProviderAdapter._get_provider().over_quota_filter()
+
+    @staticmethod
+    async def close():
+        """Release the active provider's pooled resources (called on shutdown)."""
+        global _provider_instance
+        if _provider_instance is not None:
+            await _provider_instance.aclose()
@@ -0,0 +1,146 @@
+"""
+Send Rate Limiter — Adaptive Token Buckets
+==========================================
+Token-bucket limiter consulted by the scheduler's send pipeline before
+every dispatch.  Two levels of buckets are kept per worker process:
+
+    provider bucket  — one per active provider; caps the total send rate
+    campaign buckets — one per campaign; a throttled campaign backs off
+                       without slowing other campaigns down
+
+A send must take a token from its campaign bucket and then from the
+provider bucket.
+
+AIMD (additive increase / multiplicative decrease):
+    - every successful send raises the bucket rate by
+      max_rate × AIMD_INCREASE_FRACTION, up to max_rate
+    - a rate_limit response multiplies the rate by AIMD_DECREASE_FACTOR
+      (at most once per AIMD_DECREASE_COOLDOWN_SECONDS, so a burst of
+      responses from sends already in flight counts as one signal), down
+      to min_rate, and drains the bucket so the next send waits
+Throughput therefore settles just under the provider's real ceiling.
+Rate-limited messages themselves are rescheduled individually by the
+normal retry path; no other message documents are rewritten.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# ── AIMD parameters ───────────────────────────────────────────────────────────
+AIMD_INCREASE_FRACTION = 0.02        # +2% of max_rate per successful send
+AIMD_DECREASE_FACTOR = 0.5           # halve the rate on rate_limit
+AIMD_DECREASE_COOLDOWN_SECONDS = 1.0 # one decrease per burst of rate_limit responses
+MIN_SEND_RATE = 0.2                  # floor (sends / second)
+BUCKET_BURST_SECONDS = 1.0           # bucket capacity = rate × this (min 1 token)
+CAMPAIGN_BUCKET_IDLE_SECONDS = 600   # campaign buckets unused this long are dropped
+
+
+class AdaptiveTokenBucket:
+    """Token bucket whose refill rate adapts with AIMD."""
+
+    def __init__(self, max_rate: float, min_rate: float = MIN_SEND_RATE,
+                 initial_rate: Optional[float] = None):
+        self.max_rate = max(max_rate, min_rate)
+        self.min_rate = min_rate
+        self.rate = min(initial_rate or self.max_rate, self.max_rate)
+        self._tokens = self._capacity()
+        self._updated = time.monotonic()
+        self._last_decrease = 0.0
+        self.last_used = self._updated
+        self._lock = asyncio.Lock()
+
+    def _capacity(self) -> float:
+        return max(1.0, self.rate * BUCKET_BURST_SECONDS)
+
+    def _refill(self, now: float):
+        self._tokens = min(self._capacity(), self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Take one token, sleeping until one is available."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    self.last_used = now
+                    return
+                await asyncio.sleep((1.0 - self._tokens) / self.rate)
+
+    def on_success(self):
+        """Additive increase."""
+        self.rate = min(self.max_rate, self.rate + self.max_rate * AIMD_INCREASE_FRACTION)
+
+    def on_rate_limited(self) -> bool:
+        """Multiplicative decrease. Returns True if the rate was actually lowered."""
+        now = time.monotonic()
+        if now - self._last_decrease < AIMD_DECREASE_COOLDOWN_SECONDS:
+            return False
+        self._last_decrease = now
+        self._refill(now)
+        self.rate = max(self.min_rate, self.rate * AIMD_DECREASE_FACTOR)
+        self._tokens = min(self._tokens, 0.0)
+        return True
+
+
+class SendRateLimiter:
+    """Provider bucket plus lazily created per-campaign buckets."""
+
+    def __init__(self, provider: str, max_rate: float):
+        self.provider = provider
+        self.provider_bucket = AdaptiveTokenBucket(max_rate)
+        self._campaign_buckets: Dict[str, AdaptiveTokenBucket] = {}
+
+    def _campaign_bucket(self, campaign_id: Optional[str]) -> Optional[AdaptiveTokenBucket]:
+        if not campaign_id:
+            return None
+        bucket = self._campaign_buckets.get(campaign_id)
+        if bucket is None:
+            self._prune()
+            # A new campaign starts at the provider's currently learned rate
+            bucket = AdaptiveTokenBucket(
+                self.provider_bucket.max_rate, initial_rate=self.provider_bucket.rate
+            )
+            self._campaign_buckets[campaign_id] = bucket
+        return bucket
+
+    def _prune(self):
+        cutoff = time.monotonic() - CAMPAIGN_BUCKET_IDLE_SECONDS
+        for cid in [c for c, b in self._campaign_buckets.items() if b.last_used < cutoff]:
+            del self._campaign_buckets[cid]
+
+    async def acquire(self, campaign_id: Optional[str] = None):
+        """Wait for a token from the campaign bucket, then from the provider bucket."""
+        bucket = self._campaign_bucket(campaign_id)
+        if bucket is not None:
+            await bucket.acquire()
+        await self.provider_bucket.acquire()
+
+    def record(self, campaign_id: Optional[str], result: Dict[str, Any]):
+        """
+        Feed one provider result back into the AIMD controllers: success →
+        increase, rate_limit → decrease, any other failure → no change.
+        """
+        bucket = self._campaign_bucket(campaign_id)
+        if result.get("error") == "rate_limit":
+            lowered = self.provider_bucket.on_rate_limited()
+            if bucket is not None:
+                lowered = bucket.on_rate_limited() or lowered
+            if lowered:
+                logger.warning(
+                    f"[RateLimiter] rate_limit from {self.provider} — "
+                    f"provider rate {self.provider_bucket.rate:.2f}/s"
+                    + (f", campaign {campaign_id} {bucket.rate:.2f}/s" if bucket else "")
+                )
+        elif result.get("success"):
+            self.provider_bucket.on_success()
+            if bucket is not None:
+                bucket.on_success()
+
+    def claim_budget(self, horizon_seconds: float) -> int:
+        """How many sends the provider bucket can admit within `horizon_seconds`."""
+        return max(1, int(self.provider_bucket.rate * horizon_seconds))
@@ -1,15 +1,28 @@
 """
 Scheduler Worker — Deterministic 6-State Engine
 ================================================
-Non-blocking event-loop polling worker that processes the messages
-collection directly.  APScheduler serves only as a 7-second clock tick;
-zero job state is kept in memory — MongoDB is the single source of truth.
+Non-blocking, event-driven worker that processes the messages collection
+directly.  Zero job state is kept in memory — MongoDB is the single source
+of truth.
+
+Wakeup Channel:
+    The worker loop sleeps until the earliest next_attempt_at among queued
+    messages, or until a wakeup signal arrives — whichever comes first:
+        - in-process: notify_scheduler() sets a module-level asyncio.Event
+          (called by create_batch, resume_batch and the requeue routes)
+        - multi-process (optional, SCHEDULER_CHANGE_STREAM=true): a MongoDB
+          change-stream listener signals on new / re-queued messages and on
+          campaigns flipped back to 'sending' (requires a replica set)
+    APScheduler only drives a slow maintenance tick (orphan recovery).
 
 6-State Lifecycle:
     pending → processing → sent            (success)
                         → retry_wait       (transient failure, attempt_count < 3)
                         → failed_permanently (terminal or exhausted retries)
                         → cancelled         (user-aborted campaign)
+                        → unconfirmed       (send started but not confirmed in
+                                             time — may have gone out; left for
+                                             an operator to verify, never retried)
 
 Gate Integration (DummyGateProvider):
     Uses MD5 bucket math for deterministic, reproducible delivery simulation:
@@ -24,29 +37,134 @@ Demo-Friendly Backoff:
     Attempt 2 failure → retry in 30 seconds
     Attempt 3 failure → failed_permanently (DLQ)
 
+Lease-Based Claims (multi-worker):
+    Every worker process has a unique worker_id (host:pid:nonce) and claims
+    due messages in bulk through MessageQueue.claim_due(), which stamps
+    lease_owner / lease_token / lease_expires_at atomically.  Several
+    uvicorn workers or hosts can drain the same queue without lock
+    contention; all outcome writes are fenced on lease_token.
+
+Campaign Control State:
+    Pause / cancel / stop are honoured without a campaigns round trip per
+    message.  A module-level CampaignStateCache (TTL = CAMPAIGN_STATE_TTL_SECONDS)
+    holds each campaign's status plus the current set of paused campaign ids:
+        - the claim query excludes paused campaigns, so their messages are
+          never fetched at all
+        - claimed items are checked against cached statuses, fetched for all
+          unknown campaign ids of a micro-batch in one $in query
+    The pause / resume / cancel / stop routes call invalidate_campaign_state()
+    so control changes take effect on the very next cycle in this process;
+    other processes see them within the TTL.
+
+Write-Behind Transitions:
+    Outcome writes of a micro-batch (sent / retry_wait / failed_permanently /
+    cancelled) are collected in a TransitionBuffer and flushed with one
+    unordered bulk_write once the batch's sends finish; the counter deltas
+    of the writes that applied are then aggregated per batch / campaign and
+    flushed the same way.  Round trips per micro-batch are constant instead
+    of 3–4 per message.  Until the flush a message is still 'processing'
+    under its lease, so a crash before the flush ends in lease expiry →
+    orphan recovery → retry (at-least-once, never lost).
+
+Quota Admission:
+    Before claiming, the provider is asked for messages it cannot send
+    today (WhatsApp Web accounts over WHATSAPP_MAX_PER_DAY, tracked durably
+    in the whatsapp_quota collection).  Those due messages are deferred in
+    bulk to the next 9AM IST and are never claimed.
+
 Deadlock Prevention:
-    - asyncio.wait_for(timeout=45s) hard-kills stalled processing threads
-    - try...finally scans for orphaned 'processing' records and releases them
-    - Orphan recovery: messages stuck in 'processing' for >60s are auto-reset
+    - asyncio.wait_for(timeout=45s) hard-kills stalled sends (per pipeline slot);
+      the provider's send slot (ProviderAdapter.send_slot — one per WhatsApp
+      tab of the owning account) is taken before the timeout starts, so
+      the 45s cover the send itself, not a wait behind other sends
+    - a send that times out or raises without buffering an outcome is
+      buffered as failed_permanently (worker_crash_or_timeout), so a claimed
+      item never stays 'processing'; a send_many() batch that times out or
+      raises is buffered as unconfirmed instead, since the provider may
+      already have accepted part of it
+    - Orphan recovery: 'processing' messages whose lease has expired are
+      released per lease_owner (checked on the MAINTENANCE_INTERVAL_SECONDS tick)
+
+Concurrent Send Pipeline:
+    Each poll cycle drains due messages in micro-batches and dispatches them
+    through a bounded asyncio worker pool:
+        - global semaphore   → MAX_CONCURRENT_SENDS in-flight sends per process
+        - provider semaphore → provider.max_concurrency (mock=64, twilio=16,
+                               whatsapp_web=one per tab in the sender pool)
+        - SendPacer          → per-provider gap (min_send_interval + jitter) and
+                               per-phone gap, replacing the old global sleep
+        - send_many()        → unpaced providers (mock, twilio, http_api) get
+                               the whole micro-batch in one provider call;
+                               paced ones (whatsapp_web) go item by item
+        - SendRateLimiter    → adaptive (AIMD) token buckets per provider and
+                               per campaign; rate_limit responses lower the
+                               rate instead of bulk-rescheduling the campaign
+                               (see services/rate_limiter.py)
+    Mock / API providers therefore run at hundreds of sends per second while
+    WhatsApp Web stays throttled to one human-paced send at a time.
+
+Incremental Counters:
+    Batch and campaign counters are maintained with $inc-style deltas on
+    each terminal transition instead of re-aggregating the whole campaign
+    after every message:
+        processing → sent                batch: success_count+1, pending_count-1
+                                         campaign: messages_sent+1, segment sent+1
+        processing → failed_permanently  batch: failed_count+1, pending_count-1
+                                         campaign: messages_failed+1, segment failed+1
+        processing → retry_wait          no delta (message stays in pending_count)
+        processing → cancelled           batch: pending_count-1
+        processing → unconfirmed         batch: pending_count-1
+    The same transitions move the shop summary (shop_stats live_stats):
+    sent / failed +1 and pending -1, and active_batches -1 when a batch
+    closes.  A batch whose pending_count reaches 0 is closed and bumps the campaign's
+    completed_batches.  Messages moved back to 'pending' from outside the
+    worker (requeue / reschedule / resend routes) go through
+    reopen_for_requeue() first, which applies the inverse deltas and
+    reopens closed batches and campaigns.  Deltas are applied only when the fenced state write
+    actually matched, so a lapsed lease never double-counts.  Deltas of one
+    micro-batch are summed and written with one bulk_write per collection.  A periodic
+    reconciliation job (RECONCILE_INTERVAL_SECONDS) re-aggregates active
+    campaigns, campaigns that still have pending / processing / retry_wait
+    messages and campaigns flagged reconcile_requested from the messages
+    collection to repair any drift (e.g. from cancel routes that move
+    messages outside the worker).
 
 Timing Parameters:
-    POLL_INTERVAL_SECONDS   = 7       (heartbeat frequency)
-    MICRO_BATCH_SIZE        = 8       (messages per poll cycle)
-    INTER_MSG_JITTER_MIN    = 0.5     (seconds between messages — fast for demo)
-    INTER_MSG_JITTER_MAX    = 1.5     (seconds between messages — fast for demo)
+    POLL_INTERVAL_SECONDS   = 7       (re-check interval while due items are parked)
+    IDLE_SLEEP_MAX_SECONDS  = 300     (longest sleep with no signal and nothing scheduled)
+    MAINTENANCE_INTERVAL_SECONDS = 30 (orphan-recovery tick)
+    RECONCILE_INTERVAL_SECONDS = 300  (counter drift-repair job)
+    SHOP_STATS_RECONCILE_SECONDS = 300 (shop summary drift-repair job, services.shop_stats)
+    MICRO_BATCH_SIZE        = 256     (max messages claimed per drain round)
+    CLAIM_PER_SLOT          = 4       (claim size = provider concurrency × this, ≤ batch)
+    LEASE_BASE_SECONDS      = 60      (lease = base + send waves × per-send budget)
+    MAX_DRAIN_ROUNDS        = 20      (max micro-batches drained per cycle)
+    MAX_CONCURRENT_SENDS    = 64      (process-wide in-flight send cap)
     MAX_RETRY_COUNT         = 3       (max attempts before failed_permanently)
     RETRY_BACKOFF = [15, 30]          (seconds: attempt 1, attempt 2)
 """
 import logging
 import asyncio
+import math
+import os
 import random
+import time
 from datetime import datetime, timezone, timedelta
-from typing import Dict, Any, List
+from typing import Dict, Any, Iterable, List, Optional, Tuple
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
 
 from services.provider_adapter import ProviderAdapter
+from services.message_queue import MessageQueue, TransitionBuffer, make_worker_id
+from services.rate_limiter import SendRateLimiter
+from services.shop_stats import (
+    ShopStatsStore,
+    SHOP_STATS_RECONCILE_SECONDS,
+    FAILED_STATUSES as SHOP_FAILED_STATUSES,
+)
 from services.whatsapp_sender import _now_ist, _next_day_9am_ist_utc
 
 logger = logging.getLogger(__name__)
@@ -57,9 +175,16 @@ WORKING_HOURS_END   = 19  # 7 PM IST
 
 # ── Configurable Boundary Matrix ──────────────────────────────────────────────
 POLL_INTERVAL_SECONDS = 7
-MICRO_BATCH_SIZE = 8
-INTER_MSG_JITTER_MIN = 0.5    # fast for demo
-INTER_MSG_JITTER_MAX = 1.5    # fast for demo
+IDLE_SLEEP_MAX_SECONDS = 300
+MAINTENANCE_INTERVAL_SECONDS = 30
+RECONCILE_INTERVAL_SECONDS = 300
+MICRO_BATCH_SIZE = 256
+CLAIM_PER_SLOT = 4
+LEASE_BASE_SECONDS = 60
+MAX_DRAIN_ROUNDS = 20
+MAX_CONCURRENT_SENDS = 64
+SEND_TIMEOUT_SECONDS = 45.0
+CAMPAIGN_STATE_TTL_SECONDS = 5
 MAX_RETRY_COUNT = 3
 
 # Demo-friendly backoff schedule (seconds per attempt number)
@@ -68,65 +193,454 @@ RETRY_BACKOFF_BY_ATTEMPT = {
     2: 30,   # Second failure → wait 30s
 }
 
-# Orphan threshold: if a message stays 'processing' longer than this, recover it
+# Orphan threshold for legacy 'processing' records claimed before leases existed
 ORPHAN_THRESHOLD_SECONDS = 60
 
+# Change-stream listener: reconnect backoff after a transient error
+WATCH_RETRY_BASE_SECONDS = 1
+WATCH_RETRY_MAX_SECONDS = 60
+
+
+# ── Wakeup channel ────────────────────────────────────────────────────────────
+_wakeup_event: Optional[asyncio.Event] = None
+
+
+def _get_wakeup_event() -> asyncio.Event:
+    global _wakeup_event
+    if _wakeup_event is None:
+        _wakeup_event = asyncio.Event()
+    return _wakeup_event
+
+
+def notify_scheduler():
+    """
+    Wake the scheduler worker immediately (in-process signal).
+
+    Call after anything that makes messages due sooner than the worker
+    expects: new campaign, resumed batch/campaign, re-queued items.
+    Safe to call when no worker is running — the signal is simply kept.
+    """
+    _get_wakeup_event().set()
+
+
+# ── Campaign control-state cache ──────────────────────────────────────────────
+
+class CampaignStateCache:
+    """
+    TTL cache of campaign control state (status), keyed by campaign_id,
+    plus the list of currently paused campaign ids for the claim query.
+    """
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._statuses: Dict[str, Tuple[str, float]] = {}
+        self._paused: Optional[Tuple[List[str], float]] = None
+
+    def invalidate(self, campaign_id: Optional[str] = None):
+        """Drop one campaign (or everything) so the next lookup hits MongoDB."""
+        if campaign_id is None:
+            self._statuses.clear()
+        else:
+            self._statuses.pop(campaign_id, None)
+        self._paused = None
+
+    async def paused_ids(self, db: Any) -> List[str]:
+        """Ids of campaigns currently paused (refreshed at most once per TTL)."""
+        now = time.monotonic()
+        if self._paused is None or now - self._paused[1] > self.ttl_seconds:
+            ids = [c["_id"] async for c in db.campaigns.find({"status": "paused"}, {"_id": 1})]
+            self._paused = (ids, now)
+        return self._paused[0]
+
+    async def statuses(self, db: Any, campaign_ids: Iterable[str]) -> Dict[str, str]:
+        """Status per campaign id; unknown / expired ids are fetched in one $in query."""
+        now = time.monotonic()
+        result: Dict[str, str] = {}
+        missing = []
+        for cid in set(campaign_ids):
+            entry = self._statuses.get(cid)
+            if entry and now - entry[1] <= self.ttl_seconds:
+                result[cid] = entry[0]
+            else:
+                missing.append(cid)
+        if missing:
+            async for camp in db.campaigns.find({"_id": {"$in": missing}}, {"_id": 1, "status": 1}):
+                status = camp.get("status", "")
+                self._statuses[camp["_id"]] = (status, now)
+                result[camp["_id"]] = status
+        return result
+
+
+_campaign_state_cache = CampaignStateCache(CAMPAIGN_STATE_TTL_SECONDS)
+
+
+def invalidate_campaign_state(campaign_id: Optional[str] = None):
+    """Call after changing a campaign's status (pause / resume / cancel / stop)."""
+    _campaign_state_cache.invalidate(campaign_id)
+
+
+def _batch_unconfirmed(error: str) -> Dict[str, Any]:
+    """Provider result for a send_many() item whose outcome was lost with the call."""
+    return {"success": False, "provider_sid": None, "error": error, "outcome": "unknown"}
+
+
+# ── Requeue: put counters back in flight ──────────────────────────────────────
+TERMINAL_BATCH_STATUSES = ["completed", "failed", "cancelled"]
+IN_FLIGHT_MESSAGE_STATUSES = ["pending", "processing", "retry_wait"]
+# Statuses already inside a batch's pending_count (paused messages stay counted)
+_COUNTED_PENDING = {"pending", "processing", "retry_wait", "paused"}
+# Statuses inside a batch's failed_count / a campaign's messages_failed
+_COUNTED_FAILED = {"failed_permanently", "failed_final"}
+
+
+async def reopen_for_requeue(db: Any, messages: List[Dict[str, Any]]):
+    """
+    Call BEFORE moving `messages` back to 'pending' from outside the worker.
+
+    Applies the inverse of the terminal deltas — batch pending_count +1 and
+    failed_count -1, campaign messages_failed / segment failed -1, shop
+    pending +1 / failed -1 — and reopens batches (and their campaigns) that
+    were already closed, so the worker's deltas on the resend land on
+    consistent counters.  Every touched campaign is flagged
+    reconcile_requested, so a message whose status changed meanwhile is
+    settled by the next _reconcile_counters run.
+
+    Each message needs id, status, batch_id, campaign_id, shop_id and
+    customer_segment.
+    """
+    batch_deltas: Dict[str, Dict[str, int]] = {}
+    batch_owner: Dict[str, Tuple[Optional[str], Optional[str]]] = {}  # batch → (campaign, shop)
+    campaign_deltas: Dict[str, Dict[str, List[int]]] = {}
+    campaign_ids = set()
+    shop_deltas: Dict[str, Dict[str, int]] = {}
+
+    for msg in messages:
+        status = msg.get("status")
+        if status in _COUNTED_PENDING:
+            continue
+        failed = 1 if status in _COUNTED_FAILED else 0
+
+        batch_id = msg.get("batch_id")
+        if batch_id:
+            d = batch_deltas.setdefault(batch_id, {"failed_count": 0, "pending_count": 0})
+            d["failed_count"] -= failed
+            d["pending_count"] += 1
+            batch_owner[batch_id] = (msg.get("campaign_id"), msg.get("shop_id"))
+
+        campaign_id = msg.get("campaign_id")
+        if campaign_id:
+            campaign_ids.add(campaign_id)
+            if failed:
+                seg = msg.get("customer_segment") or "boring"
+                campaign_deltas.setdefault(campaign_id, {}).setdefault(seg, [0, 0])[1] -= 1
+
+        shop_id = msg.get("shop_id")
+        if shop_id:
+            d = shop_deltas.setdefault(shop_id, {"failed": 0, "pending": 0})
+            d["failed"] -= 1 if status in SHOP_FAILED_STATUSES else 0
+            d["pending"] += 1
+
+    # ── Batches: counters first, then reopen the closed ones ──
+    reopened: Dict[str, int] = {}
+    if batch_deltas:
+        await db.batches.bulk_write(
+            [UpdateOne({"id": bid}, {"$inc": d}) for bid, d in batch_deltas.items()],
+            ordered=False,
+        )
+        for batch_id, (campaign_id, shop_id) in batch_owner.items():
+            res = await db.batches.update_one(
+                {"id": batch_id, "status": {"$in": TERMINAL_BATCH_STATUSES}},
+                {"$set": {"status": "sending"}, "$unset": {"completed_at": ""}},
+            )
+            if res.modified_count:
+                if campaign_id:
+                    reopened[campaign_id] = reopened.get(campaign_id, 0) + 1
+                if shop_id:
+                    d = shop_deltas.setdefault(shop_id, {})
+                    d["active_batches"] = d.get("active_batches", 0) + 1
+
+    # ── Campaigns: failed totals, completed_batches, status, reconcile flag ──
+    for campaign_id in campaign_ids:
+        if campaign_id in campaign_deltas:
+            await db.campaigns.update_one(
+                {"_id": campaign_id},
+                SchedulerWorker._campaign_counter_pipeline(campaign_deltas[campaign_id]),
+            )
+        update: Dict[str, Any] = {"$set": {"reconcile_requested": True}}
+        if reopened.get(campaign_id):
+            update["$inc"] = {"completed_batches": -reopened[campaign_id]}
+        await db.campaigns.update_one({"_id": campaign_id}, update)
+        if reopened.get(campaign_id):
+            await db.campaigns.update_one(
+                {"_id": campaign_id, "status": "completed"},
+                {"$set": {"status": "sending"}, "$unset": {"completed_at": ""}},
+            )
+            invalidate_campaign_state(campaign_id)
+
+    if shop_deltas:
+        await ShopStatsStore(db).increment_many(shop_deltas)
+
+
+class SendPacer:
+    """
+    Pacing policy for one provider.
+
+    Replaces the old global inter-message sleep:
+        - provider gap: consecutive dispatches are spaced by
+          min_send_interval + uniform(0, pacing_jitter)
+        - phone gap:    two sends to the same phone are spaced by
+          per_phone_interval
+    A provider with all three values at 0 (mock) is never delayed.
+    """
+
+    _PHONE_TABLE_MAX = 10000  # prune threshold for the per-phone table
+
+    def __init__(self, min_send_interval: float = 0.0, pacing_jitter: float = 0.0,
+                 per_phone_interval: float = 0.0):
+        self.min_send_interval = min_send_interval
+        self.pacing_jitter = pacing_jitter
+        self.per_phone_interval = per_phone_interval
+        self._lock = asyncio.Lock()
+        self._next_slot = 0.0
+        self._phone_last: Dict[str, float] = {}
+
+    async def wait(self, phone: str):
+        """Block until both the phone gap and the provider gap allow a send."""
+        loop = asyncio.get_running_loop()
+
+        if self.per_phone_interval > 0 and phone:
+            last = self._phone_last.get(phone)
+            if last is not None:
+                delay = last + self.per_phone_interval - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+        if self.min_send_interval > 0 or self.pacing_jitter > 0:
+            async with self._lock:
+                delay = self._next_slot - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self._next_slot = (
+                    loop.time()
+                    + self.min_send_interval
+                    + random.uniform(0, self.pacing_jitter)
+                )
+
+        if self.per_phone_interval > 0 and phone:
+            now = loop.time()
+            self._phone_last[phone] = now
+            if len(self._phone_last) > self._PHONE_TABLE_MAX:
+                cutoff = now - self.per_phone_interval
+                self._phone_last = {p: t for p, t in self._phone_last.items() if t > cutoff}
+
 
 class SchedulerWorker:
     """
     Background async worker — DB-driven 6-state message engine.
-    APScheduler fires every 7s; all scheduling logic lives in MongoDB.
+    Sleeps until the next message is due or a wakeup signal arrives;
+    all scheduling logic lives in MongoDB.
     """
 
     def __init__(self, db: Any):
         self.db = db
+        self.worker_id = make_worker_id()
+        self.queue = MessageQueue(db)
         self.scheduler = AsyncIOScheduler()
         self._processing = False  # Guard against overlapping cycles
+        self._running = False
+        self._loop_task: Optional[asyncio.Task] = None
+        self._watch_task: Optional[asyncio.Task] = None
+        # Send pipeline (built lazily on the running loop — see _get_pipeline)
+        self._send_policy: Optional[Dict[str, Any]] = None
+        self._global_semaphore: Optional[asyncio.Semaphore] = None
+        self._provider_semaphore: Optional[asyncio.Semaphore] = None
+        self._pacer: Optional[SendPacer] = None
+        self._limiter: Optional[SendRateLimiter] = None
+        self._batch_dispatch = False
+        self._claim_limit = MICRO_BATCH_SIZE
+        self._lease_seconds = float(LEASE_BASE_SECONDS)
 
     # ──────────────────────────────────────────────────────────────────────
     # Lifecycle: start / stop
     # ──────────────────────────────────────────────────────────────────────
 
     def start(self):
-        """Start the scheduler polling heartbeat."""
-        if self.scheduler.running:
+        """Start the worker loop, the maintenance tick and (optionally) the change-stream listener."""
+        if self._running:
             logger.warning("Scheduler worker already running")
             return
+        self._running = True
 
         self.scheduler.add_job(
-            self._poll_cycle,
-            trigger=IntervalTrigger(seconds=POLL_INTERVAL_SECONDS),
-            id="scheduler_worker_poll",
-            name="Scheduler Worker Poll",
+            self._maintenance_tick,
+            trigger=IntervalTrigger(seconds=MAINTENANCE_INTERVAL_SECONDS),
+            id="scheduler_worker_maintenance",
+            name="Scheduler Worker Maintenance",
+            max_instances=1,
+            replace_existing=True,
+        )
+        self.scheduler.add_job(
+            self._reconcile_counters,
+            trigger=IntervalTrigger(seconds=RECONCILE_INTERVAL_SECONDS),
+            id="scheduler_worker_reconcile",
+            name="Scheduler Counter Reconciliation",
+            max_instances=1,
+            replace_existing=True,
+        )
+        self.scheduler.add_job(
+            ShopStatsStore(self.db).reconcile,
+            trigger=IntervalTrigger(seconds=SHOP_STATS_RECONCILE_SECONDS),
+            id="scheduler_worker_shop_stats",
+            name="Shop Stats Reconciliation",
             max_instances=1,
             replace_existing=True,
         )
         self.scheduler.start()
+
+        self._loop_task = asyncio.create_task(self._run_loop())
+        if os.environ.get("SCHEDULER_CHANGE_STREAM", "false").lower() == "true":
+            self._watch_task = asyncio.create_task(self._watch_changes())
+
         logger.info(
-            f"✓ Scheduler worker started "
-            f"(poll={POLL_INTERVAL_SECONDS}s, batch={MICRO_BATCH_SIZE}, "
-            f"jitter={INTER_MSG_JITTER_MIN}-{INTER_MSG_JITTER_MAX}s, "
+            f"✓ Scheduler worker {self.worker_id} started "
+            f"(event-driven, idle_max={IDLE_SLEEP_MAX_SECONDS}s, batch={MICRO_BATCH_SIZE}, "
+            f"concurrency={MAX_CONCURRENT_SENDS}, "
+            f"change_stream={self._watch_task is not None}, "
             f"backoff=[15s,30s], gate=DummyGateProvider/MD5)"
         )
 
     def stop(self):
-        """Stop the scheduler gracefully."""
+        """Stop the worker loop and the maintenance scheduler gracefully."""
+        self._running = False
+        for task in (self._loop_task, self._watch_task):
+            if task and not task.done():
+                task.cancel()
+        self._loop_task = None
+        self._watch_task = None
         if self.scheduler.running:
             self.scheduler.shutdown(wait=True)
-            logger.info("✓ Scheduler worker stopped")
+        logger.info("✓ Scheduler worker stopped")
+
+    # ──────────────────────────────────────────────────────────────────────
+    # Event-driven loop
+    # ──────────────────────────────────────────────────────────────────────
+
+    async def _run_loop(self):
+        """Run a cycle, then sleep until the next message is due or a signal arrives."""
+        event = _get_wakeup_event()
+        while self._running:
+            # Clear BEFORE the cycle so signals raised during it trigger a re-run
+            event.clear()
+            try:
+                backlog = await self._poll_cycle()
+                delay = 0.0 if backlog else await self._seconds_until_next_due()
+            except Exception as e:
+                logger.error(f"[Worker] Loop error: {e}", exc_info=True)
+                delay = POLL_INTERVAL_SECONDS
+
+            if delay <= 0:
+                await asyncio.sleep(0)  # yield to the event loop between drains
+                continue
+            try:
+                await asyncio.wait_for(event.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _seconds_until_next_due(self) -> float:
+        """
+        Seconds until the earliest queued next_attempt_at, capped at
+        IDLE_SLEEP_MAX_SECONDS.  Items that are already due after a full
+        drain are parked (e.g. paused campaign) — re-check them every
+        POLL_INTERVAL_SECONDS instead of spinning.
+        """
+        query = {"status": {"$in": ["pending", "retry_wait"]}}
+        query.update(await self._claim_filter() or {})
+        earliest = await self.db.messages.find_one(
+            query,
+            {"_id": 0, "next_attempt_at": 1},
+            sort=[("next_attempt_at", 1)],
+        )
+        next_at = (earliest or {}).get("next_attempt_at")
+        if not isinstance(next_at, datetime):
+            return IDLE_SLEEP_MAX_SECONDS
+        if next_at.tzinfo is None:
+            next_at = next_at.replace(tzinfo=timezone.utc)
+        delay = (next_at - datetime.now(timezone.utc)).total_seconds()
+        if delay <= 0:
+            return POLL_INTERVAL_SECONDS
+        return min(delay, IDLE_SLEEP_MAX_SECONDS)
+
+    async def _maintenance_tick(self):
+        """Slow APScheduler tick: release orphans and wake the loop if any were found."""
+        try:
+            if await self._recover_orphans():
+                notify_scheduler()
+        except Exception as e:
+            logger.error(f"[Worker] Maintenance tick error: {e}", exc_info=True)
+
+    async def _watch_changes(self):
+        """
+        Optional MongoDB change-stream listener for multi-process deployments.
+        Signals the local loop when another process enqueues or re-queues
+        messages, or resumes a campaign.  Transient errors (primary step-down,
+        network blips, an invalidated stream) reattach with exponential
+        backoff up to WATCH_RETRY_MAX_SECONDS, waking the loop once on each
+        reattach to cover events missed while detached.  Only a deployment
+        without change streams (not a replica set) stops the listener; the
+        worker then runs on the in-process signal + due-time sleep alone.
+        """
+        pipeline = [{"$match": {"$or": [
+            {"ns.coll": "messages", "operationType": "insert"},
+            {"ns.coll": "messages",
+             "updateDescription.updatedFields.status": {"$in": ["pending", "retry_wait"]}},
+            {"ns.coll": "campaigns",
+             "updateDescription.updatedFields.status": "sending"},
+        ]}}]
+        delay = WATCH_RETRY_BASE_SECONDS
+        attached_before = False
+        while self._running:
+            try:
+                async with self.db.watch(pipeline) as stream:
+                    logger.info("[Worker] Change-stream wakeup listener attached")
+                    delay = WATCH_RETRY_BASE_SECONDS
+                    if attached_before:
+                        notify_scheduler()
+                    attached_before = True
+                    async for _change in stream:
+                        notify_scheduler()
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                if e.code == 40573 or "only supported on replica sets" in str(e):
+                    logger.warning(
+                        f"[Worker] Change streams not supported ({e}) — "
+                        f"falling back to in-process wakeups only"
+                    )
+                    return
+                logger.warning(f"[Worker] Change-stream error ({e}) — reattaching in {delay}s")
+            except Exception as e:
+                logger.warning(f"[Worker] Change-stream error ({e}) — reattaching in {delay}s")
+            if not self._running:
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WATCH_RETRY_MAX_SECONDS)
 
     # ──────────────────────────────────────────────────────────────────────
     # Core poll cycle
     # ──────────────────────────────────────────────────────────────────────
 
-    async def _poll_cycle(self):
+    async def _poll_cycle(self) -> bool:
         """
-        Main heartbeat — fires every POLL_INTERVAL_SECONDS.
-        Queries MongoDB for due messages, processes them through the 6-state machine.
+        One worker cycle — runs on wakeup or when the next message falls due.
+        Drains due messages from MongoDB in micro-batches and pushes each
+        batch through the concurrent send pipeline.
+
+        Returns True if the drain stopped at MAX_DRAIN_ROUNDS with work left.
         """
         if self._processing:
-            return  # Previous cycle still running — skip
+            return False  # Previous cycle still running — skip
         self._processing = True
+        backlog = False
 
         try:
             # ── Working Hours Gate ────────────────────────────────────────
@@ -137,70 +651,31 @@ class SchedulerWorker:
                 )
                 # return  # TEMPORARILY DISABLED FOR TESTING
 
-            # ── Orphan Recovery: release stale 'processing' records ───────
-            await self._recover_orphans()
-
-            current_time = datetime.now(timezone.utc)
-
-            # ── Time-Window Fetch ─────────────────────────────────────────
-            # Query: status IN ['pending','retry_wait'] AND next_attempt_at <= now
-            query = {
-                "status": {"$in": ["pending", "retry_wait"]},
-                "next_attempt_at": {"$lte": current_time},
-            }
-            cursor = self.db.messages.find(
-                query, {"_id": 0}
-            ).sort([
-                ("priority", 1),          # VIP first (priority=1)
-                ("next_attempt_at", 1),   # Oldest due first
-            ]).limit(MICRO_BATCH_SIZE)
-
-            items = await cursor.to_list(length=MICRO_BATCH_SIZE)
+            self._get_pipeline()
+            await self._defer_over_quota()
+            processed = 0
+            for round_no in range(MAX_DRAIN_ROUNDS):
+                # Never claim more than the (adaptive) rate can send within the lease base
+                claim_limit = min(self._claim_limit, self._limiter.claim_budget(LEASE_BASE_SECONDS))
+                items = await self.queue.claim_due(
+                    self.worker_id, claim_limit, self._lease_seconds,
+                    extra_filter=await self._claim_filter(),
+                )
 
-            if not items:
-                # ── Dynamic Macro Consolidation (Auto-Complete Check) ─────
-                await self._auto_complete_campaigns()
-                return  # Nothing due — silent return
+                if not items:
+                    # ── Dynamic Macro Consolidation (Auto-Complete Check) ─
+                    await self._auto_complete_campaigns()
+                    break  # Nothing (more) due
 
-            logger.info(f"[Worker] Picked up {len(items)} due items")
+                logger.info(f"[Worker] Claimed {len(items)} due items")
 
-            processed = 0
-            for item in items:
-                # ── Manual State Interrupt Check ──
-                campaign_id = item.get("campaign_id")
-                if campaign_id:
-                    campaign = await self.db.campaigns.find_one(
-                        {"_id": campaign_id},
-                        {"_id": 0, "status": 1},
-                    )
-                    if campaign:
-                        c_status = campaign.get("status", "")
-                        if c_status == "paused":
-                            logger.info(
-                                f"[Worker] Campaign {campaign_id} is paused — "
-                                f"skipping item {item.get('id')}"
-                            )
-                            continue
-                        if c_status in ("cancelled", "stopped"):
-                            await self._cancel_item(item)
-                            continue
-
-                # ── Process the item (hard 45s timeout to break any deadlock) ──
-                try:
-                    await asyncio.wait_for(self._process_item(item), timeout=45.0)
-                except asyncio.TimeoutError:
-                    logger.error(
-                        f"[Worker] ✗ TIMEOUT processing item {item.get('id')} — deadlock broken."
-                    )
-                except Exception as ex:
-                    logger.error(
-                        f"[Worker] ✗ Unhandled exception processing item {item.get('id')}: {ex}"
-                    )
-                processed += 1
+                dispatched = await self._dispatch_items(items)
+                processed += dispatched
 
-                # ── Inter-message jitter (demo-friendly, fast) ──
-                jitter = random.uniform(INTER_MSG_JITTER_MIN, INTER_MSG_JITTER_MAX)
-                await asyncio.sleep(jitter)
+                # Partial page, or everything left is parked (paused campaign)
+                if len(items) < claim_limit or dispatched == 0:
+                    break
+                backlog = round_no == MAX_DRAIN_ROUNDS - 1
 
             if processed > 0:
                 logger.info(f"[Worker] Cycle complete: {processed} items processed")
@@ -209,151 +684,349 @@ class SchedulerWorker:
             logger.error(f"[Worker] Poll cycle error: {e}", exc_info=True)
         finally:
             self._processing = False
+        return backlog
+
+    async def _defer_over_quota(self) -> int:
+        """
+        Quota admission check: due messages routed to a sender account whose
+        daily quota is used up are pushed to the next 9AM IST in one
+        update_many, so they are never claimed (and never spend an attempt).
+        """
+        quota_filter = await ProviderAdapter.over_quota_filter()
+        if not quota_filter:
+            return 0
+        now = datetime.now(timezone.utc)
+        result = await self.db.messages.update_many(
+            {
+                "status": {"$in": ["pending", "retry_wait"]},
+                "next_attempt_at": {"$lte": now},
+                **quota_filter,
+            },
+            {"$set": {
+                "next_attempt_at": _next_day_9am_ist_utc(),
+                "failure_reason": "daily_quota_exhausted",
+                "updated_at": now.isoformat(),
+            }},
+        )
+        if result.modified_count:
+            logger.warning(
+                f"[Worker] ⏸ Daily quota exhausted — deferred {result.modified_count} "
+                f"message(s) to next 9AM IST"
+            )
+        return result.modified_count
+
+    async def _claim_filter(self) -> Optional[Dict[str, Any]]:
+        """Extra claim predicate: never fetch messages of paused campaigns."""
+        paused = await _campaign_state_cache.paused_ids(self.db)
+        if not paused:
+            return None
+        return {"campaign_id": {"$nin": paused}}
 
     # ──────────────────────────────────────────────────────────────────────
-    # Orphan Recovery
+    # Concurrent send pipeline
     # ──────────────────────────────────────────────────────────────────────
 
-    async def _recover_orphans(self):
+    def _get_pipeline(self):
         """
-        Detect messages stuck in 'processing' longer than ORPHAN_THRESHOLD_SECONDS.
-        These are caused by a previous server crash or hard timeout.
-        Reset them to 'retry_wait' (or 'pending' if attempt_count == 0) with
-        incremented attempt_count so they can be retried cleanly.
+        Build (once) the semaphores, pacer, rate limiter, claim size and lease
+        length from the active provider's policy.  Claims are sized so every
+        claimed item can be sent well within its lease, even on a 1-wide
+        provider.
         """
-        threshold = datetime.now(timezone.utc) - timedelta(seconds=ORPHAN_THRESHOLD_SECONDS)
-        orphan_cursor = self.db.messages.find({
-            "status": "processing",
-            "updated_at": {"$lt": threshold.isoformat()}
-        }, {"_id": 0, "id": 1, "attempt_count": 1})
-        orphans = await orphan_cursor.to_list(length=50)
-        for orphan in orphans:
-            orphan_id = orphan.get("id")
-            attempt_count = orphan.get("attempt_count", 0) + 1
-            now_iso = datetime.now(timezone.utc).isoformat()
-            if attempt_count >= MAX_RETRY_COUNT:
-                await self.db.messages.update_one(
-                    {"id": orphan_id},
-                    {"$set": {
-                        "status": "failed_permanently",
-                        "failure_reason": "worker_crash_or_timeout",
-                        "attempt_count": attempt_count,
-                        "dlq_at": now_iso,
-                        "updated_at": now_iso,
-                    }}
+        if self._send_policy is None:
+            policy = ProviderAdapter.get_send_policy()
+            self._send_policy = policy
+            concurrency = min(MAX_CONCURRENT_SENDS, policy["max_concurrency"])
+            self._claim_limit = min(MICRO_BATCH_SIZE, concurrency * CLAIM_PER_SLOT)
+            per_send_budget = (
+                SEND_TIMEOUT_SECONDS
+                + policy["min_send_interval"]
+                + policy["pacing_jitter"]
+                + policy["per_phone_interval"]
+            )
+            self._lease_seconds = (
+                LEASE_BASE_SECONDS
+                + math.ceil(self._claim_limit / concurrency) * per_send_budget
+            )
+            self._global_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+            self._provider_semaphore = asyncio.Semaphore(policy["max_concurrency"])
+            self._pacer = SendPacer(
+                min_send_interval=policy["min_send_interval"],
+                pacing_jitter=policy["pacing_jitter"],
+                per_phone_interval=policy["per_phone_interval"],
+            )
+            self._limiter = SendRateLimiter(policy["provider"], policy["max_send_rate"])
+            # Unpaced providers take a whole micro-batch per send_many() call
+            self._batch_dispatch = not (
+                policy["min_send_interval"] or policy["pacing_jitter"] or policy["per_phone_interval"]
+            )
+            logger.info(
+                f"[Worker] Send pipeline: provider={policy['provider']} "
+                f"concurrency={min(MAX_CONCURRENT_SENDS, policy['max_concurrency'])} "
+                f"rate≤{policy['max_send_rate']}/s "
+                f"dispatch={'batch' if self._batch_dispatch else 'per-item'}"
+                f"{' (native)' if policy['native_batch'] else ''} "
+                f"interval={policy['min_send_interval']}s+{policy['pacing_jitter']}s "
+                f"per_phone={policy['per_phone_interval']}s "
+                f"claim={self._claim_limit} lease={self._lease_seconds:.0f}s"
+            )
+        return self._global_semaphore, self._provider_semaphore, self._pacer
+
+    async def _dispatch_items(self, items: List[Dict[str, Any]]) -> int:
+        """
+        Apply the manual state interrupt check to claimed items, run every
+        remaining item through the bounded worker pool, then flush all
+        outcomes in bulk.  Items of campaigns paused after the claim query
+        ran are released back to the queue without spending an attempt.
+        Returns the number dispatched.
+        """
+        to_send = []
+        parked = []
+        buffer = TransitionBuffer()
+        statuses = await _campaign_state_cache.statuses(
+            self.db, (item["campaign_id"] for item in items if item.get("campaign_id"))
+        )
+        for item in items:
+            # ── Manual State Interrupt Check (cached control state) ──
+            campaign_id = item.get("campaign_id")
+            if campaign_id:
+                c_status = statuses.get(campaign_id)
+                if c_status is not None:
+                    if c_status == "paused":
+                        logger.info(
+                            f"[Worker] Campaign {campaign_id} is paused — "
+                            f"skipping item {item.get('id')}"
+                        )
+                        parked.append(item)
+                        continue
+                    if c_status in ("cancelled", "stopped"):
+                        self._cancel_item(item, buffer)
+                        continue
+            to_send.append(item)
+
+        if parked:
+            await self.queue.release(parked)
+        try:
+            if to_send and self._batch_dispatch:
+                await self._send_batch(to_send, buffer)
+            elif to_send:
+                await asyncio.gather(*(self._send_slot(item, buffer) for item in to_send))
+        finally:
+            await self._flush_transitions(buffer)
+        return len(to_send)
+
+    async def _send_slot(self, item: Dict[str, Any], buffer: TransitionBuffer):
+        """Acquire a pipeline slot, wait for pacing, then process one item."""
+        global_sem, provider_sem, pacer = self._get_pipeline()
+        # Account slot first: an item waiting for a busy account must not hold a pool-wide slot
+        async with ProviderAdapter.send_slot(item.get("shop_id")), global_sem, provider_sem:
+            await self._limiter.acquire(item.get("campaign_id"))
+            await pacer.wait(item.get("phone_number", ""))
+
+            # ── Process the item (hard timeout to break any deadlock) ──
+            try:
+                await asyncio.wait_for(self._process_item(item, buffer), timeout=SEND_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                logger.error(
+                    f"[Worker] ✗ TIMEOUT processing item {item.get('id')} — deadlock broken."
                 )
-                logger.error(f"[Worker] ⚠ Orphan {orphan_id} exhausted retries → failed_permanently")
-            else:
-                backoff = RETRY_BACKOFF_BY_ATTEMPT.get(attempt_count, 30)
-                next_retry = datetime.now(timezone.utc) + timedelta(seconds=backoff)
-                await self.db.messages.update_one(
-                    {"id": orphan_id},
-                    {"$set": {
-                        "status": "retry_wait",
-                        "failure_reason": "worker_crash_or_timeout",
-                        "attempt_count": attempt_count,
-                        "next_attempt_at": next_retry,
-                        "updated_at": now_iso,
-                    }}
+            except Exception as ex:
+                logger.error(
+                    f"[Worker] ✗ Unhandled exception processing item {item.get('id')}: {ex}"
                 )
-                logger.warning(f"[Worker] ⚠ Orphan {orphan_id} recovered → retry_wait (attempt {attempt_count})")
+
+            self._ensure_outcome(item, buffer)
+
+    async def _send_batch(self, items: List[Dict[str, Any]], buffer: TransitionBuffer):
+        """
+        Send a whole micro-batch with one ProviderAdapter.send_many() call
+        (unpaced providers only).  Rate-limiter tokens are taken per item
+        up front; the call gets one timeout budget per concurrency wave.
+        If the call times out or raises, which items the provider accepted
+        is unknown, so every item is recorded as unconfirmed — never retried
+        (a resend could deliver twice) nor dead-lettered as failed.
+        """
+        self._get_pipeline()
+        for item in items:
+            await self._limiter.acquire(item.get("campaign_id"))
+
+        requests = [
+            {
+                "phone": item.get("phone_number", ""),
+                "content": item.get("message_content", ""),
+                "attempt_count": item.get("attempt_count") or 1,
+                "shop_id": item.get("shop_id"),
+            }
+            for item in items
+        ]
+        waves = math.ceil(len(items) / self._send_policy["max_concurrency"])
+        results: List[Dict[str, Any]] = []
+        try:
+            results = await asyncio.wait_for(
+                ProviderAdapter.send_many(requests), timeout=SEND_TIMEOUT_SECONDS * waves
+            )
+        except asyncio.TimeoutError:
+            logger.error(f"[Worker] ✗ TIMEOUT sending batch of {len(items)} — outcomes unknown.")
+            results = [_batch_unconfirmed("batch_timeout")] * len(items)
+        except Exception as ex:
+            logger.error(f"[Worker] ✗ Unhandled exception sending batch of {len(items)}: {ex}")
+            results = [_batch_unconfirmed("batch_exception")] * len(items)
+
+        now = datetime.now(timezone.utc)
+        for item, result in zip(items, results):
+            self._apply_result(item, result, now, buffer)
+        for item in items:
+            self._ensure_outcome(item, buffer)
+
+    def _ensure_outcome(self, item: Dict[str, Any], buffer: TransitionBuffer):
+        """Strict Deadlock Fallback: never leave a claimed item 'processing'."""
+        if buffer.has(item.get("id")):
+            return
+        now_iso = datetime.now(timezone.utc).isoformat()
+        logger.error(
+            f"[Worker] ⚠ Item {item.get('id')} has no outcome. Releasing to failed_permanently."
+        )
+        buffer.add(
+            item,
+            {"$set": {
+                "status": "failed_permanently",
+                "failure_reason": "worker_crash_or_timeout",
+                "dlq_at": now_iso,
+                "updated_at": now_iso,
+            }},
+            "failed_permanently",
+            status="processing",
+        )
+
+    async def _flush_transitions(self, buffer: TransitionBuffer) -> int:
+        """Flush buffered message transitions, then their counter deltas. Returns writes applied."""
+        applied = await buffer.flush(self.db)
+        if applied:
+            await self._apply_counter_deltas(applied)
+        return len(applied)
+
+    # ──────────────────────────────────────────────────────────────────────
+    # Orphan Recovery
+    # ──────────────────────────────────────────────────────────────────────
+
+    async def _recover_orphans(self) -> int:
+        """
+        Release 'processing' messages whose lease has expired — caused by a
+        worker crash, hard timeout or a host that went away.  Orphans are
+        handled per lease_owner; each write is fenced on the lapsed
+        lease_token so a late-finishing worker and the recovery never both
+        win.  Reset to 'retry_wait' (or DLQ once retries are exhausted).
+        attempt_count was already incremented at claim time.
+        Returns the number of orphans released.
+        """
+        by_owner = await self.queue.expired_leases(ORPHAN_THRESHOLD_SECONDS)
+        buffer = TransitionBuffer()
+        for owner, orphans in by_owner.items():
+            logger.warning(
+                f"[Worker] ⚠ {len(orphans)} expired lease(s) held by {owner} — releasing"
+            )
+            for orphan in orphans:
+                orphan_id = orphan.get("id")
+                attempt_count = max(orphan.get("attempt_count", 0), 1)
+                now_iso = datetime.now(timezone.utc).isoformat()
+                if attempt_count >= MAX_RETRY_COUNT:
+                    buffer.add(
+                        orphan,
+                        {"$set": {
+                            "status": "failed_permanently",
+                            "failure_reason": "worker_crash_or_timeout",
+                            "attempt_count": attempt_count,
+                            "dlq_at": now_iso,
+                            "updated_at": now_iso,
+                        }},
+                        "failed_permanently",
+                        status="processing",
+                    )
+                    logger.error(f"[Worker] ⚠ Orphan {orphan_id} exhausted retries → failed_permanently")
+                else:
+                    backoff = RETRY_BACKOFF_BY_ATTEMPT.get(attempt_count, 30)
+                    next_retry = datetime.now(timezone.utc) + timedelta(seconds=backoff)
+                    buffer.add(
+                        orphan,
+                        {"$set": {
+                            "status": "retry_wait",
+                            "failure_reason": "worker_crash_or_timeout",
+                            "attempt_count": attempt_count,
+                            "next_attempt_at": next_retry,
+                            "updated_at": now_iso,
+                        }},
+                        "retry_wait",
+                        status="processing",
+                    )
+                    logger.warning(f"[Worker] ⚠ Orphan {orphan_id} recovered → retry_wait (attempt {attempt_count})")
+        return await self._flush_transitions(buffer)
 
     # ──────────────────────────────────────────────────────────────────────
     # Process a single queue item
     # ──────────────────────────────────────────────────────────────────────
 
-    async def _process_item(self, item: Dict[str, Any]):
+    async def _process_item(self, item: Dict[str, Any], buffer: TransitionBuffer):
         """
-        Process a single messages item through the 6-state machine.
-        Uses attempt_count (reads retry_count as fallback for old messages).
+        Process a single claimed messages item through the 6-state machine.
+        The item is already 'processing' under this worker's lease, and its
+        attempt_count was incremented at claim time (attempt 1 = first try).
+        The resulting state write is buffered; _dispatch_items flushes it.
         """
-        item_id = item.get("id")
         phone = item.get("phone_number", "")
-        user_id = item.get("user_id", "")
         now = datetime.now(timezone.utc)
 
-        # Read attempt_count (new field) — fallback to retry_count for backward compat
-        current_attempt = item.get("attempt_count", item.get("retry_count", 0))
-        # Increment BEFORE calling the gate (attempt 1 = first try)
-        this_attempt = current_attempt + 1
-
-        # ── Step 1: Atomic Concurrency Lock ──────────────────────────────
-        lock_result = await self.db.messages.update_one(
-            {"id": item_id, "status": {"$in": ["pending", "retry_wait"]}},
-            {"$set": {
-                "status": "processing",
-                "attempt_count": this_attempt,
-                "processing_started_at": now.isoformat(),
-                "updated_at": now.isoformat(),
-            }},
-        )
-        if lock_result.modified_count == 0:
-            return  # Another worker already grabbed it
+        # ── Step 1: Lease already held (MessageQueue.claim_due) ──────────
+        this_attempt = item.get("attempt_count") or 1
 
         # ── Step 2: Get message content ───────────────────────────────────
         content = item.get("message_content", "")
 
+        # ── Step 3: Call DummyGateProvider ────────────────────────────────
         try:
-            # ── Step 3: Call DummyGateProvider ────────────────────────────
-            try:
-                result = await ProviderAdapter.send_message(phone, content, attempt_count=this_attempt)
-            except Exception as e:
-                result = {
-                    "success": False,
-                    "provider_sid": None,
-                    "error": str(e),
-                    "outcome": "temporary",
-                    "reschedule_at": None,
-                }
+            result = await ProviderAdapter.send_message(
+                phone, content, attempt_count=this_attempt, shop_id=item.get("shop_id")
+            )
+        except Exception as e:
+            result = {
+                "success": False,
+                "provider_sid": None,
+                "error": str(e),
+                "outcome": "temporary",
+                "reschedule_at": None,
+            }
 
-            # ── Step 4: State Transition Triage ───────────────────────────
-            if result.get("success"):
-                await self._handle_success(item, result, now)
-            elif result.get("outcome") == "permanent":
-                await self._handle_permanent_failure(item, result, now, this_attempt)
-            else:
-                # Transient failure (network / rate_limit)
-                await self._handle_transient_failure(item, result, now, this_attempt)
+        self._apply_result(item, result, now, buffer)
 
-            # ── Step 5: Update batch & campaign stats ─────────────────────
-            await self._update_batch_stats(item.get("batch_id"), user_id)
-            campaign_id = item.get("campaign_id")
-            if campaign_id:
-                await self._update_campaign_stats(campaign_id)
+    def _apply_result(self, item: Dict[str, Any], result: Dict[str, Any], now: datetime,
+                      buffer: TransitionBuffer):
+        """Feed a provider result to the rate limiter and buffer the state transition."""
+        this_attempt = item.get("attempt_count") or 1
 
-        finally:
-            # ── Step 6: Strict Deadlock Fallback ─────────────────────────
-            # If the item is STILL 'processing' after everything (crash/timeout), release it.
-            stuck_check = await self.db.messages.find_one(
-                {"id": item_id, "status": "processing"}
-            )
-            if stuck_check:
-                now_iso = datetime.now(timezone.utc).isoformat()
-                logger.error(
-                    f"[Worker] ⚠ Item {item_id} stuck in processing. Releasing to failed_permanently."
-                )
-                await self.db.messages.update_one(
-                    {"id": item_id},
-                    {"$set": {
-                        "status": "failed_permanently",
-                        "failure_reason": "worker_crash_or_timeout",
-                        "dlq_at": now_iso,
-                        "updated_at": now_iso,
-                    }}
-                )
+        # Feed the outcome back into the adaptive rate limiter (AIMD)
+        self._limiter.record(item.get("campaign_id"), result)
+
+        # ── Step 4: State Transition Triage (buffered write) ─────────────
+        if result.get("success"):
+            self._handle_success(item, result, now, buffer)
+        elif result.get("outcome") == "permanent":
+            self._handle_permanent_failure(item, result, now, this_attempt, buffer)
+        elif result.get("outcome") == "unknown":
+            self._handle_unconfirmed(item, result, now, this_attempt, buffer)
+        else:
+            # Transient failure (network / rate_limit)
+            self._handle_transient_failure(item, result, now, this_attempt, buffer)
 
     # ──────────────────────────────────────────────────────────────────────
     # Success Handler
     # ──────────────────────────────────────────────────────────────────────
 
-    async def _handle_success(self, item: Dict, result: Dict, now: datetime):
+    def _handle_success(self, item: Dict, result: Dict, now: datetime, buffer: TransitionBuffer):
         """Mark message as sent (success state)."""
-        item_id = item.get("id")
         provider_sid = result.get("provider_sid", "")
         now_iso = now.isoformat()
 
-        await self.db.messages.update_one(
-            {"id": item_id},
+        buffer.add(
+            item,
             {"$set": {
                 "status": "sent",
                 "provider_sid": provider_sid,
@@ -369,6 +1042,7 @@ class SchedulerWorker:
                     "attempt_count": item.get("attempt_count", 1),
                 }
             }},
+            "sent",
         )
         logger.info(f"[Worker] ✓ SENT {item.get('phone_number')} (sid={provider_sid})")
 
@@ -376,17 +1050,17 @@ class SchedulerWorker:
     # Permanent Failure Handler (Terminal DLQ — no retries)
     # ──────────────────────────────────────────────────────────────────────
 
-    async def _handle_permanent_failure(self, item: Dict, result: Dict, now: datetime, this_attempt: int):
+    def _handle_permanent_failure(self, item: Dict, result: Dict, now: datetime, this_attempt: int,
+                                  buffer: TransitionBuffer):
         """
         Terminal failure (e.g. invalid_number).
         Bypass retries entirely — straight to failed_permanently.
         """
-        item_id = item.get("id")
         error_msg = result.get("error", "permanent_failure")
         now_iso = now.isoformat()
 
-        await self.db.messages.update_one(
-            {"id": item_id},
+        buffer.add(
+            item,
             {"$set": {
                 "status": "failed_permanently",
                 "failure_reason": error_msg,
@@ -403,23 +1077,64 @@ class SchedulerWorker:
                     "attempt_count": this_attempt,
                 }
             }},
+            "failed_permanently",
         )
         logger.warning(
             f"[Worker] ✗ FAILED_PERMANENTLY {item.get('phone_number')} "
             f"reason={error_msg} (terminal, no retry)"
         )
 
+    # ──────────────────────────────────────────────────────────────────────
+    # Unconfirmed Handler (send may have gone out — verify, never retry)
+    # ──────────────────────────────────────────────────────────────────────
+
+    def _handle_unconfirmed(self, item: Dict, result: Dict, now: datetime, this_attempt: int,
+                            buffer: TransitionBuffer):
+        """
+        The provider started the send but could not confirm it in time.
+        Retrying could deliver the message twice and the DLQ would count it
+        as failed, so it is parked as unconfirmed for an operator to verify
+        (DLQ desk: resolve if delivered, requeue if not).
+        """
+        error_msg = result.get("error") or "send_unconfirmed"
+        now_iso = now.isoformat()
+
+        buffer.add(
+            item,
+            {"$set": {
+                "status": "unconfirmed",
+                "failure_reason": error_msg,
+                "attempt_count": this_attempt,
+                "updated_at": now_iso,
+            },
+            "$push": {
+                "error_log": {
+                    "timestamp": now_iso,
+                    "code": error_msg,
+                    "message": "Send started but not confirmed — verify before resending",
+                    "attempt_count": this_attempt,
+                }
+            }},
+            "unconfirmed",
+        )
+        logger.warning(
+            f"[Worker] ? UNCONFIRMED {item.get('phone_number')} "
+            f"(attempt {this_attempt}) — left for verification"
+        )
+
     # ──────────────────────────────────────────────────────────────────────
     # Transient Failure Handler (retry or DLQ after 3 attempts)
     # ──────────────────────────────────────────────────────────────────────
 
-    async def _handle_transient_failure(self, item: Dict, result: Dict, now: datetime, this_attempt: int):
+    def _handle_transient_failure(self, item: Dict, result: Dict, now: datetime, this_attempt: int,
+                                  buffer: TransitionBuffer):
         """
         Transient failure (network, rate_limit).
         If attempt_count < MAX_RETRY_COUNT → retry_wait with backoff.
         If attempt_count >= MAX_RETRY_COUNT → failed_permanently (DLQ).
+        Only this message is rescheduled; a rate_limit slows the rest of the
+        campaign down through the rate limiter instead of rewriting it.
         """
-        item_id = item.get("id")
         error_msg = result.get("error", "unknown_error")
         now_iso = now.isoformat()
 
@@ -432,8 +1147,8 @@ class SchedulerWorker:
 
         if this_attempt >= MAX_RETRY_COUNT:
             # ── Exhausted Retries → DLQ ───────────────────────────────────
-            await self.db.messages.update_one(
-                {"id": item_id},
+            buffer.add(
+                item,
                 {"$set": {
                     "status": "failed_permanently",
                     "failure_reason": error_msg,
@@ -443,6 +1158,7 @@ class SchedulerWorker:
                     "updated_at": now_iso,
                 },
                 "$push": {"error_log": error_entry}},
+                "failed_permanently",
             )
             logger.warning(
                 f"[Worker] ✗ FAILED_PERMANENTLY {item.get('phone_number')} "
@@ -453,8 +1169,8 @@ class SchedulerWorker:
             backoff_seconds = RETRY_BACKOFF_BY_ATTEMPT.get(this_attempt, 30)
             next_attempt_at = now + timedelta(seconds=backoff_seconds)
 
-            await self.db.messages.update_one(
-                {"id": item_id},
+            buffer.add(
+                item,
                 {"$set": {
                     "status": "retry_wait",
                     "failure_reason": error_msg,
@@ -463,6 +1179,7 @@ class SchedulerWorker:
                     "updated_at": now_iso,
                 },
                 "$push": {"error_log": error_entry}},
+                "retry_wait",
             )
             logger.warning(
                 f"[Worker] ⟳ RETRY_WAIT {item.get('phone_number')} "
@@ -470,37 +1187,19 @@ class SchedulerWorker:
                 f"next in {backoff_seconds}s at {next_attempt_at.isoformat()})"
             )
 
-            # If rate_limit — bulk-reschedule all other pending messages for this campaign
-            if error_msg == "rate_limit" and item.get("campaign_id"):
-                await self.db.messages.update_many(
-                    {
-                        "campaign_id": item["campaign_id"],
-                        "status": {"$in": ["pending", "retry_wait", "processing"]},
-                        "id": {"$ne": item_id},
-                    },
-                    {"$set": {
-                        "next_attempt_at": next_attempt_at,
-                        "failure_reason": "rate_limit",
-                        "status": "retry_wait",
-                        "updated_at": now_iso,
-                    }},
-                )
-                logger.warning(
-                    f"[Worker] ⏰ Rate limit bulk-reschedule for campaign {item['campaign_id']}"
-                )
-
     # ──────────────────────────────────────────────────────────────────────
     # Cancel Handler
     # ──────────────────────────────────────────────────────────────────────
 
-    async def _cancel_item(self, item: Dict):
+    def _cancel_item(self, item: Dict, buffer: TransitionBuffer):
         """Mark an item as cancelled (campaign was stopped/cancelled)."""
-        await self.db.messages.update_one(
-            {"id": item.get("id")},
+        buffer.add(
+            item,
             {"$set": {
                 "status": "cancelled",
                 "updated_at": datetime.now(timezone.utc).isoformat(),
             }},
+            "cancelled",
         )
 
     # ──────────────────────────────────────────────────────────────────────
@@ -540,7 +1239,172 @@ class SchedulerWorker:
                 logger.info(f"[Worker] 🏁 Auto-Complete: Campaign {camp_id} → completed!")
 
     # ──────────────────────────────────────────────────────────────────────
-    # Stats Updaters
+    # Incremental Counters
+    # ──────────────────────────────────────────────────────────────────────
+
+    async def _apply_counter_deltas(self, transitions: List[Tuple[Dict[str, Any], str]]):
+        """
+        Sum the counter deltas of applied transitions per batch, campaign
+        and shop, then write them with one bulk_write per collection.
+        retry_wait keeps the message in pending_count, so it is a no-op.
+        """
+        batch_deltas: Dict[str, Dict[str, int]] = {}
+        batch_campaign: Dict[str, Optional[str]] = {}
+        campaign_deltas: Dict[str, Dict[str, List[int]]] = {}  # campaign → segment → [sent, failed]
+        shop_deltas: Dict[str, Dict[str, int]] = {}
+
+        for item, new_status in transitions:
+            if new_status == "retry_wait":
+                continue
+            d_sent = 1 if new_status == "sent" else 0
+            d_failed = 1 if new_status == "failed_permanently" else 0
+
+            batch_id = item.get("batch_id")
+            if batch_id:
+                d = batch_deltas.setdefault(
+                    batch_id, {"success_count": 0, "failed_count": 0, "pending_count": 0}
+                )
+                d["success_count"] += d_sent
+                d["failed_count"] += d_failed
+                d["pending_count"] -= 1
+                batch_campaign[batch_id] = item.get("campaign_id")
+
+            shop_id = item.get("shop_id")
+            if shop_id:
+                d = shop_deltas.setdefault(shop_id, {"sent": 0, "failed": 0, "pending": 0})
+                d["sent"] += d_sent
+                d["failed"] += d_failed
+                d["pending"] -= 1
+
+            campaign_id = item.get("campaign_id")
+            if campaign_id and (d_sent or d_failed):
+                seg = item.get("customer_segment") or "boring"
+                seg_d = campaign_deltas.setdefault(campaign_id, {}).setdefault(seg, [0, 0])
+                seg_d[0] += d_sent
+                seg_d[1] += d_failed
+
+        # ── Batches: $inc counters, close the ones with nothing left in flight ──
+        if batch_deltas:
+            await self.db.batches.bulk_write(
+                [UpdateOne({"id": bid}, {"$inc": d}) for bid, d in batch_deltas.items()],
+                ordered=False,
+            )
+            drained = await self.db.batches.find(
+                {
+                    "id": {"$in": list(batch_deltas)},
+                    "pending_count": {"$lte": 0},
+                    "status": {"$nin": ["completed", "failed", "cancelled"]},
+                },
+                {"_id": 0, "id": 1, "shop_id": 1, "success_count": 1, "failed_count": 1, "status": 1},
+            ).to_list(None)
+            for batch in drained:
+                if await self._close_batch(batch["id"], batch, batch_campaign.get(batch["id"])):
+                    d = shop_deltas.setdefault(batch.get("shop_id"), {})
+                    d["active_batches"] = d.get("active_batches", 0) - 1
+
+        # ── Campaigns: totals + per-segment stats in one pipeline update each ──
+        if campaign_deltas:
+            await self.db.campaigns.bulk_write(
+                [
+                    UpdateOne({"_id": cid}, self._campaign_counter_pipeline(seg_deltas))
+                    for cid, seg_deltas in campaign_deltas.items()
+                ],
+                ordered=False,
+            )
+
+        if shop_deltas:
+            await ShopStatsStore(self.db).increment_many(shop_deltas)
+
+    @staticmethod
+    def _campaign_counter_pipeline(seg_deltas: Dict[str, List[int]]) -> List[Dict[str, Any]]:
+        """Pipeline update adding sent/failed deltas to totals and segment_stats, then recomputing pct."""
+        add_stage: Dict[str, Any] = {
+            "messages_sent": {"$add": [{"$ifNull": ["$messages_sent", 0]},
+                                       sum(v[0] for v in seg_deltas.values())]},
+            "messages_failed": {"$add": [{"$ifNull": ["$messages_failed", 0]},
+                                         sum(v[1] for v in seg_deltas.values())]},
+            "updated_at": {"$literal": datetime.now(timezone.utc)},
+        }
+        pct_stage: Dict[str, Any] = {}
+        for seg, (d_sent, d_failed) in seg_deltas.items():
+            seg_path = f"segment_stats.{seg}"
+            add_stage[f"{seg_path}.sent"] = {"$add": [{"$ifNull": [f"${seg_path}.sent", 0]}, d_sent]}
+            add_stage[f"{seg_path}.failed"] = {"$add": [{"$ifNull": [f"${seg_path}.failed", 0]}, d_failed]}
+            add_stage[f"{seg_path}.total"] = {"$ifNull": [f"${seg_path}.total", 0]}
+            pct_stage[f"{seg_path}.pct"] = {"$cond": [
+                {"$gt": [f"${seg_path}.total", 0]},
+                {"$round": [{"$multiply": [
+                    {"$divide": [f"${seg_path}.sent", f"${seg_path}.total"]}, 100,
+                ]}, 1]},
+                0,
+            ]}
+        return [{"$set": add_stage}, {"$set": pct_stage}]
+
+    async def _close_batch(self, batch_id: str, batch: Dict[str, Any], campaign_id: Optional[str]) -> bool:
+        """Flip a drained batch to completed/failed and count it on the campaign (once); True if it closed it."""
+        if batch.get("failed_count", 0) > 0 and batch.get("success_count", 0) == 0:
+            batch_status = "failed"
+        else:
+            batch_status = "completed"
+        res = await self.db.batches.update_one(
+            {"id": batch_id, "status": {"$nin": ["completed", "failed", "cancelled"]}},
+            {"$set": {
+                "status": batch_status,
+                "pending_count": 0,
+                "completed_at": datetime.now(timezone.utc).isoformat(),
+            }},
+        )
+        if res.modified_count and campaign_id:
+            await self.db.campaigns.update_one(
+                {"_id": campaign_id},
+                {"$inc": {"completed_batches": 1}},
+            )
+        return bool(res.modified_count)
+
+    async def _reconcile_counters(self):
+        """
+        Periodic drift repair: re-aggregate counters from the messages
+        collection for campaigns still in flight (by status or by messages
+        left to send), campaigns flagged reconcile_requested, plus campaigns
+        that finished within the last two reconciliation windows (to settle
+        final counts).
+        """
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=2 * RECONCILE_INTERVAL_SECONDS)
+        try:
+            # Campaigns of any status with messages still to send (e.g. requeued
+            # into a campaign that had already completed)
+            in_flight = await self.db.messages.distinct(
+                "campaign_id", {"status": {"$in": IN_FLIGHT_MESSAGE_STATUSES}}
+            )
+            campaigns = await self.db.campaigns.find(
+                {"$or": [
+                    {"status": {"$in": ["sending", "paused", "pending", "in_progress"]}},
+                    {"completed_at": {"$gte": cutoff}},
+                    {"reconcile_requested": True},
+                    {"_id": {"$in": [cid for cid in in_flight if cid]}},
+                ]},
+                {"_id": 1},
+            ).to_list(None)
+            for camp in campaigns:
+                campaign_id = camp["_id"]
+                batch_ids = [
+                    b["id"] async for b in self.db.batches.find(
+                        {"campaign_id": campaign_id}, {"_id": 0, "id": 1}
+                    )
+                ]
+                for batch_id in batch_ids:
+                    await self._update_batch_stats(batch_id, "")
+                await self._update_campaign_stats(campaign_id)
+                await self.db.campaigns.update_one(
+                    {"_id": campaign_id}, {"$unset": {"reconcile_requested": ""}}
+                )
+            if campaigns:
+                logger.info(f"[Worker] Reconciled counters for {len(campaigns)} campaign(s)")
+        except Exception as e:
+            logger.error(f"[Worker] Counter reconciliation error: {e}", exc_info=True)
+
+    # ──────────────────────────────────────────────────────────────────────
+    # Full Re-aggregation (used by reconciliation only)
     # ──────────────────────────────────────────────────────────────────────
 
     async def _update_batch_stats(self, batch_id: str, user_id: str):
@@ -559,14 +1423,15 @@ class SchedulerWorker:
 
         # Support both 'sent' (new) and 'delivered' (legacy)
         success_count = counts.get("sent", 0) + counts.get("delivered", 0)
-        failed_count = counts.get("failed_permanently", 0) + counts.get("failed_final", 0)
-        pending_count = counts.get("pending", 0) + counts.get("retry_wait", 0)
-        processing_count = counts.get("processing", 0)
+        failed_count = sum(counts.get(s, 0) for s in _COUNTED_FAILED)
+        # Same set the incremental deltas keep in pending_count: paused
+        # messages still have to be sent, so they hold the batch open
+        pending_count = sum(counts.get(s, 0) for s in _COUNTED_PENDING)
         cancelled_count = counts.get("cancelled", 0)
         total = sum(counts.values())
 
         # Determine batch status
-        if pending_count == 0 and processing_count == 0:
+        if pending_count == 0:
             if failed_count > 0 and success_count == 0:
                 batch_status = "failed"
             else:
@@ -579,7 +1444,7 @@ class SchedulerWorker:
         update_doc = {
             "success_count": success_count,
             "failed_count": failed_count,
-            "pending_count": pending_count + processing_count,
+            "pending_count": pending_count,
         }
 
         if batch_status in ("completed", "failed"):
@@ -592,6 +1457,12 @@ class SchedulerWorker:
             {"id": batch_id},
             {"$set": update_doc},
         )
+        if batch_status == "sending":
+            # Messages were requeued into a closed batch: open it again
+            await self.db.batches.update_one(
+                {"id": batch_id, "status": {"$in": TERMINAL_BATCH_STATUSES}},
+                {"$set": {"status": "sending"}, "$unset": {"completed_at": ""}},
+            )
 
     async def _update_campaign_stats(self, campaign_id: str):
         """Recompute campaign-level stats from all its batches."""
@@ -667,17 +1538,17 @@ class SchedulerWorker:
             "segment_stats": segment_stats,
             "updated_at": datetime.now(timezone.utc),
         }
+        update: Dict[str, Any] = {"$set": update_fields}
         if status == "completed":
             current_comp = await self.db.campaigns.find_one(
                 {"_id": campaign_id}, {"_id": 0, "completed_at": 1}
             )
             if not current_comp or not current_comp.get("completed_at"):
                 update_fields["completed_at"] = datetime.now(timezone.utc)
+        elif status in ("sending", "pending"):
+            update["$unset"] = {"completed_at": ""}
 
-        await self.db.campaigns.update_one(
-            {"_id": campaign_id},
-            {"$set": update_fields},
-        )
+        await self.db.campaigns.update_one({"_id": campaign_id}, update)
 
     # ──────────────────────────────────────────────────────────────────────
     # Public API for route layer
@@ -11,6 +11,8 @@ import logging
 import logging
 import pandas as pd
 
+from services.shop_stats import ShopStatsStore
+
 logger = logging.getLogger(__name__)
 
 
@@ -31,87 +33,19 @@ class ShopService:
             "created_at": datetime.now(timezone.utc).isoformat(),
         }
         await self.db.shops.insert_one(shop_doc)
+        await ShopStatsStore(self.db).create(shop_id, user_id)
         return {k: v for k, v in shop_doc.items() if k != "_id"}
 
     async def list_shops(self, user_id: str) -> List[Dict[str, Any]]:
-        """List all shops with CSV upload status and live campaign stats."""
+        """List all shops with CSV upload status and live campaign stats (from shop_stats)."""
         shops = await self.db.shops.find(
             {"user_id": user_id}, {"_id": 0}
         ).sort("created_at", -1).to_list(100)
+        if not shops:
+            return []
 
-        enriched = []
-        for shop in shops:
-            shop_id = shop["id"]
-            # CSV status: find latest file per data_purpose
-            csv_status = {}
-            for purpose in ["customer_data", "product_data", "transaction_data"]:
-                latest_file = await self.db.files.find_one(
-                    {"shop_id": shop_id, "data_purpose": purpose},
-                    {"_id": 0, "uploaded_at": 1, "original_file_name": 1},
-                    sort=[("uploaded_at", -1)],
-                )
-                csv_status[purpose] = {
-                    "uploaded": latest_file is not None,
-                    "last_updated": latest_file["uploaded_at"].isoformat() if latest_file and isinstance(latest_file.get("uploaded_at"), datetime) else (latest_file["uploaded_at"] if latest_file else None),
-                    "file_name": latest_file["original_file_name"] if latest_file else None,
-                }
-
-            # Counts
-            customer_count = await self.db.customers.count_documents(
-                {"user_id": user_id, "shop_id": shop_id}
-            )
-            product_count = await self.db.products.count_documents(
-                {"shop_id": shop_id}
-            )
-            transaction_count = await self.db.transactions.count_documents(
-                {"shop_id": shop_id}
-            )
-
-            # Live campaign stats
-            active_batches = await self.db.batches.count_documents(
-                {"user_id": user_id, "shop_id": shop_id, "status": {"$in": ["pending", "scheduled", "sending"]}}
-            )
-
-            # Aggregate sent/failed/pending message counts for this shop's batches
-            batch_ids_cursor = self.db.batches.find(
-                {"user_id": user_id, "shop_id": shop_id},
-                {"_id": 0, "id": 1}
-            )
-            batch_ids = [b["id"] async for b in batch_ids_cursor]
-
-            sent_count = 0
-            failed_count = 0
-            pending_count = 0
-            if batch_ids:
-                sent_count = await self.db.messages.count_documents(
-                    {"batch_id": {"$in": batch_ids}, "status": {"$in": ["sent", "delivered"]}}
-                )
-                failed_count = await self.db.messages.count_documents(
-                    {"batch_id": {"$in": batch_ids}, "status": {"$in": ["failed", "failed_permanently"]}}
-                )
-                pending_count = await self.db.messages.count_documents(
-                    {"batch_id": {"$in": batch_ids}, "status": {"$in": ["pending", "processing", "paused"]}}
-                )
-
-            total_campaigns = await self.db.campaigns.count_documents(
-                {"user_id": user_id, "shop_id": shop_id}
-            )
-
-            shop["csv_status"] = csv_status
-            shop["customer_count"] = customer_count
-            shop["product_count"] = product_count
-            shop["transaction_count"] = transaction_count
-            shop["live_stats"] = {
-                "active_batches": active_batches,
-                "total_campaigns": total_campaigns,
-                "sent": sent_count,
-                "failed": failed_count,
-                "pending": pending_count,
-                "total_messages": sent_count + failed_count + pending_count,
-            }
-            enriched.append(shop)
-
-        return enriched
+        stats = await ShopStatsStore(self.db).load(user_id, [shop["id"] for shop in shops])
+        return [{**shop, **stats[shop["id"]]} for shop in shops]
 
     async def get_shop_detail(self, shop_id: str, user_id: str) -> Optional[Dict[str, Any]]:
         """Get full shop detail including CSV status, counts, and behavioral insights."""
@@ -348,6 +282,38 @@ class ShopService:
         }
         return shop
 
+    async def get_segment_rules(self, shop_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        """The shop's segmentation rule table (the default waterfall unless overridden)."""
+        from utils.segmentation import DEFAULT_SEGMENT_RULES
+        shop = await self.db.shops.find_one(
+            {"id": shop_id, "user_id": user_id}, {"_id": 0, "segment_rules": 1}
+        )
+        if shop is None:
+            return None
+        rules = shop.get("segment_rules")
+        return {"segment_rules": rules or DEFAULT_SEGMENT_RULES, "is_default": not rules}
+
+    async def update_segment_rules(
+        self, shop_id: str, user_id: str, rules: Optional[List[Dict[str, Any]]]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Store (or, with rules=None, reset) the shop's segmentation rule table.
+        Takes effect at the next insights recalculation.
+
+        Raises:
+            ValueError: if the rule table is invalid.
+        """
+        from utils.segmentation import DEFAULT_SEGMENT_RULES, validate_segment_rules
+        if rules is None:
+            update = {"$unset": {"segment_rules": ""}}
+        else:
+            rules = validate_segment_rules(rules)
+            update = {"$set": {"segment_rules": rules}}
+        result = await self.db.shops.update_one({"id": shop_id, "user_id": user_id}, update)
+        if result.matched_count == 0:
+            return None
+        return {"segment_rules": rules or DEFAULT_SEGMENT_RULES, "is_default": rules is None}
+
     async def delete_campaign_data(self, shop_id: str, user_id: str) -> Dict[str, Any]:
         """Delete only campaign data (messages, batches, campaigns) for a shop. Keeps customer/product/transaction data."""
         batch_ids_cursor = self.db.batches.find(
@@ -370,6 +336,7 @@ class ShopService:
         campaigns = await self.db.campaigns.delete_many(
             {"user_id": user_id, "shop_id": shop_id}
         )
+        await ShopStatsStore(self.db).mark_stale(shop_id)
 
         return {
             "message": "Campaign data deleted successfully",
@@ -397,6 +364,8 @@ class ShopService:
             self.db.transactions.delete_many({"shop_id": shop_id}),
             self.db.customer_insights.delete_many({"shop_id": shop_id}),
             self.db.customer_behavior_map.delete_many({"shop_id": shop_id}),
+            self.db.product_affinity.delete_many({"shop_id": shop_id}),
+            self.db.customer_aggregates.delete_many({"shop_id": shop_id}),
             self.db.offers.delete_many({"shop_id": shop_id}),
             self.db.files.delete_many({"shop_id": shop_id}),
             self.db.templates.delete_many({"user_id": user_id, "shop_id": shop_id}),
@@ -405,16 +374,18 @@ class ShopService:
             self.db.messages.delete_many({"user_id": user_id, "shop_id": shop_id}),
             self.db.msg_queues.delete_many({"user_id": user_id, "shop_id": shop_id}),
             self.db.campaign_batches.delete_many({"user_id": user_id, "shop_id": shop_id}),
+            self.db.shop_stats.delete_many({"shop_id": shop_id}),
             self.db.shops.delete_one({"id": shop_id, "user_id": user_id})
         )
 
         (
             customers,
             products,
-            legacy_products,
             transactions,
             insights,
             behavior,
+            affinity,
+            aggregates,
             offers,
             files,
             templates,
@@ -423,6 +394,7 @@ class ShopService:
             messages,
             queues,
             cb,
+            _stats,
             shop_del
         ) = results
 
@@ -430,10 +402,12 @@ class ShopService:
             "message": "Shop and all associated data deleted permanently",
             "shop_deleted": shop_del.deleted_count,
             "customers_deleted": customers.deleted_count,
-            "products_deleted": products.deleted_count + legacy_products.deleted_count,
+            "products_deleted": products.deleted_count,
             "transactions_deleted": transactions.deleted_count,
             "insights_deleted": insights.deleted_count,
             "behavior_maps_deleted": behavior.deleted_count,
+            "product_affinity_deleted": affinity.deleted_count,
+            "customer_aggregates_deleted": aggregates.deleted_count,
             "offers_deleted": offers.deleted_count,
             "files_deleted": files.deleted_count,
             "templates_deleted": templates.deleted_count,
@@ -0,0 +1,271 @@
+"""
+Shop Stats — Denormalized Per-Shop Summary for the Shop List
+============================================================
+The shop list used to run 10+ queries per shop on every page load:
+latest file per data purpose, four count_documents, a batch-id scan and
+three message counts over those batches.  Each shop now has one summary
+document that the writers keep current, and list_shops reads all of
+them with a single find.
+
+Collection: shop_stats
+    shop_id, user_id
+    csv_status          {customer_data | product_data | transaction_data:
+                         {uploaded, last_updated, file_name}}
+    customer_count, product_count, transaction_count
+    live_stats          {active_batches, total_campaigns, sent, failed, pending}
+    stale               set by writers that cannot compute their delta
+    updated_at, reconciled_at
+
+Incremental writers ($inc / $set on an existing summary — never upserted,
+a missing summary is rebuilt on read):
+    file upload             csv_status.<purpose>             record_upload
+    customer upload         customer_count += new customers  increment
+    product upload          product_count += new products
+    transaction upload      transaction_count += inserted − replaced
+    campaign creation       total_campaigns += 1, then active_batches and
+                            pending += batches / messages as they are generated
+    scheduler transitions   sent or failed += 1 and pending −= 1 per terminal
+                            message, summed per micro-batch (increment_many);
+                            active_batches −= 1 when a batch closes
+    pause / resume / stop / cancel / requeue / deletes       mark_stale
+
+"pending" is every message still in flight — pending, processing, paused
+or retry_wait — the same set a batch's pending_count covers, so a retry
+never moves a message in or out of it.
+
+Reconciliation:
+    rebuild() recomputes one summary from the source collections.
+    list_shops rebuilds missing and stale summaries on read, and
+    reconcile() — scheduled by the scheduler worker every
+    SHOP_STATS_RECONCILE_SECONDS — rebuilds stale summaries, summaries
+    with batches or messages in flight, and any summary not rebuilt for
+    SHOP_STATS_FULL_RECONCILE_SECONDS, repairing drift (e.g. an increment
+    racing a rebuild).
+"""
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Any, Dict, List, Optional
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+SHOP_STATS_RECONCILE_SECONDS = 300
+SHOP_STATS_FULL_RECONCILE_SECONDS = 6 * 3600
+SHOP_STATS_RECONCILE_LIMIT = 200    # summaries rebuilt per reconcile pass
+
+CSV_PURPOSES = ("customer_data", "product_data", "transaction_data")
+COUNT_FIELDS = ("customer_count", "product_count", "transaction_count")
+LIVE_FIELDS = ("active_batches", "total_campaigns", "sent", "failed", "pending")
+
+ACTIVE_BATCH_STATUSES = ["pending", "scheduled", "sending"]
+SENT_STATUSES = ["sent", "delivered"]
+FAILED_STATUSES = ["failed", "failed_permanently"]
+PENDING_STATUSES = ["pending", "processing", "paused", "retry_wait"]
+
+
+def _iso(value: Any) -> Any:
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _empty_csv_status() -> Dict[str, Dict[str, Any]]:
+    return {purpose: {"uploaded": False, "last_updated": None, "file_name": None} for purpose in CSV_PURPOSES}
+
+
+def _field_path(field: str) -> str:
+    if field in COUNT_FIELDS:
+        return field
+    if field in LIVE_FIELDS:
+        return f"live_stats.{field}"
+    raise ValueError(f"Unknown shop_stats field {field!r}")
+
+
+def shop_stats_view(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """The summary fields list_shops returns for a shop."""
+    live = {field: doc.get("live_stats", {}).get(field, 0) for field in LIVE_FIELDS}
+    live["total_messages"] = live["sent"] + live["failed"] + live["pending"]
+    return {
+        "csv_status": {**_empty_csv_status(), **doc.get("csv_status", {})},
+        **{field: doc.get(field, 0) for field in COUNT_FIELDS},
+        "live_stats": live,
+    }
+
+
+class ShopStatsStore:
+    """Per-shop summary documents in shop_stats."""
+
+    def __init__(self, db: Any):
+        self.db = db
+
+    # ── Reads ────────────────────────────────────────────────────────────
+
+    async def load(self, user_id: str, shop_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Summaries of the given shops (one find); missing or stale ones are rebuilt."""
+        docs = {
+            doc["shop_id"]: doc async for doc in self.db.shop_stats.find(
+                {"shop_id": {"$in": shop_ids}}, {"_id": 0}
+            )
+        }
+        for shop_id in shop_ids:
+            doc = docs.get(shop_id)
+            if doc is None or doc.get("stale"):
+                docs[shop_id] = await self.rebuild(shop_id, user_id)
+        return {shop_id: shop_stats_view(docs[shop_id]) for shop_id in shop_ids}
+
+    # ── Full recomputation ───────────────────────────────────────────────
+
+    async def rebuild(self, shop_id: str, user_id: str) -> Dict[str, Any]:
+        """Recompute a shop's summary from the source collections and store it."""
+        csv_status = {}
+        for purpose in CSV_PURPOSES:
+            latest_file = await self.db.files.find_one(
+                {"shop_id": shop_id, "data_purpose": purpose},
+                {"_id": 0, "uploaded_at": 1, "original_file_name": 1},
+                sort=[("uploaded_at", -1)],
+            )
+            csv_status[purpose] = {
+                "uploaded": latest_file is not None,
+                "last_updated": _iso(latest_file.get("uploaded_at")) if latest_file else None,
+                "file_name": latest_file.get("original_file_name") if latest_file else None,
+            }
+
+        batch_ids = [
+            b["id"] async for b in self.db.batches.find(
+                {"user_id": user_id, "shop_id": shop_id}, {"_id": 0, "id": 1}
+            )
+        ]
+        message_counts = {"sent": 0, "failed": 0, "pending": 0}
+        if batch_ids:
+            async for row in self.db.messages.aggregate([
+                {"$match": {"batch_id": {"$in": batch_ids}}},
+                {"$group": {"_id": "$status", "count": {"$sum": 1}}},
+            ]):
+                if row["_id"] in SENT_STATUSES:
+                    message_counts["sent"] += row["count"]
+                elif row["_id"] in FAILED_STATUSES:
+                    message_counts["failed"] += row["count"]
+                elif row["_id"] in PENDING_STATUSES:
+                    message_counts["pending"] += row["count"]
+
+        now = datetime.now(timezone.utc)
+        doc = {
+            "shop_id": shop_id,
+            "user_id": user_id,
+            "csv_status": csv_status,
+            "customer_count": await self.db.customers.count_documents({"user_id": user_id, "shop_id": shop_id}),
+            "product_count": await self.db.products.count_documents({"shop_id": shop_id}),
+            "transaction_count": await self.db.transactions.count_documents({"shop_id": shop_id}),
+            "live_stats": {
+                "active_batches": await self.db.batches.count_documents(
+                    {"user_id": user_id, "shop_id": shop_id, "status": {"$in": ACTIVE_BATCH_STATUSES}}
+                ),
+                "total_campaigns": await self.db.campaigns.count_documents({"user_id": user_id, "shop_id": shop_id}),
+                **message_counts,
+            },
+            "stale": False,
+            "updated_at": now,
+            "reconciled_at": now,
+        }
+        await self.db.shop_stats.replace_one({"shop_id": shop_id}, doc, upsert=True)
+        return doc
+
+    async def reconcile(self) -> int:
+        """
+        Drift repair pass: rebuild stale summaries, summaries with campaigns
+        in flight and summaries older than SHOP_STATS_FULL_RECONCILE_SECONDS.
+        Returns the number rebuilt.
+        """
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=SHOP_STATS_FULL_RECONCILE_SECONDS)
+        rebuilt = 0
+        try:
+            due = await self.db.shop_stats.find(
+                {"$or": [
+                    {"stale": True},
+                    {"live_stats.active_batches": {"$gt": 0}},
+                    {"live_stats.pending": {"$gt": 0}},
+                    {"reconciled_at": {"$lt": cutoff}},
+                ]},
+                {"_id": 0, "shop_id": 1, "user_id": 1},
+            ).sort("reconciled_at", 1).limit(SHOP_STATS_RECONCILE_LIMIT).to_list(None)
+            for doc in due:
+                await self.rebuild(doc["shop_id"], doc["user_id"])
+                rebuilt += 1
+            if rebuilt:
+                logger.info(f"[ShopStats] Reconciled {rebuilt} shop summaries")
+        except Exception as e:
+            logger.error(f"[ShopStats] Reconciliation error: {e}", exc_info=True)
+        return rebuilt
+
+    # ── Incremental writers ──────────────────────────────────────────────
+
+    async def create(self, shop_id: str, user_id: str):
+        """Zeroed summary for a newly created shop."""
+        now = datetime.now(timezone.utc)
+        await self.db.shop_stats.update_one(
+            {"shop_id": shop_id},
+            {"$setOnInsert": {
+                "shop_id": shop_id,
+                "user_id": user_id,
+                "csv_status": _empty_csv_status(),
+                **dict.fromkeys(COUNT_FIELDS, 0),
+                "live_stats": dict.fromkeys(LIVE_FIELDS, 0),
+                "stale": False,
+                "updated_at": now,
+                "reconciled_at": now,
+            }},
+            upsert=True,
+        )
+
+    async def record_upload(self, shop_id: Optional[str], purpose: str, file_name: str, uploaded_at: Any):
+        """A data file was uploaded: it is now the shop's latest file for `purpose`."""
+        if not shop_id or purpose not in CSV_PURPOSES:
+            return
+        await self.db.shop_stats.update_one(
+            {"shop_id": shop_id},
+            {"$set": {
+                f"csv_status.{purpose}": {
+                    "uploaded": True,
+                    "last_updated": _iso(uploaded_at),
+                    "file_name": file_name,
+                },
+                "updated_at": datetime.now(timezone.utc),
+            }},
+        )
+
+    async def increment(self, shop_id: Optional[str], **deltas: int):
+        """$inc counters of one shop, e.g. increment(shop_id, customer_count=12)."""
+        if shop_id:
+            await self.increment_many({shop_id: deltas})
+
+    async def increment_many(self, deltas: Dict[str, Dict[str, int]]):
+        """$inc counters of several shops with one bulk_write ({shop_id: {field: delta}})."""
+        ops = []
+        for shop_id, fields in deltas.items():
+            inc = {_field_path(field): delta for field, delta in fields.items() if delta}
+            if shop_id and inc:
+                ops.append(UpdateOne(
+                    {"shop_id": shop_id},
+                    {"$inc": inc, "$set": {"updated_at": datetime.now(timezone.utc)}},
+                ))
+        if ops:
+            await self.db.shop_stats.bulk_write(ops, ordered=False)
+
+    async def mark_stale(self, shop_id: Optional[str]):
+        """The shop's summary changed in a way without a cheap delta; rebuild it on next read."""
+        if shop_id:
+            await self.db.shop_stats.update_one({"shop_id": shop_id}, {"$set": {"stale": True}})
+
+    async def mark_campaign_stale(self, campaign_id: Optional[str]):
+        """mark_stale for the shop of a campaign."""
+        if not campaign_id:
+            return
+        campaign = await self.db.campaigns.find_one({"_id": campaign_id}, {"_id": 0, "shop_id": 1})
+        if campaign:
+            await self.mark_stale(campaign.get("shop_id"))
+
+    async def mark_user_stale(self, user_id: str):
+        """mark_stale for every shop of a user (user-wide deletes)."""
+        await self.db.shop_stats.update_many({"user_id": user_id}, {"$set": {"stale": True}})
+
+    async def delete(self, shop_id: str):
+        await self.db.shop_stats.delete_many({"shop_id": shop_id})
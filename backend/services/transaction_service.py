@@ -1,21 +1,38 @@
 """
 Transaction service for processing transaction CSV uploads.
+Uploads are streamed: parsed block by block in the CPU process pool and
+inserted in chunks while the next blocks parse.
 Per schema spec:
   - transaction_id (UUID string, generated)
   - purchase_qty  (renamed from quantity)
   - total_amount  (renamed from amount)
 """
+import asyncio
 import io
 import logging
-import uuid
+import os
+from collections import Counter, deque
+from itertools import repeat
 from datetime import datetime, timezone
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Callable, Awaitable, AsyncIterator, Deque, Set, Tuple
 
+import numpy as np
 import pandas as pd
 from motor.motor_asyncio import AsyncIOMotorDatabase
 
+from services.job_service import CPU_WORKERS, run_cpu
+from services.shop_stats import ShopStatsStore
+
 logger = logging.getLogger(__name__)
 
+REQUIRED_COLUMNS = ["customer_id", "product_id", "purchase_date", "quantity", "amount"]
+ID_COLUMNS = ("customer_id", "product_id")
+
+TX_BLOCK_BYTES = 4 * 1024 * 1024   # CSV bytes per parse task (~50k rows)
+TX_PARSE_AHEAD = CPU_WORKERS       # blocks parsed concurrently in the process pool
+TX_QUEUE_BLOCKS = 2                # parsed blocks waiting for the inserter
+TX_INSERT_CHUNK = 10000            # documents per insert_many
+
 
 class TransactionService:
     """Service for transaction data operations."""
@@ -42,10 +59,24 @@ class TransactionService:
         shop_id: str,
         column_mapping: Dict[str, str],
         period_tag: str = None,
+        on_stage: Optional[Callable[[str], Awaitable[None]]] = None,
+        on_progress: Optional[Callable[[int, Optional[int]], Awaitable[None]]] = None,
     ) -> Dict[str, Any]:
         """
         Parse transaction CSV, store in transactions collection,
-        and trigger full insight recalculation (RFM + Level 2).
+        and update the insights (RFM + Level 2).
+
+        The upload is streamed: CSV files are cut into blocks of whole rows
+        (TX_BLOCK_BYTES), each parsed and turned into documents in the CPU
+        process pool while earlier blocks are being inserted, so memory
+        holds a few blocks of documents instead of the whole upload.  Excel
+        files are parsed as a single block.  on_stage(name) is awaited as
+        each stage starts ("parsing", "storing", "insights"), and
+        on_progress(rows_stored, estimated_rows) after every block.
+
+        Insights are updated incrementally from customer_aggregates when the
+        shop already has them (only this period's aggregates are regrouped);
+        otherwise the aggregates are built and a full recalculation runs.
 
         Stored fields per spec:
             transaction_id, shop_id, customer_id, product_id,
@@ -55,139 +86,382 @@ class TransactionService:
             Dict with transaction_count, categories_found, top_products_per_category,
             customer_category_percentages
         """
-        # Parse file
-        filename_lower = filename.lower()
-        if filename_lower.endswith(".csv"):
-            df = pd.read_csv(io.BytesIO(file_content))
-        elif filename_lower.endswith((".xlsx", ".xls")):
-            df = pd.read_excel(io.BytesIO(file_content))
-        else:
-            raise ValueError("Unsupported file format. Use CSV or Excel.")
-
-        # Apply column mapping (user maps their CSV headers → our canonical names)
-        reverse_map = {v: k for k, v in column_mapping.items() if v and v != "none"}
-        df = df.rename(columns=reverse_map)
-
-        # Validate required columns
-        required = ["customer_id", "product_id", "purchase_date", "quantity", "amount"]
-        missing = [col for col in required if col not in df.columns]
-        if missing:
-            raise ValueError(f"Missing required columns after mapping: {', '.join(missing)}")
-
-        # Clean data
-        df["customer_id"] = df["customer_id"].astype(str).str.strip()
-        df["product_id"] = df["product_id"].astype(str).str.strip()
-        df["purchase_date"] = pd.to_datetime(df["purchase_date"], errors="coerce")
-        df["quantity"] = pd.to_numeric(df["quantity"], errors="coerce").fillna(1).astype(int)
-        df["amount"] = pd.to_numeric(df["amount"], errors="coerce").fillna(0)
-
-        # Drop rows with missing critical data
-        df = df.dropna(subset=["purchase_date"])
-        df = df[df["customer_id"].str.len() > 0]
-        df = df[df["product_id"].str.len() > 0]
+        if on_stage:
+            await on_stage("parsing")
+        header, ranges = _split_upload(file_content, filename)
+        # Reject a file with missing columns before the period is wiped
+        await run_cpu(_check_transaction_header, header or file_content, filename, column_mapping)
 
-        # Look up product categories from products
-        product_ids = df["product_id"].unique().tolist()
-        products_cursor = self.db.products.find(
-            {"shop_id": shop_id, "product_id": {"$in": product_ids}},
-            {"_id": 0, "product_id": 1, "category": 1, "product_name": 1},
-        )
+        # Product categories / names for enrichment and the response summary
         product_map = {}
-        async for p in products_cursor:
+        async for p in self.db.products.find(
+            {"shop_id": shop_id}, {"_id": 0, "product_id": 1, "category": 1, "product_name": 1}
+        ):
             product_map[p["product_id"]] = p
-
-        # Enrich transactions with category
-        df["category"] = df["product_id"].map(
-            lambda pid: product_map.get(pid, {}).get("category", "Unknown")
-        )
+        categories = {pid: p.get("category") or "Unknown" for pid, p in product_map.items()}
 
         # Auto-detect period_tag if not provided
         if not period_tag:
-            try:
-                # Get most common month in the data
-                dominant_month = df["purchase_date"].dt.to_period("M").mode()[0]
-                period_tag = str(dominant_month)
-            except Exception as e:
-                logger.warning(f"Failed to auto-detect period_tag: {e}")
+            # Most common month in the data (ties: earliest), counted block by block
+            month_counts: Counter = Counter()
+            async for counts in _map_blocks(_count_block_months, file_content, header, ranges,
+                                            filename, column_mapping):
+                month_counts.update(counts)
+            if month_counts:
+                period_tag = max(sorted(month_counts.items()), key=lambda item: item[1])[0]
+            else:
+                logger.warning("Failed to auto-detect period_tag: no valid purchase dates")
                 period_tag = datetime.now(timezone.utc).strftime("%Y-%m")
-                
+
         logger.info(f"Processing transactions for shop {shop_id} with period_tag {period_tag}")
 
-        # Period-scoped replace (Addendum A / Bug 3 fix):
-        # Wipe old transactions for THIS period, then insert fresh.
-        deleted = await self.db.transactions.delete_many({
-            "shop_id": shop_id,
-            "period_tag": period_tag
-        })
+        # Period-scoped replace (Addendum A / Bug 3 fix): the period's current
+        # rows are flagged superseded (part of the unique_transaction_row_v2
+        # key, so an unchanged row can be inserted again next to its old copy),
+        # the fresh rows are inserted, and the flagged rows are deleted only
+        # once every block has been stored.  A block that fails to parse or
+        # insert removes this upload's rows and unflags the old ones instead,
+        # so the period — and its customer_aggregates — stay as they were.
+        if on_stage:
+            await on_stage("storing")
+        uploaded_at = datetime.now(timezone.utc).isoformat()
+        period_rows = {"shop_id": shop_id, "period_tag": period_tag}
+        await self.db.transactions.update_many(
+            {**period_rows, "superseded": {"$exists": False}},
+            {"$set": {"superseded": uploaded_at}},
+        )
+        estimated_rows = max(file_content.count(b"\n") - 1, 1) if header else None
+        queue: asyncio.Queue = asyncio.Queue(maxsize=TX_QUEUE_BLOCKS)
+
+        async def produce():
+            try:
+                async for block in _map_blocks(_process_transaction_block, file_content, header, ranges,
+                                               filename, column_mapping, categories, shop_id,
+                                               period_tag, uploaded_at):
+                    await queue.put(block)
+            except Exception as e:
+                await queue.put(e)
+            else:
+                await queue.put(None)
+
+        summary = _UploadSummary()
+        built = inserted = 0
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                block = await queue.get()
+                if block is None:
+                    break
+                if isinstance(block, Exception):
+                    raise block
+                tx_docs, stats = block
+                for start in range(0, len(tx_docs), TX_INSERT_CHUNK):
+                    inserted += await self._insert_transactions(tx_docs[start:start + TX_INSERT_CHUNK])
+                built += len(tx_docs)
+                summary.add(stats)
+                if on_progress:
+                    await on_progress(built, max(estimated_rows or built, built))
+        except BaseException:
+            removed = await self.db.transactions.delete_many(
+                {**period_rows, "uploaded_at": uploaded_at, "superseded": {"$exists": False}}
+            )
+            await self.db.transactions.update_many(
+                {**period_rows, "superseded": uploaded_at}, {"$unset": {"superseded": ""}}
+            )
+            logger.warning(f"Transaction upload for shop {shop_id} failed; "
+                           f"removed its {removed.deleted_count} stored rows for period {period_tag}")
+            raise
+        finally:
+            producer.cancel()
+
+        # Everything else in the period: the rows flagged above, plus any left
+        # flagged by an upload that died before its swap or rollback
+        deleted = await self.db.transactions.delete_many(
+            {**period_rows, "superseded": {"$exists": True}}
+        )
         if deleted.deleted_count > 0:
             logger.info(f"Deleted {deleted.deleted_count} existing transactions for period {period_tag}")
+        await ShopStatsStore(self.db).increment(
+            shop_id, transaction_count=inserted - deleted.deleted_count
+        )
+        logger.info(f"Inserted {inserted} of {built} transactions for shop {shop_id}")
 
-        # Prepare and insert transaction documents (per spec field names)
-        uploaded_at = datetime.now(timezone.utc).isoformat()
-        tx_docs = []
-        for _, row in df.iterrows():
-            doc = {
-                "transaction_id": str(uuid.uuid4()),    # NEW: per spec
-                "shop_id": shop_id,
-                "customer_id": str(row["customer_id"]),
-                "product_id": str(row["product_id"]),
-                "category": row["category"],
-                "purchase_date": row["purchase_date"],
-                "purchase_qty": int(row["quantity"]),    # renamed per spec
-                "total_amount": float(row["amount"]),    # renamed per spec
-                "period_tag": period_tag,                # NEW
-                "uploaded_at": uploaded_at,
-            }
-            tx_docs.append(doc)
+        # ── Update insights (RFM + Level 2) ─────────────────────────────────
+        from services.customer_aggregates import CustomerAggregateStore
+        from services.insights_service import recalculate_all_insights, recalculate_insights_incremental
+        if on_stage:
+            await on_stage("insights")
+        aggregates = CustomerAggregateStore(self.db)
+        if await aggregates.has_aggregates(shop_id):
+            changed = await aggregates.replace_period(shop_id, period_tag)
+            counts = await recalculate_insights_incremental(self.db, shop_id, changed)
+            insights_count = counts["profiled"] + counts["rescored"]
+            logger.info(f"Updated {insights_count} customer insights incrementally after transaction upload")
+        else:
+            await aggregates.rebuild(shop_id)
+            insights_count = await recalculate_all_insights(self.db, shop_id)
+            logger.info(f"Recalculated {insights_count} customer insights after transaction upload")
 
-        if tx_docs:
-            from pymongo.errors import BulkWriteError
-            try:
-                await self.db.transactions.insert_many(tx_docs, ordered=False)
-                logger.info(f"Inserted {len(tx_docs)} transactions for shop {shop_id}")
-            except BulkWriteError as bwe:
-                # Silently ignore duplicate row errors if unique index exists
-                n_inserted = bwe.details.get('nInserted', 0)
-                n_errors = len(bwe.details.get('writeErrors', []))
-                logger.info(f"Inserted {n_inserted} transactions for shop {shop_id}. Skipped {n_errors} duplicates.")
-
-        # ── Trigger full insight recalculation (RFM + Level 2) ──────────────
-        from services.insights_service import recalculate_all_insights
-        insights_count = await recalculate_all_insights(self.db, shop_id)
-        logger.info(f"Recalculated {insights_count} customer insights after transaction upload")
-
-        # ── Build response insights ──────────────────────────────────────────
-        categories_found = df["category"].nunique()
-
-        # Top product per category (by total purchase_qty)
-        top_per_cat = {}
-        for cat in df["category"].unique():
-            cat_df = df[df["category"] == cat]
-            top_product_id = cat_df.groupby("product_id")["quantity"].sum().idxmax()
-            prod_info = product_map.get(top_product_id, {})
-            top_per_cat[cat] = {
-                "product_id": top_product_id,
-                "product_name": prod_info.get("product_name", top_product_id),
-                "total_qty": int(cat_df[cat_df["product_id"] == top_product_id]["quantity"].sum()),
+        return {
+            "transaction_count": built,
+            **summary.result(product_map),
+            "insights_generated": insights_count,
+        }
+
+    async def _insert_transactions(self, tx_docs: List[Dict[str, Any]]) -> int:
+        """Unordered insert of one chunk; returns the number of documents inserted."""
+        if not tx_docs:
+            return 0
+        from pymongo.errors import BulkWriteError
+        try:
+            await self.db.transactions.insert_many(tx_docs, ordered=False)
+            return len(tx_docs)
+        except BulkWriteError as bwe:
+            # Silently ignore duplicate row errors if unique index exists
+            n_inserted = bwe.details.get('nInserted', 0)
+            n_errors = len(bwe.details.get('writeErrors', []))
+            logger.info(f"Inserted {n_inserted} transactions. Skipped {n_errors} duplicates.")
+            return n_inserted
+
+
+class _UploadSummary:
+    """Response summary, accumulated block by block from _process_transaction_block stats."""
+
+    def __init__(self):
+        self.product_qty: Dict[Tuple[str, str], int] = {}
+        self.category_customers: Set[Tuple[str, str]] = set()
+
+    def add(self, stats: Dict[str, Any]):
+        for category, product_id, qty in stats["product_qty"]:
+            key = (category, product_id)
+            self.product_qty[key] = self.product_qty.get(key, 0) + qty
+        self.category_customers.update(stats["category_customers"])
+
+    def result(self, product_map: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+        """Top product per category (by total purchase_qty) and customer share per category."""
+        # Ties go to the smallest product_id, as groupby().idxmax() did
+        best: Dict[str, Tuple[str, int]] = {}
+        for (category, product_id), qty in sorted(self.product_qty.items()):
+            if category not in best or qty > best[category][1]:
+                best[category] = (product_id, qty)
+        top_per_cat = {
+            category: {
+                "product_id": product_id,
+                "product_name": product_map.get(product_id, {}).get("product_name", product_id),
+                "total_qty": int(qty),
             }
+            for category, (product_id, qty) in best.items()
+        }
 
-        # Customer category percentages
-        total_unique_customers = df["customer_id"].nunique()
-        cat_customer_counts = {}
-        for cat in df["category"].unique():
-            cat_customers = df[df["category"] == cat]["customer_id"].nunique()
-            cat_customer_counts[cat] = round(cat_customers / total_unique_customers * 100, 1) if total_unique_customers > 0 else 0
+        customers_per_cat: Dict[str, int] = {}
+        for category, _ in self.category_customers:
+            customers_per_cat[category] = customers_per_cat.get(category, 0) + 1
+        total_unique_customers = len({customer for _, customer in self.category_customers})
+        cat_customer_counts = {
+            category: round(n / total_unique_customers * 100, 1) if total_unique_customers > 0 else 0
+            for category, n in customers_per_cat.items()
+        }
 
         return {
-            "transaction_count": len(tx_docs),
-            "categories_found": categories_found,
+            "categories_found": len(customers_per_cat),
             "top_products_per_category": top_per_cat,
             "customer_category_pct": cat_customer_counts,
             "unique_customers": total_unique_customers,
-            "insights_generated": insights_count,
         }
 
 
+# ── Upload blocks ────────────────────────────────────────────────────────────
+
+def _row_end(content: bytes, start: int, pos: int) -> int:
+    """
+    Offset just past the first newline at or after `pos` that ends a row.
+
+    `start` must be a row boundary; a newline only ends a row when the
+    number of '"' since `start` is even (RFC 4180 escapes a quote as ""),
+    so quoted fields with embedded newlines are never cut.
+    """
+    quotes = content.count(b'"', start, pos)
+    while True:
+        newline = content.find(b"\n", pos)
+        if newline < 0:
+            return len(content)
+        quotes += content.count(b'"', pos, newline)
+        if quotes % 2 == 0:
+            return newline + 1
+        pos = newline + 1
+
+
+def _split_upload(content: bytes, filename: str) -> Tuple[bytes, List[Tuple[int, int]]]:
+    """
+    CSV: the header row and (start, end) offsets of blocks of whole rows,
+    about TX_BLOCK_BYTES each — a block is parsed as header + content[start:end].
+    Excel: no header and a single block (the workbook cannot be cut).
+    """
+    if not filename.lower().endswith(".csv"):
+        return b"", [(0, len(content))]
+    header_end = _row_end(content, 0, 0)
+    ranges: List[Tuple[int, int]] = []
+    start = header_end
+    while start < len(content):
+        end = _row_end(content, start, min(start + TX_BLOCK_BYTES, len(content)))
+        ranges.append((start, end))
+        start = end
+    return content[:header_end], ranges
+
+
+async def _map_blocks(fn: Callable[..., Any], content: bytes, header: bytes,
+                      ranges: List[Tuple[int, int]], *args) -> AsyncIterator[Any]:
+    """Yield run_cpu(fn, block, *args) per block in order, TX_PARSE_AHEAD blocks in flight."""
+    pending: Deque[asyncio.Future] = deque()
+    try:
+        for start, end in ranges:
+            pending.append(asyncio.ensure_future(run_cpu(fn, header + content[start:end], *args)))
+            if len(pending) >= TX_PARSE_AHEAD:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+# ── CPU stages (run in the job process pool; arguments must be picklable) ────
+
+def _read_table(data: bytes, filename: str, **kwargs) -> pd.DataFrame:
+    filename_lower = filename.lower()
+    if filename_lower.endswith(".csv"):
+        return pd.read_csv(io.BytesIO(data), **kwargs)
+    elif filename_lower.endswith((".xlsx", ".xls")):
+        return pd.read_excel(io.BytesIO(data), **kwargs)
+    raise ValueError("Unsupported file format. Use CSV or Excel.")
+
+
+def _source_columns(column_mapping: Dict[str, str]) -> Dict[str, str]:
+    """The user's mapping as {file header: canonical name}."""
+    return {v: k for k, v in column_mapping.items() if v and v != "none"}
+
+
+def _check_transaction_header(data: bytes, filename: str, column_mapping: Dict[str, str]):
+    """Raise ValueError unless every required column is present after mapping."""
+    reverse_map = _source_columns(column_mapping)
+    columns = {reverse_map.get(c, c) for c in _read_table(data, filename, nrows=0).columns}
+    missing = [col for col in REQUIRED_COLUMNS if col not in columns]
+    if missing:
+        raise ValueError(f"Missing required columns after mapping: {', '.join(missing)}")
+
+
+def _clean_ids(ids: pd.Series) -> pd.Series:
+    """
+    Identifiers as stripped strings.  They are read as text so every block
+    of an upload agrees; all-digit ids are written without leading zeros,
+    as the former whole-file numeric parse (and the customer upload) wrote
+    them.
+    """
+    ids = ids.astype(str).str.strip()
+    numeric = ids.str.isdigit()
+    if numeric.any():
+        stripped = ids[numeric].str.lstrip("0")
+        ids[numeric] = stripped.where(stripped != "", "0")
+    return ids
+
+
+def _uuid4_strings(n: int) -> List[str]:
+    """n random (version 4) UUID strings, formatted in bulk instead of one uuid4() per row."""
+    raw = np.frombuffer(os.urandom(16 * n), dtype=np.uint8).reshape(n, 16).copy()
+    raw[:, 6] = (raw[:, 6] & 0x0F) | 0x40    # version 4
+    raw[:, 8] = (raw[:, 8] & 0x3F) | 0x80    # RFC 4122 variant
+    hexed = np.frombuffer(raw.tobytes().hex().encode("ascii"), dtype="S1").reshape(n, 32)
+    dash = np.full((n, 1), b"-", dtype="S1")
+    parts = [hexed[:, :8], dash, hexed[:, 8:12], dash, hexed[:, 12:16], dash, hexed[:, 16:20], dash, hexed[:, 20:]]
+    return np.ascontiguousarray(np.hstack(parts)).view("S36").ravel().astype(str).tolist()
+
+
+def _parse_transaction_file(file_content: bytes, filename: str, column_mapping: Dict[str, str],
+                            columns: Tuple[str, ...] = tuple(REQUIRED_COLUMNS)) -> pd.DataFrame:
+    """Read, map and clean a transaction upload (or one block of it), keeping `columns`."""
+    # Apply column mapping (user maps their CSV headers → our canonical names)
+    reverse_map = _source_columns(column_mapping)
+    id_dtypes = {c: str for c in ID_COLUMNS}
+    id_dtypes.update({src: str for src, canonical in reverse_map.items() if canonical in ID_COLUMNS})
+    df = _read_table(
+        file_content, filename,
+        usecols=lambda c: reverse_map.get(c, c) in columns,
+        dtype=id_dtypes,
+    )
+    df = df.rename(columns=reverse_map)
+
+    # Validate required columns
+    missing = [col for col in columns if col not in df.columns]
+    if missing:
+        raise ValueError(f"Missing required columns after mapping: {', '.join(missing)}")
+
+    # Clean data
+    df["customer_id"] = _clean_ids(df["customer_id"])
+    df["product_id"] = _clean_ids(df["product_id"])
+    df["purchase_date"] = pd.to_datetime(df["purchase_date"], errors="coerce")
+    if "quantity" in df.columns:
+        df["quantity"] = pd.to_numeric(df["quantity"], errors="coerce").fillna(1).astype(int)
+    if "amount" in df.columns:
+        df["amount"] = pd.to_numeric(df["amount"], errors="coerce").fillna(0)
+
+    # Drop rows with missing critical data
+    df = df.dropna(subset=["purchase_date"])
+    df = df[df["customer_id"].str.len() > 0]
+    df = df[df["product_id"].str.len() > 0]
+
+    return df
+
+
+def _count_block_months(block: bytes, filename: str, column_mapping: Dict[str, str]) -> Dict[str, int]:
+    """Valid rows per purchase month ("YYYY-MM") in one block, for period_tag detection."""
+    df = _parse_transaction_file(block, filename, column_mapping, ("customer_id", "product_id", "purchase_date"))
+    return df["purchase_date"].dt.to_period("M").astype(str).value_counts().to_dict()
+
+
+def _process_transaction_block(
+    block: bytes,
+    filename: str,
+    column_mapping: Dict[str, str],
+    categories: Dict[str, str],
+    shop_id: str,
+    period_tag: str,
+    uploaded_at: str,
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    One block → transaction documents (per spec field names), built column
+    by column, plus the block's contribution to the response summary.
+    """
+    df = _parse_transaction_file(block, filename, column_mapping)
+    # Enrich transactions with category
+    df["category"] = df["product_id"].map(categories).fillna("Unknown")
+
+    n = len(df)
+    columns = {
+        "transaction_id": _uuid4_strings(n),                       # NEW: per spec
+        "shop_id": repeat(shop_id, n),
+        "customer_id": df["customer_id"].tolist(),
+        "product_id": df["product_id"].tolist(),
+        "category": df["category"].tolist(),
+        # datetime.datetime values (cheap to pickle back to the event loop)
+        "purchase_date": df["purchase_date"].to_numpy().astype("datetime64[us]").tolist(),
+        "purchase_qty": df["quantity"].tolist(),                   # renamed per spec
+        "total_amount": df["amount"].astype(float).tolist(),       # renamed per spec
+        "period_tag": repeat(period_tag, n),                       # NEW
+        "uploaded_at": repeat(uploaded_at, n),
+    }
+    keys = list(columns)
+    tx_docs = [dict(zip(keys, row)) for row in zip(*columns.values())]
+
+    product_qty = df.groupby(["category", "product_id"])["quantity"].sum()
+    stats = {
+        "product_qty": [(cat, pid, int(qty)) for (cat, pid), qty in product_qty.items()],
+        "category_customers": list(
+            df[["category", "customer_id"]].drop_duplicates().itertuples(index=False, name=None)
+        ),
+    }
+    return tx_docs, stats
+
+
 async def regenerate_level2_profiles(db: AsyncIOMotorDatabase, shop_id: str) -> int:
     """
     On-demand re-run of full insight pipeline from existing transactions + products.
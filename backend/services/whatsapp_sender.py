@@ -2,14 +2,53 @@
 WhatsApp Web Sender — Phase 7 (Playwright Migration)
 =====================================================
 Sends messages via WhatsApp Web using Playwright.
-Uses a persistent browser context so the user only needs to scan the QR code once.
+Uses persistent browser contexts so each account only needs to scan the QR code once.
 
 Design decisions:
   - Playwright async API controls a visible/headless Chromium instance.
-  - Persistent context saves login state to `./whatsapp_profile`.
+  - Persistent context saves login state to `./whatsapp_profile`
+    (`./whatsapp_profile_<account>` for additional accounts).
   - Working hours check: 9AM–7PM IST.
-  - Daily message counter: stored in-memory; reset at midnight IST.
-  - Rate limit heuristic: if 5 consecutive failures occur → rate_limit.
+  - Daily message counter: per account and IST date.  Durable and shared
+    across workers once a quota store is attached (services/account_quota.py,
+    wired in at startup); in-memory otherwise.
+  - Rate limit heuristic: if 5 consecutive failures occur → rate_limit
+    (counter kept in the same store).
+
+Sender pool:
+  - One persistent context per WhatsApp account, each with
+    WHATSAPP_PAGES_PER_ACCOUNT tabs.  A per-account asyncio.Queue sits in
+    front of the tabs; every tab runs a worker that takes the next job.
+  - In-flight sends are capped per account (slot()): the scheduler holds
+    an account slot — one per tab — before its send timeout starts, so a
+    job never waits behind another tab's work inside that timeout.
+  - Per-send budget from the moment a tab takes the job:
+        goto NAVIGATE_TIMEOUT_MS + chat ready CHAT_READY_TIMEOUT_MS
+        + confirm SEND_CONFIRM_TIMEOUT_MS = 43s
+    which stays inside the scheduler's SEND_TIMEOUT_SECONDS (45s).
+  - Once a tab has started a send, the message may go out.  A caller that
+    gives up after that point (scheduler timeout) gets an "unknown"
+    outcome: the quota reservation is kept and the message is recorded
+    as unconfirmed for an operator to verify — never retried or
+    dead-lettered blindly.
+  - Messages are routed by shop_id to the account that owns the shop
+    (WHATSAPP_ACCOUNTS), anything unmapped goes to the first account.
+  - Completion is detected from the DOM instead of a fixed sleep:
+        chat ready   → send button visible, or the invalid-number dialog
+        delivered    → a new outgoing bubble carries a check-mark icon
+
+Configuration (.env, all optional):
+  WHATSAPP_ACCOUNTS            "main=shop_a,shop_b;second=shop_c"  (default: one account)
+  WHATSAPP_PAGES_PER_ACCOUNT   tabs per account (default 1)
+  WHATSAPP_HOME_URL            page opened at start (default https://web.whatsapp.com)
+  WHATSAPP_SEND_URL            chat URL template with {phone} and {text}
+
+Offline testing:
+  services/whatsapp_stub.html mimics the send button, the outgoing bubble
+  status icons and the invalid-number dialog (numbers ending in 0000).
+  Point the sender at it with
+      WHATSAPP_HOME_URL=file:///<abs path>/whatsapp_stub.html
+      WHATSAPP_SEND_URL=file:///<abs path>/whatsapp_stub.html?phone={phone}&text={text}
 """
 import asyncio
 import logging
@@ -18,7 +57,8 @@ import re
 import time
 import os
 from datetime import datetime, timezone, timedelta
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
+from urllib.parse import quote
 
 logger = logging.getLogger(__name__)
 
@@ -35,63 +75,95 @@ def _next_day_9am_ist_utc() -> datetime:
     return next_day - IST_OFFSET
 
 
-class WhatsAppWebSender:
-    WORKING_HOURS_START = 9   # 9 AM IST
-    WORKING_HOURS_END   = 19  # 7 PM IST
-    MAX_MESSAGES_PER_DAY = 200
+# ── WhatsApp Web DOM contract (also implemented by whatsapp_stub.html) ────────
+SEND_BUTTON_SELECTOR = 'button[aria-label="Send"]'
+INVALID_NUMBER_TEXT = "Phone number shared via url is invalid"
+OUTGOING_MESSAGE_SELECTOR = "div.message-out"
+SENT_ICON_SELECTOR = '[data-icon="msg-check"], [data-icon="msg-dblcheck"], [data-icon="msg-dblcheck-ack"]'
+
+NAVIGATE_TIMEOUT_MS = 8000
+CHAT_READY_TIMEOUT_MS = 20000
+SEND_CONFIRM_TIMEOUT_MS = 15000
+
+DEFAULT_ACCOUNT = "default"
+
+
+class _SendJob:
+    """One queued message; `started` is set when a tab begins sending it."""
+
+    __slots__ = ("phone", "message", "future", "started")
+
+    def __init__(self, phone: str, message: str, future: asyncio.Future):
+        self.phone = phone
+        self.message = message
+        self.future = future
+        self.started = False
+
+
+class WhatsAppAccountSession:
+    """One WhatsApp account: a persistent context, its tabs and their job queue."""
+
+    def __init__(self, account_id: str, profile_dir: str, pages: int, max_per_day: int,
+                 send_url: str, home_url: str):
+        self.account_id = account_id
+        self.profile_dir = profile_dir
+        self.page_count = max(1, pages)
+        self._max_per_day = max_per_day
+        self._send_url = send_url
+        self._home_url = home_url
 
-    def __init__(self):
-        self._max_per_day = int(os.environ.get("WHATSAPP_MAX_PER_DAY", str(self.MAX_MESSAGES_PER_DAY)))
         self._daily_count = 0
         self._daily_count_date: str = ""
         self._consecutive_failures = 0
-        
-        # Playwright state
-        self.playwright = None
+        # Optional AccountQuotaStore — durable counters shared by all workers
+        self.quota: Optional[Any] = None
+
         self.browser_context = None
-        self.page = None
+        self.pages: List[Any] = []
+        self._queue: asyncio.Queue = asyncio.Queue()
+        # In-flight cap: one slot per tab (taken by the scheduler, see slot())
+        self.slots = asyncio.Semaphore(self.page_count)
+        self._workers: List[asyncio.Task] = []
         self._is_running = False
 
-    async def start(self):
-        """Initialize Playwright and open WhatsApp Web."""
-        if self._is_running:
-            return
-            
-        try:
-            from playwright.async_api import async_playwright
-        except ImportError:
-            logger.error("Playwright not installed. Run: pip install playwright && playwright install chromium")
-            return
-
-        logger.info("[WhatsAppSender] Starting Playwright persistent context...")
-        self.playwright = await async_playwright().start()
-        
-        # Persistent context saves cookies/localstorage (QR code login)
-        profile_dir = os.path.join(os.getcwd(), "whatsapp_profile")
-        
-        self.browser_context = await self.playwright.chromium.launch_persistent_context(
-            user_data_dir=profile_dir,
-            headless=os.environ.get("WHATSAPP_HEADLESS", "false").lower() == "true",
+    async def start(self, playwright, headless: bool):
+        self.browser_context = await playwright.chromium.launch_persistent_context(
+            user_data_dir=self.profile_dir,
+            headless=headless,
             args=["--no-sandbox", "--disable-setuid-sandbox"]
         )
-        
-        self.page = await self.browser_context.new_page()
-        
-        # Navigate to WhatsApp
-        logger.info("[WhatsAppSender] Navigating to WhatsApp Web. Please scan QR if needed.")
-        await self.page.goto("https://web.whatsapp.com", wait_until="networkidle", timeout=60000)
-        
+        existing = list(self.browser_context.pages)
+        for i in range(self.page_count):
+            page = existing[i] if i < len(existing) else await self.browser_context.new_page()
+            await page.goto(self._home_url, wait_until="domcontentloaded", timeout=60000)
+            self.pages.append(page)
+            self._workers.append(asyncio.create_task(self._page_worker(page)))
         self._is_running = True
-        logger.info("[WhatsAppSender] Ready.")
+        logger.info(
+            f"[WhatsAppSender] Account '{self.account_id}' ready with {self.page_count} tab(s)."
+        )
 
     async def stop(self):
-        """Cleanly close Playwright."""
+        self._is_running = False
+        for task in self._workers:
+            task.cancel()
+        for task in self._workers:
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._workers = []
+        # Fail whatever is still queued so callers do not hang
+        while not self._queue.empty():
+            job = self._queue.get_nowait()
+            if not job.future.done():
+                job.future.set_result({
+                    "success": False, "provider_sid": None,
+                    "error": "playwright_not_running", "reschedule_at": None
+                })
         if self.browser_context:
             await self.browser_context.close()
-        if self.playwright:
-            await self.playwright.stop()
-        self._is_running = False
-        logger.info("[WhatsAppSender] Stopped.")
+        self.pages = []
 
     def _reset_daily_counter_if_needed(self):
         today_ist = _now_ist().strftime("%Y-%m-%d")
@@ -99,94 +171,295 @@ class WhatsAppWebSender:
             self._daily_count = 0
             self._daily_count_date = today_ist
 
-    def is_within_working_hours(self) -> bool:
-        hour_ist = _now_ist().hour
-        return self.WORKING_HOURS_START <= hour_ist < self.WORKING_HOURS_END
-
-    def _normalise_phone(self, phone: str) -> str:
-        cleaned = re.sub(r"[\s\-\(\)]", "", phone)
-        if not cleaned.startswith("+"):
-            cleaned = "+" + cleaned
-        # For the wa.me URL, drop the '+' sign
-        return cleaned.replace("+", "")
-
-    async def send_message(self, phone: str, message: str) -> Dict[str, Any]:
-        """Send a message using the active Playwright page."""
-        # if not self.is_within_working_hours():
-        #     return {
-        #         "success": False, "provider_sid": None,
-        #         "error": "outside_working_hours", "reschedule_at": _next_day_9am_ist_utc()
-        #     }
-
-        self._reset_daily_counter_if_needed()
-        if self._daily_count >= self._max_per_day:
+    async def submit(self, phone: str, message: str) -> Dict[str, Any]:
+        """Queue one message for the next free tab of this account and wait for the result."""
+        quota_exhausted = {
+            "success": False, "provider_sid": None,
+            "error": "rate_limit", "reschedule_at": _next_day_9am_ist_utc()
+        }
+        if not self._is_running or not self.pages:
             return {
                 "success": False, "provider_sid": None,
-                "error": "rate_limit", "reschedule_at": _next_day_9am_ist_utc()
+                "error": "playwright_not_running", "reschedule_at": None
             }
 
+        if self.quota is not None:
+            if not await self.quota.try_reserve(self.account_id, self._max_per_day):
+                return quota_exhausted
+        else:
+            self._reset_daily_counter_if_needed()
+            if self._daily_count >= self._max_per_day:
+                return quota_exhausted
+
         if self._consecutive_failures >= 5:
-            self._consecutive_failures = 0
-            return {
-                "success": False, "provider_sid": None,
-                "error": "rate_limit", "reschedule_at": _next_day_9am_ist_utc()
-            }
+            await self._reset_failures()
+            await self._release_reservation()
+            return quota_exhausted
 
-        if not self._is_running or not self.page:
+        job = _SendJob(phone, message, asyncio.get_running_loop().create_future())
+        await self._queue.put(job)
+        try:
+            result = await job.future
+        except asyncio.CancelledError:
+            if not job.started:
+                await asyncio.shield(self._release_reservation())
+                raise
+            # A tab is already sending: the message may still go out, so the
+            # reservation stays and the caller gets "unknown" instead of a
+            # failure it would retry or dead-letter.  The tab releases the
+            # reservation itself if the send then fails.
+            logger.warning(
+                f"[WhatsAppSender:{self.account_id}] Gave up waiting on an in-progress send to {phone}"
+            )
             return {
-                "success": False, "provider_sid": None,
-                "error": "playwright_not_running", "reschedule_at": None
+                "success": False, "provider_sid": None, "outcome": "unknown",
+                "error": "send_unconfirmed", "reschedule_at": None
             }
+        if not result.get("success"):
+            await self._release_reservation()
+        return result
+
+    async def _release_reservation(self):
+        if self.quota is not None:
+            await self.quota.release(self.account_id)
+
+    async def _record_success(self):
+        if self.quota is not None:
+            await self.quota.reset_failures(self.account_id)
+        else:
+            self._daily_count += 1
+        self._consecutive_failures = 0
+
+    async def _record_failure(self):
+        if self.quota is not None:
+            self._consecutive_failures = await self.quota.record_failure(self.account_id)
+        else:
+            self._consecutive_failures += 1
+
+    async def _reset_failures(self):
+        if self.quota is not None:
+            await self.quota.reset_failures(self.account_id)
+        self._consecutive_failures = 0
+
+    async def _page_worker(self, page):
+        """Drain the account queue through one tab."""
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.future.done():
+                    continue  # Caller gave up before the send started
+                job.started = True
+                result = await self._send_on_page(page, job.phone, job.message)
+                if not job.future.done():
+                    job.future.set_result(result)
+                elif not result.get("success"):
+                    await self._release_reservation()  # caller left with "unknown"
+            finally:
+                self._queue.task_done()
+
+    async def _send_on_page(self, page, phone: str, message: str) -> Dict[str, Any]:
+        url = self._send_url.format(phone=_normalise_phone(phone), text=quote(message))
 
-        clean_phone = self._normalise_phone(phone)
-        encoded_message = __import__('urllib').parse.quote(message)
-        
         try:
             # 1. Navigate to the chat
-            await self.page.goto(f"https://web.whatsapp.com/send?phone={clean_phone}&text={encoded_message}", wait_until="load")
-            
-            # 2. Wait for the send button to appear (or invalid number modal)
+            await page.goto(url, wait_until="domcontentloaded", timeout=NAVIGATE_TIMEOUT_MS)
+
+            # 2. Wait for the send button or the invalid number dialog — whichever shows first
+            send_button = page.locator(SEND_BUTTON_SELECTOR)
+            invalid_dialog = page.get_by_text(INVALID_NUMBER_TEXT)
             try:
-                # Wait for the chat text box/send button
-                await self.page.wait_for_selector('button[aria-label="Send"]', timeout=20000)
+                await send_button.or_(invalid_dialog).first.wait_for(
+                    state="visible", timeout=CHAT_READY_TIMEOUT_MS
+                )
             except Exception:
-                # Check if it's an invalid number dialog
-                invalid = await self.page.evaluate('''() => {
-                    return document.body.innerText.includes('Phone number shared via url is invalid');
-                }''')
-                if invalid:
-                    logger.warning(f"[WhatsAppSender] Invalid number {phone}")
-                    self._consecutive_failures += 1
-                    return {
-                        "success": False, "provider_sid": None,
-                        "error": "invalid_number", "reschedule_at": None
-                    }
                 raise Exception("Timeout waiting for send button or chat to load")
 
-            # 3. Click send (or press Enter)
-            await self.page.click('button[aria-label="Send"]')
-            
-            # 4. Wait for message to actually send (a simple wait for network to settle)
-            await asyncio.sleep(2)
-            
-            self._consecutive_failures = 0
-            self._daily_count += 1
-            sid = f"wa_{int(time.time())}"
-            logger.info(f"[WhatsAppSender] ✓ Sent to {phone} (sid={sid})")
-            
+            if not await send_button.is_visible():
+                logger.warning(f"[WhatsAppSender:{self.account_id}] Invalid number {phone}")
+                await self._record_failure()
+                return {
+                    "success": False, "provider_sid": None,
+                    "error": "invalid_number", "reschedule_at": None
+                }
+
+            # 3. Click send, then wait for the new outgoing bubble to get its check mark
+            outgoing_before = await page.locator(OUTGOING_MESSAGE_SELECTOR).count()
+            await send_button.click()
+            await page.wait_for_function(
+                """([selector, icons, before]) => {
+                    const bubbles = document.querySelectorAll(selector);
+                    if (bubbles.length <= before) return false;
+                    return !!bubbles[bubbles.length - 1].querySelector(icons);
+                }""",
+                arg=[OUTGOING_MESSAGE_SELECTOR, SENT_ICON_SELECTOR, outgoing_before],
+                timeout=SEND_CONFIRM_TIMEOUT_MS,
+            )
+
+            await self._record_success()
+            sid = f"wa_{self.account_id}_{int(time.time() * 1000)}"
+            logger.info(f"[WhatsAppSender:{self.account_id}] ✓ Sent to {phone} (sid={sid})")
+
             return {
                 "success": True, "provider_sid": sid,
                 "error": None, "reschedule_at": None
             }
-            
+
         except Exception as exc:
-            self._consecutive_failures += 1
-            logger.warning(f"[WhatsAppSender] Send failed to {phone}: {exc}")
+            await self._record_failure()
+            logger.warning(f"[WhatsAppSender:{self.account_id}] Send failed to {phone}: {exc}")
             return {
                 "success": False, "provider_sid": None,
                 "error": str(exc), "reschedule_at": None
             }
 
+
+def _normalise_phone(phone: str) -> str:
+    cleaned = re.sub(r"[\s\-\(\)]", "", phone)
+    if not cleaned.startswith("+"):
+        cleaned = "+" + cleaned
+    # For the wa.me URL, drop the '+' sign
+    return cleaned.replace("+", "")
+
+
+def _parse_accounts(spec: str) -> Dict[str, List[str]]:
+    """'main=shop_a,shop_b;second=shop_c' → {'main': ['shop_a', 'shop_b'], 'second': ['shop_c']}"""
+    accounts: Dict[str, List[str]] = {}
+    for part in spec.split(";"):
+        part = part.strip()
+        if not part:
+            continue
+        account, _, shops = part.partition("=")
+        accounts[account.strip()] = [s.strip() for s in shops.split(",") if s.strip()]
+    return accounts
+
+
+class WhatsAppWebSender:
+    """Pool of WhatsApp Web account sessions with per-shop routing."""
+
+    WORKING_HOURS_START = 9   # 9 AM IST
+    WORKING_HOURS_END   = 19  # 7 PM IST
+    MAX_MESSAGES_PER_DAY = 200
+
+    def __init__(self):
+        max_per_day = int(os.environ.get("WHATSAPP_MAX_PER_DAY", str(self.MAX_MESSAGES_PER_DAY)))
+        pages = int(os.environ.get("WHATSAPP_PAGES_PER_ACCOUNT", "1"))
+        home_url = os.environ.get("WHATSAPP_HOME_URL", "https://web.whatsapp.com")
+        send_url = os.environ.get(
+            "WHATSAPP_SEND_URL", "https://web.whatsapp.com/send?phone={phone}&text={text}"
+        )
+        base_profile = os.path.join(os.getcwd(), "whatsapp_profile")
+
+        accounts = _parse_accounts(os.environ.get("WHATSAPP_ACCOUNTS", "")) or {DEFAULT_ACCOUNT: []}
+        self.sessions: Dict[str, WhatsAppAccountSession] = {}
+        self._shop_routes: Dict[str, str] = {}
+        for i, (account_id, shops) in enumerate(accounts.items()):
+            # The first account keeps the original profile dir so existing logins survive
+            profile_dir = base_profile if i == 0 else f"{base_profile}_{account_id}"
+            self.sessions[account_id] = WhatsAppAccountSession(
+                account_id, profile_dir, pages, max_per_day, send_url, home_url
+            )
+            for shop_id in shops:
+                self._shop_routes[shop_id] = account_id
+        self._default_account = next(iter(self.sessions))
+
+        self._quota: Optional[Any] = None
+
+        # Playwright state
+        self.playwright = None
+        self._is_running = False
+
+    def use_quota_store(self, store: Any):
+        """Attach an AccountQuotaStore so quota / failure counters are durable and shared."""
+        for session in self.sessions.values():
+            session.quota = store
+        self._quota = store
+
+    async def over_quota_filter(self) -> Optional[Dict[str, Any]]:
+        """
+        Messages filter matching every message routed to an account whose
+        daily quota is used up (None when all accounts have quota left or no
+        store is attached).  Used by the scheduler's admission check.
+        """
+        if self._quota is None:
+            return None
+        exhausted = await self._quota.exhausted(
+            {account_id: s._max_per_day for account_id, s in self.sessions.items()}
+        )
+        if not exhausted:
+            return None
+        clauses = []
+        for account_id in exhausted:
+            if account_id == self._default_account:
+                # Default account: every shop not explicitly routed elsewhere
+                routed_elsewhere = [
+                    shop for shop, acc in self._shop_routes.items() if acc != account_id
+                ]
+                clauses.append({"shop_id": {"$nin": routed_elsewhere}})
+            else:
+                shops = [shop for shop, acc in self._shop_routes.items() if acc == account_id]
+                if shops:
+                    clauses.append({"shop_id": {"$in": shops}})
+        if not clauses:
+            return None
+        return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+    @property
+    def pool_size(self) -> int:
+        """Total tabs across all accounts (= max concurrent sends)."""
+        return sum(s.page_count for s in self.sessions.values())
+
+    async def start(self):
+        """Initialize Playwright and open WhatsApp Web for every account."""
+        if self._is_running:
+            return
+
+        try:
+            from playwright.async_api import async_playwright
+        except ImportError:
+            logger.error("Playwright not installed. Run: pip install playwright && playwright install chromium")
+            return
+
+        logger.info("[WhatsAppSender] Starting Playwright persistent contexts...")
+        self.playwright = await async_playwright().start()
+        headless = os.environ.get("WHATSAPP_HEADLESS", "false").lower() == "true"
+
+        logger.info("[WhatsAppSender] Navigating to WhatsApp Web. Please scan QR if needed.")
+        for session in self.sessions.values():
+            await session.start(self.playwright, headless)
+
+        self._is_running = True
+        logger.info(f"[WhatsAppSender] Ready — {len(self.sessions)} account(s), {self.pool_size} tab(s).")
+
+    async def stop(self):
+        """Cleanly close Playwright."""
+        for session in self.sessions.values():
+            await session.stop()
+        if self.playwright:
+            await self.playwright.stop()
+        self._is_running = False
+        logger.info("[WhatsAppSender] Stopped.")
+
+    def is_within_working_hours(self) -> bool:
+        hour_ist = _now_ist().hour
+        return self.WORKING_HOURS_START <= hour_ist < self.WORKING_HOURS_END
+
+    def account_for_shop(self, shop_id: Optional[str]) -> str:
+        return self._shop_routes.get(shop_id or "", self._default_account)
+
+    def slot(self, shop_id: Optional[str]) -> asyncio.Semaphore:
+        """In-flight slot of the account that owns `shop_id` (hold it around send_message)."""
+        return self.sessions[self.account_for_shop(shop_id)].slots
+
+    async def send_message(self, phone: str, message: str, shop_id: Optional[str] = None) -> Dict[str, Any]:
+        """Send a message through the account session that owns `shop_id`."""
+        # if not self.is_within_working_hours():
+        #     return {
+        #         "success": False, "provider_sid": None,
+        #         "error": "outside_working_hours", "reschedule_at": _next_day_9am_ist_utc()
+        #     }
+        session = self.sessions[self.account_for_shop(shop_id)]
+        return await session.submit(phone, message)
+
 # ── Module-level singleton ────────────────────────────────────────────────────
 _sender_instance: WhatsAppWebSender | None = None
 
@@ -0,0 +1,112 @@
+"""
+Period-scoped replace of transaction uploads (TransactionService.process_transactions)
+against an in-memory MongoDB with the production indexes.
+"""
+import asyncio
+
+import pytest
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+from config.database import Database
+from services import insights_service
+from services.customer_aggregates import CustomerAggregateStore
+from services.job_service import shutdown_process_pool
+from services.transaction_service import REQUIRED_COLUMNS, TransactionService
+
+SHOP_ID = "shop-1"
+PERIOD = "2024-01"
+HEADER = "customer_id,product_id,purchase_date,quantity,amount\n"
+MAPPING = {column: column for column in REQUIRED_COLUMNS}
+
+
+def _csv(rows):
+    return (HEADER + "".join(f"{c},{p},{d},{q},{a}\n" for c, p, d, q, a in rows)).encode()
+
+
+ROWS = [(f"c{i}", "p1", f"2024-01-{i + 1:02d}", 1, 10 * (i + 1)) for i in range(5)]
+
+
+async def _setup():
+    Database.client = mongomock_motor.AsyncMongoMockClient()
+    await Database.initialize_indexes()
+    db = Database.get_database()
+    await db.shop_stats.insert_one({"shop_id": SHOP_ID, "transaction_count": 0})
+    return db
+
+
+async def _upload(db, content):
+    return await TransactionService(db).process_transactions(
+        content, "tx.csv", "user-1", SHOP_ID, MAPPING, period_tag=PERIOD
+    )
+
+
+async def _state(db):
+    rows = await db.transactions.find({"shop_id": SHOP_ID}, {"_id": 0}).to_list(None)
+    stats = await db.shop_stats.find_one({"shop_id": SHOP_ID})
+    return rows, stats["transaction_count"]
+
+
+@pytest.fixture(autouse=True)
+def _no_insights(monkeypatch):
+    """The insights stage runs aggregation operators mongomock lacks; only storage is tested."""
+    async def no_aggregates(self, shop_id):
+        return False
+
+    async def skip(*args, **kwargs):
+        return 0
+
+    monkeypatch.setattr(CustomerAggregateStore, "has_aggregates", no_aggregates)
+    monkeypatch.setattr(CustomerAggregateStore, "rebuild", skip)
+    monkeypatch.setattr(insights_service, "recalculate_all_insights", skip)
+    yield
+    shutdown_process_pool()
+    Database.client = None
+
+
+def test_reupload_identical_file_keeps_period():
+    async def run():
+        db = await _setup()
+        await _upload(db, _csv(ROWS))
+        await _upload(db, _csv(ROWS))
+        return await _state(db)
+
+    rows, count = asyncio.run(run())
+    assert sorted(r["customer_id"] for r in rows) == [f"c{i}" for i in range(5)]
+    assert count == 5
+    assert not any("superseded" in r for r in rows)
+
+
+def test_reupload_partly_changed_file_replaces_period():
+    changed = ROWS[:3] + [("c9", "p1", "2024-01-20", 2, 99)]
+
+    async def run():
+        db = await _setup()
+        await _upload(db, _csv(ROWS))
+        await _upload(db, _csv(changed))
+        return await _state(db)
+
+    rows, count = asyncio.run(run())
+    assert sorted((r["customer_id"], r["total_amount"]) for r in rows) == [
+        ("c0", 10.0), ("c1", 20.0), ("c2", 30.0), ("c9", 99.0),
+    ]
+    assert count == 4
+    assert not any("superseded" in r for r in rows)
+
+
+def test_failed_reupload_leaves_period_untouched(monkeypatch):
+    async def fail_insert(self, tx_docs):
+        raise RuntimeError("insert failed")
+
+    async def run():
+        db = await _setup()
+        await _upload(db, _csv(ROWS))
+        monkeypatch.setattr(TransactionService, "_insert_transactions", fail_insert)
+        with pytest.raises(RuntimeError):
+            await _upload(db, _csv(ROWS[:2]))
+        return await _state(db)
+
+    rows, count = asyncio.run(run())
+    assert sorted(r["customer_id"] for r in rows) == [f"c{i}" for i in range(5)]
+    assert count == 5
+    assert not any("superseded" in r for r in rows)
@@ -2,5 +2,9 @@
 Utilities module.
 """
 from utils.classifier import parse_csv_file, classify_customers, prepare_message
+from utils.template_renderer import CompiledTemplate, compile_template, render_template
 
-__all__ = ["parse_csv_file", "classify_customers", "prepare_message"]
+__all__ = [
+    "parse_csv_file", "classify_customers", "prepare_message",
+    "CompiledTemplate", "compile_template", "render_template",
+]
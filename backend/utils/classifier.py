@@ -2,6 +2,8 @@ import pandas as pd
 import numpy as np
 from typing import Dict, List, Any, Optional
 from schemas import CustomerCategory
+from utils.template_renderer import render_template
+from utils.segmentation import assign_segments
 import io
 import re
 from scipy import stats
@@ -43,7 +45,8 @@ def detect_columns(file_content: bytes, filename: str) -> List[str]:
 def classify_customers_rfm(
     df: pd.DataFrame,
     column_mapping: Optional[Dict[str, str]] = None,
-    today: Optional[pd.Timestamp] = None
+    today: Optional[pd.Timestamp] = None,
+    segment_rules: Optional[List[Dict[str, Any]]] = None,
 ) -> tuple[pd.DataFrame, Dict[str, int], Dict[str, Any]]:
     """
     Hybrid RFM+B Intelligence: Enterprise-Grade Segmentation with Bulkiness Factor.
@@ -65,11 +68,13 @@ def classify_customers_rfm(
         3. Potential (Bulk): 5-11 AND B > Store Average
         4. Loyal (Frequent): 5-11 AND F >= M
         5. Boring: Total <= 4 OR no other rules met
+        (rule table: utils.segmentation.DEFAULT_SEGMENT_RULES)
     
     Args:
         df: DataFrame with customer data
         column_mapping: Map of standard names to actual column names
         today: Reference date for recency calculation (defaults to today)
+        segment_rules: Shop rule table overriding the default waterfall
     
     Returns:
         Tuple of (classified_df, segment_counts, rfm_info)
@@ -227,48 +232,12 @@ def classify_customers_rfm(
     df['rfm_score'] = pd.to_numeric(df['rfm_score'], errors='coerce').fillna(9).astype(int)
     
     # ==== PHASE 3: 5-TIER WATERFALL DECISION TREE ====
-    def apply_waterfall_segmentation(row, previous_segment=None):
-        """
-        Enhanced Self-Balancing 5-Tier Waterfall.
-
-        Rules (evaluated top-to-bottom; first match wins):
-          1. VIP         — total >= 12 AND (m >= 4 OR f == 5)
-          2. At-Risk     — r == 1 AND total > 4
-          3. Potential Bulk — 5 <= total <= 11 AND bulkiness > store_avg_bulkiness
-          4. Loyal Frequent — total >= 5 AND f >= 3 AND f >= m
-          5. Boring      — catch-all
-        """
-        total_score = row['rfm_score']
-        r_score = row['r_score']
-        f_score = row['f_score']
-        m_score = row['m_score']
-        bulk = float(row.get('bulkiness', 0.0))
-
-        # ── Rule 1: VIP Champions (Frequency Override) ──
-        # Catches highest spenders AND highly frequent daily shoppers
-        if total_score >= 12 and (m_score >= 4 or f_score == 5):
-            return CustomerCategory.VIP.value
-
-        # ── Rule 2: At-Risk Churn (tightened to bottom-20% recency only) ──
-        # r_score == 1 means coldest 20% of dataset — historically valuable but gone cold
-        elif r_score == 1 and total_score > 4:
-            return CustomerCategory.AT_RISK.value
-
-        # ── Rule 3: Potential Bulk Pantry Stockers ──
-        # Moderate engagement BUT buys significantly more items per basket than store average
-        elif 5 <= total_score <= 11 and bulk > store_avg_bulkiness:
-            return CustomerCategory.POTENTIAL_BULK.value
-
-        # ── Rule 4: Loyal Frequent Daily Habit (floor lowered to total >= 5) ──
-        # Rescues regular foot-traffic from falling into Boring bucket
-        elif total_score >= 5 and f_score >= 3 and f_score >= m_score:
-            return CustomerCategory.LOYAL_FREQUENT.value
-
-        # ── Rule 5: Boring Baseline Catch-All ──
-        else:
-            return CustomerCategory.BORING.value
-    
-    df['category'] = df.apply(apply_waterfall_segmentation, axis=1)
+    # Evaluated over whole score columns (numpy.select), first matching rule wins
+    df['category'] = assign_segments(
+        df.assign(recency_days=df['recency_raw']),
+        segment_rules,
+        {'store_avg_bulkiness': store_avg_bulkiness},
+    )
     df['segment'] = df['category']
     
     # Calculate classification counts
@@ -491,8 +460,4 @@ def prepare_message(template: str, customer_data: Dict[str, Any]) -> str:
     """
     Replace placeholders in message template with customer data.
     """
-    message = template
-    for key, value in customer_data.items():
-        placeholder = f"{{{{{key}}}}}"
-        message = message.replace(placeholder, str(value))
-    return message
+    return render_template(template, customer_data)
@@ -10,7 +10,8 @@ Computes 8 per-customer template variables from transaction + product data:
     {{recently_bought_product}}        - Product from the most recent transaction
     {{complementary_product}}          - Most co-purchased product alongside top premium/bulk product
 
-All logic is pure pandas — no DB access here. The transaction_service passes
+All logic is pure pandas / NumPy (scipy.sparse for the co-purchase matrix) —
+no DB access here. The transaction_service passes
 pre-loaded DataFrames and calls build_customer_profiles(), which returns a
 list of dicts ready for insertion into customer_insights.
 """
@@ -18,10 +19,11 @@ list of dicts ready for insertion into customer_insights.
 import re
 import logging
 from datetime import datetime, timezone
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
 
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 
 logger = logging.getLogger(__name__)
 
@@ -80,27 +82,15 @@ def tag_premium_products(products_df: pd.DataFrame) -> pd.DataFrame:
         df["price"] = 0
 
     # --- per-category premium threshold ---
-    cat_stats = (
-        df.groupby("category")["price"]
-        .agg(["mean", "std", "count"])
-        .rename(columns={"mean": "cat_mean", "std": "cat_std", "count": "cat_count"})
-    )
-    df = df.join(cat_stats, on="category")
-    
-    thresholds = []
-    for _, row in df.iterrows():
-        mean = row["cat_mean"]
-        std = row["cat_std"]
-        count = row["cat_count"]
-        
-        # Fallback: if category has only 1 item or prices are identical (std = 0)
-        if pd.isna(std) or std == 0 or count <= 1:
-            thresholds.append(mean * 1.15)
-        else:
-            thresholds.append(mean + 1.0 * std)
-            
-    df["premium_threshold"] = thresholds
-    heuristic_premium = (df["price"] > df["premium_threshold"]) | (df.get("product_type") == "premium")
+    by_category = df.groupby("category")["price"]
+    cat_mean = by_category.transform("mean")
+    cat_std = by_category.transform("std")
+    cat_count = by_category.transform("count")
+
+    # Fallback: if category has only 1 item or prices are identical (std = 0)
+    fallback = cat_std.isna() | (cat_std == 0) | (cat_count <= 1)
+    premium_threshold = np.where(fallback, cat_mean * 1.15, cat_mean + 1.0 * cat_std)
+    heuristic_premium = (df["price"] > premium_threshold) | (df.get("product_type") == "premium")
     
     # If is_premium already exists (e.g. loaded from MongoDB with manual overrides), respect it!
     if "is_premium" in df.columns:
@@ -113,7 +103,7 @@ def tag_premium_products(products_df: pd.DataFrame) -> pd.DataFrame:
     luxury_cutoff = df["price"].quantile(0.95)
     df["is_luxury"] = df["price"] >= luxury_cutoff
 
-    return df.drop(columns=["cat_mean", "cat_std", "cat_count", "premium_threshold"], errors="ignore")
+    return df
 
 
 def tag_bulk_products(products_df: pd.DataFrame) -> pd.DataFrame:
@@ -145,6 +135,67 @@ def tag_bulk_products(products_df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
+PRODUCT_FLAG_DTYPE = np.dtype([
+    ("product_name", object),
+    ("is_premium", bool),
+    ("is_bulk", bool),
+    ("is_luxury", bool),
+])
+
+
+class ProductFlags:
+    """
+    Product flag table: one row per product_id (last catalog row wins),
+    stored as a NumPy structured array (PRODUCT_FLAG_DTYPE) aligned with a
+    pandas Index of product ids.
+
+    Flags for a whole column of product ids are array lookups:
+
+        codes = flags.codes(tx["product_id"])      # row per id, -1 = not in catalog
+        is_premium = flags.column("is_premium", codes)
+    """
+
+    def __init__(self, product_ids: pd.Index, table: np.ndarray):
+        self.product_ids = product_ids
+        self.table = table
+        # Scalar name lookups (document assembly) go through a dict built from the arrays
+        self._names = dict(zip(product_ids.tolist(), table["product_name"].tolist()))
+
+    @classmethod
+    def from_products(cls, products_df: pd.DataFrame) -> "ProductFlags":
+        """Tag premium / bulk / luxury products and build the table."""
+        tagged = tag_bulk_products(tag_premium_products(products_df))
+        if tagged.empty:
+            return cls(pd.Index([], dtype=object), np.empty(0, dtype=PRODUCT_FLAG_DTYPE))
+
+        ids = tagged["product_id"].astype(str)
+        name_col = _find_col(tagged, ["product_name", "name", "item_name"], "")
+        names = tagged[name_col].astype(str) if name_col else ids
+        last = ~ids.duplicated(keep="last").to_numpy()
+
+        table = np.empty(int(last.sum()), dtype=PRODUCT_FLAG_DTYPE)
+        table["product_name"] = names.to_numpy()[last]
+        for field in ("is_premium", "is_bulk", "is_luxury"):
+            table[field] = tagged[field].fillna(False).to_numpy(dtype=bool)[last]
+        return cls(pd.Index(ids.to_numpy()[last], dtype=object), table)
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def codes(self, product_ids: Any) -> np.ndarray:
+        """Table row of each product id (-1 = not in the catalog)."""
+        return self.product_ids.get_indexer(product_ids)
+
+    def column(self, field: str, codes: np.ndarray) -> np.ndarray:
+        """`field` for each code; products outside the catalog get False."""
+        if not len(self.table):
+            return np.zeros(len(codes), dtype=bool)
+        return np.where(codes >= 0, self.table[field][codes], False)
+
+    def name_of(self, pid: Any) -> Optional[str]:
+        """Product name, or the id itself for products outside the catalog."""
+        return None if pid is None else self._names.get(pid, pid)
+
 
 # ---------------------------------------------------------------------------
 # 2. BEHAVIORAL MAPPING — Category Affinity
@@ -157,173 +208,204 @@ RECENCY_WEIGHTS = [
 ]
 
 
-def _recency_weight(days: float) -> float:
-    for threshold, weight in RECENCY_WEIGHTS:
-        if days <= threshold:
-            return weight
-    return 0.2
+def _recency_weights(days_ago: pd.Series) -> np.ndarray:
+    """Per-transaction recency weight (RECENCY_WEIGHTS lookup over the whole column)."""
+    days = days_ago.to_numpy()
+    return np.select(
+        [days <= threshold for threshold, _ in RECENCY_WEIGHTS],
+        [weight for _, weight in RECENCY_WEIGHTS],
+        default=0.2,
+    )
 
 
-def compute_category_affinity(
-    cust_df: pd.DataFrame,
-    today: pd.Timestamp,
-) -> Dict[str, float]:
+def compute_category_affinity(tx_df: pd.DataFrame, today: pd.Timestamp) -> pd.DataFrame:
     """
     Affinity(C) = 0.5 * spend_ratio(C) + 0.3 * freq_ratio(C) + 0.2 * recency_weight(C)
 
     recency_weight(C) = sum of per-transaction recency weights for transactions in C
-    """
-    if cust_df.empty:
-        return {}
-
-    total_spend = cust_df["amount"].sum()
-    total_txn = len(cust_df)
 
-    cust_df = cust_df.copy()
-    cust_df["days_ago"] = (today - cust_df["purchase_date"]).dt.days.clip(lower=0)
-    cust_df["rec_w"] = cust_df["days_ago"].apply(_recency_weight)
-
-    scores: Dict[str, float] = {}
-    for cat, cat_df in cust_df.groupby("category"):
-        spend_ratio = cat_df["amount"].sum() / total_spend if total_spend > 0 else 0
-        freq_ratio = len(cat_df) / total_txn if total_txn > 0 else 0
-        recency_w = cat_df["rec_w"].sum()
+    Computed for every (customer_id, category) pair with one groupby.  Returns a
+    frame indexed by (customer_id, category) with columns amount (category
+    spend) and affinity (rounded to 4 places).
+    """
+    days_ago = (today - tx_df["purchase_date"]).dt.days.clip(lower=0)
+    work = tx_df[["customer_id", "category", "amount"]].assign(rec_w=_recency_weights(days_ago))
 
-        affinity = 0.5 * spend_ratio + 0.3 * freq_ratio + 0.2 * recency_w
-        scores[str(cat)] = round(affinity, 4)
+    per_cat = work.groupby(["customer_id", "category"]).agg(
+        amount=("amount", "sum"),
+        n=("amount", "size"),
+        rec_w=("rec_w", "sum"),
+    )
+    totals = work.groupby("customer_id").agg(
+        total_spend=("amount", "sum"),
+        total_txn=("amount", "size"),
+    ).reindex(per_cat.index.get_level_values("customer_id"))
+
+    total_spend = totals["total_spend"].to_numpy()
+    spend_ratio = np.divide(
+        per_cat["amount"].to_numpy(), total_spend,
+        out=np.zeros(len(per_cat)), where=total_spend > 0,
+    )
+    freq_ratio = per_cat["n"].to_numpy() / totals["total_txn"].to_numpy()
+    affinity = 0.5 * spend_ratio + 0.3 * freq_ratio + 0.2 * per_cat["rec_w"].to_numpy()
 
-    return scores
+    return per_cat[["amount"]].assign(affinity=np.round(affinity, 4))
 
 
 # ---------------------------------------------------------------------------
-# 3. PER-CUSTOMER PRODUCT VARIABLES
+# 3. GROUPED RANKINGS & SHOP-WIDE FALLBACKS
 # ---------------------------------------------------------------------------
 
-def _best_premium(
-    cust_df: pd.DataFrame,
-    product_flags: Dict[str, Dict],
-    favorite_category: Optional[str],
-    exclude_product: Optional[str] = None,
-) -> Optional[str]:
-    """Return product_name with highest spend where is_premium=True."""
-    prem = cust_df[
-        cust_df["product_id"].map(lambda p: product_flags.get(p, {}).get("is_premium", False))
-    ]
-    if favorite_category:
-        prem_cat = prem[prem["category"] == favorite_category]
-        if not prem_cat.empty:
-            prem = prem_cat
-
-    if exclude_product:
-        prem = prem[prem["product_id"] != exclude_product]
-
-    if prem.empty:
-        return None
-
-    best_pid = prem.groupby("product_id")["amount"].sum().idxmax()
-    return product_flags.get(best_pid, {}).get("product_name", best_pid)
-
-
-def _best_bulk(
-    cust_df: pd.DataFrame,
-    product_flags: Dict[str, Dict],
-) -> Optional[str]:
-    """Return product_name with highest total quantity where is_bulk=True."""
-    bulk = cust_df[
-        cust_df["product_id"].map(lambda p: product_flags.get(p, {}).get("is_bulk", False))
-    ]
-    if bulk.empty:
-        return None
-
-    best_pid = bulk.groupby("product_id")["quantity"].sum().idxmax()
-    return product_flags.get(best_pid, {}).get("product_name", best_pid)
-
-
-def _recently_bought(
-    cust_df: pd.DataFrame,
-    product_flags: Dict[str, Dict],
-) -> Optional[str]:
-    """Return product name from the most recent transaction row."""
-    if cust_df.empty:
-        return None
-    latest_row = cust_df.sort_values("purchase_date", ascending=False).iloc[0]
-    pid = latest_row["product_id"]
-    return product_flags.get(pid, {}).get("product_name", pid)
-
-
-def _complementary_product(
-    cust_df: pd.DataFrame,
-    anchor_product_id: Optional[str],
-    all_tx_df: pd.DataFrame,
-    product_flags: Dict[str, Dict],
-) -> Optional[str]:
+def _ranked(
+    frame: pd.DataFrame,
+    group_cols: List[str],
+    value_col: str,
+    limit: int,
+) -> Any:
     """
-    Most commonly co-purchased product with anchor_product_id (across all customers).
+    (product_id, value) pairs ordered by value descending, at most `limit` per group.
 
-    Strategy:
-      1. Find all transaction dates where anchor_product was bought (by any customer).
-      2. On those dates find the next most-bought product (excluding anchor itself).
+    Ties keep product_id order, which is the pick groupby(...).idxmax() makes.
+    Returns {group key: [(pid, value), ...]}, or a plain list when group_cols
+    is empty (shop-wide ranking).
     """
-    if anchor_product_id is None or all_tx_df.empty:
-        return None
-
-    # Dates when anchor was bought store-wide
-    anchor_dates = all_tx_df[all_tx_df["product_id"] == anchor_product_id]["purchase_date"].dt.date.unique()
-
-    if len(anchor_dates) == 0:
-        return None
-
-    # All transactions on those dates excluding the anchor
-    co_tx = all_tx_df[
-        (all_tx_df["purchase_date"].dt.date.isin(anchor_dates))
-        & (all_tx_df["product_id"] != anchor_product_id)
-    ]
+    ordered = frame.sort_values(
+        group_cols + [value_col, "product_id"],
+        ascending=[True] * len(group_cols) + [False, True],
+        kind="mergesort",
+    )
+    if not group_cols:
+        head = ordered.head(limit)
+        return list(zip(head["product_id"].tolist(), head[value_col].tolist()))
 
-    if co_tx.empty:
-        return None
+    head = ordered[ordered.groupby(group_cols, sort=False).cumcount() < limit]
+    keys = head[group_cols[0]].tolist() if len(group_cols) == 1 else list(
+        zip(*(head[c].tolist() for c in group_cols))
+    )
+    ranked: Dict[Any, List] = {}
+    for key, pid, value in zip(keys, head["product_id"].tolist(), head[value_col].tolist()):
+        ranked.setdefault(key, []).append((pid, value))
+    return ranked
 
-    # Most frequent co-purchased product
-    top_pid = co_tx["product_id"].value_counts().idxmax()
-    return product_flags.get(top_pid, {}).get("product_name", top_pid)
 
+def _first(ranked: Optional[List], exclude: Any = None) -> Optional[Any]:
+    """First product_id of a ranking, skipping `exclude` (when given)."""
+    for pid, _value in ranked or ():
+        if exclude is None or pid != exclude:
+            return pid
+    return None
 
-def _fallback_premium_for_category(
-    cat: Optional[str],
-    all_tx_df: pd.DataFrame,
-    product_flags: Dict[str, Dict],
-) -> Optional[str]:
-    """Return the product_id of the global best-selling premium product in cat (fallback)."""
-    if cat is None or all_tx_df.empty:
-        return None
 
-    cat_tx = all_tx_df[all_tx_df["category"] == cat]
-    prem_tx = cat_tx[cat_tx["product_id"].map(lambda p: product_flags.get(p, {}).get("is_premium", False))]
+# ---------------------------------------------------------------------------
+# 4. CO-PURCHASE MATRIX — Complementary Products
+# ---------------------------------------------------------------------------
 
-    if prem_tx.empty:
-        return None
+CO_PURCHASE_TOP_K = 10   # related products persisted per product in product_affinity
 
-    top_pid = prem_tx.groupby("product_id")["amount"].sum().idxmax()
-    return top_pid
 
+class CoPurchaseMatrix:
+    """
+    Sparse product × product co-purchase counts for one shop.
 
-def _fallback_bulk_global(
-    all_tx_df: pd.DataFrame,
-    product_flags: Dict[str, Dict],
-) -> Optional[str]:
-    """Return the global highest-quantity bulk product (fallback)."""
-    if all_tx_df.empty:
-        return None
+    A basket is one purchase day (across all customers).  With
+        B[d, p] = transactions of product p on day d
+        A[d, p] = 1 if product p was bought on day d
+    the matrix is counts = Aᵀ · B with the diagonal cleared, i.e. counts[a, b]
+    is the number of transactions of b on the days a was bought — the figure
+    the former per-anchor scan computed.  The best partner of every product
+    is found once (row argmax), so complementary() is a dict lookup.
 
-    bulk_tx = all_tx_df[all_tx_df["product_id"].map(lambda p: product_flags.get(p, {}).get("is_bulk", False))]
-    if bulk_tx.empty:
-        return None
+    Ties go to the lowest product_id.
+    """
 
-    top_pid = bulk_tx.groupby("product_id")["quantity"].sum().idxmax()
-    return product_flags.get(top_pid, {}).get("product_name", top_pid)
+    def __init__(self, product_ids: np.ndarray, counts: sp.csr_matrix, baskets: np.ndarray):
+        self.product_ids = product_ids
+        self.counts = counts
+        self.baskets = baskets            # purchase days per product
+        self._index = {pid: i for i, pid in enumerate(product_ids.tolist())}
+
+        best = np.full(len(product_ids), -1, dtype=np.int64)
+        if counts.nnz:
+            has_partner = np.diff(counts.indptr) > 0
+            best[has_partner] = np.asarray(counts.argmax(axis=1)).ravel()[has_partner]
+        self._best = best
+
+    @classmethod
+    def from_transactions(cls, tx_df: pd.DataFrame) -> "CoPurchaseMatrix":
+        """Build from a transactions frame (product_id, purchase_date)."""
+        dates = pd.to_datetime(tx_df["purchase_date"], errors="coerce")
+        valid = dates.notna().to_numpy()
+        return cls.from_baskets(
+            dates.to_numpy()[valid].astype("datetime64[D]"),
+            tx_df["product_id"].to_numpy()[valid],
+            np.ones(int(valid.sum()), dtype=np.int64),
+        )
+
+    @classmethod
+    def from_baskets(cls, days: Any, product_ids: Any, counts: Any) -> "CoPurchaseMatrix":
+        """
+        Build from (day, product_id, transaction count) rows — e.g. a
+        server-side $group of the transactions — without loading every
+        transaction.  Repeated (day, product_id) pairs are summed.
+        """
+        product_codes, product_ids = pd.factorize(pd.Series(product_ids, dtype=object), sort=True)
+        day_codes, days = pd.factorize(pd.Series(days))
+        valid = (product_codes >= 0) & (day_codes >= 0)
+
+        shape = (len(days), len(product_ids))
+        basket = sp.csr_matrix(
+            (np.asarray(counts, dtype=np.int64)[valid], (day_codes[valid], product_codes[valid])),
+            shape=shape,
+        )
+        basket.sum_duplicates()
+        bought = basket.copy()
+        bought.data[:] = 1
+
+        counts = (bought.T @ basket).tocsr()
+        counts.setdiag(0)
+        counts.eliminate_zeros()
+        counts.sort_indices()
+        baskets = np.asarray(bought.sum(axis=0)).ravel()
+        return cls(np.asarray(product_ids, dtype=object), counts, baskets)
+
+    def complementary(self, product_id: Any) -> Optional[Any]:
+        """Most co-purchased product with `product_id`, or None."""
+        i = self._index.get(product_id)
+        if i is None or self._best[i] < 0:
+            return None
+        return self.product_ids[self._best[i]]
+
+    def related(self, product_id: Any, k: int = CO_PURCHASE_TOP_K) -> List[Tuple[Any, int]]:
+        """Top-k (product_id, count) partners of `product_id`, most co-purchased first."""
+        i = self._index.get(product_id)
+        if i is None:
+            return []
+        start, end = self.counts.indptr[i], self.counts.indptr[i + 1]
+        cols = self.counts.indices[start:end]
+        vals = self.counts.data[start:end]
+        order = np.lexsort((cols, -vals))[:k]
+        return [(self.product_ids[c], int(v)) for c, v in zip(cols[order], vals[order])]
+
+    def to_docs(self, shop_id: str, updated_at: str, k: int = CO_PURCHASE_TOP_K) -> List[Dict[str, Any]]:
+        """product_affinity documents: one per product that has co-purchases."""
+        docs = []
+        for i in np.flatnonzero(np.diff(self.counts.indptr) > 0):
+            pid = self.product_ids[i]
+            docs.append({
+                "shop_id": shop_id,
+                "product_id": pid,
+                "baskets": int(self.baskets[i]),
+                "related": [
+                    {"product_id": other, "count": count}
+                    for other, count in self.related(pid, k)
+                ],
+                "updated_at": updated_at,
+            })
+        return docs
 
 
 # ---------------------------------------------------------------------------
-# 4. MAIN ENTRY POINT
+# 5. MAIN ENTRY POINT
 # ---------------------------------------------------------------------------
 
 def build_customer_profiles(
@@ -332,6 +414,8 @@ def build_customer_profiles(
     shop_id: str,
     today: Optional[pd.Timestamp] = None,
     segment_map: Optional[Dict[str, str]] = None,
+    co_purchase: Optional[CoPurchaseMatrix] = None,
+    shop_tx: Optional[pd.DataFrame] = None,
 ) -> List[Dict[str, Any]]:
     """
     Core Level 2 profiler. Returns list of behavior_map docs (one per customer).
@@ -342,6 +426,11 @@ def build_customer_profiles(
         category_affinity_scores, fav_items, recent_purchases, top_categories,
         total_spent, total_transactions, last_purchase_date.
 
+    Vectorized: product flags are joined once, per-(customer, product) and
+    per-(customer, category) aggregates come from one groupby each, favorites
+    are picked from grouped rankings, and the shop-wide fallbacks are computed
+    once.  Only the final document assembly loops over customers.
+
     Args:
         tx_df:       Transactions DataFrame with columns:
                      customer_id, product_id, purchase_date, quantity, amount, category
@@ -349,6 +438,11 @@ def build_customer_profiles(
                      product_id, product_name, category, price (or unit_price)
         shop_id:     Shop identifier for scoping DB docs.
         today:       Reference timestamp (defaults to now).
+        co_purchase: Shop co-purchase matrix (built from tx_df when omitted).
+        shop_tx:     Shop-wide rows (product_id, category, amount, quantity) for
+                     the fallbacks, when tx_df holds only some customers.
+                     Pre-aggregated (category, product_id) totals rank the
+                     same as the raw transactions.  Defaults to tx_df.
     """
     if today is None:
         today = pd.Timestamp.now()
@@ -358,215 +452,198 @@ def build_customer_profiles(
         return []
 
     # ---- Tag products ----
-    tagged = tag_premium_products(products_df)
-    tagged = tag_bulk_products(tagged)
-
-    # Build fast lookup: product_id → {product_name, is_premium, is_bulk, is_luxury}
-    product_flags: Dict[str, Dict] = {}
-    for _, row in tagged.iterrows():
-        pid = str(row["product_id"])
-        name_col = _find_col(tagged, ["product_name", "name", "item_name"], "")
-        product_flags[pid] = {
-            "product_name": str(row[name_col]) if name_col else pid,
-            "is_premium": bool(row.get("is_premium", False)),
-            "is_bulk": bool(row.get("is_bulk", False)),
-            "is_luxury": bool(row.get("is_luxury", False)),
-        }
+    product_flags = ProductFlags.from_products(products_df)
+    name_of = product_flags.name_of
 
     # Ensure purchase_date is datetime
-    tx_df = tx_df.copy()
-    tx_df["purchase_date"] = pd.to_datetime(tx_df["purchase_date"], errors="coerce")
-    tx_df = tx_df.dropna(subset=["purchase_date"])
-
-    all_tx_df = tx_df  # reference for co-purchase analysis
-
-    docs: List[Dict[str, Any]] = []
+    tx = tx_df[["customer_id", "product_id", "category", "purchase_date", "quantity", "amount"]].copy()
+    tx["purchase_date"] = pd.to_datetime(tx["purchase_date"], errors="coerce")
+    tx = tx.dropna(subset=["purchase_date"]).reset_index(drop=True)
+
+    # ---- Join product flags once ----
+    codes = product_flags.codes(tx["product_id"])
+    tx["is_premium"] = product_flags.column("is_premium", codes)
+    tx["is_bulk"] = product_flags.column("is_bulk", codes)
+    prem_tx = tx[tx["is_premium"]]
+
+    if shop_tx is None:
+        shop_tx = tx
+    else:
+        shop_codes = product_flags.codes(shop_tx["product_id"])
+        shop_tx = shop_tx[["product_id", "category", "amount", "quantity"]].assign(
+            is_premium=product_flags.column("is_premium", shop_codes),
+            is_bulk=product_flags.column("is_bulk", shop_codes),
+        )
+    shop_prem_tx = shop_tx[shop_tx["is_premium"]]
+    shop_bulk_tx = shop_tx[shop_tx["is_bulk"]]
+
+    # ---- Per-(customer, product) aggregates ----
+    cust_prod = tx.groupby(["customer_id", "product_id"], as_index=False).agg(
+        amount=("amount", "sum"),
+        quantity=("quantity", "sum"),
+        is_premium=("is_premium", "first"),
+        is_bulk=("is_bulk", "first"),
+    )
+    max_top_n = max(max(TOP_N_BY_SEGMENT.values()), DEFAULT_TOP_N)
+    qty_rank = _ranked(cust_prod, ["customer_id"], "quantity", max_top_n + 2)
+    prem_rank = _ranked(cust_prod[cust_prod["is_premium"]], ["customer_id"], "amount", 2)
+    bulk_rank = _ranked(cust_prod[cust_prod["is_bulk"]], ["customer_id"], "quantity", 1)
+
+    # ---- Per-(customer, category) aggregates: affinity, favorite & top categories ----
+    cust_cat = compute_category_affinity(tx, today)
+    affinity_scores_map: Dict[Any, Dict[str, float]] = {}
+    for (cust_id, cat), affinity in zip(cust_cat.index.tolist(), cust_cat["affinity"].tolist()):
+        affinity_scores_map.setdefault(cust_id, {})[str(cat)] = affinity
+    favorite_category_map = {
+        cust_id: str(cat) for cust_id, cat in cust_cat["affinity"].groupby(level=0).idxmax().tolist()
+    }
+    top_cat = cust_cat.reset_index().sort_values(
+        ["customer_id", "amount"], ascending=[True, False], kind="mergesort"
+    )
+    top_cat = top_cat[top_cat.groupby("customer_id", sort=False).cumcount() < 3]
+    top_categories_map: Dict[Any, List] = {}
+    for cust_id, cat in zip(top_cat["customer_id"].tolist(), top_cat["category"].tolist()):
+        top_categories_map.setdefault(cust_id, []).append(cat)
+
+    # ---- Premium spend inside each customer's favorite category ----
+    fav_filter = {c: cat for c, cat in favorite_category_map.items() if cat}
+    prem_in_fav = prem_tx[prem_tx["category"] == prem_tx["customer_id"].map(fav_filter)]
+    prem_fav_rank = _ranked(
+        prem_in_fav.groupby(["customer_id", "product_id"], as_index=False)["amount"].sum(),
+        ["customer_id"], "amount", 2,
+    )
 
-    for cust_id, cust_df in tx_df.groupby("customer_id"):
-        cust_df = cust_df.copy()
+    # ---- Shop-wide fallbacks (once per shop) ----
+    cat_prem_rank = _ranked(
+        shop_prem_tx.groupby(["category", "product_id"], as_index=False)["amount"].sum(),
+        ["category"], "amount", 2,
+    )
+    global_prem_rank = _ranked(shop_prem_tx.groupby("product_id", as_index=False)["amount"].sum(), [], "amount", 2)
+    global_bulk_rank = _ranked(shop_bulk_tx.groupby("product_id", as_index=False)["quantity"].sum(), [], "quantity", 1)
+    cat_qty_rank = _ranked(
+        shop_tx.groupby(["category", "product_id"], as_index=False)["quantity"].sum(),
+        ["category"], "quantity", 2,
+    )
+    global_qty_rank = _ranked(shop_tx.groupby("product_id", as_index=False)["quantity"].sum(), [], "quantity", 2)
+
+    # ---- Recent purchases: unique products by latest purchase (ties: upload order) ----
+    by_date = tx.sort_values(["customer_id", "purchase_date"], ascending=[True, False], kind="mergesort")
+    recent = by_date.drop_duplicates(["customer_id", "product_id"])
+    recent = recent[recent.groupby("customer_id", sort=False).cumcount() < 10]
+    recent_map: Dict[Any, List] = {}
+    for cust_id, pid in zip(recent["customer_id"].tolist(), recent["product_id"].tolist()):
+        recent_map.setdefault(cust_id, []).append(pid)
+
+    # ---- Aggregate stats ----
+    cust_totals = tx.groupby("customer_id").agg(
+        total_spent=("amount", "sum"),
+        total_transactions=("amount", "size"),
+        last_purchase=("purchase_date", "max"),
+    )
 
-        # ---- Category Affinity ----
-        affinity_scores = compute_category_affinity(cust_df, today)
+    if co_purchase is None:
+        co_purchase = CoPurchaseMatrix.from_transactions(tx)
 
-        favorite_category: Optional[str] = None
-        if affinity_scores:
-            favorite_category = max(affinity_scores, key=lambda k: affinity_scores[k])
+    updated_at = datetime.now(timezone.utc).isoformat()
+    docs: List[Dict[str, Any]] = []
 
-        # ---- Top categories (for backward compat) ----
-        cat_spend = cust_df.groupby("category")["amount"].sum().sort_values(ascending=False)
-        top_categories = cat_spend.head(3).index.tolist()
+    for cust_id, total_spent, total_transactions, last_purchase in cust_totals.itertuples():
+        favorite_category = favorite_category_map.get(cust_id)
 
         # ---- Favorite premium products ----
-        fav_prem_pid: Optional[str] = None
-        fav_prem_name: Optional[str] = None
-
-        prem_rows = cust_df[cust_df["product_id"].map(
-            lambda p: product_flags.get(p, {}).get("is_premium", False)
-        )]
         # Prefer products in favorite_category first
-        prem_in_fav = prem_rows[prem_rows["category"] == favorite_category] if favorite_category else pd.DataFrame()
-        search_rows = prem_in_fav if not prem_in_fav.empty else prem_rows
-
-        if not search_rows.empty:
-            by_spend = search_rows.groupby("product_id")["amount"].sum().sort_values(ascending=False)
-            fav_prem_pid = by_spend.index[0]
-            fav_prem_name = product_flags.get(fav_prem_pid, {}).get("product_name", fav_prem_pid)
+        search = prem_fav_rank.get(cust_id) or prem_rank.get(cust_id) or []
+        if search:
+            fav_prem_pid = search[0][0]
         else:
             # Fallback: global best premium in favorite category
-            fav_prem_pid = _fallback_premium_for_category(favorite_category, all_tx_df, product_flags)
-            if fav_prem_pid:
-                fav_prem_name = product_flags.get(fav_prem_pid, {}).get("product_name", fav_prem_pid)
-
-        # Fallback if no premium product in favorite category exists
-        if fav_prem_name is None:
-            # Try global premium fallback across the entire shop
-            global_prem_tx = all_tx_df[all_tx_df["product_id"].map(lambda p: product_flags.get(p, {}).get("is_premium", False))]
-            if not global_prem_tx.empty:
-                fav_prem_pid = global_prem_tx.groupby("product_id")["amount"].sum().idxmax()
-                fav_prem_name = product_flags.get(fav_prem_pid, {}).get("product_name", fav_prem_pid)
+            fav_prem_pid = _first(cat_prem_rank.get(favorite_category)) if favorite_category is not None else None
+            if fav_prem_pid is None:
+                # Try global premium fallback across the entire shop
+                fav_prem_pid = _first(global_prem_rank)
 
         # ---- Second favorite premium ----
-        second_prem_name: Optional[str] = None
-        if not search_rows.empty:
-            by_spend = search_rows.groupby("product_id")["amount"].sum().sort_values(ascending=False)
-            if len(by_spend) >= 2:
-                second_pid = by_spend.index[1]
-                second_prem_name = product_flags.get(second_pid, {}).get("product_name", second_pid)
+        exclude_prem = fav_prem_pid if fav_prem_pid else None
+        second_prem_pid = None
+        if search:
+            if len(search) >= 2:
+                second_prem_pid = search[1][0]
             elif fav_prem_pid:
                 # Try other categories for 2nd premium
-                other_prem = prem_rows[prem_rows["product_id"] != fav_prem_pid]
-                if not other_prem.empty:
-                    s_pid = other_prem.groupby("product_id")["amount"].sum().idxmax()
-                    second_prem_name = product_flags.get(s_pid, {}).get("product_name", s_pid)
-
-        if second_prem_name is None:
+                second_prem_pid = _first(prem_rank.get(cust_id), exclude=fav_prem_pid)
+        if second_prem_pid is None:
             # Fallback to the second global best-selling premium product in their favorite category
             if favorite_category:
-                cat_tx = all_tx_df[all_tx_df["category"] == favorite_category]
-                prem_cat_tx = cat_tx[cat_tx["product_id"].map(lambda p: product_flags.get(p, {}).get("is_premium", False))]
-                if fav_prem_pid:
-                    prem_cat_tx = prem_cat_tx[prem_cat_tx["product_id"] != fav_prem_pid]
-                if not prem_cat_tx.empty:
-                    top_pid = prem_cat_tx.groupby("product_id")["amount"].sum().idxmax()
-                    second_prem_name = product_flags.get(top_pid, {}).get("product_name", top_pid)
-            
+                second_prem_pid = _first(cat_prem_rank.get(favorite_category), exclude=exclude_prem)
             # If STILL None, fallback to the second global best-selling premium product across the store
-            if second_prem_name is None:
-                global_prem_tx = all_tx_df[all_tx_df["product_id"].map(lambda p: product_flags.get(p, {}).get("is_premium", False))]
-                if fav_prem_pid:
-                    global_prem_tx = global_prem_tx[global_prem_tx["product_id"] != fav_prem_pid]
-                if not global_prem_tx.empty:
-                    top_pid = global_prem_tx.groupby("product_id")["amount"].sum().idxmax()
-                    second_prem_name = product_flags.get(top_pid, {}).get("product_name", top_pid)
+            if second_prem_pid is None:
+                second_prem_pid = _first(global_prem_rank, exclude=exclude_prem)
 
         # ---- Favorite bulk product ----
-        bulk_name = _best_bulk(cust_df, product_flags)
-        # Capture bulk product ID for matching engine
-        bulk_pid = None
-        bulk_rows_for_pid = cust_df[cust_df["product_id"].map(
-            lambda p: product_flags.get(p, {}).get("is_bulk", False)
-        )]
-        if not bulk_rows_for_pid.empty:
-            bulk_pid = bulk_rows_for_pid.groupby("product_id")["quantity"].sum().idxmax()
+        bulk_pid = _first(bulk_rank.get(cust_id))
+        bulk_name = name_of(bulk_pid)
         if bulk_name is None:
-            bulk_name = _fallback_bulk_global(all_tx_df, product_flags)
+            bulk_name = name_of(_first(global_bulk_rank))
 
         # ---- Top N product IDs for offer matching engine ----
         cust_segment = segment_map.get(str(cust_id), "boring") if segment_map else "boring"
         n_products = TOP_N_BY_SEGMENT.get(cust_segment, DEFAULT_TOP_N)
-        all_product_counts = cust_df.groupby("product_id")["quantity"].sum().sort_values(ascending=False)
+        products_by_qty = qty_rank.get(cust_id, [])
         exclude_pids = {fav_prem_pid, bulk_pid} - {None}
-        top_n_product_ids = [pid for pid in all_product_counts.index if pid not in exclude_pids][:n_products]
-
-        # ---- Recently bought ----
-        recent_name = _recently_bought(cust_df, product_flags)
+        top_n_product_ids = [pid for pid, _qty in products_by_qty if pid not in exclude_pids][:n_products]
 
         # ---- Complementary product ----
-        # Anchor = favorite_premium_product's product_id (or favorite bulk product)
+        # Anchor = favorite premium product, else favorite bulk, else most purchased
         anchor_pid = fav_prem_pid
         if anchor_pid is None:
-            # Try to get anchor from bulk
-            bulk_rows = cust_df[cust_df["product_id"].map(
-                lambda p: product_flags.get(p, {}).get("is_bulk", False)
-            )]
-            if not bulk_rows.empty:
-                anchor_pid = bulk_rows.groupby("product_id")["quantity"].sum().idxmax()
-
-        # If STILL None, use their most purchased product as anchor!
-        if anchor_pid is None and not cust_df.empty:
-            anchor_pid = cust_df.groupby("product_id")["quantity"].sum().idxmax()
-
-        complementary_name = _complementary_product(cust_df, anchor_pid, all_tx_df, product_flags)
+            anchor_pid = bulk_pid
+        if anchor_pid is None and products_by_qty:
+            anchor_pid = products_by_qty[0][0]
+
+        complementary_name = name_of(co_purchase.complementary(anchor_pid))
         if complementary_name is None:
+            exclude_anchor = anchor_pid if anchor_pid else None
             # Fallback to the overall best-selling product in their favorite category (excluding anchor)
             if favorite_category:
-                cat_tx = all_tx_df[all_tx_df["category"] == favorite_category]
-                if anchor_pid:
-                    cat_tx = cat_tx[cat_tx["product_id"] != anchor_pid]
-                if not cat_tx.empty:
-                    top_pid = cat_tx.groupby("product_id")["quantity"].sum().idxmax()
-                    complementary_name = product_flags.get(top_pid, {}).get("product_name", top_pid)
-            
+                complementary_name = name_of(_first(cat_qty_rank.get(favorite_category), exclude=exclude_anchor))
             # If STILL None, fallback to global top product in the shop (excluding anchor)
-            if complementary_name is None and not all_tx_df.empty:
-                global_tx = all_tx_df
-                if anchor_pid:
-                    global_tx = global_tx[global_tx["product_id"] != anchor_pid]
-                if not global_tx.empty:
-                    top_pid = global_tx.groupby("product_id")["quantity"].sum().idxmax()
-                    complementary_name = product_flags.get(top_pid, {}).get("product_name", top_pid)
+            if complementary_name is None:
+                complementary_name = name_of(_first(global_qty_rank, exclude=exclude_anchor))
 
         # ---- Fav items (top 5 by total quantity, backward compat) ----
-        fav_items_series = cust_df.groupby("product_id")["quantity"].sum().sort_values(ascending=False).head(5)
         fav_items = [
-            {
-                "product_id": pid,
-                "product_name": product_flags.get(pid, {}).get("product_name", pid),
-                "total_qty": int(qty),
-            }
-            for pid, qty in fav_items_series.items()
+            {"product_id": pid, "product_name": name_of(pid), "total_qty": int(qty)}
+            for pid, qty in products_by_qty[:5]
         ]
 
         # ---- Recent purchases (last 10 unique products, backward compat) ----
-        sorted_cust = cust_df.sort_values("purchase_date", ascending=False)
-        recent_pids = sorted_cust["product_id"].unique()[:10].tolist()
-        recent_purchases = [
-            {
-                "product_id": pid,
-                "product_name": product_flags.get(pid, {}).get("product_name", pid),
-            }
-            for pid in recent_pids
-        ]
-
-        # ---- Aggregate stats ----
-        total_spent = float(cust_df["amount"].sum())
-        total_transactions = len(cust_df)
-        last_purchase = sorted_cust["purchase_date"].iloc[0] if len(sorted_cust) > 0 else None
+        recent_pids = recent_map.get(cust_id, [])
+        recent_purchases = [{"product_id": pid, "product_name": name_of(pid)} for pid in recent_pids]
 
         doc = {
             "shop_id": shop_id,
             "customer_id": str(cust_id),
             # ===== 8 TEMPLATE VARIABLES =====
             "favorite_category": favorite_category,
-            "favorite_premium_product": fav_prem_name,
+            "favorite_premium_product": name_of(fav_prem_pid),
             "favorite_bulk_product": bulk_name,
-            "second_favorite_premium_product": second_prem_name,
-            "recently_bought_product": recent_name,
+            "second_favorite_premium_product": name_of(second_prem_pid),
+            "recently_bought_product": name_of(recent_pids[0]) if recent_pids else None,
             "complementary_product": complementary_name,
             # ===== MATCHING ENGINE FIELDS =====
             "favorite_premium_product_id": fav_prem_pid,
             "favorite_bulk_product_id": bulk_pid,
             "top_n_product_ids": top_n_product_ids,
             # ================================
-            "category_affinity_scores": affinity_scores,
+            "category_affinity_scores": affinity_scores_map.get(cust_id, {}),
             # Backward-compat fields
             "fav_items": fav_items,
             "recent_purchases": recent_purchases,
-            "top_categories": top_categories,
-            "total_spent": total_spent,
-            "total_transactions": total_transactions,
+            "top_categories": top_categories_map.get(cust_id, []),
+            "total_spent": float(total_spent),
+            "total_transactions": int(total_transactions),
             "last_purchase_date": last_purchase,
-            "updated_at": datetime.now(timezone.utc).isoformat(),
+            "updated_at": updated_at,
         }
         docs.append(doc)
 
@@ -0,0 +1,172 @@
+"""
+Segmentation Rule Engine — Vectorized 5-Tier Waterfall
+=======================================================
+Assigns every customer a segment from its R / F / M scores and bulkiness
+in one pass over whole columns (numpy.select), instead of one Python call
+per customer through DataFrame.apply(axis=1).
+
+Rule table:
+    Rules are plain data, evaluated top-to-bottom; the first rule whose
+    conditions all hold wins, customers matching no rule get the default
+    segment.  Each rule is
+
+        {"segment": "<segment>",
+         "all": [condition, ...],      # every condition must hold
+         "any": [condition, ...]}      # optional: at least one must hold
+
+    and a condition is [field, op, operand]:
+        field    — a score column (r_score, f_score, m_score, b_score,
+                   rfm_score, bulkiness, recency_days, frequency, monetary)
+        op       — one of > >= < <= == !=
+        operand  — a number, another field, or a store statistic
+                   (store_avg_bulkiness)
+
+    DEFAULT_SEGMENT_RULES is the standard waterfall.  A shop can override
+    it by storing its own table in shops.segment_rules (validated by
+    validate_segment_rules), e.g. to raise the VIP floor to 13.
+
+Usage:
+    df["segment"] = assign_segments(df, rules, {"store_avg_bulkiness": avg})
+"""
+import operator
+from typing import Any, Dict, List, Mapping, Optional
+
+import numpy as np
+import pandas as pd
+
+from schemas import CustomerCategory
+
+OPERATORS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+SEGMENT_FIELDS = {
+    "r_score", "f_score", "m_score", "b_score", "rfm_score",
+    "bulkiness", "recency_days", "frequency", "monetary",
+}
+SEGMENT_STATS = {"store_avg_bulkiness"}
+
+DEFAULT_SEGMENT = CustomerCategory.BORING.value
+
+# Enhanced Self-Balancing 5-Tier Waterfall (rule 5, Boring, is the default)
+DEFAULT_SEGMENT_RULES: List[Dict[str, Any]] = [
+    {   # 1. VIP Champions — highest totals, with a frequency override for daily shoppers
+        "segment": CustomerCategory.VIP.value,
+        "all": [["rfm_score", ">=", 12]],
+        "any": [["m_score", ">=", 4], ["f_score", "==", 5]],
+    },
+    {   # 2. At-Risk Churn — coldest 20% recency, historically valuable
+        "segment": CustomerCategory.AT_RISK.value,
+        "all": [["r_score", "==", 1], ["rfm_score", ">", 4]],
+    },
+    {   # 3. Potential Bulk — moderate engagement, bigger baskets than the store average
+        "segment": CustomerCategory.POTENTIAL_BULK.value,
+        "all": [["rfm_score", ">=", 5], ["rfm_score", "<=", 11],
+                ["bulkiness", ">", "store_avg_bulkiness"]],
+    },
+    {   # 4. Loyal Frequent — regular foot traffic
+        "segment": CustomerCategory.LOYAL_FREQUENT.value,
+        "all": [["rfm_score", ">=", 5], ["f_score", ">=", 3], ["f_score", ">=", "m_score"]],
+    },
+]
+
+
+def validate_segment_rules(rules: Any) -> List[Dict[str, Any]]:
+    """
+    Check a rule table and return it normalised (conditions as lists).
+
+    Raises:
+        ValueError: on an unknown segment, field, operator or operand.
+    """
+    if not isinstance(rules, list) or not rules:
+        raise ValueError("segment_rules must be a non-empty list of rules")
+
+    segments = {c.value for c in CustomerCategory}
+    normalised = []
+    for i, rule in enumerate(rules, 1):
+        if not isinstance(rule, Mapping):
+            raise ValueError(f"Rule {i} must be an object")
+        if rule.get("segment") not in segments:
+            raise ValueError(f"Rule {i}: unknown segment {rule.get('segment')!r}")
+        if not rule.get("all") and not rule.get("any"):
+            raise ValueError(f"Rule {i}: needs at least one condition in 'all' or 'any'")
+
+        clean: Dict[str, Any] = {"segment": rule["segment"]}
+        for group in ("all", "any"):
+            conditions = rule.get(group) or []
+            if not isinstance(conditions, list):
+                raise ValueError(f"Rule {i}: '{group}' must be a list of conditions")
+            clean_group = []
+            for cond in conditions:
+                if not isinstance(cond, (list, tuple)) or len(cond) != 3:
+                    raise ValueError(f"Rule {i}: condition {cond!r} must be [field, op, operand]")
+                field, op, operand = cond
+                if field not in SEGMENT_FIELDS:
+                    raise ValueError(f"Rule {i}: unknown field {field!r}")
+                if op not in OPERATORS:
+                    raise ValueError(f"Rule {i}: unknown operator {op!r}")
+                if isinstance(operand, bool) or not isinstance(operand, (int, float, str)):
+                    raise ValueError(f"Rule {i}: operand {operand!r} must be a number or a field name")
+                if isinstance(operand, str) and operand not in SEGMENT_FIELDS | SEGMENT_STATS:
+                    raise ValueError(f"Rule {i}: unknown operand {operand!r}")
+                clean_group.append([field, op, operand])
+            if clean_group:
+                clean[group] = clean_group
+        normalised.append(clean)
+    return normalised
+
+
+def _operand(df: pd.DataFrame, operand: Any, stats: Mapping[str, float]) -> Any:
+    if not isinstance(operand, str):
+        return operand
+    if operand in stats:
+        return stats[operand]
+    return df[operand].to_numpy()
+
+
+def _condition_mask(df: pd.DataFrame, cond: List[Any], stats: Mapping[str, float]) -> np.ndarray:
+    field, op, operand = cond
+    try:
+        return OPERATORS[op](df[field].to_numpy(), _operand(df, operand, stats))
+    except KeyError as e:
+        raise ValueError(f"Segment rule references unavailable field {e}") from None
+
+
+def _rule_mask(df: pd.DataFrame, rule: Mapping[str, Any], stats: Mapping[str, float]) -> np.ndarray:
+    mask = np.ones(len(df), dtype=bool)
+    for cond in rule.get("all", ()):
+        mask &= _condition_mask(df, cond, stats)
+    if rule.get("any"):
+        any_mask = np.zeros(len(df), dtype=bool)
+        for cond in rule["any"]:
+            any_mask |= _condition_mask(df, cond, stats)
+        mask &= any_mask
+    return mask
+
+
+def assign_segments(
+    df: pd.DataFrame,
+    rules: Optional[List[Dict[str, Any]]] = None,
+    stats: Optional[Mapping[str, float]] = None,
+    default: str = DEFAULT_SEGMENT,
+) -> np.ndarray:
+    """
+    Segment per row of `df` (object array), first matching rule wins.
+
+    Args:
+        df:    Frame holding the fields the rules reference.
+        rules: Rule table (DEFAULT_SEGMENT_RULES when None).
+        stats: Store statistics referenced by operands, e.g. store_avg_bulkiness.
+    """
+    rules = DEFAULT_SEGMENT_RULES if rules is None else rules
+    stats = stats or {}
+    if df.empty:
+        return np.array([], dtype=object)
+    conditions = [_rule_mask(df, rule, stats) for rule in rules]
+    choices = [rule["segment"] for rule in rules]
+    return np.select(conditions, choices, default=default).astype(object)
@@ -0,0 +1,130 @@
+"""
+Template Renderer — Compiled {{placeholder}} Templates
+=======================================================
+Message templates are parsed once into a segment list and then rendered
+per customer with a single "".join, instead of one str.replace pass per
+key of the customer's data dict.
+
+    compiled = compile_template(template["content"], template_id=template["id"])
+    text = compiled.render(hydration_data, extra_values)
+
+Segments:
+    literals      — the text between placeholders (len = placeholders + 1)
+    placeholders  — the placeholder names, in order of appearance
+
+Rendering semantics match the old prepare_message():
+    - {{key}} is replaced by str(value) of the first source that has key
+    - a placeholder no source provides is left in the output verbatim
+    - substituted values are never re-scanned for placeholders
+
+Cache:
+    Compiled templates are cached by (template_id, sha1 of content), so an
+    edited template is recompiled automatically while an unchanged one is
+    parsed once per process.  The cache is bounded (TEMPLATE_CACHE_SIZE, LRU).
+
+Unresolved placeholders:
+    compile_template(..., known_keys=...) reports — once per compiled
+    template — placeholders that are not in `known_keys` (typos such as
+    {{customer_nmae}} would otherwise reach customers verbatim).  They are
+    exposed as CompiledTemplate.unresolved and logged as a warning.
+"""
+
+import hashlib
+import logging
+import re
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PLACEHOLDER_RE = re.compile(r"\{\{([^{}]+)\}\}")
+TEMPLATE_CACHE_SIZE = 512
+
+
+class CompiledTemplate:
+    """A template split into literal text and placeholder names."""
+
+    __slots__ = ("template_id", "content_hash", "literals", "placeholders", "unresolved")
+
+    def __init__(self, content: str, template_id: Optional[str] = None,
+                 content_hash: Optional[str] = None):
+        self.template_id = template_id
+        self.content_hash = content_hash or _content_hash(content)
+        self.literals: List[str] = []
+        self.placeholders: List[str] = []
+        self.unresolved: List[str] = []
+
+        pos = 0
+        for match in PLACEHOLDER_RE.finditer(content):
+            self.literals.append(content[pos:match.start()])
+            self.placeholders.append(match.group(1))
+            pos = match.end()
+        self.literals.append(content[pos:])
+
+    def check(self, known_keys: Iterable[str]) -> List[str]:
+        """Record (and return) the placeholders not covered by `known_keys`."""
+        known = set(known_keys)
+        self.unresolved = sorted({p for p in self.placeholders if p not in known})
+        if self.unresolved:
+            logger.warning(
+                f"[Templates] Template {self.template_id or self.content_hash[:8]} has "
+                f"unresolved placeholders: {', '.join(self.unresolved)}"
+            )
+        return self.unresolved
+
+    def render(self, *sources: Mapping[str, Any]) -> str:
+        """Fill the placeholders from `sources` (first source holding a key wins)."""
+        literals = self.literals
+        if not self.placeholders:
+            return literals[0]
+        parts = [literals[0]]
+        for i, key in enumerate(self.placeholders, 1):
+            for source in sources:
+                if key in source:
+                    parts.append(str(source[key]))
+                    break
+            else:
+                parts.append("{{" + key + "}}")
+            parts.append(literals[i])
+        return "".join(parts)
+
+
+# ── Cache ─────────────────────────────────────────────────────────────────────
+
+_cache: "OrderedDict[Tuple[Optional[str], str], CompiledTemplate]" = OrderedDict()
+
+
+def _content_hash(content: str) -> str:
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def compile_template(
+    content: str,
+    template_id: Optional[str] = None,
+    known_keys: Optional[Iterable[str]] = None,
+) -> CompiledTemplate:
+    """
+    Return the compiled form of `content`, from the cache when possible.
+
+    When `known_keys` is given and the template is compiled fresh, its
+    unresolved placeholders are checked and logged.
+    """
+    content_hash = _content_hash(content)
+    key = (template_id, content_hash)
+    compiled = _cache.get(key)
+    if compiled is not None:
+        _cache.move_to_end(key)
+        return compiled
+
+    compiled = CompiledTemplate(content, template_id=template_id, content_hash=content_hash)
+    if known_keys is not None:
+        compiled.check(known_keys)
+    _cache[key] = compiled
+    if len(_cache) > TEMPLATE_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return compiled
+
+
+def render_template(content: str, *sources: Mapping[str, Any]) -> str:
+    """One-off render of a raw template string (compiled form is cached)."""
+    return compile_template(content).render(*sources)
@@ -88,6 +88,8 @@ export const customersAPI = {
   },
   processWithMapping: (fileId, data) => api.post(`/customers/process-file/${fileId}`, data),
   list: (shopId = null) => api.get('/customers/list', { params: shopId ? { shop_id: shopId } : {} }),
+  // params: { shop_id, cursor, limit, segment, min_score, max_score } — pass next_cursor for the next page
+  page: (params = {}) => api.get('/customers/page', { params }),
   clear: (shopId = null) => api.delete('/customers/clear', { params: shopId ? { shop_id: shopId } : {} }),
   getByFile: (fileId) => api.get(`/customers/by-file/${fileId}`),
 };